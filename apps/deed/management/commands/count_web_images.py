@@ -11,6 +11,7 @@ from django.db.models import Count
 
 from apps.deed.models import DeedPage
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_inventory import get_inventory, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -22,17 +23,17 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+        add_inventory_argument(parser)
 
-    def find_matching_keys(self, workflow):
+    def find_matching_keys(self, workflow, inventory_age=None):
         print("Finding matching s3 keys...")
         # Then use the session to get the resource
         s3 = self.session.resource('s3')
 
         my_bucket = s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME)
 
-        matching_keys = [obj.key for obj in my_bucket.objects.filter(
-            Prefix=f'web/{workflow.slug}/'
-        )]
+        inventory = get_inventory(my_bucket, f'web/{workflow.slug}/', inventory_age)
+        matching_keys = inventory.keys()
 
         return matching_keys
 
@@ -43,5 +44,5 @@ class Command(BaseCommand):
         else:
             workflow = get_workflow_obj(workflow_name)
 
-            matching_keys = self.find_matching_keys(workflow)
+            matching_keys = self.find_matching_keys(workflow, kwargs['inventory_age'])
             print(len(matching_keys))
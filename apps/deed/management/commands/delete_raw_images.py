@@ -5,6 +5,8 @@ from django.core.management.base import BaseCommand
 from django.utils.text import slugify
 from django.conf import settings
 
+from apps.deed.utils.s3_inventory import get_inventory, add_inventory_argument
+
 
 class Command(BaseCommand):
 
@@ -18,6 +20,7 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+        add_inventory_argument(parser)
 
     def delete_in_batches(self, objects_to_delete, batch_size=1000):
         print(f'Deleting {len(objects_to_delete)} s3 files ...')
@@ -29,15 +32,15 @@ class Command(BaseCommand):
 
             # print(response)
 
-    def delete_raw(self, workflow_slug):
+    def delete_raw(self, workflow_slug, inventory_age=None):
 
         key_filter = re.compile(fr"raw/{workflow_slug}/.+\.(?:tif|TIF|tiff|jpg|JPG|JPEG)")
 
-        objects_to_delete = [{'Key': obj.key} for obj in self.bucket.objects.filter(
-                Prefix=f'raw/{workflow_slug}/'
-            ) if re.match(key_filter, obj.key)]
+        inventory = get_inventory(self.bucket, f'raw/{workflow_slug}/', inventory_age)
+        keys_to_delete = inventory.keys(key_filter=key_filter)
 
-        self.delete_in_batches(objects_to_delete)
+        self.delete_in_batches([{'Key': key} for key in keys_to_delete])
+        inventory.forget(keys_to_delete)
 
     # def delete_web(self, workflow_slug):
 
@@ -70,5 +73,5 @@ class Command(BaseCommand):
             self.s3 = self.session.resource('s3')
             self.bucket = self.s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME)
 
-            self.delete_raw(workflow_slug)
+            self.delete_raw(workflow_slug, kwargs['inventory_age'])
             # self.delete_web(workflow_slug)
@@ -3,7 +3,6 @@ import csv
 import json
 import boto3
 import datetime
-from multiprocessing.pool import ThreadPool
 
 from django.core.management.base import BaseCommand
 from django.db.models import Q
@@ -11,6 +10,7 @@ from django.conf import settings
 
 from apps.deed.models import DeedPage
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_fetch import s3_fetcher
 
 
 class Command(BaseCommand):
@@ -67,14 +67,17 @@ class Command(BaseCommand):
 
         return dps
             
-    def get_stats(self, deedpage_obj):
+    def get_stats(self, deedpage_obj, read):
+
+        stats_body = read(deedpage_obj['page_stats']) if deedpage_obj['page_stats'] else None
+        if stats_body is None:
+            print(f"Missing stats for {deedpage_obj['s3_lookup']}, skipping.")
+            return None
 
-        stats_file = self.s3_client.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=deedpage_obj['page_stats'])
-            
         try:
-            stats_json = json.loads(stats_file['Body'].read().decode('utf-8'))
+            stats_json = json.loads(stats_body.decode('utf-8'))
         except json.decoder.JSONDecodeError:
-            print(stats_file['Body'].read().decode('utf-8'))
+            print(stats_body.decode('utf-8'))
             stats_json = None
 
         # {"workflow": "mn-anoka-county", "remainder": "9/30641896", "public_uuid": "3fd32f9072e24cd9876ceea6631b6472", "num_lines": 120, "num_chars": 3637, "handwriting_pct": 0.26}
@@ -84,11 +87,6 @@ class Command(BaseCommand):
             stats_json['page_image_web'] = deedpage_obj['page_image_web']
             stats_json['bool_match'] = deedpage_obj['bool_match']
 
-
-            with open(self.term_test_result_path, 'a') as done_manifest:
-                writer = csv.writer(done_manifest)
-                writer.writerow(stats_json.values())
-
         return stats_json
 
     def handle(self, *args, **kwargs):
@@ -113,6 +111,8 @@ class Command(BaseCommand):
         with open(self.term_test_result_path, 'w') as done_manifest:
             done_manifest.write("workflow,s3_lookup,num_lines,num_chars,handwriting_pct,doc_type,page_img_web,bool_match\n")
 
-        # Trigger fuzzy term search update for each test page
-        pool = ThreadPool(processes=24)
-        pool.map(self.get_stats, dps)
+            # Stats files are downloaded in parallel, but rows are only written here as they come back
+            writer = csv.writer(done_manifest)
+            for stats_json in s3_fetcher(self.session).map(self.get_stats, dps.iterator()):
+                if stats_json:
+                    writer.writerow(stats_json.values())
@@ -2,8 +2,6 @@ import os
 import datetime
 import urllib
 import boto3
-import botocore
-from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 from random import sample
@@ -16,6 +14,7 @@ from django.conf import settings
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 from apps.zoon.utils.zooniverse_load import get_image_url_prefix, get_full_url
 from apps.deed.models import DeedPage
+from apps.deed.utils.s3_fetch import s3_fetcher
 from apps.zoon.models import ZooniverseSubject
 
 
@@ -26,7 +25,6 @@ class Command(BaseCommand):
              aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
              aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
 
-    s3 = session.resource('s3')
 
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str, help='Name of Zooniverse workflow to process, e.g. "Ramsey County"', required=True)
@@ -105,21 +103,6 @@ class Command(BaseCommand):
 
         return image_df
     
-    def bool_key_exists(self, key):
-        '''Determine if s3 key exists'''
-        try:
-            self.s3.Object(settings.AWS_STORAGE_BUCKET_NAME, key).load()
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                # The object does not exist.
-                return False
-            else:
-                # Something else has gone wrong.
-                raise
-        else:
-            # The object does exist.
-            return True
-    
     def add_columns(self, images_df):
 
         images_df['deed_machine_url'] = settings.PUBLIC_URL_ROOT + 'admin/deed/deedpage/' + images_df['pk'].astype(str) + '/change/'
@@ -141,41 +124,27 @@ class Command(BaseCommand):
         return images_df
     
         # Define a function to be applied to each row
-    def check_row_for_hits(self, row_obj):
-        # Process the row here
+    def check_row_for_hits(self, row_obj, read):
+        # Process the row here. A single GET both checks whether each hit file exists and fetches it.
         row = row_obj[1].to_dict()
 
-        if self.bool_key_exists(row['hit_key_basic']):
-            # pass
-            row['hit_contents_basic'] = self.get_hit_file_content(row['hit_key_basic'])
-        else:
-            row['hit_key_basic'] = ''
-            row['hit_contents_basic'] = ''
-
-        if self.bool_key_exists(row['hit_key_fuzzy']):
-            pass
-            row['hit_contents_fuzzy'] = self.get_hit_file_content(row['hit_key_fuzzy'])
-        else:
-            row['hit_key_fuzzy'] = ''
-            row['hit_contents_fuzzy'] = ''
+        for hit_type in ['basic', 'fuzzy']:
+            hit_content = read(row[f'hit_key_{hit_type}'])
+            if hit_content is not None:
+                row[f'hit_contents_{hit_type}'] = hit_content.decode("utf-8")
+            else:
+                row[f'hit_key_{hit_type}'] = ''
+                row[f'hit_contents_{hit_type}'] = ''
 
         return row
     
-    def get_hit_file_content(self, key):
-        content_object = self.s3.meta.client.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=key)
-        file_content = content_object['Body'].read().decode("utf-8")
-        return file_content
-    
     def check_for_hits(self, df):
         print('Starting parallel checks for hit files...')
 
-        pool = ThreadPool(processes=12)
-        result = pool.map(self.check_row_for_hits, df.iterrows())
+        result = list(s3_fetcher(self.session).map(self.check_row_for_hits, df.iterrows(), ordered=True))
 
         result_df = pd.DataFrame(result, columns=result[0].keys())
 
-        pool.close()
-
         return result_df
     
     def reorder_columns(self, df):
@@ -2,8 +2,6 @@ import os
 import datetime
 import urllib
 import boto3
-import botocore
-from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 from random import sample
@@ -15,6 +13,7 @@ from django.conf import settings
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 from apps.zoon.utils.zooniverse_load import get_image_url_prefix, get_full_url
 from apps.deed.models import DeedPage
+from apps.deed.utils.s3_fetch import s3_fetcher
 
 
 class Command(BaseCommand):
@@ -24,7 +23,6 @@ class Command(BaseCommand):
              aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
              aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
 
-    s3 = session.resource('s3')
 
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str, help='Name of Zooniverse workflow to process, e.g. "Ramsey County"', required=True)
@@ -78,21 +76,6 @@ class Command(BaseCommand):
 
         return images_df
     
-    def bool_key_exists(self, key):
-        '''Determine if s3 key exists'''
-        try:
-            self.s3.Object(settings.AWS_STORAGE_BUCKET_NAME, key).load()
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                # The object does not exist.
-                return False
-            else:
-                # Something else has gone wrong.
-                raise
-        else:
-            # The object does exist.
-            return True
-    
     def add_columns(self, images_df):
 
         images_df['deed_machine_url'] = settings.PUBLIC_URL_ROOT + 'admin/deed/deedpage/' + images_df['pk'].astype(str) + '/change/'
@@ -114,32 +97,23 @@ class Command(BaseCommand):
         return images_df
     
         # Define a function to be applied to each row
-    def check_row_for_hits(self, row_obj):
-        # Process the row here
+    def check_row_for_hits(self, row_obj, read):
+        # Process the row here. Hit files are small, so a GET through the fetcher is as cheap as a HEAD.
         row = row_obj[1].to_dict()
 
-        if self.bool_key_exists(row['hit_key_basic']):
-            pass
-        else:
-            row['hit_key_basic'] = ''
-
-        if self.bool_key_exists(row['hit_key_fuzzy']):
-            pass
-        else:
-            row['hit_key_fuzzy'] = ''
+        for hit_key in ['hit_key_basic', 'hit_key_fuzzy']:
+            if read(row[hit_key]) is None:
+                row[hit_key] = ''
 
         return row
     
     def check_for_hits(self, df):
         print('Starting parallel checks for hit files...')
 
-        pool = ThreadPool(processes=12)
-        result = pool.map(self.check_row_for_hits, df.iterrows())
+        result = list(s3_fetcher(self.session).map(self.check_row_for_hits, df.iterrows(), ordered=True))
 
         result_df = pd.DataFrame(result, columns=result[0].keys())
 
-        pool.close()
-
         return result_df
     
     def reorder_columns(self, df):
@@ -5,7 +5,6 @@ import datetime
 import random
 import numpy as np
 import pandas as pd
-from pathlib import PurePath
 # from itertools import batched
 
 from django.core.management.base import BaseCommand
@@ -14,7 +13,9 @@ from django.db.models import Count
 
 from apps.deed.models import DeedPage
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
-from apps.deed.utils.deed_pagination import paginate_deedpage_df
+from apps.deed.utils.deed_pagination import paginate_deedpage_df, link_deedpage_neighbors
+from apps.deed.utils.deed_keys import parse_deed_keys
+from apps.deed.utils.s3_inventory import get_inventory, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -26,6 +27,7 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+        add_inventory_argument(parser)
         
     def chunk_list(self, input_list, chunk_size):
             return [input_list[i:i + chunk_size] for i in range(0, len(input_list), chunk_size)]
@@ -41,7 +43,7 @@ class Command(BaseCommand):
             delete_count += chunk_size
             print(f"Deleted {delete_count} records...")
 
-    def find_matching_keys(self, workflow):
+    def find_matching_keys(self, workflow, inventory_age=None):
         print("Finding matching s3 keys...")
         # Then use the session to get the resource
         s3 = self.session.resource('s3')
@@ -52,16 +54,14 @@ class Command(BaseCommand):
         if workflow.workflow_name == 'Ramsey County':
             key_filter = re.compile(fr"web/{workflow.slug}/.+\.jpg")
 
-            matching_keys = [obj.key for obj in my_bucket.objects.filter(
-                Prefix=f'web/{workflow.slug}/'
-            ) if re.match(key_filter, obj.key)]
+            inventory = get_inventory(my_bucket, f'web/{workflow.slug}/', inventory_age)
+            matching_keys = inventory.keys(key_filter=key_filter)
 
         else:
             key_filter = re.compile(fr"ocr/stats/{workflow.slug}/.+\.json")
 
-            matching_keys = [obj.key for obj in my_bucket.objects.filter(
-                Prefix=f'ocr/stats/{workflow.slug}/'
-            ) if re.match(key_filter, obj.key)]
+            inventory = get_inventory(my_bucket, f'ocr/stats/{workflow.slug}/', inventory_age)
+            matching_keys = inventory.keys(key_filter=key_filter)
 
         return matching_keys
     
@@ -161,76 +161,11 @@ class Command(BaseCommand):
         '''
         print("Extracting filename data from matching keys...")
 
-        deed_pages = []
+        deed_image_regex = settings.ZOONIVERSE_QUESTION_LOOKUP[
+            workflow.workflow_name]['deed_image_regex']
 
-        # TODO: It would probably be more efficient to rewrite this loop in pandas
-        # print(random.sample(matching_keys, 100))
-        for mk in matching_keys:
-            try:
-                deed_image_regex = settings.ZOONIVERSE_QUESTION_LOOKUP[
-                    workflow.workflow_name]['deed_image_regex']
-                page_data = re.search(
-                    deed_image_regex, mk).groupdict()
-
-                # TODO: Eliminate this conditional once new Ramsey records are OCRed under new system
-                if workflow.workflow_name == 'Ramsey County':
-                    public_uuid = ''
-                else:
-                    public_uuid = re.search(r'__([a-z0-9]+)\.json', mk).group(1)
-                # print(page_data)
-            except:
-                print(f'Could not parse image path data: {mk}. You might need to adjust your deed_image_regex setting.')
-                page_data = None
-
-            if page_data:
-                # We aren't using the slug, so delete before model import
-                del page_data['workflow_slug']
-
-                # Set image path and s3 lookup
-                page_data['public_uuid'] = public_uuid
-                page_data['s3_lookup'] = mk.replace(f"ocr/stats/{workflow.slug}/", "").replace(f"__{public_uuid}.json", "")
-                # # In order to associate doc numbers with a file that has been split with splitpages, you need to join with an original file lookup, rather than the final s3_lookup created by the lambda process.
-                # page_data['orig_file_lookup'] = re.sub(r'_SPLITPAGE_\d+', '', page_data['s3_lookup'])
-                # # print(page_data['orig_file_lookup'])
-
-                page_data['page_stats'] = mk
-
-                # TODO: Eliminate this conditional once new Ramsey records are OCRed under new system
-                if workflow.workflow_name == 'Ramsey County':
-                    page_data['page_image_web'] = mk
-                    page_data['page_ocr_text'] = ''
-                    page_data['page_ocr_json'] = ''
-                else:
-                    page_data['page_image_web'] = str(PurePath(mk).with_name(public_uuid + '.jpg')).replace("ocr/stats/", "web/")
-                    page_data['page_ocr_text'] = mk.replace("ocr/stats/", "ocr/txt/").replace(f"__{public_uuid}.json", ".txt")
-                    page_data['page_ocr_json'] = mk.replace("ocr/stats/", "ocr/json/").replace(f"__{public_uuid}.json", ".json")
-
-                page_data['workflow_id'] = workflow.id
-
-                if 'doc_date_year' in page_data:
-                    page_data['doc_date'] = datetime.datetime(
-                        int(page_data['doc_date_year']),
-                        int(page_data['doc_date_month']),
-                        int(page_data['doc_date_day']),
-                    )
-                    del page_data['doc_date_year']
-                    del page_data['doc_date_month']
-                    del page_data['doc_date_day']
-
-                # Re-code bool_match as boolean if found. This likely is only a legacy feature since generally the OCR step will be done in the Lambda world and collected after this step.
-                if 'bool_match' in page_data:
-                    if page_data['bool_match']:
-                        page_data['bool_match'] = True
-                    else:
-                        page_data['bool_match'] = False
-                else:
-                    page_data['bool_match'] = False
-
-                deed_pages.append(page_data)
-
-        # dedupe
-        deed_pages_df = pd.DataFrame(deed_pages)
-        deed_pages_df = deed_pages_df.drop_duplicates(subset=['s3_lookup'])
+        # Parse keys a chunk at a time into a deduped DataFrame
+        deed_pages_df = parse_deed_keys(matching_keys, workflow, deed_image_regex)
 
         print(deed_pages_df)
 
@@ -293,7 +228,7 @@ class Command(BaseCommand):
 
             self.delete_existing_dps(workflow)
 
-            matching_keys = self.find_matching_keys(workflow)
+            matching_keys = self.find_matching_keys(workflow, kwargs['inventory_age'])
 
             deed_page_df = self.build_django_objects(matching_keys, workflow)
 
@@ -304,5 +239,8 @@ class Command(BaseCommand):
 
             image_obj_count = self.import_to_django_csv_copy(out_csv_path, workflow)
 
+            # Pages only have ids once imported, so prev/next links are set from the lookups afterwards
+            link_deedpage_neighbors(workflow)
+
             # image_objs = self.import_to_django(
             #     deed_page_df, workflow)
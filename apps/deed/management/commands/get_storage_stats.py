@@ -12,6 +12,7 @@ from django.db.models import Count
 
 from apps.deed.models import DeedPage
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_inventory import get_inventory, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -26,17 +27,17 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+        add_inventory_argument(parser)
 
-    def find_matching_keys(self, workflow, prefix):
+    def find_matching_keys(self, workflow, prefix, inventory_age=None):
         print(f'Finding matching {prefix} s3 keys...')
         # Then use the session to get the resource
         s3 = self.session.resource('s3')
 
         my_bucket = s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME)
 
-        matching_keys = [{'prefix': prefix, 'key': obj.key, 'size': obj.size} for obj in my_bucket.objects.filter(
-            Prefix=f'{prefix}/{workflow.slug}/'
-        )]
+        inventory = get_inventory(my_bucket, f'{prefix}/{workflow.slug}/', inventory_age)
+        matching_keys = [{'prefix': prefix, 'key': obj['key'], 'size': obj['size']} for obj in inventory.objects()]
 
         return matching_keys
 
@@ -69,7 +70,7 @@ class Command(BaseCommand):
             dfs = []
             for prefix in ['raw', 'web', 'ocr/json', 'ocr/stats', 'ocr/txt', 'ocr/hits']:
 
-                matching_keys = self.find_matching_keys(workflow, prefix)
+                matching_keys = self.find_matching_keys(workflow, prefix, kwargs['inventory_age'])
 
                 temp_df = pd.DataFrame.from_records(matching_keys)
                 dfs.append(temp_df)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from apps.deed.utils.deed_pagination import link_deedpage_neighbors
+from apps.zoon.utils.zooniverse_config import get_workflow_obj
+
+
+class Command(BaseCommand):
+    '''Set the prev/next/next-next DeedPage links from the page image lookups already saved by pagination, e.g. for pages ingested before the links existed'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workflow', type=str,
+                            help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+
+    def handle(self, *args, **kwargs):
+        workflow_name = kwargs['workflow']
+        if not workflow_name:
+            print('Missing workflow name. Please specify with --workflow.')
+        else:
+            workflow = get_workflow_obj(workflow_name)
+            link_deedpage_neighbors(workflow)
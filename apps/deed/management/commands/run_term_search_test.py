@@ -9,6 +9,7 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from apps.deed.models import DeedPage
+from apps.deed.utils.term_search import load_term_config, run_local_search
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 
@@ -35,6 +36,18 @@ class Command(BaseCommand):
         parser.add_argument('-ho', '--hits_only', action='store_true',
                             help='Only test DeedPages that have been flagged as conventional hits.')
 
+        parser.add_argument('-e', '--engine', type=str, choices=['local', 'lambda'], default='local',
+                    help='Search OCR text with the local fuzzy matcher (default) or the term search Lambda.')
+
+        parser.add_argument('--terms', type=str,
+                    help='Path to a JSON list or plain text file of search terms for the local engine. Defaults to the workflow\'s "term_search_terms" config or settings.TERM_SEARCH_TERMS.')
+
+        parser.add_argument('--ocr-dir', type=str,
+                    help='Read OCR json (and write hits) under this local directory instead of s3, for the local engine.')
+
+        parser.add_argument('--workers', type=int,
+                    help='Number of processes for the local engine. Default = number of CPUs')
+
     def get_test_deedpages(self, workflow=None, n=100, bool_hits_only=False):
         """Get a random sample of n (default 100) existing OCR JSON objects generated by Textract in the preliminary stages of the Deed Machine. Manually excluding legacy Ramsey County workflow, which does not include OCR text and thus can't be tested."""
 
@@ -178,6 +191,13 @@ class Command(BaseCommand):
             workflow = None
             workflow_slug = 'all_workflows'
             
+        terms = []
+        if kwargs['engine'] == 'local':
+            terms = load_term_config(workflow, kwargs['terms'])
+            if len(terms) == 0:
+                print('No search terms configured. Set TERM_SEARCH_TERMS, pass --terms, or use --engine lambda.')
+                return False
+
         num_results = kwargs['num_results']
         if not num_results:
             num_results = 100
@@ -198,6 +218,10 @@ class Command(BaseCommand):
         # Get random set of DeedPage objects to test against
         random_deedpages = self.get_test_deedpages(workflow, num_results, bool_hits_only)
 
-        # Trigger fuzzy term search update for each test page
-        pool = ThreadPool(processes=12)
-        pool.map(self.trigger_lambda, random_deedpages)
+        if kwargs['engine'] == 'local':
+            run_local_search(list(random_deedpages), terms, self.term_test_result_path, kwargs['ocr_dir'], kwargs['workers'], write_hits=False)
+        else:
+            # Trigger fuzzy term search update for each test page
+            pool = ThreadPool(processes=12)
+            pool.map(self.trigger_lambda, random_deedpages)
+
@@ -13,6 +13,7 @@ from django.conf import settings
 
 from apps.deed.models import DeedPage
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_inventory import get_inventory, delete_prefix, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -25,6 +26,8 @@ class Command(BaseCommand):
 
     bucket = s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME)
 
+    inventory_age = None  # Set in handle
+
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
@@ -32,6 +35,8 @@ class Command(BaseCommand):
         parser.add_argument('-f', '--full', action='store_true',
                             help='Delete old processed records and start over (as opposed to completing a half-done process.)')
 
+        add_inventory_argument(parser)
+
     def countdown(self, seconds=5):
         while seconds > 0:
             print(f"{seconds}...")
@@ -47,34 +52,14 @@ class Command(BaseCommand):
 
         self.countdown()
 
-        # my_bucket = s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME)
-
-        keys_to_delete = [{'Key': obj.key} for obj in self.bucket.objects.filter(
-            Prefix=f'ocr/stats/{workflow.slug}/'
-        )]
-
-        print(f'Deleting {len(keys_to_delete)} keys ...')
-        for chunk in self.chunk_list(keys_to_delete, 1000):
-            boto3.client('s3').delete_objects(
-                Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-                Delete={'Objects': chunk}
-            )
+        delete_prefix(self.bucket, f'ocr/stats/{workflow.slug}/')
 
     def delete_matching_hits(self, workflow):
         print(f"WARNING: ABOUT TO DELETE ALL EXISTING HITS JSONS IN WORKFLOW {workflow.slug}...")
 
         self.countdown()
 
-        keys_to_delete = [{'Key': obj.key} for obj in self.bucket.objects.filter(
-            Prefix=f'ocr/hits/{workflow.slug}/'
-        )]
-
-        print(f'Deleting {len(keys_to_delete)} keys ...')
-        for chunk in self.chunk_list(keys_to_delete, 1000):
-            boto3.client('s3').delete_objects(
-                Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-                Delete={'Objects': chunk}
-            )
+        delete_prefix(self.bucket, f'ocr/hits/{workflow.slug}/')
 
     def build_event(self, key):
 
@@ -115,9 +100,7 @@ class Command(BaseCommand):
 
         key_filter = re.compile(f"ocr/stats/{workflow_slug}/.+\.json")
 
-        existing_keys = [obj.key for obj in self.bucket.objects.filter(
-            Prefix=f'ocr/stats/{workflow_slug}/'
-        ) if re.match(key_filter, obj.key)]
+        existing_keys = get_inventory(self.bucket, f'ocr/stats/{workflow_slug}/', self.inventory_age).keys(key_filter=key_filter)
 
         stat_keys_to_check = [re.sub(r'__[a-z0-9]+\.json', r'.tif', key.replace('ocr/stats/', 'raw/')) for key in existing_keys]
 
@@ -145,9 +128,7 @@ class Command(BaseCommand):
 
         print(f'Gathering list of raw images in {workflow.slug} workflow ...')
 
-        matching_keys = [obj.key for obj in self.bucket.objects.filter(
-            Prefix=f'raw/{workflow.slug}/'
-        ) if re.match(key_filter, obj.key)]
+        matching_keys = get_inventory(self.bucket, f'raw/{workflow.slug}/', self.inventory_age).keys(key_filter=key_filter)
 
         # Filter out ones that already have been re-processed
         matching_keys = self.check_already_processed(workflow.slug, matching_keys)
@@ -173,6 +154,7 @@ class Command(BaseCommand):
             print('Missing workflow name. Please specify with --workflow.')
         else:
             workflow = get_workflow_obj(workflow_name)
+            self.inventory_age = kwargs['inventory_age']
 
             if kwargs['full']:
                 # TODO: add confirmation requirement
@@ -11,6 +11,7 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_inventory import get_inventory, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -47,6 +48,8 @@ class Command(BaseCommand):
         
         parser.add_argument('-f', '--full', action='store_true',
             help='Ignore previously processed files. Otherwise, will skip images with matching OCR jsons already existing on S3')
+
+        add_inventory_argument(parser)
         
     def remove_extra_key_phrases(self, key, workflow_slug):
         out_key = key.replace(
@@ -59,16 +62,14 @@ class Command(BaseCommand):
 
         return re.sub(r'__SPLITPAGE_\d+', '', out_key)
         
-    def check_already_uploaded(self, workflow, upload_df):
+    def check_already_uploaded(self, workflow, upload_df, inventory_age=None):
         print("Checking s3 to see what images have already been uploaded...")
-        s3 = self.session.resource('s3')
 
         # Check for successful OCR json
         key_filter = re.compile(fr"ocr/json/{workflow.slug}/.+\.json")
 
-        matching_keys = [self.remove_extra_key_phrases(obj.key, workflow.slug) for obj in self.bucket.objects.filter(
-            Prefix=f'ocr/json/{workflow.slug}/'
-        ) if re.match(key_filter, obj.key)]
+        inventory = get_inventory(self.bucket, f'ocr/json/{workflow.slug}/', inventory_age)
+        matching_keys = [self.remove_extra_key_phrases(key, workflow.slug) for key in inventory.keys(key_filter=key_filter)]
 
         print(f"Found {len(matching_keys)} existing OCR JSON keys on S3 that seem to have been successfully processed.")
 
@@ -179,7 +180,7 @@ class Command(BaseCommand):
 
             # Filter out already-processed keys
             if not bool_full:
-                filtered_upload_df = self.check_already_uploaded(self.workflow, upload_df)
+                filtered_upload_df = self.check_already_uploaded(self.workflow, upload_df, kwargs['inventory_age'])
             else:
                 filtered_upload_df = upload_df
                 print(f"Uploading all rows because --full selected.")
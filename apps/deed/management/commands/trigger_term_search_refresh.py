@@ -14,6 +14,7 @@ from django.conf import settings
 
 from apps.deed.models import DeedPage
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_inventory import get_inventory, delete_prefix, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -32,6 +33,8 @@ class Command(BaseCommand):
 
     num_threads = None
 
+    inventory_age = None  # Set in handle
+
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
@@ -42,6 +45,8 @@ class Command(BaseCommand):
         parser.add_argument('-p', '--pool', type=int,
                             help='How many threads to use? (Default is 8)')
 
+        add_inventory_argument(parser)
+
     def chunk_list(self, input_list, chunk_size):
         for i in range(0, len(input_list), chunk_size):
             yield input_list[i:i + chunk_size]
@@ -52,16 +57,7 @@ class Command(BaseCommand):
         # input validation
         if delete_confirmation.lower() in ('y', 'yes'):
 
-            keys_to_delete = [{'Key': obj.key} for obj in self.bucket.objects.filter(
-                Prefix=f'ocr/hits/{workflow.slug}/'
-            )]
-
-            print(f'Deleting {len(keys_to_delete)} hit objects ...')
-            for chunk in self.chunk_list(keys_to_delete, 1000):
-                boto3.client('s3').delete_objects(
-                    Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-                    Delete={'Objects': chunk}
-                )
+            delete_prefix(self.bucket, f'ocr/hits/{workflow.slug}/')
             return True
 
         elif delete_confirmation.lower() in ('n', 'no'):
@@ -144,9 +140,7 @@ class Command(BaseCommand):
 
             print(f'Gathering list of OCRed images in {workflow.slug} workflow ...')
 
-            matching_keys = [obj.key for obj in self.bucket.objects.filter(
-                Prefix=f'ocr/json/{workflow.slug}/'
-            ) if re.match(key_filter, obj.key)]
+            matching_keys = get_inventory(self.bucket, f'ocr/json/{workflow.slug}/', self.inventory_age).keys(key_filter=key_filter)
 
             today = datetime.date.today().strftime('%Y%m%d')
             export_dir = os.path.join(settings.BASE_DIR, 'data', 'main_exports')
@@ -172,6 +166,7 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         workflow_name = kwargs['workflow']
         self.num_threads = kwargs['pool'] if kwargs['pool'] else 16
+        self.inventory_age = kwargs['inventory_age']
 
         if not workflow_name:
             print('Missing workflow name. Please specify with --workflow.')
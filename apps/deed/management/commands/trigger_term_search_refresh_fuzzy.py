@@ -11,7 +11,9 @@ from django.db.models import Q
 from django.conf import settings
 
 from apps.deed.models import DeedPage
+from apps.deed.utils.term_search import load_term_config, run_local_search
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.deed.utils.s3_inventory import delete_prefix, add_inventory_argument
 
 
 class Command(BaseCommand):
@@ -42,6 +44,8 @@ class Command(BaseCommand):
 
     term_test_result_path = None
 
+    inventory_age = None  # Set in handle
+
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
@@ -58,6 +62,20 @@ class Command(BaseCommand):
         parser.add_argument('-p', '--pool', type=int, default=12,
                     help='Number of threads. Default = 12')
 
+        parser.add_argument('-e', '--engine', type=str, choices=['local', 'lambda'], default='local',
+                    help='Search OCR text with the local fuzzy matcher (default) or the term search Lambda.')
+
+        parser.add_argument('--terms', type=str,
+                    help='Path to a JSON list or plain text file of search terms for the local engine. Defaults to the workflow\'s "term_search_terms" config or settings.TERM_SEARCH_TERMS.')
+
+        parser.add_argument('--ocr-dir', type=str,
+                    help='Read OCR json (and write hits) under this local directory instead of s3, for the local engine.')
+
+        parser.add_argument('--workers', type=int,
+                    help='Number of processes for the local engine. Default = number of CPUs')
+
+        add_inventory_argument(parser)
+
     def get_existing_deedpages(self, workflow, bool_full=False, target_term=None, skip_pages=None):
         """Get DeedPage results to clear and overwrite. By default, only hits, but can be set to get all in workflow"""
 
@@ -138,9 +156,8 @@ class Command(BaseCommand):
                 print(keys_to_delete)
             else:
                 # Don't use existing DeedPage objects as reference
-                keys_to_delete = [{'Key': obj.key} for obj in self.bucket.objects.filter(
-                    Prefix=f'ocr/hits_fuzzy/{workflow.slug}/'
-                )]
+                delete_prefix(self.bucket, f'ocr/hits_fuzzy/{workflow.slug}/')
+                return True
 
             delete_count = 0
             chunk_size = 1000
@@ -284,7 +301,16 @@ class Command(BaseCommand):
             workflow = None
             return False
         
+        # Check the terms before anything is deleted, since with no terms the local engine would only clear out the old hits
+        terms = []
+        if kwargs['engine'] == 'local':
+            terms = load_term_config(workflow, kwargs['terms'])
+            if len(terms) == 0:
+                print('No search terms configured. Set TERM_SEARCH_TERMS, pass --terms, or use --engine lambda.')
+                return False
+
         bool_full = kwargs['full']
+        self.inventory_age = kwargs['inventory_age']
 
         # TODO: need to figure out how to filter delete results
         target_term = kwargs['term']
@@ -295,7 +321,7 @@ class Command(BaseCommand):
 
         dps = self.get_existing_deedpages(workflow, bool_full, target_term, skip_pages)
 
-        if not skip_pages:
+        if not skip_pages and not kwargs['ocr_dir']:
             self.delete_previous_hits(workflow, bool_full, target_term, dps)
 
         now = datetime.datetime.now().strftime('%Y%m%d_%H%M')
@@ -310,6 +336,10 @@ class Command(BaseCommand):
                 skip_writer = csv.DictWriter(done_manifest, fieldnames=skip_pages[0].keys())
                 skip_writer.writerows(skip_pages)
 
-        # Trigger fuzzy term search update for each test page
-        pool = ThreadPool(processes=kwargs['pool'])
-        pool.map(self.trigger_lambda, dps)
+        if kwargs['engine'] == 'local':
+            run_local_search(list(dps), terms, self.term_test_result_path, kwargs['ocr_dir'], kwargs['workers'], write_hits=True)
+        else:
+            # Trigger fuzzy term search update for each test page
+            pool = ThreadPool(processes=kwargs['pool'])
+            pool.map(self.trigger_lambda, dps)
+
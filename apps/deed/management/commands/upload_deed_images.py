@@ -10,6 +10,8 @@ from django.core.management.base import BaseCommand
 from django.utils.text import slugify
 from django.conf import settings
 
+from apps.deed.utils.s3_inventory import get_inventory, add_inventory_argument
+
 
 class Command(BaseCommand):
 
@@ -20,6 +22,7 @@ class Command(BaseCommand):
              aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
     s3 = None
     bucket = None
+    inventory = None
 
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
@@ -31,6 +34,8 @@ class Command(BaseCommand):
         parser.add_argument('-p', '--pool', type=int,
                             help='How many threads to use? (Default is 8)')
 
+        add_inventory_argument(parser)
+
     def gather_raw_image_paths(self, workflow_slug, deed_image_glob_root, deed_image_glob_remainder):
         print("Gathering all raw images paths for this workflow ...")
         print(os.path.join(deed_image_glob_root, deed_image_glob_remainder))
@@ -45,20 +50,17 @@ class Command(BaseCommand):
         )
         return img_df
 
-    def check_already_uploaded(self, workflow_slug, upload_keys):
+    def check_already_uploaded(self, workflow_slug, upload_keys, inventory_age=None):
         print("Checking s3 to see what images have already been uploaded...")
-        s3 = self.session.resource('s3')
 
         key_filter = re.compile(f"raw/{workflow_slug}/.+\.tif")
 
-        matching_keys = [obj.key for obj in self.bucket.objects.filter(
-            Prefix=f'raw/{workflow_slug}/'
-        ) if re.match(key_filter, obj.key)]
+        self.inventory = get_inventory(self.bucket, f'raw/{workflow_slug}/', inventory_age)
 
         web_keys_to_check = [key['s3_path'] for key in upload_keys]
 
         # subtract already uploaded matching_keys from web_keys_to_check
-        already_uploaded = set(web_keys_to_check).intersection(matching_keys)
+        already_uploaded = set([k for k in self.inventory.existing(web_keys_to_check) if re.match(key_filter, k)])
         remaining_to_upload = [
             u for u in upload_keys if u['s3_path'] not in already_uploaded]
         print(
@@ -116,7 +118,12 @@ class Command(BaseCommand):
             self.bucket = self.s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME)
 
             filtered_upload_keys = self.check_already_uploaded(
-                workflow_slug, upload_keys)
+                workflow_slug, upload_keys, kwargs['inventory_age'])
 
             pool = ThreadPool(processes=num_threads)
             pool.map(self.upload_image, filtered_upload_keys)
+
+            # Keep the local listing current so the next check doesn't have to relist
+            self.inventory.record([
+                (k['s3_path'], os.path.getsize(k['local_path']), None, None) for k in filtered_upload_keys
+            ])
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.6 on 2026-10-18 17:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deed', '0057_deedpage_zpage_index_deedpage_zpage_1_index_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deedpage',
+            name='prev_deedpage',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='deed.deedpage'),
+        ),
+        migrations.AddField(
+            model_name='deedpage',
+            name='next_deedpage',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='deed.deedpage'),
+        ),
+        migrations.AddField(
+            model_name='deedpage',
+            name='next_next_deedpage',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='deed.deedpage'),
+        ),
+    ]
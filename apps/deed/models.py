@@ -1,9 +1,7 @@
-import re
 import os
 from django.db import models
 from django.utils.html import mark_safe
 from postgres_copy import CopyManager
-from django.apps import apps
 
 from racial_covenants_processor.storage_backends import PrivateMediaStorage, PublicMediaStorage, PublicDeedStorage
 from apps.zoon.models import ZooniverseWorkflow, ZooniverseSubject
@@ -96,6 +94,16 @@ class DeedPage(models.Model):
         blank=True, max_length=203, null=True)
     """Same idea as next_next_page_image_web, except this is the s3_lookup of the previous page rather than a link to the image."""
 
+    prev_deedpage = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, related_name='+', null=True)
+    """DeedPage of prev_page_image_lookup, linked once pagination has run so the previous page doesn't have to be searched for every time it's shown."""
+    next_deedpage = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, related_name='+', null=True)
+    """DeedPage of next_page_image_lookup, linked once pagination has run."""
+    next_next_deedpage = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, related_name='+', null=True)
+    """DeedPage of next_next_page_image_lookup, linked once pagination has run."""
+
     zooniverse_subject = models.ForeignKey(
         ZooniverseSubject, on_delete=models.DO_NOTHING, related_name='subject_legacy', null=True)
     """After post-Zooniverse ingestion of subjects, used to join to the matching subject for this if it's a hit"""
@@ -142,65 +150,26 @@ class DeedPage(models.Model):
         split_page_num = f"Splitpage {self.split_page_num}" if self.split_page_num else ''
         return mark_safe(f'<a href="/admin/deed/deedpage/{self.pk}/change/" target="_blank">{self.doc_num} {page_num} {split_page_num}</a>')
 
+    def deedpage_record_link(self, deedpage_id):
+        if deedpage_id:
+            return f'<br/><a href="/admin/deed/deedpage/{deedpage_id}/change/" target="_blank">DeedPage record</a>'
+        return ''
+
     @property
     def prev_thumbnail_preview(self):
         if self.prev_page_image_web:
-            return mark_safe(f'<div style="display: inline-block;"><a href="{self.prev_page_image_web.url}" target="_blank"><img src="{self.prev_page_image_web.url}" width="100" /></a><br/><a href="/admin/deed/deedpage/{self.prev_deedpage.pk}/change/" target="_blank">DeedPage record</a></div>')
+            return mark_safe(f'<div style="display: inline-block;"><a href="{self.prev_page_image_web.url}" target="_blank"><img src="{self.prev_page_image_web.url}" width="100" /></a>{self.deedpage_record_link(self.prev_deedpage_id)}</div>')
         return ""
 
     @property
     def next_thumbnail_preview(self):
         pages = []
         if self.next_page_image_web:
-            pages.append(f'<div style="display: inline-block;"><a href="{self.next_page_image_web.url}" target="_blank" style="margin: 10px"><img src="{self.next_page_image_web.url}" width="100" /></a><br/><a href="/admin/deed/deedpage/{self.next_deedpage.pk}/change/" target="_blank">DeedPage record</a></div>')
+            pages.append(f'<div style="display: inline-block;"><a href="{self.next_page_image_web.url}" target="_blank" style="margin: 10px"><img src="{self.next_page_image_web.url}" width="100" /></a>{self.deedpage_record_link(self.next_deedpage_id)}</div>')
         if self.next_next_page_image_web:
-            pages.append(f'<div style="display: inline-block;"><a href="{self.next_next_page_image_web.url}" target="_blank" style="margin: 10px"><img src="{self.next_next_page_image_web.url}" width="100" /></a><br/><a href="/admin/deed/deedpage/{self.next_next_deedpage.pk}/change/" target="_blank">DeedPage record</a></div>')
+            pages.append(f'<div style="display: inline-block;"><a href="{self.next_next_page_image_web.url}" target="_blank" style="margin: 10px"><img src="{self.next_next_page_image_web.url}" width="100" /></a>{self.deedpage_record_link(self.next_next_deedpage_id)}</div>')
         return mark_safe(''.join(pages))
 
-    def deedpage_offset_finder(self, offset):
-        kwargs = {
-            'workflow': self.workflow,
-            'doc_type': self.doc_type,
-            'batch_id': self.batch_id,
-            'book_id': self.book_id,
-
-        }
-        if self.split_page_num and self.split_page_num >= 1:
-                kwargs['split_page_num'] = self.split_page_num + offset
-                kwargs['page_num'] = self.page_num
-                kwargs['doc_num'] = self.doc_num
-        else:
-            if self.page_num and self.page_num > 0:
-                kwargs['page_num'] = self.page_num + offset
-
-                # If the doc number includes the page number, then add offset to doc_num before attempting match
-                doc_num_regex = re.compile(fr'(.+)((?<!\d){self.page_num}(?!\d))')
-                doc_num_match = re.search(doc_num_regex, self.doc_num)
-                if doc_num_match:
-                    kwargs['doc_num'] = re.sub(doc_num_regex, fr'\g<1>{self.page_num + offset}', self.doc_num)
-                else:
-                    kwargs['doc_num'] = self.doc_num
-
-        try:
-            # Avoid circular import on DeedPage
-            return apps.get_model('deed', 'DeedPage').objects.get(**kwargs)
-        except:
-            # raise
-            return None
-        return None
-
-    @property
-    def prev_deedpage(self):
-        return self.deedpage_offset_finder(-1)
-
-    @property
-    def next_deedpage(self):
-        return self.deedpage_offset_finder(1)
-
-    @property
-    def next_next_deedpage(self):
-        return self.deedpage_offset_finder(2)
-
 
 class SearchHitReport(models.Model):
     workflow = models.ForeignKey(
@@ -1,4 +1,6 @@
 import os
+import re
+import tempfile
 import pandas as pd
 import numpy as np
 
@@ -6,10 +8,15 @@ from django.test import TestCase, override_settings
 from django.core import management
 from django.conf import settings
 
-from apps.deed.models import DeedPage
+from apps.deed.models import DeedPage, MatchTerm
 from apps.zoon.models import ZooniverseWorkflow
 
 from apps.deed.management.commands.run_term_search_test import Command as TermSearchTest
+from apps.deed.utils.match_term_writer import MatchTermPairWriter
+from apps.deed.utils.term_search import FuzzyTermMatcher, parse_term_config, run_local_search
+from apps.deed.utils.s3_inventory import S3Inventory, filesystem_lister
+from apps.deed.utils.s3_fetch import BulkFetcher, LocalObjectSource, FetchRetry
+from apps.deed.utils.deed_keys import parse_deed_keys
 from apps.deed.utils.deed_pagination import tag_prev_next_image_sql, tag_doc_num_page_counts, paginate_deedpage_df
 from apps.zoon.utils.zooniverse_load import build_zooniverse_manifest
 
@@ -59,6 +66,261 @@ class ImageHitTests(TestCase):
             self.assertEqual(row['bool_match'], row['bool_expected_match'])
             self.assertNotEqual(row['bool_exception'], row['bool_expected_match'])
 
+    def test_streamed_report_confusion_term_only(self):
+        '''A confusion term without its match term only cancels a hit if the match term was found somewhere else in the report, same as the old all-in-memory report'''
+        import tempfile
+        from apps.deed.utils.hit_report import HitReportBuilder
+
+        records = [
+            {'canadian': [10], 'white race': [20], 'workflow': 'mn-test-county', 'lookup': 'a', 'uuid': 'a'},
+        ]
+        for with_match_term, expected_num_terms in [(False, 2), (True, 1)]:
+            report_records = records + [{'caucasian': [5], 'workflow': 'mn-test-county', 'lookup': 'b', 'uuid': 'b'}] if with_match_term else records
+            report_builder = HitReportBuilder(chunksize=1)
+            with tempfile.NamedTemporaryFile('w+', newline='') as spool_file, tempfile.NamedTemporaryFile('w+', newline='') as report_file:
+                report_builder.write_report(iter(report_records), spool_file, report_file)
+                report_df = pd.concat(list(report_builder.read_chunks(report_file.name)), ignore_index=True)
+
+            self.assertEqual(report_df.loc[0, 'num_terms'], expected_num_terms)
+            self.assertEqual(report_df.loc[0, 'bool_match'], True)
+
+    def test_streamed_report_keeps_numeric_keys(self):
+        '''Are lookups and uuids that look like numbers read back out of the report as the same strings?'''
+        import tempfile
+        from apps.deed.utils.hit_report import HitReportBuilder
+
+        records = [
+            {'white race': [20], 'workflow': 'mn-test-county', 'lookup': '00123', 'uuid': '1e5'},
+        ]
+        report_builder = HitReportBuilder(chunksize=1)
+        with tempfile.NamedTemporaryFile('w+', newline='') as spool_file, tempfile.NamedTemporaryFile('w+', newline='') as report_file:
+            report_builder.write_report(iter(records), spool_file, report_file)
+            report_df = pd.concat(list(report_builder.read_chunks(report_file.name)), ignore_index=True)
+
+        self.assertEqual(report_df.loc[0, 'lookup'], '00123')
+        self.assertEqual(report_df.loc[0, 'uuid'], '1e5')
+
+    def test_term_exceptions_in_same_pass(self):
+        '''Do localized term exceptions found in the page text turn a hit into an exception, but only when they account for every term on the page?'''
+        from apps.deed.utils.hit_report import TermRuleSet, TERM_EXCEPTION_FIELD
+
+        rules = TermRuleSet(term_rules={'bad_solo_terms': []}, term_exceptions={'indian': ['indian river', 'indian creek']})
+        records = [
+            {'indian': [3], 'workflow': 'mn-test-county', 'lookup': 'a', 'uuid': 'a'},
+            {'indian': [3], 'white race': [4], 'workflow': 'mn-test-county', 'lookup': 'b', 'uuid': 'b'},
+        ]
+        for record in records:
+            self.assertTrue(rules.needs_page_text(record))
+            record[TERM_EXCEPTION_FIELD] = rules.count_term_exceptions(record, 'Lot 4, along the INDIAN RIVER')
+
+        summary_df, seen_terms = rules.summarize(records)
+        report_df = rules.classify(summary_df, seen_terms)
+        self.assertEqual(report_df['bool_exception'].tolist(), [True, False])
+        self.assertEqual(report_df['bool_match'].tolist(), [False, True])
+
+
+class MatchTermPairWriterTests(TestCase):
+    fixtures = ['deed', 'zoon']
+
+    def sync_pairs(self, pairs):
+        term_writer = MatchTermPairWriter(ZooniverseWorkflow.objects.get(pk=1))
+        for lookup, terms in pairs:
+            term_writer.add(lookup, terms)
+        return term_writer.sync()
+
+    def test_matched_terms_diff(self):
+        '''Does a second sync only add and remove the links that changed?'''
+        page_1 = 'match/but/not/really.001'
+        page_2 = 'match/but/4real/4real.001'
+
+        counts = self.sync_pairs([(page_1, ['caucasian', 'white race']), (page_2, ['caucasian']), ('not/a/real/page', ['caucasian'])])
+        self.assertEqual(counts['inserted'], 3)
+        self.assertEqual(counts['deleted'], 0)
+        self.assertEqual(sorted(DeedPage.objects.get(s3_lookup=page_1).matched_terms.values_list('term', flat=True)), ['caucasian', 'white race'])
+
+        counts = self.sync_pairs([(page_1, ['caucasian']), (page_2, ['caucasian', 'aryan'])])
+        self.assertEqual(counts['inserted'], 1)
+        self.assertEqual(counts['deleted'], 1)
+        self.assertEqual(counts['unchanged'], 2)
+        self.assertEqual(list(DeedPage.objects.get(s3_lookup=page_1).matched_terms.values_list('term', flat=True)), ['caucasian'])
+        self.assertEqual(sorted(DeedPage.objects.get(s3_lookup=page_2).matched_terms.values_list('term', flat=True)), ['aryan', 'caucasian'])
+        self.assertEqual(MatchTerm.objects.filter(term='caucasian').count(), 1)
+
+
+
+class FuzzyTermSearchTests(TestCase):
+
+    def test_fuzzy_term_lines(self):
+        '''Does the local matcher find OCR-mangled terms, and respect exact terms?'''
+        matcher = FuzzyTermMatcher(parse_term_config(['caucasian', 'white race', 'occupied by any', {'term': 'jew', 'max_edits': 0}]))
+        hits = matcher.search_lines([
+            'No person other than of the Cau casian race',
+            'shall be occupied by anv person',
+            'whiterace only',
+            'The Jewell family',
+            'nothing here',
+            'Caucasion, jew.',
+        ])
+        self.assertEqual(hits, {'caucasian': [0, 5], 'white race': [2], 'occupied by any': [1], 'jew': [5]})
+
+    def test_fuzzy_term_lines_brute_force(self):
+        '''Does line_matches agree with checking the edit distance of every run of words, for short terms with spaces in them?'''
+        import random
+
+        def edit_distance(a, b):
+            previous = list(range(len(b) + 1))
+            for i in range(1, len(a) + 1):
+                current = [i] + [0] * len(b)
+                for j in range(1, len(b) + 1):
+                    current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+                previous = current
+            return previous[-1]
+
+        matcher = FuzzyTermMatcher(parse_term_config([
+            {'term': 'a b', 'max_edits': 2},
+            {'term': 'ab c', 'max_edits': 2},
+            {'term': 'a bc', 'max_edits': 1},
+            {'term': 'x y z', 'max_edits': 1},
+        ]))
+        rng = random.Random(0)
+        for _ in range(2000):
+            words = [''.join([rng.choice('abcxyz') for _ in range(rng.randint(1, 3))]) for _ in range(rng.randint(1, 4))]
+            for term in matcher.terms:
+                windows = [w for w in set([term['num_words'] - 1, term['num_words'], term['num_words'] + 1]) if w >= 1]
+                expected = any([
+                    edit_distance(term['term'], ' '.join(words[start:start + w])) <= term['max_edits']
+                    for w in windows for start in range(0, len(words) - w + 1)
+                ])
+                self.assertEqual(matcher.line_matches(term, words), expected, f"{term['term']} in {words}")
+
+    def test_local_search_ocr_dir(self):
+        '''Does a local search of an OCR directory write a result row for every page, and a hits json only for pages with a hit?'''
+        import csv
+        import json
+
+        ocr_dir = tempfile.mkdtemp()
+        dps = []
+        for lookup, text in [('doc_1_SPLITPAGE_1', 'Caucasian race only'), ('doc_2_SPLITPAGE_1', 'Nothing to see here')]:
+            ocr_key = f'ocr/json/mn-test-county/{lookup}__abc.json'
+            os.makedirs(os.path.join(ocr_dir, os.path.dirname(ocr_key)), exist_ok=True)
+            with open(os.path.join(ocr_dir, ocr_key), 'w') as ocr_file:
+                json.dump({'Blocks': [{'BlockType': 'LINE', 'Text': text}]}, ocr_file)
+            dps.append({'workflow__slug': 'mn-test-county', 's3_lookup': lookup, 'page_ocr_json': ocr_key, 'page_ocr_text': '', 'public_uuid': 'abc', 'bool_match': False})
+
+        result_path = os.path.join(ocr_dir, 'results.csv')
+        num_done = run_local_search(dps, parse_term_config(['caucasian']), result_path, ocr_dir=ocr_dir, workers=1)
+        self.assertEqual(num_done, 2)
+
+        with open(result_path, 'r') as result_file:
+            rows = {row[1]: row for row in csv.reader(result_file)}
+        self.assertEqual(rows['doc_1_SPLITPAGE_1'][4], 'True')
+        self.assertEqual(rows['doc_2_SPLITPAGE_1'][4], 'False')
+        self.assertTrue(os.path.exists(os.path.join(ocr_dir, 'ocr/hits_fuzzy/mn-test-county/doc_1_SPLITPAGE_1__abc.json')))
+        self.assertFalse(os.path.exists(os.path.join(ocr_dir, 'ocr/hits_fuzzy/mn-test-county/doc_2_SPLITPAGE_1__abc.json')))
+
+
+class S3InventoryTests(TestCase):
+
+    def write_key(self, root_dir, key, content='x'):
+        path = os.path.join(root_dir, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_inventory_refresh(self):
+        '''Does a relisting pick up added, changed and removed keys, and a narrower relisting leave other keys alone?'''
+        with tempfile.TemporaryDirectory() as bucket_dir, tempfile.TemporaryDirectory() as inventory_dir:
+            for key in ['web/fake/batch_1/a.jpg', 'web/fake/batch_1/b.jpg', 'web/fake/batch_2/c.jpg', 'web/other/d.jpg']:
+                self.write_key(bucket_dir, key)
+
+            inventory = S3Inventory('web/fake/', filesystem_lister(bucket_dir), 'fake-bucket', inventory_dir)
+            self.assertEqual(inventory.refresh(), {'added': 3, 'changed': 0, 'removed': 0, 'total': 3})
+
+            self.write_key(bucket_dir, 'web/fake/batch_1/a.jpg', 'changed')
+            os.remove(os.path.join(bucket_dir, 'web', 'fake', 'batch_1', 'b.jpg'))
+            os.remove(os.path.join(bucket_dir, 'web', 'fake', 'batch_2', 'c.jpg'))
+            self.assertEqual(inventory.refresh('web/fake/batch_1/'), {'added': 0, 'changed': 1, 'removed': 1, 'total': 1})
+            self.assertEqual(inventory.keys(), ['web/fake/batch_1/a.jpg', 'web/fake/batch_2/c.jpg'])
+
+            self.assertIsNone(inventory.refresh_if_stale(60))
+            self.assertEqual(inventory.refresh_if_stale()['removed'], 1)
+            self.assertEqual(inventory.keys(key_filter=re.compile(r'.+\.jpg')), ['web/fake/batch_1/a.jpg'])
+
+            inventory.record([('web/fake/batch_3/e.jpg', 1, None, None)])
+            self.assertEqual(inventory.existing(['web/fake/batch_3/e.jpg', 'web/fake/batch_2/c.jpg']), {'web/fake/batch_3/e.jpg'})
+            inventory.forget(['web/fake/batch_3/e.jpg'])
+            self.assertNotIn('web/fake/batch_3/e.jpg', inventory)
+
+            with self.assertRaises(ValueError):
+                inventory.keys('web/other/')
+            inventory.close()
+
+
+class FlakyObjectSource(LocalObjectSource):
+    '''Throttles every third read'''
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.num_reads = 0
+
+    def read(self, key):
+        self.num_reads += 1
+        if self.num_reads % 3 == 0:
+            raise FetchRetry(key, throttled=True)
+        return super().read(key)
+
+
+class BulkFetcherTests(TestCase):
+
+    def test_fetch_with_retries(self):
+        '''Does the fetcher return every object in order, read missing ones as None, and retry throttled reads?'''
+        with tempfile.TemporaryDirectory() as bucket_dir:
+            keys = [f'ocr/hits_fuzzy/fake/page_{i}.json' for i in range(50)]
+            os.makedirs(os.path.join(bucket_dir, 'ocr', 'hits_fuzzy', 'fake'))
+            for i, key in enumerate(keys):
+                with open(os.path.join(bucket_dir, key), 'w') as f:
+                    f.write(str(i))
+
+            fetcher = BulkFetcher(FlakyObjectSource(bucket_dir), max_workers=1, max_in_flight=5, base_delay=0)
+            results = list(fetcher.fetch(keys + ['ocr/hits_fuzzy/fake/missing.json'], ordered=True))
+
+            self.assertEqual(results[:-1], [(key, str(i).encode()) for i, key in enumerate(keys)])
+            self.assertEqual(results[-1], ('ocr/hits_fuzzy/fake/missing.json', None))
+            self.assertEqual(fetcher.stats.missing, 1)
+            self.assertGreater(fetcher.stats.throttles, 0)
+            self.assertEqual(fetcher.stats.retries, fetcher.stats.throttles)
+
+
+class DeedKeyParsingTests(TestCase):
+    fixtures = ['zoon']
+
+    def test_parse_deed_keys(self):
+        '''Are stats keys parsed into the same DeedPage fields build_django_objects used to set one key at a time?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        workflow.slug = workflow.get_slug()
+        deed_image_regex = r'/(?P<workflow_slug>[a-z\-]+)/(?P<batch_id>[a-z]+)/(?P<doc_date_year>\d{4})(?P<doc_date_month>\d{2})(?P<doc_date_day>\d{2})_(?P<doc_num>\d+)(?:_page_(?P<page_num>\d+))?(?P<bool_match>_match)?'
+        keys = [
+            f'ocr/stats/{workflow.slug}/batch/19470512_1234_page_2_match__abc123.json',
+            f'ocr/stats/{workflow.slug}/batch/19470512_1234__def456.json',
+            f'ocr/stats/{workflow.slug}/batch/19470512_1234__def456.json',
+            f'ocr/stats/{workflow.slug}/batch/not_a_deed__fff000.json',
+            f'ocr/stats/{workflow.slug}/batch/19470513_1235.json',
+        ]
+
+        deed_pages_df = parse_deed_keys(keys, workflow, deed_image_regex, chunk_size=2, workers=1)
+
+        self.assertEqual(deed_pages_df['s3_lookup'].tolist(), ['batch/19470512_1234_page_2_match', 'batch/19470512_1234'])
+        first_page = deed_pages_df.iloc[0]
+        self.assertEqual(first_page['public_uuid'], 'abc123')
+        self.assertEqual(first_page['page_num'], '2')
+        self.assertEqual(first_page['doc_date'], pd.Timestamp(1947, 5, 12))
+        self.assertEqual(first_page['page_image_web'], f'web/{workflow.slug}/batch/abc123.jpg')
+        self.assertEqual(first_page['page_ocr_text'], f'ocr/txt/{workflow.slug}/batch/19470512_1234_page_2_match.txt')
+        self.assertEqual(first_page['page_ocr_json'], f'ocr/json/{workflow.slug}/batch/19470512_1234_page_2_match.json')
+        self.assertEqual(first_page['page_stats'], keys[0])
+        self.assertEqual(deed_pages_df['bool_match'].tolist(), [True, False])
+        self.assertTrue(pd.isna(deed_pages_df.iloc[1]['page_num']))
+        self.assertNotIn('workflow_slug', deed_pages_df.columns)
 
 @override_settings(ZOONIVERSE_QUESTION_LOOKUP=TEST_SUPPLEMENTAL_DATA_SETTINGS)
 class ManualExceptionTests(TestCase):
@@ -174,6 +436,29 @@ class DeedPagePaginationTests(TestCase):
         self.assertEqual(df[df['doc_num'] == '2']['doc_page_count'].iloc[0], 3)
         self.assertEqual(df[df['doc_num'] == '17']['doc_page_count'].iloc[0], 1)
 
+    def test_paginate_deedpage_df_page_gaps(self):
+        """Are prev/next/next-next pages found by page number, so a missing page leaves a gap?"""
+        df = pd.DataFrame([
+            {'doc_num': '1', 'page_num': 1, 's3_lookup': 'doc1/p1'},
+            {'doc_num': '1', 'page_num': 2, 's3_lookup': 'doc1/p2'},
+            {'doc_num': '1', 'page_num': 4, 's3_lookup': 'doc1/p4'},
+            {'doc_num': '2', 'page_num': 3, 's3_lookup': 'doc2/p3'},
+        ])
+        df['public_uuid'] = df['s3_lookup']
+        df['page_image_web'] = 'web/' + df['s3_lookup'] + '.jpg'
+
+        paginated_df = paginate_deedpage_df(df).set_index('s3_lookup')
+
+        self.assertEqual(paginated_df.loc['doc1/p1', 'prev_page_image_lookup'], '')
+        self.assertEqual(paginated_df.loc['doc1/p1', 'next_page_image_lookup'], 'doc1/p2')
+        self.assertEqual(paginated_df.loc['doc1/p1', 'next_next_page_image_lookup'], '')
+        self.assertEqual(paginated_df.loc['doc1/p2', 'next_page_image_lookup'], '')
+        self.assertEqual(paginated_df.loc['doc1/p2', 'next_next_page_image_lookup'], 'doc1/p4')
+        self.assertEqual(paginated_df.loc['doc1/p2', 'next_next_page_image_web'], 'web/doc1/p4.jpg')
+        self.assertEqual(paginated_df.loc['doc1/p4', 'prev_page_image_lookup'], '')
+        self.assertEqual(paginated_df.loc['doc2/p3', 'prev_page_image_lookup'], '')
+        self.assertEqual(paginated_df.loc['doc2/p3', 'next_page_image_lookup'], '')
+
 
 # @override_settings(AWS_S3_CUSTOM_DOMAIN='https://fake.s3.amazon.aws.com/')
 class DeedPagePrevNextTests(TestCase):
@@ -295,6 +580,18 @@ class DeedPagePrevNextTests(TestCase):
         self.assertEqual(deed_page_2.next_deedpage, deed_page_3)
         self.assertEqual(deed_page_2.next_next_deedpage, deed_page_4)
 
+    def test_prev_next_deedpage_links_select_related(self):
+        """Are prev/next DeedPages stored links that can be read without further queries?"""
+
+        deed_page_2 = DeedPage.objects.select_related('prev_deedpage', 'next_deedpage', 'next_next_deedpage').get(
+            s3_lookup='Abstract_Images_Books_Deeds 104-277 by Book and Page/DEEDS/doc_1234_book_NONE_page_2'
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(deed_page_2.prev_deedpage.s3_lookup, deed_page_2.prev_page_image_lookup)
+            self.assertEqual(deed_page_2.next_deedpage.s3_lookup, deed_page_2.next_page_image_lookup)
+            self.assertEqual(deed_page_2.next_next_deedpage.s3_lookup, deed_page_2.next_next_page_image_lookup)
+
     def test_prev_next_deed_page_doc_num_has_page_num(self):
 
         deed_page = DeedPage.objects.get(
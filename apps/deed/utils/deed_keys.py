@@ -0,0 +1,133 @@
+import os
+import re
+import multiprocessing
+
+import pandas as pd
+
+from django.db import connections
+
+# Turns the s3 keys found by gather_deed_images into DeedPage rows with pandas string methods, rather than running the workflow's deed_image_regex and building paths key by key. Keys are parsed a chunk at a time, and with more than one worker the chunks are spread across processes.
+
+KEY_CHUNK_SIZE = 250000
+MATCHED_GROUP = '_key_matched'  # Empty group prepended to deed_image_regex, so rows the regex matched can be told apart from matches where every group is empty
+# Everything before and after the first "__{public_uuid}.json" in a stats key, and (in a lookahead, so it's the same pass) the key's directory
+UUID_SPLIT_REGEX = re.compile(r'(?s)^(?=(?P<key_dir>.*/)?)(?P<head>.*?)__(?P<public_uuid>[a-z0-9]+)\.json(?P<tail>.*)$')
+STATS_DIR = 'ocr/stats/'
+
+# Set in each worker by init_key_worker
+_key_config = None
+
+
+def compile_deed_image_regex(deed_image_regex):
+    '''The workflow's deed_image_regex with a leading empty group that is only set when the whole regex matches'''
+    if isinstance(deed_image_regex, re.Pattern):
+        return re.compile(f'(?P<{MATCHED_GROUP}>){deed_image_regex.pattern}', deed_image_regex.flags)
+    return re.compile(f'(?P<{MATCHED_GROUP}>){deed_image_regex}')
+
+
+def init_key_worker(config):
+    global _key_config
+    _key_config = config
+
+
+def chunk_keys(keys, chunk_size=KEY_CHUNK_SIZE):
+    keys = list(keys)
+    for i in range(0, len(keys), chunk_size):
+        yield keys[i:i + chunk_size]
+
+
+def parse_key_chunk(keys):
+    '''DeedPage fields for one list of keys, leaving out keys the regex (or for OCRed workflows the UUID pattern) doesn't match. Returns the rows and the unparseable keys.'''
+    config = _key_config
+    key_regex = config['key_regex']
+    keys = pd.Series(keys, dtype=object)
+
+    page_data = keys.str.extract(key_regex)
+    named_groups = [name for name, index in sorted(key_regex.groupindex.items(), key=lambda g: g[1]) if name != MATCHED_GROUP]
+    matched = page_data[MATCHED_GROUP].notna()
+
+    # TODO: Eliminate this conditional once new Ramsey records are OCRed under new system
+    if not config['bool_legacy']:
+        key_parts = keys.str.extract(UUID_SPLIT_REGEX)
+        matched = matched & key_parts['public_uuid'].notna()
+        key_parts = key_parts[matched]
+
+    unparsed = keys[~matched].tolist()
+    keys = keys[matched]
+    # We aren't using the slug, so drop before model import
+    page_data = page_data.loc[matched, [g for g in named_groups if g != 'workflow_slug']]
+
+    if config['bool_legacy']:
+        page_data['public_uuid'] = ''
+        page_data['s3_lookup'] = keys.str.replace('__.json', '', regex=False).str.replace(config['stats_prefix'], '', regex=False)
+        page_data['page_stats'] = keys
+        page_data['page_image_web'] = keys
+        page_data['page_ocr_text'] = ''
+        page_data['page_ocr_json'] = ''
+    else:
+        head, tail = key_parts['head'], key_parts['tail']
+        page_data['public_uuid'] = key_parts['public_uuid']
+        page_data['s3_lookup'] = (head + tail).str.replace(config['stats_prefix'], '', regex=False)
+        page_data['page_stats'] = keys
+        # Same as PurePath(key).with_name(public_uuid + '.jpg') for the keys s3 gives us
+        page_data['page_image_web'] = (key_parts['key_dir'].fillna('') + key_parts['public_uuid'] + '.jpg').str.replace(STATS_DIR, 'web/', regex=False)
+        page_data['page_ocr_text'] = (head + '.txt' + tail).str.replace(STATS_DIR, 'ocr/txt/', regex=False)
+        page_data['page_ocr_json'] = (head + '.json' + tail).str.replace(STATS_DIR, 'ocr/json/', regex=False)
+
+    page_data['workflow_id'] = config['workflow_id']
+
+    if 'doc_date_year' in page_data.columns:
+        page_data['doc_date'] = pd.to_datetime(pd.DataFrame({
+            'year': pd.to_numeric(page_data['doc_date_year']),
+            'month': pd.to_numeric(page_data['doc_date_month']),
+            'day': pd.to_numeric(page_data['doc_date_day']),
+        }))
+        page_data = page_data.drop(columns=['doc_date_year', 'doc_date_month', 'doc_date_day'])
+
+    # Re-code bool_match as boolean if found. This likely is only a legacy feature since generally the OCR step will be done in the Lambda world and collected after this step.
+    if 'bool_match' in page_data.columns:
+        page_data['bool_match'] = page_data['bool_match'].fillna('').astype(bool)
+    else:
+        page_data['bool_match'] = False
+
+    return page_data.drop_duplicates(subset=['s3_lookup']), unparsed
+
+
+def parse_deed_keys(matching_keys, workflow, deed_image_regex, chunk_size=KEY_CHUNK_SIZE, workers=None):
+    '''One DataFrame of DeedPage fields for every parseable key, deduplicated on s3_lookup, the same rows build_django_objects used to build key by key. Chunks are parsed across worker processes and put back in key order.'''
+    chunks = list(chunk_keys(matching_keys, chunk_size))
+    workers = min(workers or os.cpu_count(), max(len(chunks), 1))
+    config = {
+        'key_regex': compile_deed_image_regex(deed_image_regex),
+        'bool_legacy': workflow.workflow_name == 'Ramsey County',
+        'stats_prefix': f'{STATS_DIR}{workflow.slug}/',
+        'workflow_id': workflow.id,
+    }
+
+    if workers == 1:
+        init_key_worker(config)
+        chunk_results = map(parse_key_chunk, chunks)
+        pool = None
+    else:
+        # Fork so workers inherit the configured Django app, but they mustn't share the parent's database connection
+        connections.close_all()
+        pool = multiprocessing.get_context('fork').Pool(processes=workers, initializer=init_key_worker, initargs=(config,))
+        chunk_results = pool.imap(parse_key_chunk, chunks)
+
+    page_data_chunks = []
+    num_parsed = 0
+    try:
+        for page_data, unparsed in chunk_results:
+            for mk in unparsed:
+                print(f'Could not parse image path data: {mk}. You might need to adjust your deed_image_regex setting.')
+            page_data_chunks.append(page_data)
+            num_parsed += len(page_data.index)
+            print(f'Parsed {num_parsed} keys...')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if len(page_data_chunks) == 0:
+        return pd.DataFrame()
+    return pd.concat(page_data_chunks, ignore_index=True).drop_duplicates(subset=['s3_lookup'])
@@ -23,47 +23,60 @@ def tag_doc_num_page_counts(df):
     )
 
 
-def pagination_merge(match_df, doc_list_df, doc_or_book_selector='doc_num', offset=1, split_page=False):
-    split_str = ''
-    if split_page:
-        split_str = 'split_'
-
-    if offset == -1:
-        new_image_field = 'prev_page_image_web'
-        new_image_lookup_field = 'prev_page_image_lookup'
-    elif offset == 1:
-        new_image_field = 'next_page_image_web'
-        new_image_lookup_field = 'next_page_image_lookup'
-    elif offset == 2:
-        new_image_field = 'next_next_page_image_web'
-        new_image_lookup_field = 'next_next_page_image_lookup'
-
-    match_df[f'{split_str}page_num_{offset}'] = match_df[f'{split_str}page_num'] + offset
-
-    # doc_list_copy = doc_list_df.copy()
-    # Rather than making a copy here, why not just keep changing/adding values for lookup purposes, and drop unwanted columns when merging
-    doc_list_df[new_image_field] = doc_list_df['page_image_web']
-    doc_list_df[new_image_lookup_field] = doc_list_df['s3_lookup']
-    doc_list_df[f'{split_str}page_num_right'] = doc_list_df[f'{split_str}page_num']
-    # doc_list_copy.drop(columns=['page_image_web', f'{split_str}page_num'])
-
-    '''Problem here is caused by there being a splitpage page in the next and next-next positions. That's somewhat of an outlier, but it's also not even supposed to be hitting join 3 because it has a doc num in addition to book and page. Should just rely on doc num and page count to say no prev or next. Need to sort right side of join by doc_num/page_num/splitpage_num and drop duplicates on result on important fields'''
-
-    match_df = match_df.merge(
-        doc_list_df[[
-            'doc_type',
-            'batch_id',
-            doc_or_book_selector,
-            f'{split_str}page_num_right',
-            new_image_field,
-            new_image_lookup_field
-        ]],
-        how="left",
-        left_on=["doc_type", "batch_id", doc_or_book_selector, f"{split_str}page_num_{offset}"],
-        right_on=["doc_type", "batch_id", doc_or_book_selector, f"{split_str}page_num_right"]
-    ).drop(columns=[f"{split_str}page_num_right"]).drop_duplicates(subset=['s3_lookup'])
-
-    return match_df
+PAGINATION_NEIGHBORS = [
+    # (label, steps along the sorted pages to look, page number offset). Page numbers are whole numbers, so page + 2 is at most two distinct pages along.
+    ('prev', [-1], -1),
+    ('next', [1], 1),
+    ('next_next', [1, 2], 2),
+]
+
+def neighbor_pages(df, doc_or_book_selector='doc_num', split_page=False):
+    '''prev/next/next-next page_image_web and s3_lookup for every row of df, indexed like df. Pages are sorted once by doc_type, batch_id, doc or book and page number, and each neighbor is read off the sorted pages instead of being merged in. A neighbor has to be numbered exactly one before, one after or two after in the same doc or book, so a gap in the numbering leaves it blank. As with the old per-offset merges, a page number that appears more than once resolves to its first row in df, and rows without a page number get the first page of their doc or book that also has none.'''
+    page_field = 'split_page_num' if split_page else 'page_num'
+
+    group = df.groupby(['doc_type', 'batch_id', doc_or_book_selector], sort=False, dropna=False).ngroup().to_numpy()
+    page = pd.to_numeric(df[page_field]).to_numpy(dtype=float)
+    no_page = np.isnan(page)
+    page = np.where(no_page, 0, page)
+
+    # lexsort is stable, so rows sharing a page number stay in df order
+    order = np.lexsort((page, no_page, group))
+    group_s, page_s, no_page_s = group[order], page[order], no_page[order]
+
+    # One "run" per distinct page in each doc or book, represented by its first row
+    run_start = np.ones(len(order), dtype=bool)
+    run_start[1:] = (group_s[1:] != group_s[:-1]) | (no_page_s[1:] != no_page_s[:-1]) | (~no_page_s[1:] & (page_s[1:] != page_s[:-1]))
+    run_first = order[run_start]
+    run_group, run_page, run_no_page = group_s[run_start], page_s[run_start], no_page_s[run_start]
+    num_runs = len(run_first)
+
+    row_run = np.empty(len(order), dtype=int)
+    row_run[order] = np.cumsum(run_start) - 1
+
+    runs = np.arange(num_runs)
+    neighbors = pd.DataFrame(index=df.index)
+    for label, steps, offset in PAGINATION_NEIGHBORS:
+        neighbor_run = np.where(run_no_page, runs, -1)
+        for step in steps:
+            candidate = runs + step
+            in_range = (candidate >= 0) & (candidate < num_runs)
+            candidate = np.where(in_range, candidate, 0)
+            found = (neighbor_run == -1) & in_range & ~run_no_page & (run_group[candidate] == run_group) & ~run_no_page[candidate] & (run_page[candidate] == run_page + offset)
+            neighbor_run = np.where(found, candidate, neighbor_run)
+
+        row_neighbor = neighbor_run[row_run]
+        has_neighbor = row_neighbor >= 0
+        neighbor_row = run_first[np.where(has_neighbor, row_neighbor, 0)]
+        for kind, field in [('web', 'page_image_web'), ('lookup', 's3_lookup')]:
+            values = pd.Series(df[field].array.take(neighbor_row), index=df.index)
+            neighbors[f'{label}_page_image_{kind}'] = values.where(has_neighbor)
+
+    return neighbors
+
+
+def paginate_cohort(cohort_df, neighbors):
+    '''Tag a cohort of pages with the neighbors found for its grouping key'''
+    return cohort_df.join(neighbors).drop_duplicates(subset=['s3_lookup'])
 
 def round_float_to_str(x):
     try:
@@ -128,31 +141,19 @@ def paginate_deedpage_df(df, matches_only=False):
 
     print(f'Starting with {match_df.shape[0]} objects...')
 
-    doc_list_df = df[[
-        # 'pk',
-        's3_lookup',
-        'doc_type',
-        'batch_id',
-        'doc_num',
-        'book_id',
-        'page_num',
-        'split_page_num',
-        'page_image_web'
-    ]].drop_duplicates()
+    # Each grouping key is sorted once across all pages, whichever cohort is being tagged
+    print('Finding neighboring pages...')
+    neighbors = {
+        (doc_or_book_selector, split_page): neighbor_pages(df, doc_or_book_selector, split_page)
+        for doc_or_book_selector in ['doc_num', 'book_id'] for split_page in [True, False]
+    }
 
     print('Join 1')
     # same doc num with multiple pages + splitpage
     doc_num_split_page_df = match_df[(match_df['doc_num'] != '') & (match_df['doc_page_count'] > 1) & (match_df['split_page_num'] >= 1)].copy()
 
     print(f'Join 1 input: {doc_num_split_page_df.shape[0]} objects')
-    for offset in [-1, 1, 2]:
-        doc_num_split_page_df = pagination_merge(
-            doc_num_split_page_df,
-            doc_list_df,
-            'doc_num',
-            offset=offset,
-            split_page=True
-        )
+    doc_num_split_page_df = paginate_cohort(doc_num_split_page_df, neighbors[('doc_num', True)])
 
     validation_fields = ['s3_lookup', 'doc_type', 'doc_num', 'book_id', 'page_num', 'split_page_num', 'doc_page_count']
     page_to_find = None
@@ -170,14 +171,7 @@ def paginate_deedpage_df(df, matches_only=False):
     book_id_split_page_df = match_df[(match_df['book_id'] != '') & (match_df['doc_page_count'] == 1) & (match_df['split_page_num'] >= 1)].copy()
     print(f'Join 2 input: {book_id_split_page_df.shape[0]} objects')
 
-    for offset in [-1, 1, 2]:
-        book_id_split_page_df = pagination_merge(
-            book_id_split_page_df,
-            doc_list_df,
-            'book_id',
-            offset=offset,
-            split_page=True
-        )
+    book_id_split_page_df = paginate_cohort(book_id_split_page_df, neighbors[('book_id', True)])
 
     print(book_id_split_page_df[validation_fields])
     if page_to_find:
@@ -194,14 +188,7 @@ def paginate_deedpage_df(df, matches_only=False):
     book_id_no_split_page_df = match_df[(match_df['book_id'] != '') & (~match_df['page_num'].isna()) & (match_df['doc_page_count'] == 1)].copy()
     print(f'Join 3 input: {book_id_no_split_page_df.shape[0]} objects')
 
-    for offset in [-1, 1, 2]:
-        book_id_no_split_page_df = pagination_merge(
-            book_id_no_split_page_df,
-            doc_list_df,
-            'book_id',
-            offset=offset,
-            split_page=False
-        )
+    book_id_no_split_page_df = paginate_cohort(book_id_no_split_page_df, neighbors[('book_id', False)])
 
     print(book_id_no_split_page_df[validation_fields])
     if page_to_find:
@@ -256,14 +243,7 @@ def paginate_deedpage_df(df, matches_only=False):
     # print(doc_num_no_split_page_df.shape)
     # print(doc_num_no_split_page_df[['s3_lookup', 'doc_num', 'book_id', 'page_num', 'split_page_num', 'doc_page_count']])
 
-    for offset in [-1, 1, 2]:
-        doc_num_no_split_page_df = pagination_merge(
-            doc_num_no_split_page_df,
-            doc_list_df,
-            'doc_num',
-            offset=offset,
-            split_page=False
-        )
+    doc_num_no_split_page_df = paginate_cohort(doc_num_no_split_page_df, neighbors[('doc_num', False)])
 
     print(doc_num_no_split_page_df[validation_fields])
     if page_to_find:
@@ -298,15 +278,6 @@ def paginate_deedpage_df(df, matches_only=False):
     out_df["page_num"] = out_df["page_num"].astype(pd.Int64Dtype())
     out_df["split_page_num"] = out_df["split_page_num"].astype(pd.Int64Dtype())
 
-    out_df = out_df.drop(columns=[
-        'page_num_-1',
-        'page_num_1',
-        'page_num_2',
-        'split_page_num_-1',
-        'split_page_num_1',
-        'split_page_num_2',
-    ])
-
     print(out_df[validation_fields])
 
     return out_df
@@ -375,6 +346,44 @@ def tag_prev_next_image_sql(workflow, matches_only=False):
         batch_size=5000
     )
 
+    link_deedpage_neighbors(workflow)
+
+
+def link_deedpage_neighbors(workflow):
+    '''Point prev_deedpage, next_deedpage and next_next_deedpage at the DeedPages named by each page's *_page_image_lookup, in one set-based update using the workflow/s3_lookup index. Run after pagination or after importing paginated pages. Returns the number of pages whose links changed.'''
+    table = DeedPage._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            WITH lookup AS (
+                SELECT DISTINCT ON (s3_lookup) s3_lookup, id
+                FROM {table}
+                WHERE workflow_id = %s
+                ORDER BY s3_lookup, id
+            ),
+            links AS (
+                SELECT dp.id, prev.id AS prev_id, next.id AS next_id, next_next.id AS next_next_id
+                FROM {table} AS dp
+                LEFT JOIN lookup AS prev ON prev.s3_lookup = NULLIF(dp.prev_page_image_lookup, '')
+                LEFT JOIN lookup AS next ON next.s3_lookup = NULLIF(dp.next_page_image_lookup, '')
+                LEFT JOIN lookup AS next_next ON next_next.s3_lookup = NULLIF(dp.next_next_page_image_lookup, '')
+                WHERE dp.workflow_id = %s
+            )
+            UPDATE {table} AS dp
+            SET prev_deedpage_id = links.prev_id,
+                next_deedpage_id = links.next_id,
+                next_next_deedpage_id = links.next_next_id
+            FROM links
+            WHERE dp.id = links.id
+            AND (
+                dp.prev_deedpage_id IS DISTINCT FROM links.prev_id
+                OR dp.next_deedpage_id IS DISTINCT FROM links.next_id
+                OR dp.next_next_deedpage_id IS DISTINCT FROM links.next_next_id
+            )
+        ''', [workflow.id, workflow.id])
+        linked_count = cursor.rowcount
+    print(f'Linked prev/next DeedPages on {linked_count} pages.')
+    return linked_count
+
 # DEPRECATED
 def pagination_merge_deedpage(workflow, image_lookup_df, offset=1):
     if offset == -1:
@@ -0,0 +1,229 @@
+import csv
+import pandas as pd
+
+from django.conf import settings
+
+# Keys in a hits json that are not search terms. 'expected_result' and 'bool_expected_match' are only present in test data
+HIT_FIELDS = ['workflow', 'lookup', 'uuid']
+TEST_HIT_FIELDS = ['expected_result', 'bool_expected_match']
+
+# Added to a hit record by gather_image_hits when the page text has been checked for localized term exceptions
+TERM_EXCEPTION_FIELD = 'term_exception_hits'
+
+# Default rule lists. Any of these can be replaced for one workflow with a 'term_rules' dict in its ZOONIVERSE_QUESTION_LOOKUP config
+DEFAULT_TERM_RULES = {
+    # Exceptions when they occur as the only term hit like "occupied by any" and "death certificate"
+    'bad_solo_terms': ["african", "any person of", "citizen", "descent", "extraction", "gentile", "hawaiian", "hindu", "indian", "irish", "italian", "malay", "malayan", "moorish", "mulatto", "mulato", "muslim", "nationality", "occupied by any", "oriental", "ottoman", "persian", "persons not of", "persons other than", "philippine", "polish", "racial", "said races", "servant", "syrian", "turkish", "used or occupied", "white or"],
+
+    # Non-racial terms, for example as requested by CC County. If this is only term found, set as exception so it can be exported separately
+    'nonracial_terms': ['disorderly persons', 'less than 18 years', 'no children', 'no minor', 'occupy said real property', 'poverty', 'under the age of', 'years of age or older'],
+
+    # Death certs, military records and misc exceptions are exceptions no matter how many other terms found
+    'deathcert_terms': ['death certificate', 'certificate of death', 'date of death', 'name of deceased', 'report of birth', 'certificate of hawaiian birth'],
+    'military_terms': ['report of transfer', 'report of separation', 'transfer or discharge', 'blood group', 'notice of separation', 'place of separation', 'rank and classification', 'service no', 'was discharged from', 'date enlisted', 'enlisted record', 'honorable discharge', 'warrant at time of discharge', 'special military qualifications', 'release or discharge', 'from active duty'],
+    'misc_exception_terms': ['minority business enterprise', 'nigger'],
+
+    # Confusion terms: Sometimes there are fuzzy variations that cannot be eliminated
+    # because you need the fuzziness, but are clearly not valid matches.
+    # For example, "caucasian" with a fuzziness of 3 matches "canadian"
+    # With confusion terms we'll attempt to let matches of "canadian" cancel out matches of "caucasian",
+    #  and if no terms are left, then flag as an exception
+    'confusion_terms': [
+        {'match_term': 'caucasian', 'confusion_term': 'canadian'},
+        {'match_term': 'caucasian', 'confusion_term': 'calcasieu'},
+        {'match_term': 'colored', 'confusion_term': 'dolored'},
+        {'match_term': 'occupied by any', 'confusion_term': 'other than the applicant'},
+        {'match_term': 'jew (10)', 'confusion_term': 'jew'},
+        # {'match_term': 'hebrew', 'confusion_term': 'herewith'}, # This doesn't seem like a good idea on second thought
+    ],
+}
+
+# Report column: rule list it counts hits from
+COUNT_RULES = [
+    ('bad_solo_count', 'bad_solo_terms'),
+    ('nonracial_term_count', 'nonracial_terms'),
+    ('deathcert_count', 'deathcert_terms'),
+    ('military_count', 'military_terms'),
+    ('misc_exception_count', 'misc_exception_terms'),
+]
+
+SUMMARY_COLUMNS = ['matched_terms', 'num_terms'] + [c[0] for c in COUNT_RULES] + ['local_exception_count']
+
+
+def split_or_1(x):
+    try:
+        return len(x)
+    except:
+        return 1
+
+
+class TermRuleSet:
+    '''The hit classification rules for one workflow, compiled into a term -> report column table so a batch of hit records can be counted and classified with a few pandas operations instead of a loop per term.
+
+    Localized term_exceptions (phrases that cancel out a term when found in the page text) are evaluated from text fetched during the same download pass, see count_term_exceptions.'''
+
+    def __init__(self, term_rules=None, term_exceptions=None):
+        self.rules = {**DEFAULT_TERM_RULES, **(term_rules or {})}
+        self.confusion_terms = self.rules['confusion_terms']
+        self.term_exceptions = term_exceptions or {}
+
+        self.rule_table = pd.DataFrame(
+            [(term, count_col) for count_col, rule_key in COUNT_RULES for term in self.rules[rule_key]],
+            columns=['term', 'rule']
+        )
+        self.confusion_value_terms = set(
+            [t['match_term'] for t in self.confusion_terms] + [t['confusion_term'] for t in self.confusion_terms]
+        )
+        self.non_term_fields = set(HIT_FIELDS + TEST_HIT_FIELDS + [TERM_EXCEPTION_FIELD])
+
+    @classmethod
+    def for_workflow(cls, workflow):
+        config = settings.ZOONIVERSE_QUESTION_LOOKUP.get(workflow.workflow_name, {}) if workflow else {}
+        return cls(config.get('term_rules'), config.get('term_exceptions'))
+
+    def needs_page_text(self, record):
+        return any([record.get(term) is not None for term in self.term_exceptions])
+
+    def count_term_exceptions(self, record, page_text):
+        '''For each term in this record with localized exceptions, how many of its exception phrases appear in the page text'''
+        page_text = page_text.lower()
+        return {
+            term: len([e for e in exceptions if e.lower() in page_text])
+            for term, exceptions in self.term_exceptions.items() if record.get(term) is not None
+        }
+
+    def summarize(self, records, fields=HIT_FIELDS):
+        '''Reduce a batch of hits json records to narrow report rows: term list and per-rule counts. The one rule that can't be settled per batch, confusion terms found without their match term, is left in "confusion_only" (as confusion_terms indexes) for classify, because it only applies if the match term was found somewhere in the whole report. Returns the rows and the set of terms seen.'''
+        num_records = len(records)
+        record_ids = []
+        terms = []
+        hits = []
+        confusion_values = {}
+        exception_hits = {}
+        for i, record in enumerate(records):
+            for term, value in record.items():
+                if term in self.non_term_fields or value is None:
+                    continue
+                record_ids.append(i)
+                terms.append(term)
+                hits.append(split_or_1(value))
+                if term in self.confusion_value_terms:
+                    confusion_values.setdefault(i, {})[term] = value
+            if record.get(TERM_EXCEPTION_FIELD):
+                exception_hits[i] = record[TERM_EXCEPTION_FIELD]
+
+        hits_df = pd.DataFrame({'record_id': record_ids, 'term': terms, 'hits': hits})
+        all_ids = range(num_records)
+
+        df = pd.DataFrame({f: [record.get(f) for record in records] for f in fields})
+        df['matched_terms'] = hits_df.groupby('record_id')['term'].agg(','.join).reindex(all_ids, fill_value='')
+        term_counts = hits_df.groupby('record_id').size().reindex(all_ids, fill_value=0)
+        # An empty matched_terms still counted as one term
+        df['num_terms'] = term_counts.clip(lower=1)
+
+        rule_hits = hits_df.merge(self.rule_table, on='term').groupby(['record_id', 'rule'])['hits'].sum().unstack()
+        for count_col, rule_key in COUNT_RULES:
+            if count_col in rule_hits.columns:
+                df[count_col] = rule_hits[count_col].reindex(all_ids).fillna(0).astype(int)
+            else:
+                df[count_col] = 0
+
+        confusion_only = [[] for i in all_ids]
+        for i, values in confusion_values.items():
+            for rule_index, term in enumerate(self.confusion_terms):
+                if term['confusion_term'] not in values:
+                    continue
+                if term['match_term'] not in values:
+                    confusion_only[i].append(str(rule_index))
+                elif values[term['match_term']] <= values[term['confusion_term']]:
+                    df.loc[i, 'num_terms'] -= 2
+        df['confusion_only'] = ['|'.join(c) for c in confusion_only]
+
+        # A localized exception cancels the page if its phrases account for every term found
+        df['local_exception_count'] = 0
+        for i, found in exception_hits.items():
+            df.loc[i, 'local_exception_count'] = len([term for term, num_found in found.items() if term_counts[i] - num_found <= 0])
+
+        return df, set(terms)
+
+    def classify(self, df, seen_terms):
+        '''Final pass over a chunk of summarized rows, setting bool_match and bool_exception'''
+        for rule_index, term in enumerate(self.confusion_terms):
+            if term['match_term'] in seen_terms:
+                confusion_only = df['confusion_only'].str.split('|').apply(lambda x: str(rule_index) in x)
+                df.loc[confusion_only, 'num_terms'] -= 1
+
+        solo_exception = (df['num_terms'] == 1) & ((df['bad_solo_count'] > 0) | (df['nonracial_term_count'] > 0))
+
+        # If all match terms have been eliminated by confusion, also an exception
+        bool_exception = solo_exception \
+            | (df['deathcert_count'] > 0) \
+            | (df['military_count'] > 0) \
+            | (df['misc_exception_count'] > 0) \
+            | (df['local_exception_count'] > 0) \
+            | (df['num_terms'] < 1)
+        df['bool_match'] = ~bool_exception
+        df['bool_exception'] = bool_exception
+
+        return df.drop(columns=['confusion_only'])
+
+
+class HitReportBuilder:
+    '''Streams hits json records into a search hit report CSV without holding the whole report in memory. Records are summarized a batch at a time into a narrow spool file, then classified chunk by chunk once the set of terms seen across the whole report is known.'''
+
+    def __init__(self, rules=None, fields=HIT_FIELDS, chunksize=50000):
+        self.rules = rules or TermRuleSet()
+        self.fields = fields
+        self.chunksize = chunksize
+        self.seen_terms = set()
+        self.num_records = 0
+        self.num_hits = 0
+        self.num_exceptions = 0
+
+    def spool_batch(self, batch, spool_file):
+        summary_df, terms = self.rules.summarize(batch, self.fields)
+        self.seen_terms.update(terms)
+        summary_df[self.fields + SUMMARY_COLUMNS + ['confusion_only']].to_csv(spool_file, index=False, header=False)
+        self.num_records += len(batch)
+        print(f'{self.num_records} hit records summarized...')
+
+    def spool(self, records, spool_file):
+        csv.writer(spool_file).writerow(self.fields + SUMMARY_COLUMNS + ['confusion_only'])
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.chunksize:
+                self.spool_batch(batch, spool_file)
+                batch = []
+        if len(batch) > 0:
+            self.spool_batch(batch, spool_file)
+        spool_file.flush()
+
+    def read_chunks(self, csv_path):
+        return pd.read_csv(
+            csv_path,
+            chunksize=self.chunksize,
+            dtype={'lookup': str, 'uuid': str, 'matched_terms': str, 'confusion_only': str},
+            keep_default_na=False,
+            na_values={f: [''] for f in self.fields},
+        )
+
+    def write_report(self, records, spool_file, report_file):
+        '''Summarize records into spool_file, then write the classified report to report_file. Returns the report path.'''
+        self.spool(records, spool_file)
+        print(f'{self.num_records} hit records, {len(self.seen_terms)} distinct terms.')
+
+        header = True
+        for chunk in self.read_chunks(spool_file.name):
+            chunk = self.rules.classify(chunk, self.seen_terms)
+            self.num_hits += int(chunk['bool_match'].sum())
+            self.num_exceptions += int(chunk['bool_exception'].sum())
+            chunk.to_csv(report_file, index=False, header=header)
+            header = False
+        if header:
+            # No hits at all, but still write a valid empty report
+            csv.writer(report_file).writerow(self.fields + SUMMARY_COLUMNS + ['bool_match', 'bool_exception'])
+        report_file.flush()
+
+        print(f'{self.num_hits} hits, {self.num_exceptions} exceptions.')
+        return report_file.name
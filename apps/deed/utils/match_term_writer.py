@@ -0,0 +1,101 @@
+import csv
+import time
+import tempfile
+
+from django.db import connection, transaction
+
+from apps.deed.models import DeedPage, MatchTerm
+
+
+class MatchTermPairWriter:
+    '''Replaces the DeedPage.matched_terms links for one workflow with a new full set of (s3_lookup, term) pairs. Pairs are spooled to disk as they are added, then COPYed into a temp table and diffed against the existing through table in SQL, so only links that actually changed are inserted or deleted.'''
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.spool = tempfile.TemporaryFile('w+', newline='')
+        self.writer = csv.writer(self.spool)
+        self.num_pairs = 0
+        self.timings = {}
+        self.counts = {}
+
+    def log_phase(self, phase, start):
+        self.timings[phase] = time.perf_counter() - start
+        print(f'{phase} took {self.timings[phase]:.1f}s')
+
+    def add(self, s3_lookup, terms):
+        for term in terms:
+            if term not in [None, '']:
+                self.writer.writerow([s3_lookup, term])
+                self.num_pairs += 1
+
+    def sync(self):
+        '''Apply the diff. Returns counts of new MatchTerms and inserted, deleted and unchanged links.'''
+        through_table = DeedPage.matched_terms.through._meta.db_table
+        deedpage_table = DeedPage._meta.db_table
+        term_table = MatchTerm._meta.db_table
+        run_start = time.perf_counter()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            phase_start = time.perf_counter()
+            # ON COMMIT DROP only fires at the outermost commit, so a second sync in the same transaction would find these still there
+            cursor.execute('DROP TABLE IF EXISTS tmp_page_terms, tmp_page_term_ids;')
+            cursor.execute('''
+                CREATE TEMP TABLE tmp_page_terms (s3_lookup varchar(500), term varchar(100)) ON COMMIT DROP;
+            ''')
+            self.spool.seek(0)
+            cursor.copy_expert('COPY tmp_page_terms (s3_lookup, term) FROM STDIN WITH (FORMAT csv)', self.spool)
+            self.log_phase(f'Copying {self.num_pairs} page/term pairs', phase_start)
+
+            phase_start = time.perf_counter()
+            cursor.execute(f'''
+                INSERT INTO {term_table} (term)
+                SELECT DISTINCT tmp.term FROM tmp_page_terms AS tmp
+                WHERE NOT EXISTS (SELECT 1 FROM {term_table} AS mt WHERE mt.term = tmp.term);
+            ''')
+            self.counts['new_terms'] = cursor.rowcount
+
+            # Terms aren't unique in MatchTerm, so always link to the oldest one, like get_or_create would
+            cursor.execute(f'''
+                CREATE TEMP TABLE tmp_page_term_ids ON COMMIT DROP AS
+                SELECT DISTINCT dp.id AS deedpage_id, mt.id AS matchterm_id
+                FROM tmp_page_terms AS tmp
+                JOIN {deedpage_table} AS dp ON dp.s3_lookup = tmp.s3_lookup AND dp.workflow_id = %s
+                JOIN (
+                    SELECT MIN(id) AS id, term FROM {term_table} GROUP BY term
+                ) AS mt ON mt.term = tmp.term;
+            ''', [self.workflow.pk])
+            cursor.execute('CREATE INDEX ON tmp_page_term_ids (deedpage_id, matchterm_id);')
+            cursor.execute('ANALYZE tmp_page_term_ids;')
+            self.log_phase('Resolving pages and terms', phase_start)
+
+            phase_start = time.perf_counter()
+            cursor.execute(f'''
+                DELETE FROM {through_table} AS pt
+                USING {deedpage_table} AS dp
+                WHERE pt.deedpage_id = dp.id
+                AND dp.workflow_id = %s
+                AND NOT EXISTS (
+                    SELECT 1 FROM tmp_page_term_ids AS new
+                    WHERE new.deedpage_id = pt.deedpage_id AND new.matchterm_id = pt.matchterm_id
+                );
+            ''', [self.workflow.pk])
+            self.counts['deleted'] = cursor.rowcount
+
+            cursor.execute(f'''
+                INSERT INTO {through_table} (deedpage_id, matchterm_id)
+                SELECT new.deedpage_id, new.matchterm_id FROM tmp_page_term_ids AS new
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {through_table} AS pt
+                    WHERE pt.deedpage_id = new.deedpage_id AND pt.matchterm_id = new.matchterm_id
+                );
+            ''')
+            self.counts['inserted'] = cursor.rowcount
+
+            cursor.execute('SELECT COUNT(*) FROM tmp_page_term_ids;')
+            self.counts['unchanged'] = cursor.fetchone()[0] - self.counts['inserted']
+            self.log_phase('Applying matched term diff', phase_start)
+
+        self.spool.close()
+        self.log_phase('Total', run_start)
+        print(f"Matched terms: {self.counts['inserted']} links added, {self.counts['deleted']} removed, {self.counts['unchanged']} unchanged, {self.counts['new_terms']} new terms.")
+        return self.counts
@@ -0,0 +1,223 @@
+import os
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+
+# Fetch one small object per DeedPage (hits json, stats json, OCR text) without a thread per request. A fixed pool of threads works through the items, but only a bounded window of them is in flight at once, so results stream back to the caller as a generator instead of piling up in memory. The number of concurrent reads adapts to S3: it creeps up while requests succeed and halves whenever S3 asks us to slow down, and failed reads are retried with jittered backoff.
+
+DEFAULT_MAX_WORKERS = 24
+THROTTLE_ERROR_CODES = ['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests', '503']
+RETRY_ERROR_CODES = ['InternalError', 'ServiceUnavailable', 'RequestTimeout', '500', '502', '504']
+MISSING_ERROR_CODES = ['NoSuchKey', '404', 'NotFound']
+
+
+class FetchRetry(Exception):
+    '''Raised by a source for a failure that's worth retrying. throttled=True if the store asked us to slow down, which also lowers concurrency.'''
+
+    def __init__(self, message, throttled=False):
+        super().__init__(message)
+        self.throttled = throttled
+
+
+class LocalObjectSource:
+    '''Reads keys under a local directory laid out like the s3 bucket. Missing keys read as None.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as infile:
+                return infile.read()
+        except FileNotFoundError:
+            return None
+
+
+class S3ObjectSource:
+    '''Reads keys from an s3 bucket with a client whose connection pool is big enough for every worker. Missing keys read as None. Retries are left to BulkFetcher rather than botocore, so throttling can also slow the whole fetch down.'''
+
+    def __init__(self, bucket_name=None, session=None, max_pool_connections=DEFAULT_MAX_WORKERS, client=None):
+        self.bucket_name = bucket_name or settings.AWS_STORAGE_BUCKET_NAME
+        if client is None:
+            import boto3
+            from botocore.config import Config
+            session = session or boto3.Session(
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+            )
+            client = session.client('s3', config=Config(
+                max_pool_connections=max_pool_connections,
+                retries={'max_attempts': 0}
+            ))
+        self.client = client
+
+    def read(self, key):
+        from botocore.exceptions import ClientError, BotoCoreError
+        try:
+            return self.client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+        except ClientError as e:
+            code = str(e.response.get('Error', {}).get('Code', ''))
+            if code in MISSING_ERROR_CODES:
+                return None
+            if code in THROTTLE_ERROR_CODES:
+                raise FetchRetry(f'{key}: {code}', throttled=True) from e
+            if code in RETRY_ERROR_CODES:
+                raise FetchRetry(f'{key}: {code}') from e
+            raise
+        except BotoCoreError as e:
+            # Dropped connections, timeouts and truncated bodies
+            raise FetchRetry(f'{key}: {e}') from e
+
+
+class ConcurrencyLimit:
+    '''How many reads may run at once. Additive increase while reads succeed (about one more per limit's worth of successes), halved on throttling.'''
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, outcome):
+        '''outcome is 'ok', 'throttled' or 'error'. Errors leave the limit as it was.'''
+        with self.condition:
+            self.active -= 1
+            if outcome == 'throttled':
+                self.limit = max(self.minimum, self.limit / 2)
+            elif outcome == 'ok':
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class FetchStats:
+    '''Running counts for a bulk fetch, safe to update from worker threads'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.items = 0
+        self.reads = 0
+        self.bytes = 0
+        self.missing = 0
+        self.retries = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def summary(self, concurrency=None):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        message = f'{self.items} items, {self.reads} reads ({self.missing} missing), {self.bytes / 1e6:.1f} MB in {elapsed:.1f}s ({self.reads / elapsed:.0f} reads/s, {self.bytes / 1e6 / elapsed:.2f} MB/s), {self.retries} retries ({self.throttles} throttled)'
+        if concurrency is not None:
+            message += f', concurrency {concurrency:.0f}'
+        return message
+
+
+class BulkFetcher:
+    '''Run func(item, read) over many items on a pool of threads, where read(key) returns an object's bytes (None if it doesn't exist) with retries and adaptive concurrency. Only max_in_flight items are queued or unconsumed at once.'''
+
+    def __init__(self, source, max_workers=DEFAULT_MAX_WORKERS, min_workers=1, initial_workers=None, max_in_flight=None, max_attempts=5, base_delay=0.1, max_delay=10.0, report_every=1000):
+        self.source = source
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or max_workers * 4
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.report_every = report_every
+        self.limit = ConcurrencyLimit(initial_workers or max(min_workers, max_workers // 2), min_workers, max_workers)
+        self.stats = FetchStats()
+
+    def backoff(self, attempt):
+        '''Full jitter: a random wait up to the exponential backoff for this attempt'''
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def read(self, key):
+        for attempt in range(self.max_attempts):
+            self.limit.acquire()
+            outcome = 'error'
+            try:
+                body = self.source.read(key)
+            except FetchRetry as e:
+                if e.throttled:
+                    outcome = 'throttled'
+                if attempt == self.max_attempts - 1:
+                    raise
+                self.stats.add(retries=1, throttles=int(e.throttled))
+            else:
+                outcome = 'ok'
+                if body is None:
+                    self.stats.add(reads=1, missing=1)
+                else:
+                    self.stats.add(reads=1, bytes=len(body))
+                return body
+            finally:
+                self.limit.release(outcome)
+            self.backoff(attempt)
+
+    def run_item(self, func, item):
+        result = func(item, self.read)
+        self.stats.add(items=1)
+        return result
+
+    def map(self, func, items, ordered=False):
+        '''Yield func(item, read) for each item as it finishes, or in the order of items if ordered. items can be any iterable and is only consumed as the window frees up.'''
+        items = iter(items)
+        self.stats = FetchStats()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            num_yielded = 0
+
+            def fill():
+                while len(pending) < self.max_in_flight:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    pending.append(executor.submit(self.run_item, func, item))
+
+            try:
+                fill()
+                while len(pending) > 0:
+                    if ordered:
+                        future = pending.popleft()
+                    else:
+                        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                        future = done.pop()
+                        pending.remove(future)
+                    result = future.result()
+                    fill()
+                    num_yielded += 1
+                    if self.report_every and num_yielded % self.report_every == 0:
+                        print(f'Fetched {self.stats.summary(self.limit.limit)}')
+                    yield result
+            finally:
+                # Don't start anything else if the caller stops early or a read fails for good
+                for future in pending:
+                    future.cancel()
+        print(f'Done. Fetched {self.stats.summary(self.limit.limit)}')
+
+    def fetch(self, keys, ordered=False):
+        '''Yield (key, bytes or None) for each key'''
+        return self.map(lambda key, read: (key, read(key)), keys, ordered=ordered)
+
+
+def s3_fetcher(session=None, max_workers=DEFAULT_MAX_WORKERS, local_dir=None, **kwargs):
+    '''BulkFetcher for the project bucket, or for a local copy of it under local_dir'''
+    if local_dir:
+        source = LocalObjectSource(local_dir)
+    else:
+        source = S3ObjectSource(session=session, max_pool_connections=max_workers)
+    return BulkFetcher(source, max_workers=max_workers, **kwargs)
@@ -0,0 +1,222 @@
+import os
+import time
+import hashlib
+import sqlite3
+import datetime
+
+from django.conf import settings
+from django.utils.text import slugify
+
+# Local listings of S3 prefixes. Commands that need every key under web/, ocr/stats/, ocr/hits*/ etc. read them from a SQLite file per bucket and prefix instead of paging through millions of keys each time they run. A prefix is relisted when its listing is older than the max age asked for, and commands that upload or delete keep the listing in step as they go.
+# Only this project's commands keep listings in step. Keys the Lambdas write (ocr/stats/, ocr/json/, ocr/hits*/ etc.) never reach a listing until it is relisted, so a cached listing of those prefixes hides pages from gather_deed_images and hits from gather_image_hits. Deletes always relist first.
+
+LIST_BATCH_SIZE = 10000
+QUERY_CHUNK_SIZE = 900  # Below SQLite's default limit on query parameters
+
+
+def bucket_lister(bucket):
+    '''Lister for a boto3 Bucket resource, yielding (key, size, ETag, last modified) for every key under a prefix'''
+    def list_objects(prefix):
+        for obj in bucket.objects.filter(Prefix=prefix):
+            yield (obj.key, obj.size, obj.e_tag.strip('"'), obj.last_modified.isoformat())
+    return list_objects
+
+
+def filesystem_lister(root_dir):
+    '''Lister that treats a local directory as the bucket, with keys relative to root_dir. An offline stand-in for bucket_lister.'''
+    def list_objects(prefix):
+        # Only walk the deepest directory the prefix names
+        walk_dir = os.path.join(root_dir, *prefix.split('/')[:-1])
+        for dir_path, dir_names, file_names in os.walk(walk_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, root_dir).replace(os.sep, '/')
+                if not key.startswith(prefix):
+                    continue
+                with open(path, 'rb') as f:
+                    etag = hashlib.md5(f.read()).hexdigest()
+                stat = os.stat(path)
+                last_modified = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)
+                yield (key, stat.st_size, etag, last_modified.isoformat())
+    return list_objects
+
+
+def prefix_range(prefix):
+    '''Bounds for an indexed range scan of every key starting with prefix'''
+    return prefix, prefix + chr(0x10FFFF)
+
+
+def chunk_list(input_list, chunk_size=QUERY_CHUNK_SIZE):
+    input_list = list(input_list)
+    for i in range(0, len(input_list), chunk_size):
+        yield input_list[i:i + chunk_size]
+
+
+class S3Inventory:
+    '''Key, size, ETag and last modified for every object under one S3 prefix, kept in SQLite'''
+
+    def __init__(self, prefix, lister, bucket_name='', inventory_dir=None):
+        self.prefix = prefix
+        self.lister = lister
+
+        inventory_dir = os.path.join(inventory_dir or os.path.join(settings.BASE_DIR, 'data', 's3_inventory'), slugify(bucket_name) or 'bucket')
+        os.makedirs(inventory_dir, exist_ok=True)
+        prefix_hash = hashlib.md5(prefix.encode('utf-8')).hexdigest()[:8]
+        self.db_path = os.path.join(inventory_dir, f"{slugify(prefix.replace('/', ' '))}-{prefix_hash}.sqlite")
+
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS listings (
+                prefix TEXT PRIMARY KEY,
+                listed_at REAL
+            );
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def check_prefix(self, prefix):
+        prefix = self.prefix if prefix is None else prefix
+        if not prefix.startswith(self.prefix):
+            raise ValueError(f'{prefix} is outside the inventory prefix {self.prefix}')
+        return prefix
+
+    def listed_at(self, prefix=None):
+        '''When prefix, or a prefix containing it, was last listed, as a timestamp. None if it never has been.'''
+        prefix = self.check_prefix(prefix)
+        listed = [listed_at for listed_prefix, listed_at in self.conn.execute('SELECT prefix, listed_at FROM listings') if prefix.startswith(listed_prefix)]
+        return max(listed) if len(listed) > 0 else None
+
+    def refresh(self, prefix=None):
+        '''Relist prefix (by default the whole inventory prefix) and bring the stored keys in line with it. A narrower prefix, like one batch folder, only relists and replaces keys under it. Returns counts of keys added, changed and removed and the total now stored under prefix.'''
+        prefix = self.check_prefix(prefix)
+        start, end = prefix_range(prefix)
+        listed_at = time.time()
+        print(f'Listing s3 keys under {prefix}...')
+
+        with self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS temp.listed')
+            self.conn.execute('CREATE TEMP TABLE listed (key TEXT PRIMARY KEY, size INTEGER, etag TEXT, last_modified TEXT) WITHOUT ROWID')
+
+            batch = []
+            num_listed = 0
+            for obj in self.lister(prefix):
+                batch.append(obj)
+                if len(batch) >= LIST_BATCH_SIZE:
+                    self.conn.executemany('INSERT OR REPLACE INTO temp.listed VALUES (?, ?, ?, ?)', batch)
+                    num_listed += len(batch)
+                    print(f'Listed {num_listed} keys...')
+                    batch = []
+            self.conn.executemany('INSERT OR REPLACE INTO temp.listed VALUES (?, ?, ?, ?)', batch)
+
+            removed = self.conn.execute('''
+                DELETE FROM objects
+                WHERE key >= ? AND key < ?
+                AND key NOT IN (SELECT key FROM temp.listed)
+            ''', [start, end]).rowcount
+            added = self.conn.execute('''
+                SELECT COUNT(*) FROM temp.listed
+                WHERE key NOT IN (SELECT key FROM objects)
+            ''').fetchone()[0]
+            changed = self.conn.execute('''
+                SELECT COUNT(*) FROM temp.listed AS l
+                JOIN objects AS o ON o.key = l.key
+                WHERE o.etag IS NOT l.etag OR o.size IS NOT l.size
+            ''').fetchone()[0]
+            self.conn.execute('''
+                INSERT INTO objects SELECT * FROM temp.listed WHERE true
+                ON CONFLICT (key) DO UPDATE SET
+                    size = excluded.size, etag = excluded.etag, last_modified = excluded.last_modified
+            ''')
+            self.conn.execute('DROP TABLE temp.listed')
+
+            # A fresh listing of prefix supersedes any narrower listings inside it
+            self.conn.execute('DELETE FROM listings WHERE prefix >= ? AND prefix < ?', [start, end])
+            self.conn.execute('INSERT INTO listings VALUES (?, ?)', [prefix, listed_at])
+
+        total = self.count(prefix)
+        print(f'{total} keys under {prefix}: {added} added, {changed} changed, {removed} removed since last listing.')
+        return {'added': added, 'changed': changed, 'removed': removed, 'total': total}
+
+    def refresh_if_stale(self, max_age=None, prefix=None):
+        '''Relist prefix unless it was listed within the last max_age minutes. With no max_age it is always relisted.'''
+        listed_at = self.listed_at(prefix)
+        if max_age and listed_at is not None and time.time() - listed_at < max_age * 60:
+            print(f'Using s3 key listing of {self.check_prefix(prefix)} from {datetime.datetime.fromtimestamp(listed_at):%Y-%m-%d %H:%M}.')
+            return None
+        return self.refresh(prefix)
+
+    def keys(self, prefix=None, key_filter=None):
+        '''Every key under prefix in key order, optionally only those matching a compiled regex'''
+        start, end = prefix_range(self.check_prefix(prefix))
+        keys = [row[0] for row in self.conn.execute('SELECT key FROM objects WHERE key >= ? AND key < ? ORDER BY key', [start, end])]
+        if key_filter is not None:
+            return [k for k in keys if key_filter.match(k)]
+        return keys
+
+    def objects(self, prefix=None):
+        '''dicts of key, size, etag and last_modified for every key under prefix'''
+        start, end = prefix_range(self.check_prefix(prefix))
+        cursor = self.conn.execute('SELECT key, size, etag, last_modified FROM objects WHERE key >= ? AND key < ? ORDER BY key', [start, end])
+        return [{'key': key, 'size': size, 'etag': etag, 'last_modified': last_modified} for key, size, etag, last_modified in cursor]
+
+    def count(self, prefix=None):
+        start, end = prefix_range(self.check_prefix(prefix))
+        return self.conn.execute('SELECT COUNT(*) FROM objects WHERE key >= ? AND key < ?', [start, end]).fetchone()[0]
+
+    def existing(self, keys):
+        '''The subset of keys that are in the inventory'''
+        found = set()
+        for chunk in chunk_list(keys):
+            found.update([row[0] for row in self.conn.execute(
+                f"SELECT key FROM objects WHERE key IN ({', '.join(['?'] * len(chunk))})", chunk
+            )])
+        return found
+
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM objects WHERE key = ?', [key]).fetchone() is not None
+
+    def record(self, objs):
+        '''Add or update (key, size, ETag, last modified) tuples after uploading them. ETag and last modified can be None if unknown; the next listing fills them in.'''
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)', [tuple(o) for o in objs])
+
+    def forget(self, keys):
+        '''Remove keys after deleting them from S3'''
+        with self.conn:
+            for chunk in chunk_list(keys):
+                self.conn.execute(f"DELETE FROM objects WHERE key IN ({', '.join(['?'] * len(chunk))})", chunk)
+
+
+def get_inventory(bucket, prefix, max_age=None):
+    '''S3Inventory of prefix in a boto3 Bucket, relisted first unless it was listed within the last max_age minutes'''
+    inventory = S3Inventory(prefix, bucket_lister(bucket), bucket.name)
+    inventory.refresh_if_stale(max_age)
+    return inventory
+
+
+def add_inventory_argument(parser):
+    parser.add_argument('--inventory-age', type=float, default=getattr(settings, 'S3_INVENTORY_MAX_AGE', None),
+                        help='Reuse the local listing of s3 keys if it is less than this many minutes old, rather than listing the bucket again. Default = S3_INVENTORY_MAX_AGE setting, or always relist. Don\'t use this while the Lambdas are writing to the prefixes being listed (ocr/stats, ocr/json, ocr/hits*), since keys they wrote after the last listing are missed')
+
+
+def delete_prefix(bucket, prefix, key_filter=None, batch_size=1000):
+    '''Delete every key under prefix in a boto3 Bucket, or only those matching key_filter, in batches of delete_objects calls, and drop them from the inventory. The prefix is always relisted first, so keys the Lambdas wrote since the last listing are deleted too. Returns the number of keys deleted.'''
+    inventory = get_inventory(bucket, prefix)
+    keys_to_delete = inventory.keys(key_filter=key_filter)
+
+    print(f'Deleting {len(keys_to_delete)} keys ...')
+    for chunk in chunk_list(keys_to_delete, batch_size):
+        bucket.meta.client.delete_objects(
+            Bucket=bucket.name,
+            Delete={'Objects': [{'Key': key} for key in chunk]}
+        )
+        inventory.forget(chunk)
+    return len(keys_to_delete)
@@ -0,0 +1,267 @@
+import os
+import csv
+import json
+import string
+from multiprocessing import Pool
+
+from django.conf import settings
+
+PUNCTUATION = string.punctuation + '“”‘’'
+
+
+def auto_max_edits(term):
+    '''Same as Elasticsearch's "auto" fuzziness: exact for 1-2 characters, 1 edit for 3-5, 2 edits for longer terms'''
+    term_len = len(term.replace(' ', ''))
+    if term_len <= 2:
+        return 0
+    if term_len <= 5:
+        return 1
+    return 2
+
+
+def parse_term_config(terms):
+    '''Terms can be plain strings, which get auto_max_edits, or dicts like {"term": "jew", "max_edits": 0, "label": "jew (exact)"}. The label is the key used in the hits json and defaults to the term itself.'''
+    parsed = []
+    for t in terms:
+        if isinstance(t, str):
+            t = {'term': t}
+        term = normalize_text(t['term'])
+        parsed.append({
+            'label': t.get('label', t['term']),
+            'term': term,
+            'max_edits': t.get('max_edits', auto_max_edits(term)),
+        })
+    return parsed
+
+
+def load_term_config(workflow=None, terms_path=None):
+    '''Search terms from a file (a JSON list, or one term per line), the workflow's "term_search_terms" config, or settings.TERM_SEARCH_TERMS, in that order'''
+    if terms_path:
+        with open(terms_path, 'r') as terms_file:
+            raw = terms_file.read()
+        try:
+            terms = json.loads(raw)
+        except json.decoder.JSONDecodeError:
+            terms = [line.strip() for line in raw.splitlines() if line.strip()]
+    else:
+        config = settings.ZOONIVERSE_QUESTION_LOOKUP.get(workflow.workflow_name, {}) if workflow else {}
+        terms = config.get('term_search_terms', getattr(settings, 'TERM_SEARCH_TERMS', []))
+    return parse_term_config(terms)
+
+
+def normalize_text(text):
+    '''Lowercase, and strip punctuation from the ends of each word, so "Caucasian," still matches exactly'''
+    words = [w.strip(PUNCTUATION) for w in text.lower().split()]
+    return ' '.join([w for w in words if w])
+
+
+def bounded_edit_distance(a, b, max_edits):
+    '''Levenshtein distance between a and b, or max_edits + 1 as soon as it's clear the distance is larger. Only the diagonal band within max_edits is computed.'''
+    too_far = max_edits + 1
+    if abs(len(a) - len(b)) > max_edits:
+        return too_far
+    previous = [j if j <= max_edits else too_far for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [i if i <= max_edits else too_far] + [too_far] * len(b)
+        for j in range(max(1, i - max_edits), min(len(b), i + max_edits) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]), too_far)
+        if min(current) > max_edits:
+            return too_far
+        previous = current
+    return previous[-1]
+
+
+class FuzzyTermMatcher:
+    '''Finds which OCR lines contain each search term within its max_edits, comparing the term against runs of whole words on the line.
+
+    Every term is split into max_edits + 1 pieces. A line within max_edits of the term must contain at least one piece exactly, so that cheap substring check rules out nearly every line before any edit distances are computed.'''
+
+    def __init__(self, terms):
+        self.terms = []
+        for t in terms:
+            max_edits = min(t['max_edits'], max(len(t['term']) - 1, 0))
+            num_pieces = max_edits + 1
+            piece_len = len(t['term']) // num_pieces
+            pieces = [t['term'][i * piece_len:(i + 1) * piece_len if i < num_pieces - 1 else None] for i in range(num_pieces)]
+            # Every piece has to be kept, even one that's only a space, or a line could miss all the others and still be within max_edits
+            self.terms.append({
+                **t,
+                'max_edits': max_edits,
+                'num_words': len(t['term'].split(' ')),
+                'pieces': pieces,
+            })
+
+    def line_matches(self, term, words):
+        # A split or merged word in the OCR costs one edit, so also check runs one word longer or shorter
+        for window in set([term['num_words'] - 1, term['num_words'], term['num_words'] + 1]):
+            if window < 1:
+                continue
+            for start in range(0, len(words) - window + 1):
+                candidate = ' '.join(words[start:start + window])
+                if not any([p in candidate for p in term['pieces']]):
+                    continue
+                if bounded_edit_distance(term['term'], candidate, term['max_edits']) <= term['max_edits']:
+                    return True
+        return False
+
+    def search_lines(self, lines):
+        '''Returns {term label: [line numbers]} for every term found, line numbers being indexes into lines'''
+        normalized = [normalize_text(line) for line in lines]
+        page_text = '\n'.join(normalized)
+
+        hits = {}
+        for term in self.terms:
+            if not any([p in page_text for p in term['pieces']]):
+                continue
+            line_nums = []
+            for line_num, line in enumerate(normalized):
+                if any([p in line for p in term['pieces']]) and self.line_matches(term, line.split(' ')):
+                    line_nums.append(line_num)
+            if len(line_nums) > 0:
+                hits[term['label']] = line_nums
+        return hits
+
+
+def ocr_lines(ocr_json):
+    return [block['Text'] for block in ocr_json['Blocks'] if block['BlockType'] == 'LINE']
+
+
+def hits_key(page_ocr_json):
+    return page_ocr_json.replace('ocr/json/', 'ocr/hits_fuzzy/')
+
+
+class LocalOcrStore:
+    '''Reads and writes keys under a local directory laid out like the s3 bucket, e.g. {root}/ocr/json/{workflow}/...json'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, key):
+        with open(os.path.join(self.root, key), 'rb') as infile:
+            return infile.read()
+
+    def write(self, key, body):
+        out_path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path, 'w') as outfile:
+            outfile.write(body)
+
+
+class S3OcrStore:
+    '''Same interface as LocalOcrStore for the project bucket. The boto3 client is created in each worker process.'''
+
+    def __init__(self):
+        self.bucket = settings.AWS_STORAGE_BUCKET_NAME
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            import boto3
+            self.client = boto3.Session(
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_S3_REGION_NAME
+            ).client('s3')
+        return self.client
+
+    def read(self, key):
+        return self.get_client().get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def write(self, key, body):
+        self.get_client().put_object(Bucket=self.bucket, Key=key, Body=body, ContentType='application/json')
+
+    def __getstate__(self):
+        return {'bucket': self.bucket, 'client': None}
+
+
+_worker = {}
+
+
+def init_search_worker(terms, store, write_hits):
+    _worker['matcher'] = FuzzyTermMatcher(terms)
+    _worker['store'] = store
+    _worker['write_hits'] = write_hits
+
+
+def search_page(deedpage_obj):
+    '''Search one DeedPage's OCR json. Returns the same result fields the term search Lambda did, plus the matched lines for context, without fetching anything again.'''
+    matcher = _worker['matcher']
+    store = _worker['store']
+    result = {
+        'deedpage': deedpage_obj,
+        'bool_hit': False,
+        'match_file': '',
+        'match_context': [],
+        'status': 'Complete',
+    }
+    try:
+        ocr_json = json.loads(store.read(deedpage_obj['page_ocr_json']).decode('utf-8'))
+    except Exception as e:
+        print(f"Couldn't read {deedpage_obj['page_ocr_json']}: {e}")
+        result['status'] = 'Error'
+        return result
+
+    lines = ocr_lines(ocr_json)
+    hits = matcher.search_lines(lines)
+    if len(hits) > 0:
+        result['bool_hit'] = True
+        result['match_context'] = [
+            {'term': term, 'line_nums': line_nums, 'lines': [lines[n] for n in line_nums]} for term, line_nums in hits.items()
+        ]
+        if _worker['write_hits']:
+            result['match_file'] = hits_key(deedpage_obj['page_ocr_json'])
+            store.write(result['match_file'], json.dumps({
+                **hits,
+                'workflow': deedpage_obj['workflow__slug'],
+                'lookup': deedpage_obj['s3_lookup'],
+                'uuid': str(deedpage_obj['public_uuid']),
+            }))
+    return result
+
+
+def run_term_search(deedpages, terms, store, workers=None, write_hits=True):
+    '''Search many DeedPages across a process pool, yielding search_page results as they finish'''
+    with Pool(processes=workers, initializer=init_search_worker, initargs=(terms, store, write_hits)) as pool:
+        for result in pool.imap_unordered(search_page, deedpages, chunksize=50):
+            yield result
+
+
+def result_csv_row(result):
+    '''A search_page result as a row of the term search test/update CSVs'''
+    deedpage_obj = result['deedpage']
+    match_context = ''
+    if len(result['match_context']) > 0:
+        match_context = '"' + json.dumps(result['match_context']).replace('"', "'") + '"'
+    return {
+        'workflow': deedpage_obj['workflow__slug'],
+        's3_lookup': deedpage_obj['s3_lookup'],
+        'page_ocr_text': deedpage_obj['page_ocr_text'],
+        'bool_basic_match': str(deedpage_obj['bool_match']),
+        'bool_fuzzy_match': str(result['bool_hit']) if result['status'] == 'Complete' else '',
+        'fuzzy_match_json': result['match_file'],
+        'test_status': result['status'],
+        'match_context': match_context,
+    }
+
+
+def run_local_search(dps, terms, result_path, ocr_dir=None, workers=None, write_hits=True):
+    '''Search dps for terms, reading OCR json from ocr_dir or s3, and append a row per page to the CSV at result_path. Returns the number of pages searched.'''
+    if ocr_dir:
+        store = LocalOcrStore(ocr_dir)
+    else:
+        store = S3OcrStore()
+
+    print(f'Searching {len(dps)} pages for {len(terms)} terms ...')
+    num_done = 0
+    num_hits = 0
+    with open(result_path, 'a') as done_manifest:
+        writer = csv.writer(done_manifest)
+        for result in run_term_search(dps, terms, store, workers, write_hits=write_hits):
+            writer.writerow(result_csv_row(result).values())
+            num_done += 1
+            if result['bool_hit']:
+                num_hits += 1
+            if num_done % 1000 == 0:
+                print(f'{num_done} pages searched, {num_hits} hits ...')
+    print(f'{num_done} pages searched, {num_hits} hits.')
+    return num_done
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.parcel.models import Parcel
+from apps.parcel.utils.export_utils import get_parcel_covenant_values, diff_parcel_covenant_values
+from apps.zoon.utils.zooniverse_config import get_workflow_obj
+
+
+class Command(BaseCommand):
+    '''Time the original annotated Parcel.covenant_objects queryset against the single-pass query used by save_flat_covenanted_parcels, and check that both return the same values'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workflow', type=str,
+                            help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+        parser.add_argument('-r', '--repeat', type=int, default=3,
+                            help='Number of timed runs of each method. Default = 3')
+        parser.add_argument('-l', '--limit', type=int, default=None,
+                            help='Only use the first N covenanted parcels in the workflow')
+
+    def time_method(self, parcels, single_pass, repeat):
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            rows = get_parcel_covenant_values(parcels, single_pass)
+            timings.append(time.perf_counter() - start)
+        return rows, timings
+
+    def handle(self, *args, **kwargs):
+        workflow_name = kwargs['workflow']
+        if not workflow_name:
+            print('Missing workflow name. Please specify with --workflow.')
+            return False
+
+        workflow = get_workflow_obj(workflow_name)
+        parcels = Parcel.objects.filter(workflow=workflow, bool_covenant=True).only('pk')
+        if kwargs['limit']:
+            parcels = Parcel.objects.filter(pk__in=list(parcels.order_by('pk').values_list('pk', flat=True)[:kwargs['limit']]))
+        print(f'Benchmarking {parcels.count()} covenanted parcels, {kwargs["repeat"]} runs each...')
+
+        results = {}
+        for label, single_pass in [('annotated', False), ('single pass', True)]:
+            rows, timings = self.time_method(parcels, single_pass, kwargs['repeat'])
+            results[label] = rows
+            print(f'{label}: {len(rows)} rows, best {min(timings):.2f}s, mean {sum(timings) / len(timings):.2f}s')
+
+        diffs = diff_parcel_covenant_values(results['annotated'], results['single pass'])
+        if len(diffs) == 0:
+            print('Both methods returned identical values.')
+        else:
+            print(f'{len(diffs)} differences found. First 20:')
+            for diff in diffs[:20]:
+                print(diff)
@@ -1,14 +1,13 @@
 import os
 import datetime
 import tempfile
-import pandas as pd
 
 from django.core.management.base import BaseCommand
 from django.core.files.base import File
 from django.conf import settings
 
 from apps.parcel.models import CSVExport
-from apps.parcel.utils.export_utils import build_gdf
+from apps.parcel.utils.stream_export import write_covenants_csv
 from apps.zoon.models import MATCH_TYPE_OPTIONS
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
@@ -21,24 +20,28 @@ class Command(BaseCommand):
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
         parser.add_argument('-l', '--local', action='store_true',
                             help='Save to local csv in "main_exports" dir, rather than Django object/S3')
+        parser.add_argument('-c', '--chunksize', type=int, default=5000,
+                            help='Number of rows to read from the database at a time. Default = 5000')
 
-    def save_csv_local(self, df, version_slug):
+    def save_csv_local(self, workflow, version_slug, chunksize=5000):
         out_csv = os.path.join(
             settings.BASE_DIR, 'data', 'main_exports', f"{version_slug}.csv")
-        df.to_csv(out_csv, index=False)
+        with open(out_csv, 'w', newline='') as out_file:
+            write_covenants_csv(workflow, out_file, chunksize=chunksize)
 
         return out_csv
 
-    def save_csv_model(self, df, version_slug, workflow, created_at):
-        # Convert to shapefile and serve it to the user
+    def save_csv_model(self, workflow, version_slug, created_at, chunksize=5000):
+        # Stream the csv to a temp file, then upload it with the export object
         with tempfile.TemporaryDirectory() as tmp_dir:
             tmp_file_path = os.path.join(tmp_dir, f'{version_slug}.csv')
-            df.to_csv(tmp_file_path, index=False)
+            with open(tmp_file_path, 'w', newline='') as out_file:
+                row_count = write_covenants_csv(workflow, out_file, chunksize=chunksize)
 
             csv_export_obj = CSVExport(
                 workflow=workflow,
-                covenant_count=df.shape[0],
-                created_at = created_at
+                covenant_count=row_count,
+                created_at=created_at
             )
 
             # Using File
@@ -54,17 +57,12 @@ class Command(BaseCommand):
         else:
             workflow = get_workflow_obj(workflow_name)
 
-            covenants_df = build_gdf(workflow)
-            covenants_df.drop(columns=['geometry'], inplace=True)
-
-            print(covenants_df)
-
             now = datetime.datetime.now()
             timestamp = now.strftime('%Y%m%d_%H%M')
             version_slug = f"{workflow.slug}_covenants_{timestamp}"
 
             if kwargs['local']:
-                csv_local = self.save_csv_local(covenants_df, version_slug)
+                csv_local = self.save_csv_local(workflow, version_slug, kwargs['chunksize'])
             else:
-                # Save to zipped shp in Django storages/model
-                csv_export_obj = self.save_csv_model(covenants_df, version_slug, workflow, now)
+                # Save to csv in Django storages/model
+                csv_export_obj = self.save_csv_model(workflow, version_slug, now, kwargs['chunksize'])
@@ -1,16 +1,13 @@
 import os
-import json
 import datetime
 import tempfile
-import geopandas as gpd
 
 from django.core.management.base import BaseCommand
 from django.core.files.base import File
 from django.conf import settings
 
 from apps.parcel.models import GeoJSONExport
-from apps.parcel.utils.export_utils import build_gdf
-from apps.zoon.models import MATCH_TYPE_OPTIONS
+from apps.parcel.utils.stream_export import write_covenants_geojson
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 
@@ -22,24 +19,27 @@ class Command(BaseCommand):
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
         parser.add_argument('-l', '--local', action='store_true',
                             help='Save to local geojson in "main_exports" dir, rather than Django object/S3')
+        parser.add_argument('-c', '--chunksize', type=int, default=5000,
+                            help='Number of features to read from the database at a time. Default = 5000')
 
-    def save_geojson_local(self, gdf, version_slug, schema=None):
+    def save_geojson_local(self, workflow, version_slug, chunksize=5000):
         out_geojson = os.path.join(
             settings.BASE_DIR, 'data', 'main_exports', f"{version_slug}.geojson")
-        gdf.to_file(out_geojson, index=False, schema=schema)
+        with open(out_geojson, 'w') as out_file:
+            write_covenants_geojson(workflow, out_file, version_slug, chunksize=chunksize)
 
         return out_geojson
 
-    def save_geojson_model(self, gdf, version_slug, workflow, created_at, schema=None):
-        # export to .geojson temp file and serve it to the user
+    def save_geojson_model(self, workflow, version_slug, created_at, chunksize=5000):
+        # Stream the geojson to a temp file, then upload it with the export object
         with tempfile.TemporaryDirectory() as tmp_dir:
             tmp_file_path = os.path.join(tmp_dir, f'{version_slug}.geojson')
-            # df.to_geojson(tmp_file_path, index=False)
-            gdf.to_file(tmp_file_path, index=False, schema=schema)
+            with open(tmp_file_path, 'w') as out_file:
+                feature_count = write_covenants_geojson(workflow, out_file, version_slug, chunksize=chunksize)
 
             geojson_export_obj = GeoJSONExport(
                 workflow=workflow,
-                covenant_count=gdf.shape[0],
+                covenant_count=feature_count,
                 created_at = created_at
             )
 
@@ -56,27 +56,12 @@ class Command(BaseCommand):
         else:
             workflow = get_workflow_obj(workflow_name)
 
-            covenants_gdf = build_gdf(workflow)
-
-            try:
-                import pyogrio
-                schema = None
-                # Pyogrio doesn't allow schemas
-            except:
-                # Shapefiles don't like datetime format, so if fiona, specify date in manual schema
-                schema = gpd.io.file.infer_schema(covenants_gdf)
-                schema['properties']['deed_date'] = 'date'
-                schema['properties']['dt_updated'] = 'date'
-                schema['properties']['zn_dt_ret'] = 'date'
-
-            print(covenants_gdf)
-
             now = datetime.datetime.now()
             timestamp = now.strftime('%Y%m%d_%H%M')
             version_slug = f"{workflow.slug}_covenants_{timestamp}"
 
             if kwargs['local']:
-                geojson_local = self.save_geojson_local(covenants_gdf, version_slug, schema)
+                geojson_local = self.save_geojson_local(workflow, version_slug, kwargs['chunksize'])
             else:
                 # Save to geojson in Django storages/model
-                geojson_export_obj = self.save_geojson_model(covenants_gdf, version_slug, workflow, now, schema)
+                geojson_export_obj = self.save_geojson_model(workflow, version_slug, now, kwargs['chunksize'])
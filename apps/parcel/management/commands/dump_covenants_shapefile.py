@@ -1,8 +1,9 @@
 import os
+import glob
+import shutil
 import datetime
 import tempfile
 import subprocess
-import geopandas as gpd
 from zipfile import ZipFile
 
 from django.core.management.base import BaseCommand
@@ -10,7 +11,11 @@ from django.core.files.base import File
 from django.conf import settings
 
 from apps.parcel.models import ShpExport, PMTilesExport
-from apps.parcel.utils.export_utils import build_gdf
+from apps.parcel.utils.stream_export import write_covenants_geojson, write_covenants_shapefile
+from apps.parcel.utils.pmtiles_export import (
+    covenant_manifest, write_manifest, read_manifest, write_python_pmtiles, update_pmtiles,
+    PYTHON_TILER_MIN_ZOOM, PYTHON_TILER_MAX_ZOOM, INCREMENTAL_MIN_ZOOM
+)
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 
@@ -36,8 +41,29 @@ class Command(BaseCommand):
             action="store_true",
             help="Export to PMTiles format instead of shapefile",
         )
+        parser.add_argument(
+            "-c",
+            "--chunksize",
+            type=int,
+            default=5000,
+            help="Number of features to read from the database at a time. Default = 5000",
+        )
+        parser.add_argument(
+            "-i",
+            "--incremental",
+            action="store_true",
+            help=f"With --pmtiles, only rebuild tiles touched by covenants that changed since the last PMTiles export, and copy the rest from it. Tiles below zoom {INCREMENTAL_MIN_ZOOM} are always copied, so they only change on a full export",
+        )
+        parser.add_argument(
+            "-t",
+            "--tiler",
+            type=str,
+            choices=["auto", "tippecanoe", "python"],
+            default="auto",
+            help="Tiler for full PMTiles builds. auto = tippecanoe if installed, otherwise the built-in Python tiler",
+        )
 
-    def save_shp_local(self, gdf, version_slug, schema=None):
+    def save_shp_local(self, workflow, version_slug, chunksize=5000):
         os.makedirs(
             os.path.join(settings.BASE_DIR, "data", "main_exports", version_slug),
             exist_ok=True,
@@ -50,18 +76,14 @@ class Command(BaseCommand):
             f"{version_slug}.shp",
         )
 
-        gdf.to_file(out_shp, index=False, schema=schema)
+        write_covenants_shapefile(workflow, out_shp, chunksize)
 
         return out_shp
 
-    def convert_to_pmtiles(self, gdf, geojson_path, pmtiles_path, version_slug):
-        """Convert GeoDataFrame to PMTiles format using tippecanoe"""
-        # Ensure GeoDataFrame has proper CRS (EPSG:4326 required for PMTiles)
-        if gdf.crs is None or gdf.crs.to_epsg() != 4326:
-            gdf = gdf.to_crs(epsg=4326)
-
-        # Export to GeoJSON first
-        gdf.to_file(geojson_path, driver="GeoJSON")
+    def convert_to_pmtiles(self, workflow, geojson_path, pmtiles_path, version_slug, chunksize=5000):
+        """Stream covenants to GeoJSON (already EPSG:4326, as PMTiles requires), then convert to PMTiles format using tippecanoe. Returns number of features."""
+        with open(geojson_path, "w") as out_file:
+            feature_count = write_covenants_geojson(workflow, out_file, version_slug, chunksize)
 
         try:
             subprocess.run(
@@ -86,6 +108,7 @@ class Command(BaseCommand):
             )
 
             print(f"PMTiles created successfully: {pmtiles_path}")
+            return feature_count
 
         except subprocess.CalledProcessError as e:
             print(f"Error creating PMTiles: {e}")
@@ -98,21 +121,59 @@ class Command(BaseCommand):
             print("  Linux: https://github.com/felt/tippecanoe")
             raise
 
-    def save_pmtiles_local(self, gdf, version_slug):
-        """Export GeoDataFrame to PMTiles format and save locally"""
+    def build_pmtiles(self, workflow, pmtiles_path, manifest_path, version_slug, base=None, tiler="auto", chunksize=5000):
+        """Build a PMTiles archive and the manifest the next incremental export will diff against. base is an open (pmtiles file, manifest file) pair to update incrementally. Returns feature count and, for incremental builds, number of changed covenants."""
+        manifest = covenant_manifest(workflow)
+        changed_count = None
+
+        if base:
+            base_pmtiles, base_manifest = base
+            with open(pmtiles_path, "wb") as out_file:
+                counts = update_pmtiles(
+                    workflow, base_pmtiles, read_manifest(base_manifest), manifest, out_file, chunksize
+                )
+            print(
+                f"{counts['rebuilt_tiles']} tiles rebuilt at zoom {counts['rebuild_min_zoom']} and up, {counts['removed_tiles']} removed, {counts['total_tiles']} total."
+            )
+            layer_name, min_zoom, max_zoom = counts["layer"], counts["min_zoom"], counts["max_zoom"]
+            changed_count = counts["changed_features"]
+        elif tiler == "tippecanoe" or (tiler == "auto" and shutil.which("tippecanoe")):
+            geojson_path = f"{os.path.splitext(pmtiles_path)[0]}.geojson"
+            self.convert_to_pmtiles(workflow, geojson_path, pmtiles_path, version_slug, chunksize)
+            if os.path.exists(geojson_path):
+                os.remove(geojson_path)
+            layer_name, min_zoom, max_zoom = version_slug, 0, 18
+        else:
+            print("Building PMTiles with the Python tiler...")
+            with open(pmtiles_path, "wb") as out_file:
+                tile_count = write_python_pmtiles(workflow, out_file, version_slug, manifest, chunksize=chunksize)
+            print(f"PMTiles created successfully: {pmtiles_path} ({tile_count} tiles)")
+            layer_name, min_zoom, max_zoom = version_slug, PYTHON_TILER_MIN_ZOOM, PYTHON_TILER_MAX_ZOOM
+
+        with open(manifest_path, "wb") as out_file:
+            write_manifest(manifest, out_file, layer_name, min_zoom, max_zoom)
+
+        return len(manifest), changed_count
+
+    def find_local_base(self, workflow, version_slug):
+        """Paths of the newest local PMTiles export for this workflow that has a manifest next to it"""
+        pattern = os.path.join(
+            settings.BASE_DIR, "data", "main_exports", f"{workflow.slug}_covenants_*", "*.manifest.json.gz"
+        )
+        for manifest_path in sorted(glob.glob(pattern), reverse=True):
+            pmtiles_path = manifest_path.replace(".manifest.json.gz", ".pmtiles")
+            if version_slug not in manifest_path and os.path.exists(pmtiles_path):
+                return pmtiles_path, manifest_path
+        return None
+
+    def save_pmtiles_local(self, workflow, version_slug, incremental=False, tiler="auto", chunksize=5000):
+        """Export covenants to PMTiles format and save locally"""
 
         os.makedirs(
             os.path.join(settings.BASE_DIR, "data", "main_exports", version_slug),
             exist_ok=True,
         )
 
-        geojson_path = os.path.join(
-            settings.BASE_DIR,
-            "data",
-            "main_exports",
-            version_slug,
-            f"{version_slug}.geojson",
-        )
         out_pmtiles = os.path.join(
             settings.BASE_DIR,
             "data",
@@ -120,24 +181,29 @@ class Command(BaseCommand):
             version_slug,
             f"{version_slug}.pmtiles",
         )
+        out_manifest = out_pmtiles.replace(".pmtiles", ".manifest.json.gz")
 
-        self.convert_to_pmtiles(gdf, geojson_path, out_pmtiles, version_slug)
+        base_paths = self.find_local_base(workflow, version_slug) if incremental else None
+        if incremental and not base_paths:
+            print("No earlier PMTiles export with a manifest found, building all tiles.")
 
-        # Clean up temporary GeoJSON
-        if os.path.exists(geojson_path):
-            os.remove(geojson_path)
+        if base_paths:
+            print(f"Updating tiles from {base_paths[0]}")
+            with open(base_paths[0], "rb") as base_pmtiles, open(base_paths[1], "rb") as base_manifest:
+                self.build_pmtiles(
+                    workflow, out_pmtiles, out_manifest, version_slug, (base_pmtiles, base_manifest), tiler, chunksize
+                )
+        else:
+            self.build_pmtiles(workflow, out_pmtiles, out_manifest, version_slug, None, tiler, chunksize)
 
         return out_pmtiles
 
-    def generate_zip_tmp(self, gdf, version_slug, workflow, created_at, schema=None):
+    def generate_zip_tmp(self, workflow, version_slug, created_at, chunksize=5000):
         # Convert to shapefile and serve it to the user
         with tempfile.TemporaryDirectory() as tmp_dir:
-            # Export gdf as shapefile
-            gdf.to_file(
-                os.path.join(tmp_dir, f"{version_slug}.shp"),
-                index=False,
-                driver="ESRI Shapefile",
-                schema=schema,
+            # Export covenants as shapefile
+            feature_count = write_covenants_shapefile(
+                workflow, os.path.join(tmp_dir, f"{version_slug}.shp"), chunksize
             )
 
             # Zip the exported files to a single file
@@ -152,7 +218,7 @@ class Command(BaseCommand):
             tmp_zip_obj.close()
 
             shp_export_obj = ShpExport(
-                workflow=workflow, covenant_count=gdf.shape[0], created_at=created_at
+                workflow=workflow, covenant_count=feature_count, created_at=created_at
             )
 
             # Using File
@@ -161,22 +227,47 @@ class Command(BaseCommand):
             shp_export_obj.save()
             return shp_export_obj
 
-    def generate_pmtiles_tmp(self, gdf, version_slug, workflow, created_at):
-        """Convert GeoDataFrame to PMTiles and save to S3"""
+    def generate_pmtiles_tmp(self, workflow, version_slug, created_at, incremental=False, tiler="auto", chunksize=5000):
+        """Export covenants to PMTiles and save to S3"""
+        base_export = None
+        if incremental:
+            base_export = PMTilesExport.objects.filter(
+                workflow=workflow, manifest__isnull=False
+            ).exclude(manifest="").first()
+            if not base_export:
+                print("No earlier PMTiles export with a manifest found, building all tiles.")
+
         with tempfile.TemporaryDirectory() as tmp_dir:
-            geojson_path = os.path.join(tmp_dir, f"{version_slug}.geojson")
             pmtiles_path = os.path.join(tmp_dir, f"{version_slug}.pmtiles")
-
-            # Convert to PMTiles using shared method
-            self.convert_to_pmtiles(gdf, geojson_path, pmtiles_path, version_slug)
+            manifest_path = os.path.join(tmp_dir, f"{version_slug}.manifest.json.gz")
+
+            if base_export:
+                print(f"Updating tiles from {base_export.pmtiles.name}")
+                base_pmtiles_path = os.path.join(tmp_dir, "base.pmtiles")
+                with base_export.pmtiles.open("rb") as f, open(base_pmtiles_path, "wb") as out_file:
+                    shutil.copyfileobj(f, out_file)
+                with open(base_pmtiles_path, "rb") as base_pmtiles, base_export.manifest.open("rb") as base_manifest:
+                    feature_count, changed_count = self.build_pmtiles(
+                        workflow, pmtiles_path, manifest_path, version_slug, (base_pmtiles, base_manifest), tiler, chunksize
+                    )
+            else:
+                feature_count, changed_count = self.build_pmtiles(
+                    workflow, pmtiles_path, manifest_path, version_slug, None, tiler, chunksize
+                )
 
             # Create PMTilesExport object and save to S3
             pmtiles_export_obj = PMTilesExport(
-                workflow=workflow, covenant_count=gdf.shape[0], created_at=created_at
+                workflow=workflow,
+                covenant_count=feature_count,
+                created_at=created_at,
+                base_export=base_export,
+                changed_count=changed_count,
             )
 
             with open(pmtiles_path, "rb") as f:
-                pmtiles_export_obj.pmtiles.save(f"{version_slug}.pmtiles", File(f))
+                pmtiles_export_obj.pmtiles.save(f"{version_slug}.pmtiles", File(f), save=False)
+            with open(manifest_path, "rb") as f:
+                pmtiles_export_obj.manifest.save(f"{version_slug}.manifest.json.gz", File(f), save=False)
             pmtiles_export_obj.save()
             return pmtiles_export_obj
 
@@ -187,10 +278,6 @@ class Command(BaseCommand):
         else:
             workflow = get_workflow_obj(workflow_name)
 
-            covenants_geo_df = build_gdf(workflow)
-
-            print(covenants_geo_df)
-
             now = datetime.datetime.now()
             timestamp = now.strftime("%Y%m%d_%H%M")
             version_slug = f"{workflow.slug}_covenants_{timestamp}"
@@ -198,40 +285,22 @@ class Command(BaseCommand):
             if kwargs["pmtiles"]:
                 # Export to PMTiles format
                 if kwargs["local"]:
-                    pmtiles_path = self.save_pmtiles_local(covenants_geo_df, version_slug)
+                    pmtiles_path = self.save_pmtiles_local(
+                        workflow, version_slug, kwargs["incremental"], kwargs["tiler"], kwargs["chunksize"]
+                    )
                     print(f"PMTiles saved to: {pmtiles_path}")
                 else:
                     pmtiles_export_obj = self.generate_pmtiles_tmp(
-                        covenants_geo_df, version_slug, workflow, now
+                        workflow, version_slug, now, kwargs["incremental"], kwargs["tiler"], kwargs["chunksize"]
                     )
                     print(f"PMTiles export object created: {pmtiles_export_obj}")
             elif kwargs["local"]:
                 # Export to shapefile locally
-                try:
-                    schema = None
-                    # Pyogrio doesn't allow schemas
-                except:
-                    # Shapefiles don't like datetime format, so if fiona, specify date in manual schema
-                    schema = gpd.io.file.infer_schema(covenants_geo_df)
-                    schema["properties"]["deed_date"] = "date"
-                    schema["properties"]["dt_updated"] = "date"
-                    schema["properties"]["zn_dt_ret"] = "date"
-
-                shp_local = self.save_shp_local(covenants_geo_df, version_slug, schema)
+                shp_local = self.save_shp_local(workflow, version_slug, kwargs["chunksize"])
                 print(f"Shapefile saved to: {shp_local}")
             else:
                 # Save to zipped shp in Django storages/model
-                try:
-                    schema = None
-                    # Pyogrio doesn't allow schemas
-                except:
-                    # Shapefiles don't like datetime format, so if fiona, specify date in manual schema
-                    schema = gpd.io.file.infer_schema(covenants_geo_df)
-                    schema["properties"]["deed_date"] = "date"
-                    schema["properties"]["dt_updated"] = "date"
-                    schema["properties"]["zn_dt_ret"] = "date"
-
                 shp_export_obj = self.generate_zip_tmp(
-                    covenants_geo_df, version_slug, workflow, now, schema
+                    workflow, version_slug, now, kwargs["chunksize"]
                 )
                 print(f"Shapefile export object created: {shp_export_obj}")
@@ -9,10 +9,8 @@ from django.core.management.base import BaseCommand
 from django.core import management
 from django.conf import settings
 
-from apps.parcel.models import Parcel, ParcelJoinCandidate
 from apps.plat.models import Plat, PlatAlternateName
-from apps.parcel.utils.parcel_utils import standardize_addition, get_all_parcel_options
-from apps.parcel.utils.gis_utils import save_multipoly_instances
+from apps.parcel.utils.parcel_loader import load_parcel_shp_parallel
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 
@@ -25,6 +23,12 @@ class Command(BaseCommand):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
 
+        parser.add_argument('-c', '--chunksize', type=int, default=50000,
+                            help='Number of shapefile features to read and load at a time')
+
+        parser.add_argument('-j', '--workers', type=int, default=None,
+                            help='Number of processes parsing shapefile chunks. Defaults to the number of CPUs.')
+
     def download_shp(self, workflow, shp_config: object):
         '''
         Downloads a zipped (or not) parcel shapefile to this workflow's data/shp folder,
@@ -84,20 +88,8 @@ class Command(BaseCommand):
                    zip_obj.extractall(self.shp_dir)
                    return os.path.join(self.shp_dir, glob.glob('*.shp', recursive=True)[0])
 
-    def standardize_parcel_plats(self, workflow):
-        ''' Standardize each unique addition name, and save back to Parcel objects with that plat_name'''
-        print('Standardizing parcel plat names...')
-        parcel_additions = Parcel.objects.filter(
-            workflow=workflow).values_list('plat_name', flat=True).distinct().order_by('plat_name')
-        for pa in parcel_additions:
-            standardized_add = standardize_addition(pa)
-            print(f'{pa} -> {standardized_add}')
-            Parcel.objects.filter(workflow=workflow, plat_name=pa).update(
-                plat_standardized=standardized_add)
-
-    def join_to_plats(self, workflow):
-        '''Find matching plat names based on addition value'''
-        print("Joining plats to parcel objs...")
+    def get_plat_lookup(self, workflow):
+        '''Plat ids by standardized plat name and alternate name, for matching parcels to plats as they load'''
         plat_lookup = {p['plat_name_standardized']: p['id'] for p in Plat.objects.filter(
             workflow=workflow).values('id', 'plat_name_standardized')}
 
@@ -107,32 +99,10 @@ class Command(BaseCommand):
             plat_alternate_lookup = {p['alternate_name_standardized']: p['plat__id'] for p in PlatAlternateName.objects.filter(
                 workflow=workflow).values('plat__id', 'alternate_name_standardized')}
 
-            # Wait do we even need to do the alternate here or are we doing it twice?
-            # TODO: Attempt plat match before trying to list all join options on both sides
-            # plat match can be optional, but if it's there it can give you alternate candidates (again on both sides)
-
             # Merge alternates into main plat lookup
             plat_lookup.update(plat_alternate_lookup)
 
-            plat_matches = []
-            cant_match = {}
-            for parcel in Parcel.objects.filter(workflow=workflow).only('plat_standardized', 'id'):
-                try:
-                    plat_id = plat_lookup[parcel.plat_standardized]
-                    parcel.plat_id = plat_id
-                    plat_matches.append(parcel)
-                except:
-                    if parcel.plat_standardized not in cant_match:
-                        cant_match[parcel.plat_standardized] = 1
-                    else:
-                        cant_match[parcel.plat_standardized] += 1
-
-            print("Can't match these additions:")
-            for plat, num_parcels in cant_match.items():
-                print(f"{plat}: {num_parcels} parcels")
-
-            print(f'\nUpdating {len(plat_matches)} Parcel objs with plat map matches...')
-            Parcel.objects.bulk_update(plat_matches, ['plat_id'], batch_size=5000)
+        return plat_lookup
 
     def handle(self, *args, **kwargs):
         workflow_name = kwargs['workflow']
@@ -146,6 +116,8 @@ class Command(BaseCommand):
             self.shp_dir = os.path.join(
                 settings.BASE_DIR, 'data', 'shp', workflow.slug)
 
+            plat_lookup = self.get_plat_lookup(workflow)
+
             for shp in self.batch_config['parcel_shps']:
                 if 'download_url' in shp:
                     local_shp = self.download_shp(workflow, shp)
@@ -160,23 +132,22 @@ class Command(BaseCommand):
                     raise
 
                 print(
-                    'Beginning homegrown layermapping: {} ...'.format(local_shp))
+                    'Beginning chunked parcel load: {} ...'.format(local_shp))
 
-                required_attrs = ["pin_primary", "pin_secondary", "street_address", "city",
-                             "state", "zip_code", "county_name", "county_fips", "plat_name",
-                             "block", "lot", "join_description", "phys_description",
-                             "township", "range", "section"]
-
-                save_multipoly_instances(
+                results = load_parcel_shp_parallel(
                     workflow,
-                    Parcel,
                     local_shp,
                     shp['mapping'],
-                    required_attrs
+                    plat_lookup,
+                    kwargs['chunksize'],
+                    kwargs['workers']
                 )
 
-            self.standardize_parcel_plats(workflow)
-            self.join_to_plats(workflow)
+                if len(plat_lookup) > 0:
+                    print("Can't match these additions:")
+                    for plat, num_parcels in sorted(results['unmatched'].items()):
+                        print(f"{plat}: {num_parcels} parcels")
+
             management.call_command(
                 'join_subdivisions_to_parcels', workflow=workflow_name)
             management.call_command(
@@ -8,11 +8,14 @@ from django.core.files.base import ContentFile
 from django.core.management.base import BaseCommand
 from django.core import management
 from django.conf import settings
+from django.utils import timezone
 
 from apps.zoon.models import ZooniverseSubject, ManualCovenant, ManualParcelPINLink, ManualCovenantParcelPINLink
-from apps.parcel.models import JoinReport, Parcel, CovenantedParcel
-from apps.parcel.utils.parcel_utils import build_parcel_spatial_lookups, addition_wide_parcel_match
+from apps.parcel.models import JoinReport, Parcel, CovenantedParcel, DirtyMatchKey
+from apps.parcel.utils.parcel_utils import addition_wide_parcel_match
+from apps.parcel.utils.lookup_cache import get_cached_parcel_lookup
 from apps.parcel.utils.export_utils import delete_flat_covenanted_parcels, save_flat_covenanted_parcels
+from apps.parcel.utils.match_utils import BulkParcelMatcher, IncrementalParcelMatcher
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 from apps.zoon.utils.zooniverse_join import set_addresses
 
@@ -30,6 +33,10 @@ class Command(BaseCommand):
                             help='Save to local CSV in "analysis" dir, rather than Django object/S3')
         parser.add_argument('-t', '--test', action='store_true',
                             help="Don't save match report, this is only a test")
+        parser.add_argument('--legacy', action='store_true',
+                            help="Match one covenant at a time through each covenant's save routine, rather than the bulk matcher")
+        parser.add_argument('-i', '--incremental', action='store_true',
+                            help="Only re-match covenants and parcels logged as changed since the last run")
 
     def match_parcel(self, parcel_lookup, target_obj, subject_obj, matched_lots_list):
         ''' Separate subject necessary because you also have to run this on the ExtraParcelCandidate objects and then link the result to its subject'''
@@ -267,22 +274,44 @@ class Command(BaseCommand):
         else:
             workflow = get_workflow_obj(workflow_name)
 
-            # Get all possible parcel lots to join
-            parcel_lookup = build_parcel_spatial_lookups(workflow)
+            if kwargs['incremental']:
+                dirty_keys = DirtyMatchKey.objects.filter(workflow=workflow, date_matched__isnull=True)
+                print(f'{dirty_keys.count()} changes logged since last match...')
+                matcher = IncrementalParcelMatcher(workflow, dirty_keys)
+                self.match_report = matcher.run()
 
-            self.match_parcels_bulk_zoon(workflow, parcel_lookup)
-            self.match_parcels_bulk_manual(workflow, parcel_lookup)
+                # The JoinReport describes a full run, so it is not rewritten here
+                management.call_command('refresh_flattened_covenants', workflow=workflow.workflow_name, incremental=True)
+                return
 
-            # Join addition-wide covenants
-            self.match_addition_wide_covenants(workflow, parcel_lookup)
+            run_start = timezone.now()
 
-            # Join covenants by PIN
-            workflow_pins_lookup = {parcel['pin_primary']: parcel['pk'] for parcel in Parcel.objects.filter(workflow=workflow).values('pk', 'pin_primary')}
-            self.match_parcel_pin_links_zooniverse(workflow, workflow_pins_lookup)
-            self.match_parcel_pin_links_manual(workflow, workflow_pins_lookup)
+            # Get all possible parcel lots to join
+            parcel_lookup = get_cached_parcel_lookup(workflow)
+
+            if kwargs['legacy']:
+                self.match_report = []
+                self.matched_lots_zoon = []
+                self.matched_lots_manual = []
+                self.match_parcels_bulk_zoon(workflow, parcel_lookup)
+                self.match_parcels_bulk_manual(workflow, parcel_lookup)
+
+                # Join addition-wide covenants
+                self.match_addition_wide_covenants(workflow, parcel_lookup)
+
+                # Join covenants by PIN
+                workflow_pins_lookup = {parcel['pin_primary']: parcel['pk'] for parcel in Parcel.objects.filter(workflow=workflow).values('pk', 'pin_primary')}
+                self.match_parcel_pin_links_zooniverse(workflow, workflow_pins_lookup)
+                self.match_parcel_pin_links_manual(workflow, workflow_pins_lookup)
+            else:
+                matcher = BulkParcelMatcher(workflow, parcel_lookup)
+                self.match_report = matcher.run()
 
             self.tag_matched_parcels(workflow)         
 
+            # Everything logged before this run is now matched
+            DirtyMatchKey.objects.filter(workflow=workflow, created_at__lte=run_start).update(date_matched=timezone.now())
+
             bool_local = kwargs['local']
             bool_test = kwargs['test']
             self.write_match_report(workflow, bool_local, bool_test)
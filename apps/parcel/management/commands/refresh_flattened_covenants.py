@@ -1,8 +1,10 @@
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
-from apps.parcel.models import Parcel, CovenantedParcel
+from apps.parcel.models import DirtyMatchKey
 
-from apps.parcel.utils.export_utils import save_flat_covenanted_parcels
+from apps.parcel.utils.export_utils import CovenantedParcelRefresher
+from apps.parcel.utils.match_utils import dirty_parcel_ids
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 
@@ -12,20 +14,39 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+        parser.add_argument('-i', '--incremental', action='store_true',
+                            help="Only refresh CovenantedParcel records for covenants and parcels logged as changed since the last refresh")
+        parser.add_argument('-c', '--chunksize', type=int, default=5000,
+                            help='Number of parcels to flatten at a time. Default = 5000')
 
-    def save_flattened_covenants(self, workflow):
-        # Do a more broad deletion to find any stragglers
-        print("Deleting old CovenantedParcel records from this workflow...")
-        CovenantedParcel.objects.filter(workflow=workflow).delete()
+    def save_flattened_covenants(self, workflow, chunksize=5000):
+        run_start = timezone.now()
 
-        print("Creating CovenantedParcel records from this workflow...")
-        matched_parcels = Parcel.objects.filter(workflow=workflow, bool_covenant=True).only('pk')
-        flat_covenants = save_flat_covenanted_parcels(matched_parcels)
+        # Replaces every CovenantedParcel record in this workflow, including any stragglers
+        print("Refreshing CovenantedParcel records for this workflow...")
+        flat_count = CovenantedParcelRefresher(workflow, chunksize).run()
 
-        if flat_covenants:
-            print(f"{flat_covenants.count()} CovenantedParcel objects saved.")
-            return flat_covenants
-        return False
+        # Everything logged before this run is now flattened
+        DirtyMatchKey.objects.filter(workflow=workflow, created_at__lte=run_start).update(date_flattened=timezone.now())
+        DirtyMatchKey.objects.purge(workflow)
+
+        print(f"{flat_count} CovenantedParcel objects saved.")
+        return flat_count
+
+    def save_flattened_covenants_incremental(self, workflow, chunksize=5000):
+        dirty_keys = DirtyMatchKey.objects.filter(workflow=workflow, date_flattened__isnull=True)
+        dirty_key_pks = list(dirty_keys.values_list('pk', flat=True))
+        parcel_ids = dirty_parcel_ids(workflow, DirtyMatchKey.objects.filter(pk__in=dirty_key_pks))
+
+        # Records for deleted parcels are cleared in the same swap
+        print(f"Refreshing CovenantedParcel records for {len(parcel_ids)} changed parcels...")
+        flat_count = CovenantedParcelRefresher(workflow, chunksize).run(parcel_ids)
+
+        DirtyMatchKey.objects.filter(pk__in=dirty_key_pks).update(date_flattened=timezone.now())
+        DirtyMatchKey.objects.purge(workflow)
+
+        print(f"{flat_count} CovenantedParcel objects saved.")
+        return flat_count
 
     def handle(self, *args, **kwargs):
         workflow_name = kwargs['workflow']
@@ -34,4 +55,7 @@ class Command(BaseCommand):
         else:
             workflow = get_workflow_obj(workflow_name)
 
-            self.save_flattened_covenants(workflow)
+            if kwargs['incremental']:
+                self.save_flattened_covenants_incremental(workflow, kwargs['chunksize'])
+            else:
+                self.save_flattened_covenants(workflow, kwargs['chunksize'])
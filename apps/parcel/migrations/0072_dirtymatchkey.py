@@ -0,0 +1,27 @@
+# Generated by Django 6.0.6 on 2026-10-18 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcel', '0071_alter_covenantedparcel_lot_cov_alter_parcel_state'),
+        ('zoon', '0061_alter_manualcovenant_doc_num_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyMatchKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_type', models.CharField(choices=[('zs', 'ZooniverseSubject'), ('mc', 'ManualCovenant'), ('pa', 'Parcel'), ('ad', 'Standardized addition')], db_index=True, max_length=2)),
+                ('key', models.CharField(max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('date_matched', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('date_flattened', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zoon.zooniverseworkflow')),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 6.0.6 on 2026-10-18 14:40
+
+import django.db.models.deletion
+import racial_covenants_processor.storage_backends
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcel', '0072_dirtymatchkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pmtilesexport',
+            name='base_export',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='parcel.pmtilesexport'),
+        ),
+        migrations.AddField(
+            model_name='pmtilesexport',
+            name='changed_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pmtilesexport',
+            name='manifest',
+            field=models.FileField(null=True, storage=racial_covenants_processor.storage_backends.PrivateMediaStorage(), upload_to='main_exports/manifests/'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.6 on 2026-10-18 16:05
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcel', '0073_pmtilesexport_manifest'),
+        ('zoon', '0063_recomputerequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdditionWideMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('addition_standardized', models.CharField(db_index=True, max_length=255)),
+                ('bool_match', models.BooleanField(default=False)),
+                ('parcel_ids', models.JSONField(default=list)),
+                ('geom_union_4326', django.contrib.gis.db.models.fields.MultiPolygonField(null=True, srid=4326)),
+                ('parcel_lookup_version', models.CharField(max_length=32)),
+                ('date_built', models.DateTimeField(auto_now=True)),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zoon.zooniverseworkflow')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('workflow', 'addition_standardized'), name='unique_addition_wide_match')],
+            },
+        ),
+    ]
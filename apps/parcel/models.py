@@ -1,13 +1,28 @@
+import json
+
 from django.db.models import OuterRef, Subquery, F, Case, Value, When, Exists, BooleanField, DateField, CharField, IntegerField, JSONField, FloatField
 from django.contrib.gis.db import models
 from django.dispatch import receiver
+from django.utils import timezone
 from localflavor.us.us_states import US_STATES
 
 from postgres_copy import CopyManager
 
-from racial_covenants_processor.storage_backends import PublicMediaStorage
-from apps.plat.models import Plat, Subdivision
+from racial_covenants_processor.storage_backends import PublicMediaStorage, PrivateMediaStorage
+from apps.plat.models import Plat, PlatAlternateName, Subdivision, SubdivisionAlternateName
 from .utils.parcel_utils import get_all_parcel_options
+from .utils.lookup_cache import bump_parcel_lookup_version
+
+
+class ParcelQuerySet(models.QuerySet):
+
+    def delete(self):
+        '''ParcelJoinCandidates cascade with the Parcels, so cached lookups for their workflows are now stale. Bumped once per workflow here rather than in a post_delete receiver, which would stop Django fast-deleting and bump once per parcel.'''
+        workflow_ids = set(self.order_by().values_list('workflow_id', flat=True).distinct())
+        deleted = super().delete()
+        for workflow_id in workflow_ids:
+            bump_parcel_lookup_version(workflow_id)
+        return deleted
 
 
 class CovenantsParcelManager(models.Manager):
@@ -361,6 +376,114 @@ class CovenantsParcelManager(models.Manager):
         )
 
 
+    def single_pass_values(self, parcels, fields):
+        '''Same rows as get_queryset().filter(pk__in=parcels).values(*fields), but the oldest ZooniverseSubject and ManualCovenant for each parcel are each picked once with DISTINCT ON and joined in, instead of being re-run as correlated subqueries for every annotated column. Used by save_flat_covenanted_parcels, where the subquery version gets very slow on large workflows.'''
+        from django.contrib.gis.geos import GEOSGeometry
+        from django.db import connection
+        from apps.zoon.models import ZooniverseSubject, ManualCovenant
+        from apps.deed.models import DeedPage
+
+        parcel_table = self.model._meta.db_table
+        zs_table = ZooniverseSubject._meta.db_table
+        zs_through = ZooniverseSubject.parcel_matches.through._meta.db_table
+        mc_table = ManualCovenant._meta.db_table
+        mc_through = ManualCovenant.parcel_matches.through._meta.db_table
+        deedpage_table = DeedPage._meta.db_table
+
+        parcel_sql, parcel_params = parcels.values('pk').query.sql_with_params()
+
+        # Covenant page lookups for each of the subject's first 3 pages
+        page_joins = '\n'.join([f'''
+            LEFT JOIN LATERAL (
+                SELECT s3_lookup FROM {deedpage_table}
+                WHERE zooniverse_subject_{ordinal}_page_id = zs.id
+                ORDER BY id LIMIT 1
+            ) AS dp_{ordinal} ON TRUE''' for ordinal in ['1st', '2nd', '3rd']])
+
+        sql = f'''
+            WITH target_parcels AS MATERIALIZED (
+                SELECT p.id, p.workflow_id FROM {parcel_table} AS p
+                WHERE p.id IN ({parcel_sql}) AND p.bool_covenant = TRUE
+            ),
+            oldest_zs AS MATERIALIZED (
+                SELECT DISTINCT ON (tp.id) tp.id AS parcel_id, zs.id AS zs_id
+                FROM target_parcels AS tp
+                JOIN {zs_through} AS pm ON pm.parcel_id = tp.id
+                JOIN {zs_table} AS zs ON zs.id = pm.zooniversesubject_id
+                WHERE zs.bool_covenant_final = TRUE AND zs.workflow_id = tp.workflow_id
+                ORDER BY tp.id, zs.deed_date_final ASC, zs.id
+            ),
+            oldest_mc AS MATERIALIZED (
+                SELECT DISTINCT ON (tp.id) tp.id AS parcel_id, mc.id AS mc_id
+                FROM target_parcels AS tp
+                JOIN {mc_through} AS pm ON pm.parcel_id = tp.id
+                JOIN {mc_table} AS mc ON mc.id = pm.manualcovenant_id
+                WHERE mc.bool_confirmed = TRUE AND mc.workflow_id = tp.workflow_id
+                ORDER BY tp.id, mc.deed_date ASC, mc.id
+            )
+            SELECT
+                p.id AS id,
+                p.county_name AS cnty_name,
+                p.county_fips AS cnty_fips,
+                CASE WHEN zs.id IS NOT NULL THEN zs.deedpage_doc_num WHEN mc.id IS NOT NULL THEN mc.doc_num ELSE '' END AS doc_num,
+                CASE WHEN zs.id IS NOT NULL THEN zs.deedpage_s3_lookup WHEN mc.id IS NOT NULL THEN mc.doc_num ELSE '' END AS main_image,
+                p.pin_primary AS cnty_pin,
+                CASE WHEN zs.id IS NOT NULL THEN zs.deed_date_final WHEN mc.id IS NOT NULL THEN mc.deed_date ELSE NULL END AS deed_date,
+                CASE WHEN zs.id IS NOT NULL THEN zs.seller_final WHEN mc.id IS NOT NULL THEN mc.seller ELSE '' END AS seller,
+                CASE WHEN zs.id IS NOT NULL THEN zs.buyer_final WHEN mc.id IS NOT NULL THEN mc.buyer ELSE '' END AS buyer,
+                CASE WHEN zs.id IS NOT NULL THEN 'zooniverse' WHEN mc.id IS NOT NULL THEN 'manual' ELSE '' END AS cov_type,
+                CASE WHEN zs.id IS NOT NULL THEN zs.covenant_text_final WHEN mc.id IS NOT NULL THEN mc.covenant_text ELSE '' END AS cov_text,
+                zs.zoon_subject_id AS zn_subj_id,
+                zs.dt_retired AS zn_dt_ret,
+                CASE WHEN zs.id IS NOT NULL THEN dp_1st.s3_lookup ELSE '' END AS deed_page_1,
+                CASE WHEN zs.id IS NOT NULL THEN dp_2nd.s3_lookup ELSE '' END AS deed_page_2,
+                CASE WHEN zs.id IS NOT NULL THEN dp_3rd.s3_lookup ELSE '' END AS deed_page_3,
+                zs.median_score AS med_score,
+                CASE WHEN zs.id IS NOT NULL THEN zs.bool_manual_correction WHEN mc.id IS NOT NULL THEN TRUE ELSE FALSE END AS manual_cx,
+                CASE WHEN zs.id IS NOT NULL THEN zs.match_type_final WHEN mc.id IS NOT NULL THEN mc.cov_type ELSE '' END AS match_type,
+                CASE WHEN zs.id IS NOT NULL THEN zs.join_candidates WHEN mc.id IS NOT NULL THEN mc.join_candidates ELSE NULL END AS join_candidates,
+                p.street_address AS street_add,
+                p.city AS city,
+                p.state AS state,
+                p.zip_code AS zip_code,
+                CASE WHEN zs.id IS NOT NULL THEN zs.addition_final WHEN mc.id IS NOT NULL THEN mc.addition ELSE '' END AS add_cov,
+                CASE WHEN zs.id IS NOT NULL THEN zs.block_final WHEN mc.id IS NOT NULL THEN mc.block ELSE '' END AS block_cov,
+                CASE WHEN zs.id IS NOT NULL THEN zs.lot_final WHEN mc.id IS NOT NULL THEN mc.lot ELSE '' END AS lot_cov,
+                CASE WHEN zs.id IS NOT NULL THEN zs.map_book_final WHEN mc.id IS NOT NULL THEN mc.map_book ELSE '' END AS map_book,
+                CASE WHEN zs.id IS NOT NULL THEN zs.map_book_page_final WHEN mc.id IS NOT NULL THEN mc.map_book_page ELSE '' END AS map_page,
+                p.plat_name AS add_mod,
+                p.block AS block_mod,
+                p.lot AS lot_mod,
+                p.phys_description AS ph_dsc_mod,
+                p.plat_id AS "plat__pk",
+                p.subdivision_spatial_id AS "subdivision_spatial__pk",
+                CASE WHEN zs.id IS NOT NULL THEN zs.date_updated WHEN mc.id IS NOT NULL THEN mc.date_updated ELSE NULL END AS dt_updated,
+                p.geom_4326 AS geom_4326
+            FROM target_parcels AS tp
+            JOIN {parcel_table} AS p ON p.id = tp.id
+            LEFT JOIN oldest_zs AS oz ON oz.parcel_id = tp.id
+            LEFT JOIN {zs_table} AS zs ON zs.id = oz.zs_id
+            LEFT JOIN oldest_mc AS om ON om.parcel_id = tp.id
+            LEFT JOIN {mc_table} AS mc ON mc.id = om.mc_id
+            {page_joins};
+        '''
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, parcel_params)
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+        for row in rows:
+            # Parse the same way the ORM would for JSONField and geometry columns
+            if isinstance(row['join_candidates'], str):
+                row['join_candidates'] = json.loads(row['join_candidates'])
+            elif row['join_candidates'] is None and row['cov_type'] == '':
+                row['join_candidates'] = "[]"
+            if row['geom_4326'] is not None:
+                row['geom_4326'] = GEOSGeometry(row['geom_4326'])
+
+        return [{f: row[f] for f in fields} for row in rows]
+
 class Parcel(models.Model):
     '''A modern GIS parcel record imported from a shapefile, generally sourced from a county GIS system or open records portal. Imported via load_parcel_shp management command. Racial covenant exports (besides unmapped documents) are aggregated to identify the earliest recorded covenant for each modern parcel, which means each row in covenants exports is equivalent to one Parcel object. By filling out the parcel_shps -> mapping object in the workflow config, users can tell the load_parcel_shp management command which attributes/columns in the original shapefile correspond to the attribute names needed to import into the Parcel table.'''
     workflow = models.ForeignKey(
@@ -417,7 +540,7 @@ class Parcel(models.Model):
     bool_covenant = models.BooleanField(default=False, db_index=True)
     """Has this Parcel been linked to a confirmed racial covenant? Set by match_parcels.py and individual save routines of ZooniverseSubject, ManualCovenant, PlatAlternateName, and SubdivisionAlternateName."""
 
-    objects = models.Manager()
+    objects = ParcelQuerySet.as_manager()
     """Manager used to list all Parcel rows, not just parcels linked to covenants."""
     covenant_objects = CovenantsParcelManager()
     """Manager used to list only parcels linked to racial covenants See CovenantsParcelManager() for details."""
@@ -456,6 +579,16 @@ class Parcel(models.Model):
 
         super(Parcel, self).save(*args, **kwargs)
 
+        # Log for incremental re-matching
+        DirtyMatchKey.objects.mark(self.workflow, 'pa', [self.pk])
+        bump_parcel_lookup_version(self.workflow_id)
+
+    def delete(self, *args, **kwargs):
+        # ParcelJoinCandidates cascade with the Parcel, so any cached lookup for the workflow is now stale
+        deleted = super().delete(*args, **kwargs)
+        bump_parcel_lookup_version(self.workflow_id)
+        return deleted
+
 
 class ParcelJoinCandidate(models.Model):
     '''A given parcel can be made up of more than one lot, theoretically. This
@@ -474,6 +607,8 @@ class ParcelJoinCandidate(models.Model):
     metadata = models.JSONField(null=True, blank=True)
     """Information about the filtering/processing of this candidate, see parcel_utils.py"""
 
+    objects = CopyManager()
+
 
 class ManualParcelCandidate(models.Model):
     '''Similar to ExtraParcelCandidate on ZooniverseSubject, this would let you fill out a smart range of lots in combo with addition and block, and would generate additional join strings. To be used where the physical description is difficult to automatically parse, but simple lots are extractable manually.'''
@@ -533,6 +668,104 @@ class JoinReport(models.Model):
     created_at = models.DateTimeField()
 
 
+DIRTY_KEY_TYPES = (
+    ('zs', 'ZooniverseSubject'),
+    ('mc', 'ManualCovenant'),
+    ('pa', 'Parcel'),
+    ('ad', 'Standardized addition'),
+)
+
+
+class DirtyMatchKeyManager(models.Manager):
+
+    def mark(self, workflow, key_type, keys, bool_matched=False):
+        '''Record a set of keys of one type as dirty for this workflow. Pass bool_matched=True when parcel matches are already current and only the CovenantedParcel rows need refreshing.'''
+        if workflow is None:
+            return 0
+        keys = set([str(k) for k in keys if k not in [None, '']])
+        date_matched = timezone.now() if bool_matched else None
+        if key_type == 'ad':
+            AdditionWideMatch.objects.invalidate(workflow, keys)
+        self.bulk_create([
+            self.model(workflow=workflow, key_type=key_type, key=k, date_matched=date_matched) for k in keys
+        ], batch_size=5000)
+        return len(keys)
+
+    def purge(self, workflow):
+        '''Delete keys that have been both re-matched and re-flattened'''
+        return self.filter(
+            workflow=workflow,
+            date_matched__isnull=False,
+            date_flattened__isnull=False
+        ).delete()
+
+
+class DirtyMatchKey(models.Model):
+    """Persistent change log of covenants, parcels and standardized addition names whose parcel matches or CovenantedParcel rows may be out of date. Written when a ManualCorrection, ExtraParcelCandidate, PIN link, alternate name or Parcel is saved or deleted, or a parcel shapefile is reloaded. Consumed by the --incremental mode of match_parcels and refresh_flattened_covenants."""
+    workflow = models.ForeignKey(
+         "zoon.ZooniverseWorkflow", on_delete=models.CASCADE)
+    key_type = models.CharField(max_length=2, choices=DIRTY_KEY_TYPES, db_index=True)
+    key = models.CharField(max_length=500)
+    """Database id of the covenant or parcel, or the standardized addition name"""
+    created_at = models.DateTimeField(auto_now_add=True)
+    date_matched = models.DateTimeField(null=True, blank=True, db_index=True)
+    """Set once match_parcels has re-matched this key"""
+    date_flattened = models.DateTimeField(null=True, blank=True, db_index=True)
+    """Set once refresh_flattened_covenants has rebuilt CovenantedParcel rows for this key"""
+
+    objects = DirtyMatchKeyManager()
+
+    def __str__(self):
+        return f"{self.workflow} {self.get_key_type_display()} {self.key}"
+
+
+class AdditionWideMatchManager(models.Manager):
+
+    def invalidate(self, workflow, keys=None):
+        '''Throw away cached addition-wide matches for some standardized additions, or for the whole workflow'''
+        if workflow is None:
+            return 0
+        entries = self.filter(workflow=workflow)
+        if keys is not None:
+            entries = entries.filter(addition_standardized__in=list(keys))
+        return entries.delete()[0]
+
+
+class AdditionWideMatch(models.Model):
+    """Cached result of addition-wide (AW) matching for one standardized addition name: whether anything matched, every parcel in the addition, plat, subdivision or alternate name, and the union of those parcels' geometries. Built by apps/parcel/utils/addition_cache.py the first time an AW covenant in that addition is matched, so later covenants in the same addition don't repeat the lookups or the ST_Union. Only used while parcel_lookup_version matches the workflow's, so any Parcel or ParcelJoinCandidate change makes it stale, and deleted outright when alternate names, plats, subdivisions or the parcel shapefile change."""
+    workflow = models.ForeignKey(
+         "zoon.ZooniverseWorkflow", on_delete=models.CASCADE)
+    addition_standardized = models.CharField(max_length=255, db_index=True)
+    bool_match = models.BooleanField(default=False)
+    """Same as the bool_parcel_match an AW covenant in this addition gets. Can be True with no parcels, e.g. for a plat with no parcels joined to it."""
+    parcel_ids = models.JSONField(default=list)
+    geom_union_4326 = models.MultiPolygonField(srid=4326, null=True)
+    parcel_lookup_version = models.CharField(max_length=32)
+    """The workflow's parcel_lookup_version when this was built"""
+    date_built = models.DateTimeField(auto_now=True)
+
+    objects = AdditionWideMatchManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['workflow', 'addition_standardized'], name='unique_addition_wide_match'),
+        ]
+
+    def __str__(self):
+        return f"{self.workflow} {self.addition_standardized} ({len(self.parcel_ids)} parcels)"
+
+
+@receiver(models.signals.post_save, sender=Plat)
+@receiver(models.signals.post_delete, sender=Plat)
+@receiver(models.signals.post_save, sender=Subdivision)
+@receiver(models.signals.post_delete, sender=Subdivision)
+@receiver(models.signals.post_delete, sender=PlatAlternateName)
+@receiver(models.signals.post_delete, sender=SubdivisionAlternateName)
+def addition_source_changed(sender, instance, **kwargs):
+    """Plats, subdivisions and alternate names decide which parcels belong to an addition, so cached addition-wide matches for the workflow can't be trusted after one changes. (Saved alternate names invalidate their own additions via DirtyMatchKey.)"""
+    AdditionWideMatch.objects.invalidate(instance.workflow)
+
+
 class ShpExport(models.Model):
     """One of the Deed Machine's main public data exports. A shapefile export of modern properties that have confirmed racial covenants. Generated by dump_covenants_shp management command. File saved to S3 by default, but can be saved locally as well."""
     workflow = models.ForeignKey(
@@ -565,6 +798,14 @@ class PMTilesExport(models.Model):
          "zoon.ZooniverseWorkflow", null=True, on_delete=models.SET_NULL)
     pmtiles = models.FileField(
         storage=PublicMediaStorage(), upload_to="main_exports/", null=True)
+    manifest = models.FileField(
+        storage=PrivateMediaStorage(), upload_to="main_exports/manifests/", null=True)
+    '''Gzipped JSON hash and bbox of every exported feature, used to find which tiles need rebuilding in the next --incremental export'''
+    base_export = models.ForeignKey(
+        "self", null=True, on_delete=models.SET_NULL)
+    '''For incremental exports, the earlier export whose unchanged tiles were copied into this one'''
+    changed_count = models.IntegerField(null=True)
+    '''For incremental exports, how many covenants were added, changed or removed since base_export'''
     covenant_count = models.IntegerField()
     created_at = models.DateTimeField()
 
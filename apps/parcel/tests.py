@@ -1,10 +1,30 @@
+import io
+import csv
+import json
+import tempfile
+import pandas as pd
+import shapely
+import geopandas as gpd
+from shapely.geometry import Polygon, MultiPolygon
+
 from django.test import TestCase, override_settings
 from django.core import management
+from django.db import transaction
 from apps.zoon.models import ZooniverseWorkflow, ZooniverseSubject, ManualCovenant
-from apps.parcel.models import Parcel, ManualParcelCandidate, CovenantedParcel
-
-from apps.parcel.utils.parcel_utils import standardize_addition, get_blocks, get_lots, write_join_strings
-from apps.parcel.utils.export_utils import delete_flat_covenanted_parcels, save_flat_covenanted_parcels
+from apps.parcel.models import Parcel, ParcelJoinCandidate, ManualParcelCandidate, CovenantedParcel, DirtyMatchKey
+
+from apps.parcel.utils.parcel_utils import standardize_addition, get_blocks, get_lots, write_join_strings, standardize_many, write_join_strings_many, get_all_parcel_options
+from apps.parcel.utils.export_utils import delete_flat_covenanted_parcels, save_flat_covenanted_parcels, get_parcel_covenant_values, diff_parcel_covenant_values, CovenantedParcelRefresher
+from apps.parcel.utils.rebuild_utils import ParcelJoinCandidateRebuilder
+from apps.parcel.utils.stream_export import write_covenants_csv, write_covenants_geojson
+from apps.parcel.utils.pmtiles_export import covenant_manifest, write_manifest, read_manifest, write_python_pmtiles, update_pmtiles, INCREMENTAL_MIN_ZOOM
+from apps.parcel.utils.pmtiles_utils import PMTilesReader, zxy_to_tileid, tileid_to_zxy, decompress
+from apps.parcel.utils.mvt_utils import decode_layer_summary
+from apps.parcel.utils.export_utils import EXPORT_FIELDS_ORDERED
+from apps.parcel.utils.parcel_loader import multipolygons_4326, mapped_values, orig_data_json
+from apps.parcel.utils.lookup_cache import get_cached_parcel_lookup, get_parcel_lookup_version
+from apps.parcel.utils.parcel_utils import build_parcel_spatial_lookups
+from apps.parcel.management.commands.match_parcels import Command as MatchParcelsCommand
 
 
 TEST_ZOON_SETTINGS = {
@@ -241,6 +261,64 @@ class JoinStringTests(TestCase):
         self.assertEqual(write_join_strings(
             addition, block, lot)[0]['join_string'], 'arden hills 2 block 7 lot 1')
 
+    def test_lots_cached_list_not_shared(self):
+        lots, lot_style = get_lots('1,2')
+        lots.append('3')
+        self.assertEqual(get_lots('1,2'), (['1', '2'], 'list_of_nums'))
+
+    def test_standardize_many(self):
+        additions = pd.Series(["Jane's Addn", "ARDEN HILLS NO. 2", None, "Second Addition", "Jane's Addn"], index=[5, 6, 7, 8, 9])
+        standardized = standardize_many(additions)
+        self.assertEqual(list(standardized.index), [5, 6, 7, 8, 9])
+        self.assertEqual(list(standardized), [standardize_addition(a) for a in additions])
+
+    def test_write_join_strings_many(self):
+        rows = [
+            ("JANE'S ADDITION", '1', '1,2'),
+            ("ARDEN HILLS NO. 2", 'blk 07', 'Lots 1 thru 3'),
+            ("Oak Ridge", None, 'six 6'),
+            ("Oak Ridge", '2', None),
+            ("Oak Ridge", '2', 'partial'),
+        ]
+        df = pd.DataFrame(rows, columns=['addition', 'block', 'lot'])
+        candidates = write_join_strings_many(df['addition'], df['block'], df['lot'])
+        self.assertEqual(list(candidates), [write_join_strings(*row) for row in rows])
+
+    def test_parcel_loader_chunk_values(self):
+        '''Does the chunked parcel loader drop Z values, reproject to 4326, force multipolygons and map attributes like save_multipoly_instances did?'''
+        gdf = gpd.GeoDataFrame({
+            # A null in an integer field makes the whole column float64
+            'PIN': [1001, 1002, None],
+            'ADDN': ['Jane\'s Addn', None, 'Other Addn'],
+            'TWP': [29.0, None, 30.0],
+            'ACRES': [1.5, 2.0, None],
+            'SALE_DATE': pd.to_datetime(['1999-02-03', None, None]),
+        }, geometry=[
+            Polygon([(480000, 4980000, 5), (480100, 4980000, 5), (480100, 4980100, 5), (480000, 4980000, 5)]),
+            MultiPolygon([Polygon([(480200, 4980200), (480300, 4980200), (480300, 4980300)])]),
+            Polygon([(480400, 4980400), (480500, 4980400), (480500, 4980500)]),
+        ], crs='EPSG:26915', index=[10, 11, 12])
+
+        geoms = multipolygons_4326(gdf.geometry)
+        self.assertEqual(list(shapely.get_type_id(geoms)), [6, 6, 6])
+        self.assertFalse(shapely.has_z(geoms).any())
+        self.assertEqual(list(shapely.get_srid(geoms)), [4326, 4326, 4326])
+        self.assertTrue(-94 < shapely.get_x(shapely.centroid(geoms[0])) < -93)
+
+        values = mapped_values(gdf, {'pin_primary': 'PIN', 'plat_name': 'ADDN', 'township': 'TWP', 'zip_code': 'ACRES', 'state': ('static', 'MN')})
+        self.assertEqual(list(values['pin_primary'][:2]), ['1001', '1002'])
+        self.assertTrue(pd.isna(values['pin_primary'][12]))
+        self.assertEqual(values['plat_name'][10], "Jane's Addn")
+        self.assertTrue(pd.isna(values['plat_name'][11]))
+        self.assertEqual(values['township'][10], 29)
+        self.assertTrue(pd.isna(values['township'][11]))
+        self.assertEqual(list(values['zip_code'][:2]), ['1.5', '2.0'])
+        self.assertEqual(list(values['state']), ['MN', 'MN', 'MN'])
+
+        orig_data = [json.loads(o) for o in orig_data_json(gdf.drop(columns='geometry'))]
+        self.assertEqual(orig_data[0], {'PIN': 1001, 'ADDN': "Jane's Addn", 'TWP': 29.0, 'SALE_DATE': '1999-02-03'})
+        self.assertEqual(orig_data[1]['SALE_DATE'], None)
+
 
 @override_settings(ZOONIVERSE_QUESTION_LOOKUP=TEST_ZOON_SETTINGS)
 class ParcelCandidateTests(TestCase):
@@ -284,6 +362,52 @@ class ParcelCandidateTests(TestCase):
         mpc.delete()
         self.assertEqual(parcel.parceljoincandidate_set.all().count(), 1)
 
+    def test_parallel_rebuild_same_as_per_parcel(self):
+        '''Does the sharded, multi-process rebuild produce the same ParcelJoinCandidates as get_all_parcel_options run on each parcel?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        expected = set()
+        for parcel in Parcel.objects.filter(workflow=workflow).exclude(lot__isnull=True):
+            for c in get_all_parcel_options(parcel):
+                expected.add((parcel.pk, parcel.plat_standardized, c['join_string'], json.dumps(c['metadata'], sort_keys=True)))
+
+        ParcelJoinCandidateRebuilder(workflow, workers=2, shard_size=3).run()
+
+        rebuilt = set(
+            (pjc['parcel_id'], pjc['plat_name_standardized'], pjc['join_string'], json.dumps(pjc['metadata'], sort_keys=True))
+            for pjc in ParcelJoinCandidate.objects.filter(workflow=workflow).values('parcel_id', 'plat_name_standardized', 'join_string', 'metadata')
+        )
+        self.assertGreater(len(rebuilt), 0)
+        self.assertEqual(rebuilt, expected)
+
+    def test_cached_parcel_lookup(self):
+        '''Does the cached lookup match a freshly built one, and is it invalidated when a Parcel changes?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        with override_settings(PARCEL_LOOKUP_CACHE_DIR=tempfile.mkdtemp()):
+            self.assertEqual(get_cached_parcel_lookup(workflow), build_parcel_spatial_lookups(workflow))
+
+            # Changes made by a caller don't leak into the next call
+            cached = get_cached_parcel_lookup(workflow)
+            cached['not a real join string'] = []
+            self.assertNotIn('not a real join string', get_cached_parcel_lookup(workflow))
+
+            version = get_parcel_lookup_version(workflow)
+            parcel = Parcel.objects.get(workflow_id=1, pk=8)
+            parcel.lot = '99'
+            parcel.save()
+            self.assertNotEqual(get_parcel_lookup_version(workflow), version)
+
+            lookup = get_cached_parcel_lookup(workflow)
+            self.assertEqual(lookup, build_parcel_spatial_lookups(workflow))
+            self.assertEqual(len([k for k in lookup if k.endswith('lot 99')]), 1)
+
+            # A bulk delete bumps the version once for the workflow, not per parcel
+            version = get_parcel_lookup_version(workflow)
+            Parcel.objects.filter(workflow_id=1, pk=8).delete()
+            self.assertNotEqual(get_parcel_lookup_version(workflow), version)
+            lookup = get_cached_parcel_lookup(workflow)
+            self.assertEqual(lookup, build_parcel_spatial_lookups(workflow))
+            self.assertEqual(len([k for k in lookup if k.endswith('lot 99')]), 0)
+
 
 @override_settings(ZOONIVERSE_QUESTION_LOOKUP=TEST_ZOON_SETTINGS)
 class CovenantedParcelTests(TestCase):
@@ -327,6 +451,134 @@ class CovenantedParcelTests(TestCase):
         self.assertEqual(CovenantedParcel.objects.filter(parcel__pin_primary='covenanted-parcel-1').count(), 0)
         self.assertEqual(CovenantedParcel.objects.filter(parcel__pin_primary='covenanted-parcel-2').count(), 0)
 
+    def test_single_pass_covenant_values(self):
+        '''Does the single-pass query return the same values as the annotated covenant_objects queryset?'''
+        parcels = Parcel.objects.filter(bool_covenant=True)
+        annotated = get_parcel_covenant_values(parcels, single_pass=False)
+        single_pass = get_parcel_covenant_values(parcels, single_pass=True)
+        self.assertGreater(len(single_pass), 0)
+        self.assertEqual(len(annotated), len(single_pass))
+        self.assertEqual(diff_parcel_covenant_values(annotated, single_pass), [])
+
+    def test_covenanted_parcel_refresher(self):
+        '''Does the COPY refresh produce the same CovenantedParcel records as save_flat_covenanted_parcels?'''
+        parcel_1 = Parcel.objects.get(pin_primary='covenanted-parcel-1')
+        workflow = parcel_1.workflow
+        compare_fields = ['parcel_id', 'cov_text', 'deed_date', 'deed_year', 'join_strgs', 'image_ids', 'match_type', 'manual_cx', 'dt_updated', 'zn_dt_ret', 'plat_dbid']
+
+        CovenantedParcel.objects.filter(workflow=workflow).delete()
+        save_flat_covenanted_parcels(Parcel.objects.filter(workflow=workflow, bool_covenant=True))
+        expected = list(CovenantedParcel.objects.filter(workflow=workflow).order_by('parcel_id').values(*compare_fields))
+
+        # Stray record from a deleted parcel should be swapped out too
+        CovenantedParcel.objects.create(workflow=workflow, parcel=None, geom_4326=parcel_1.geom_4326)
+
+        inserted = CovenantedParcelRefresher(workflow, chunksize=1).run()
+        self.assertEqual(inserted, len(expected))
+        self.assertEqual(list(CovenantedParcel.objects.filter(workflow=workflow).order_by('parcel_id').values(*compare_fields)), expected)
+        self.assertEqual(CovenantedParcel.objects.get(parcel=parcel_1).geom_4326, parcel_1.geom_4326)
+
+        # Incremental refresh of one parcel leaves the others alone
+        inserted = CovenantedParcelRefresher(workflow).run([parcel_1.pk])
+        self.assertEqual(inserted, 1)
+        self.assertEqual(CovenantedParcel.objects.filter(workflow=workflow).count(), len(expected))
+
+    def test_streamed_covenant_exports(self):
+        '''Do the streaming CSV and GeoJSON writers export every CovenantedParcel, a chunk at a time?'''
+        workflow = Parcel.objects.get(pin_primary='covenanted-parcel-1').workflow
+        cov_count = CovenantedParcel.objects.filter(workflow=workflow).count()
+        self.assertGreater(cov_count, 0)
+
+        csv_file = io.StringIO()
+        self.assertEqual(write_covenants_csv(workflow, csv_file, chunksize=1), cov_count)
+        csv_rows = list(csv.DictReader(io.StringIO(csv_file.getvalue())))
+        self.assertEqual(len(csv_rows), cov_count)
+        self.assertEqual(list(csv_rows[0].keys()), EXPORT_FIELDS_ORDERED)
+
+        geojson_file = io.StringIO()
+        self.assertEqual(write_covenants_geojson(workflow, geojson_file, 'test_export', chunksize=1), cov_count)
+        geojson = json.loads(geojson_file.getvalue())
+        self.assertEqual(len(geojson['features']), cov_count)
+        self.assertEqual(list(geojson['features'][0]['properties'].keys()), EXPORT_FIELDS_ORDERED)
+        self.assertEqual(geojson['features'][0]['geometry']['type'], 'MultiPolygon')
+
+    def test_incremental_pmtiles(self):
+        '''Does updating a Python-tiled PMTiles archive after a covenant changes give the same tiles as building it again from scratch?'''
+        for tile_id in [0, 1, 5, 21, 1000, 123456]:
+            self.assertEqual(zxy_to_tileid(*tileid_to_zxy(tile_id)), tile_id)
+        self.assertEqual(zxy_to_tileid(1, 0, 1), 2)
+
+        workflow = Parcel.objects.get(pin_primary='covenanted-parcel-1').workflow
+        base_manifest = covenant_manifest(workflow)
+        self.assertEqual(len(base_manifest), CovenantedParcel.objects.filter(workflow=workflow).count())
+
+        base_pmtiles = io.BytesIO()
+        write_python_pmtiles(workflow, base_pmtiles, 'test_layer', base_manifest, 0, 12)
+        manifest_file = io.BytesIO()
+        write_manifest(base_manifest, manifest_file, 'test_layer', 0, 12)
+        manifest_file.seek(0)
+
+        changed = CovenantedParcel.objects.filter(workflow=workflow).first()
+        changed.doc_num = 'changed-doc-num'
+        changed.save()
+        manifest = covenant_manifest(workflow)
+
+        updated = io.BytesIO()
+        counts = update_pmtiles(workflow, io.BytesIO(base_pmtiles.getvalue()), read_manifest(manifest_file), manifest, updated, min_rebuild_zoom=0)
+        self.assertEqual(counts['changed_features'], 1)
+        self.assertGreater(counts['rebuilt_tiles'], 0)
+
+        rebuilt = io.BytesIO()
+        write_python_pmtiles(workflow, rebuilt, 'test_layer', manifest, 0, 12)
+
+        updated_tiles = dict(PMTilesReader(io.BytesIO(updated.getvalue())).iter_tiles())
+        rebuilt_tiles = dict(PMTilesReader(io.BytesIO(rebuilt.getvalue())).iter_tiles())
+        self.assertGreater(len(rebuilt_tiles), 0)
+        self.assertEqual(sorted(updated_tiles.keys()), sorted(rebuilt_tiles.keys()))
+        for tile_id, data in rebuilt_tiles.items():
+            self.assertEqual(decompress(updated_tiles[tile_id], 2), decompress(data, 2))
+        self.assertIn('test_layer', decode_layer_summary(decompress(list(rebuilt_tiles.values())[-1], 2)))
+
+    def test_incremental_pmtiles_low_zooms_kept(self):
+        '''Are tiles below INCREMENTAL_MIN_ZOOM copied from the base archive untouched, while the changed tiles above it match a full rebuild?'''
+        workflow = Parcel.objects.get(pin_primary='covenanted-parcel-1').workflow
+        base_manifest = covenant_manifest(workflow)
+
+        # Like a tippecanoe archive, the base covers every zoom, far more than the changed covenant needs rebuilt
+        base_pmtiles = io.BytesIO()
+        write_python_pmtiles(workflow, base_pmtiles, 'test_layer', base_manifest, 0, 14)
+        manifest_file = io.BytesIO()
+        write_manifest(base_manifest, manifest_file, 'test_layer', 0, 14)
+        manifest_file.seek(0)
+
+        changed = CovenantedParcel.objects.filter(workflow=workflow).first()
+        changed.doc_num = 'changed-doc-num'
+        changed.save()
+        manifest = covenant_manifest(workflow)
+
+        updated = io.BytesIO()
+        counts = update_pmtiles(workflow, io.BytesIO(base_pmtiles.getvalue()), read_manifest(manifest_file), manifest, updated)
+        self.assertEqual(counts['rebuild_min_zoom'], INCREMENTAL_MIN_ZOOM)
+        self.assertEqual((counts['min_zoom'], counts['max_zoom']), (0, 14))
+        self.assertGreater(counts['rebuilt_tiles'], 0)
+
+        rebuilt = io.BytesIO()
+        write_python_pmtiles(workflow, rebuilt, 'test_layer', manifest, 0, 14)
+
+        base_tiles = dict(PMTilesReader(io.BytesIO(base_pmtiles.getvalue())).iter_tiles())
+        updated_tiles = dict(PMTilesReader(io.BytesIO(updated.getvalue())).iter_tiles())
+        rebuilt_tiles = dict(PMTilesReader(io.BytesIO(rebuilt.getvalue())).iter_tiles())
+
+        low_zoom_ids = [t for t in base_tiles if tileid_to_zxy(t)[0] < INCREMENTAL_MIN_ZOOM]
+        self.assertGreater(len(low_zoom_ids), 0)
+        for tile_id in low_zoom_ids:
+            self.assertEqual(updated_tiles[tile_id], base_tiles[tile_id])
+
+        high_zoom_ids = sorted([t for t in rebuilt_tiles if tileid_to_zxy(t)[0] >= INCREMENTAL_MIN_ZOOM])
+        self.assertEqual(sorted([t for t in updated_tiles if tileid_to_zxy(t)[0] >= INCREMENTAL_MIN_ZOOM]), high_zoom_ids)
+        for tile_id in high_zoom_ids:
+            self.assertEqual(decompress(updated_tiles[tile_id], 2), decompress(rebuilt_tiles[tile_id], 2))
+
     def test_addition_wide_covenanted_parcel_creation(self):
         # Create addition-wide ZooniverseSubject and see if it creates CovenantedParcel objects
         cps_initial = CovenantedParcel.objects.filter(
@@ -395,3 +647,110 @@ class CovenantedParcelTests(TestCase):
         )
         self.assertEqual(cps_after_delete.count(), 0)
 
+
+@override_settings(ZOONIVERSE_QUESTION_LOOKUP=TEST_ZOON_SETTINGS)
+class BulkParcelMatchTests(TestCase):
+    fixtures = ['zoon', 'plat', 'parcel']
+
+    @classmethod
+    def setUpTestData(cls):
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+
+        management.call_command('rebuild_parcel_spatial_lookups', workflow=workflow.workflow_name)
+        management.call_command('rebuild_covenant_spatial_lookups', workflow=workflow.workflow_name)
+
+    def get_match_state(self):
+        zoon_state = {
+            z.pk: (z.bool_parcel_match, sorted(z.parcel_matches.values_list('pk', flat=True)), z.parcel_city, z.geom_union_4326.area if z.geom_union_4326 else None)
+            for z in ZooniverseSubject.objects.filter(workflow_id=1)
+        }
+        manual_state = {
+            m.pk: (m.bool_parcel_match, sorted(m.parcel_matches.values_list('pk', flat=True)), m.parcel_city)
+            for m in ManualCovenant.objects.filter(workflow_id=1)
+        }
+        covenanted_parcels = sorted(Parcel.objects.filter(workflow_id=1, bool_covenant=True).values_list('pk', flat=True))
+        return zoon_state, manual_state, covenanted_parcels
+
+    def run_match_parcels(self, legacy):
+        command = MatchParcelsCommand()
+        command.handle(workflow='MN Test County', local=False, test=True, legacy=legacy, incremental=False)
+        return [(r['join_string'], r['match'], r['num_parcels']) for r in command.match_report]
+
+    def test_bulk_matcher_same_as_legacy(self):
+        '''Does the bulk matcher produce the same parcel matches, flags and match report as matching through each covenant's save routine?'''
+        with transaction.atomic():
+            legacy_report = self.run_match_parcels(legacy=True)
+            legacy_state = self.get_match_state()
+            transaction.set_rollback(True)
+
+        bulk_report = self.run_match_parcels(legacy=False)
+        bulk_state = self.get_match_state()
+
+        self.assertGreater(len(bulk_report), 0)
+        self.assertEqual(bulk_report, legacy_report)
+        self.assertEqual(bulk_state, legacy_state)
+
+    def make_stale(self, subjects):
+        '''Drop parcel matches and flattened covenants behind the back of the change log'''
+        parcel_ids = list(Parcel.objects.filter(zooniversesubject__in=subjects).values_list('pk', flat=True))
+        CovenantedParcel.objects.filter(parcel__pk__in=parcel_ids).delete()
+        for subject in subjects:
+            subject.parcel_matches.clear()
+        ZooniverseSubject.objects.filter(pk__in=[s.pk for s in subjects]).update(bool_parcel_match=False)
+
+    def test_incremental_match_dirty_covenant(self):
+        '''Does match_parcels --incremental re-match a covenant logged as dirty and rebuild its CovenantedParcel rows?'''
+        self.run_match_parcels(legacy=False)
+        full_state = self.get_match_state()
+        full_flat_count = CovenantedParcel.objects.filter(workflow_id=1).count()
+
+        subject = ZooniverseSubject.objects.filter(workflow_id=1, bool_parcel_match=True).first()
+        self.make_stale([subject])
+        DirtyMatchKey.objects.mark(subject.workflow, 'zs', [subject.pk])
+
+        management.call_command('match_parcels', workflow='MN Test County', incremental=True)
+
+        self.assertEqual(self.get_match_state(), full_state)
+        self.assertEqual(CovenantedParcel.objects.filter(workflow_id=1).count(), full_flat_count)
+        self.assertEqual(DirtyMatchKey.objects.filter(workflow_id=1).count(), 0)
+
+    def test_incremental_match_dirty_addition(self):
+        '''Does match_parcels --incremental re-match every covenant in an addition logged as dirty, and leave other covenants alone?'''
+        # A covenant in another addition, which won't be logged as dirty
+        other = ZooniverseSubject.objects.create(
+            workflow_id=1,
+            zoon_subject_id='9001',
+            bool_covenant=True,
+            bool_covenant_final=True,
+            deed_date_final='2025-04-01',
+            addition_final='MPC BASE ADDITION',
+            block_final='1',
+            lot_final='1',
+            bool_parcel_match=False,
+            image_ids='',
+        )
+
+        self.run_match_parcels(legacy=False)
+        full_state = self.get_match_state()
+
+        subject = ZooniverseSubject.objects.get(pk=5)
+        addition = standardize_addition(subject.addition_final)
+        self.assertNotEqual(standardize_addition(other.addition_final), addition)
+        self.assertTrue(full_state[0][other.pk][0])
+        self.assertTrue(full_state[0][subject.pk][0])
+
+        addition_subjects = [z for z in ZooniverseSubject.objects.filter(workflow_id=1, bool_parcel_match=True) if standardize_addition(z.addition_final) == addition]
+        self.make_stale(addition_subjects)
+
+        # Not logged as dirty, so should stay stale
+        self.make_stale([other])
+        stale_other = self.get_match_state()[0][other.pk]
+        self.assertFalse(stale_other[0])
+        self.assertEqual(stale_other[1], [])
+        full_state[0][other.pk] = stale_other
+
+        DirtyMatchKey.objects.mark(subject.workflow, 'ad', [addition])
+        management.call_command('match_parcels', workflow='MN Test County', incremental=True)
+
+        self.assertEqual(self.get_match_state()[0][other.pk], stale_other)
+        self.assertEqual(self.get_match_state()[0], full_state[0])
@@ -0,0 +1,111 @@
+from django.db import connection
+from django.contrib.gis.geos import GEOSGeometry
+
+from apps.parcel.models import Parcel, AdditionWideMatch
+from apps.zoon.models import ZooniverseSubject
+from apps.parcel.utils.lookup_cache import get_parcel_lookup_version
+from apps.parcel.utils.match_utils import resolve_addition_wide_parcels, chunk_list
+
+
+def build_addition_unions(parcel_ids_by_name):
+    '''{standardized addition: MultiPolygon} of the union of each addition's parcels, in one grouped query'''
+    names = []
+    parcel_ids = []
+    for name, ids in parcel_ids_by_name.items():
+        names.extend([name] * len(ids))
+        parcel_ids.extend(ids)
+    if len(parcel_ids) == 0:
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            SELECT additions.name, ST_AsEWKB(ST_Multi(ST_CollectionExtract(ST_Union(p.geom_4326), 3)))
+            FROM unnest(%s::text[], %s::int[]) AS additions(name, parcel_id)
+            JOIN {Parcel._meta.db_table} AS p ON p.id = additions.parcel_id
+            GROUP BY additions.name
+        ''', [names, parcel_ids])
+        return {name: GEOSGeometry(memoryview(geom)) if geom is not None else None for name, geom in cursor.fetchall()}
+
+
+def get_addition_wide_matches(workflow, names):
+    '''{standardized addition: AdditionWideMatch} for every name, reading current cache entries and building the rest with resolve_addition_wide_parcels and a grouped ST_Union. None and blank names are left out.'''
+    names = set([n for n in names if n not in [None, '']])
+    if len(names) == 0:
+        return {}
+
+    version = get_parcel_lookup_version(workflow)
+    entries = {e.addition_standardized: e for e in AdditionWideMatch.objects.filter(
+        workflow=workflow,
+        addition_standardized__in=names,
+        parcel_lookup_version=version
+    )}
+
+    missing = names - set(entries.keys())
+    if len(missing) > 0:
+        resolved = resolve_addition_wide_parcels(workflow, missing)
+        unions = build_addition_unions({name: ids for name, (bool_match, ids) in resolved.items()})
+        new_entries = [
+            AdditionWideMatch(
+                workflow=workflow,
+                addition_standardized=name,
+                bool_match=bool_match,
+                parcel_ids=sorted(ids),
+                geom_union_4326=unions.get(name),
+                parcel_lookup_version=version
+            ) for name, (bool_match, ids) in resolved.items()
+        ]
+        AdditionWideMatch.objects.bulk_create(
+            new_entries,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['workflow', 'addition_standardized'],
+            update_fields=['bool_match', 'parcel_ids', 'geom_union_4326', 'parcel_lookup_version', 'date_built']
+        )
+        entries.update({e.addition_standardized: e for e in new_entries})
+
+    return entries
+
+
+def cached_geom_union(cov_obj):
+    '''The cached union for an addition-wide covenant whose parcel matches are exactly its addition's parcels, or None if the union has to be computed (no cached entry, or parcels were added by other means like PIN links)'''
+    entry = getattr(cov_obj, 'addition_wide_match', None)
+    if entry is None or entry.geom_union_4326 is None:
+        return None
+    if set(cov_obj.parcel_matches.values_list('pk', flat=True)) != set(entry.parcel_ids):
+        return None
+    return entry.geom_union_4326
+
+
+def apply_cached_geom_unions(workflow, subject_additions):
+    '''Set geom_union_4326 from the cache for addition-wide ZooniverseSubjects ({subject id: standardized addition}) whose parcel matches are exactly their addition's parcels. Returns the ids that were set, so only the rest need a fresh union.'''
+    entries = get_addition_wide_matches(workflow, subject_additions.values())
+    through = ZooniverseSubject.parcel_matches.through
+
+    current_matches = {}
+    for chunk in chunk_list(subject_additions.keys()):
+        for subject_id, parcel_id in through.objects.filter(
+            zooniversesubject_id__in=chunk
+        ).values_list('zooniversesubject_id', 'parcel_id'):
+            current_matches.setdefault(subject_id, set()).add(parcel_id)
+
+    subjects_by_entry = {}
+    for subject_id, addition in subject_additions.items():
+        entry = entries.get(addition)
+        if entry is None or entry.geom_union_4326 is None:
+            continue
+        if current_matches.get(subject_id, set()) == set(entry.parcel_ids):
+            subjects_by_entry.setdefault(entry.pk, []).append(subject_id)
+
+    applied_ids = set()
+    with connection.cursor() as cursor:
+        for entry_pk, subject_ids in subjects_by_entry.items():
+            for chunk in chunk_list(subject_ids):
+                cursor.execute(f'''
+                    UPDATE {ZooniverseSubject._meta.db_table} AS zs
+                    SET geom_union_4326 = awm.geom_union_4326
+                    FROM {AdditionWideMatch._meta.db_table} AS awm
+                    WHERE awm.id = %s AND zs.id = ANY(%s) AND zs.bool_parcel_match = TRUE
+                    RETURNING zs.id;
+                ''', [entry_pk, chunk])
+                applied_ids.update([row[0] for row in cursor.fetchall()])
+    return applied_ids
@@ -1,8 +1,14 @@
+import csv
+import json
+import time
+import tempfile
 import pandas as pd
 import numpy as np
 import geopandas as gpd
 
+from django.contrib.gis.db import models
 from django.contrib.gis.db.models.functions import AsWKT
+from django.db import connection, transaction
 
 from apps.parcel.models import Parcel, CovenantedParcel
 from apps.deed.models import DeedPage
@@ -10,9 +16,12 @@ from apps.zoon.models import ZooniverseSubject, ManualCovenant
 from apps.zoon.models import MATCH_TYPE_OPTIONS, MANUAL_COV_OPTIONS
 
 from apps.zoon.utils.zooniverse_load import get_image_url_prefix, get_full_url
+from apps.parcel.utils.match_utils import chunk_list
 
 MATCH_TYPES = MATCH_TYPE_OPTIONS + MANUAL_COV_OPTIONS
 
+COPY_NULL = '\\N'
+
 EXPORT_FIELDS_ORDERED = [
     'db_id',
     'workflow',
@@ -55,6 +64,58 @@ EXPORT_FIELDS_ORDERED = [
     'subd_dbid',
 ]
 
+# Values pulled from Parcel.covenant_objects to build each CovenantedParcel
+PARCEL_MODEL_FIELDS = [
+    'id',
+    'cnty_name',
+    'cnty_fips',
+    'doc_num',
+    'main_image',
+    'cnty_pin',
+
+    'deed_date',
+    'seller',
+    'buyer',
+    'cov_type',
+    'cov_text',
+
+    'zn_subj_id',
+    'zn_dt_ret',
+
+    'deed_page_1',
+    'deed_page_2',
+    'deed_page_3',
+
+    'med_score',
+    'manual_cx',
+    'match_type',
+    'join_candidates',
+
+    'street_add',
+    'city',
+    'state',
+    'zip_code',
+
+    'add_cov',
+    'block_cov',
+    'lot_cov',
+
+    'map_book',
+    'map_page',
+
+    'add_mod',
+    'block_mod',
+    'lot_mod',
+    'ph_dsc_mod',
+
+    'plat__pk',
+    'subdivision_spatial__pk',
+
+    'dt_updated',
+    'geom_4326'
+]
+
+
 def delete_flat_covenanted_parcels(parcels):
     existing_covs = CovenantedParcel.objects.filter(parcel__pk__in=parcels.values_list('pk', flat=True))
     if existing_covs.count() > 0:
@@ -84,58 +145,66 @@ def match_type_to_str(match_type):
         return 'Something else'
 
 
-def save_flat_covenanted_parcels(parcels):
-    '''Take a queryset of covenanted parcels instances and make flat CovenantedParcel export instance using Parcel.covenanted_parcels model manager.'''
-
-    PARCEL_MODEL_FIELDS = [
-        'id',
-        'cnty_name',
-        'cnty_fips',
-        'doc_num',
-        'main_image',
-        'cnty_pin',
-
-        'deed_date',
-        'seller',
-        'buyer',
-        'cov_type',
-        'cov_text',
-
-        'zn_subj_id',
-        'zn_dt_ret',
-
-        'deed_page_1',
-        'deed_page_2',
-        'deed_page_3',
-
-        'med_score',
-        'manual_cx',
-        'match_type',
-        'join_candidates',
-
-        'street_add',
-        'city',
-        'state',
-        'zip_code',
+def get_parcel_covenant_values(parcels, single_pass=True):
+    '''The PARCEL_MODEL_FIELDS values for each covenanted parcel, resolved with the single-pass query by default or the original annotated Parcel.covenant_objects queryset'''
+    if single_pass:
+        return Parcel.covenant_objects.single_pass_values(parcels, PARCEL_MODEL_FIELDS)
+    return list(Parcel.covenant_objects.filter(pk__in=parcels.values_list('pk', flat=True)).values(*PARCEL_MODEL_FIELDS))
+
+
+def diff_parcel_covenant_values(rows_a, rows_b):
+    '''Compare two get_parcel_covenant_values() results. Returns a list of (parcel id, field, value a, value b) for every difference.'''
+    rows_a = {r['id']: r for r in rows_a}
+    rows_b = {r['id']: r for r in rows_b}
+    diffs = []
+    for parcel_id in sorted(set(rows_a.keys()) | set(rows_b.keys())):
+        a = rows_a.get(parcel_id)
+        b = rows_b.get(parcel_id)
+        if a is None or b is None:
+            diffs.append((parcel_id, 'id', a is not None, b is not None))
+            continue
+        for field in PARCEL_MODEL_FIELDS:
+            value_a = a[field]
+            value_b = b[field]
+            if field == 'geom_4326' and value_a is not None and value_b is not None:
+                value_a = value_a.ewkt
+                value_b = value_b.ewkt
+            if value_a != value_b:
+                diffs.append((parcel_id, field, value_a, value_b))
+    return diffs
+
+
+def flatten_covenant_values(parcel_covenants):
+    '''Turn get_parcel_covenant_values() rows into a DataFrame with the CovenantedParcel field names (minus workflow)'''
+    covenants_df = pd.DataFrame(parcel_covenants, columns=PARCEL_MODEL_FIELDS)
+
+    covenants_df['deed_date'] = pd.to_datetime(covenants_df['deed_date'], errors='coerce', format='%Y-%m-%d')
+    covenants_df['deed_year'] = covenants_df['deed_date'].dt.year.astype('Int64')
+
+    covenants_df['dt_updated'] = pd.DatetimeIndex(covenants_df['dt_updated']).date
+
+    covenants_df['join_strgs'] = covenants_df['join_candidates'].apply(join_strings_to_str)
+    covenants_df['match_type'] = covenants_df['match_type'].apply(match_type_to_str)
+    covenants_df['image_ids'] = [
+        ','.join([page for page in pages if pd.notna(page)])
+        for pages in covenants_df[['deed_page_1', 'deed_page_2', 'deed_page_3']].itertuples(index=False, name=None)
+    ]
 
-        'add_cov',
-        'block_cov',
-        'lot_cov',
+    covenants_df.rename(columns={
+        'id': 'parcel_id', # Set foreign key to parcel
+        'plat__pk': 'plat_dbid',  # These can just be text representations
+        'subdivision_spatial__pk': 'subd_dbid',  # These can just be text representations
+    }, inplace=True)
 
-        'map_book',
-        'map_page',
+    # Delete unnecessary fields
+    covenants_df.drop(columns=['join_candidates', 'deed_page_1', 'deed_page_2', 'deed_page_3'], inplace=True)
 
-        'add_mod',
-        'block_mod',
-        'lot_mod',
-        'ph_dsc_mod',
+    # Fill nulls
+    return covenants_df.astype(object).where(covenants_df.notna(), None)
 
-        'plat__pk',
-        'subdivision_spatial__pk',
 
-        'dt_updated',
-        'geom_4326'
-    ]
+def save_flat_covenanted_parcels(parcels, single_pass=True):
+    '''Take a queryset of covenanted parcels instances and make flat CovenantedParcel export instance using Parcel.covenanted_parcels model manager.'''
 
     parcel_pks = parcels.values_list('pk', flat=True)
 
@@ -143,47 +212,120 @@ def save_flat_covenanted_parcels(parcels):
         print('No mapped covenants to export.')
         return False
     else:
-        cov_creation_objs = []
-
-        parcel_covenants = Parcel.covenant_objects.filter(pk__in=parcel_pks).values(*PARCEL_MODEL_FIELDS)
-        covenants_df = pd.DataFrame(parcel_covenants)
+        covenants_df = flatten_covenant_values(get_parcel_covenant_values(parcels, single_pass))
         covenants_df['workflow'] = parcels.first().workflow
 
-        covenants_df['deed_date'] = covenants_df['deed_date'].apply(lambda x: pd.to_datetime(x,errors = 'coerce', format = '%Y-%m-%d'))
-        covenants_df['deed_year'] = covenants_df['deed_date'].apply(lambda x: year_or_null(x))
-        covenants_df['deed_year'] = covenants_df['deed_year'].fillna(np.nan).replace([np.nan], [None])
-
-        covenants_df['dt_updated'] = pd.DatetimeIndex(covenants_df['dt_updated']).date
-
-        covenants_df['join_strgs'] = covenants_df['join_candidates'].apply(lambda x: join_strings_to_str(x))
-        covenants_df['match_type'] = covenants_df['match_type'].apply(lambda x: match_type_to_str(x))
-        covenants_df['image_ids'] = covenants_df[['deed_page_1', 'deed_page_2', 'deed_page_3']].apply(lambda x: ','.join(x.dropna()), axis=1)
-
-        covenants_df.rename(columns={
-            'id': 'parcel_id', # Set foreign key to parcel
-            'plat__pk': 'plat_dbid',  # These can just be text representations
-            'subdivision_spatial__pk': 'subd_dbid',  # These can just be text representations
-        }, inplace=True)
-
-        # Delete unnecessary fields
-        covenants_df.drop(columns=['join_candidates', 'deed_page_1', 'deed_page_2', 'deed_page_3'], inplace=True)
-        
-        # Fill nulls
-        covenants_df = covenants_df.fillna(np.nan).replace([np.nan], [None])
- 
-        for p in covenants_df.to_dict('records'):
-            cp = CovenantedParcel(
-                **p
-            )
-            cov_creation_objs.append(cp)
-
-        print(f'Creating {len(cov_creation_objs)} CovenantedParcel objects...')    
-        
-        CovenantedParcel.objects.bulk_create(cov_creation_objs)
+        cov_creation_objs = [CovenantedParcel(**p) for p in covenants_df.to_dict('records')]
+
+        print(f'Creating {len(cov_creation_objs)} CovenantedParcel objects...')
+
+        CovenantedParcel.objects.bulk_create(cov_creation_objs, batch_size=5000)
 
         return CovenantedParcel.objects.filter(parcel__pk__in=parcel_pks)
 
 
+class CovenantedParcelRefresher:
+    '''Rebuild a workflow's CovenantedParcel rows without holding the whole county in memory. Covenanted parcels are flattened a chunk at a time and streamed to a temporary CSV, which is COPYed into a staging table. The old rows are then swapped for the staged ones in a single transaction, so readers see either the old or the new set, never a half-refreshed one.'''
+
+    def __init__(self, workflow, chunksize=5000):
+        self.workflow = workflow
+        self.chunksize = chunksize
+        self.timings = {}
+        self.fields = [f for f in CovenantedParcel._meta.concrete_fields if not f.primary_key]
+        self.date_field = models.DateField()
+
+    def log_phase(self, phase, start):
+        self.timings[phase] = time.perf_counter() - start
+        print(f'{phase} took {self.timings[phase]:.1f}s')
+
+    def copy_value(self, field, value):
+        if value is None:
+            return COPY_NULL
+        if isinstance(field, models.JSONField):
+            return json.dumps(value)
+        if isinstance(field, models.GeometryField):
+            return value.hexewkb.decode()
+        if isinstance(field, models.BooleanField):
+            return 't' if value else 'f'
+        if isinstance(field, models.IntegerField) or isinstance(field, models.ForeignKey):
+            return str(int(value))
+        if isinstance(field, models.DateField):
+            # Same conversion Django applies when saving a datetime to a DateField
+            return self.date_field.to_python(value).isoformat()
+        return str(value)
+
+    def write_rows(self, parcel_ids, csv_file):
+        '''Flatten parcels a chunk at a time and write them to csv_file. Returns number of rows written.'''
+        writer = csv.writer(csv_file)
+        writer.writerow([f.column for f in self.fields])
+
+        row_count = 0
+        for chunk in chunk_list(parcel_ids, self.chunksize):
+            parcel_covenants = get_parcel_covenant_values(Parcel.objects.filter(pk__in=chunk))
+            covenants_df = flatten_covenant_values(parcel_covenants)
+            covenants_df['workflow'] = self.workflow.pk
+            covenants_df['parcel'] = covenants_df.pop('parcel_id')
+            for row in covenants_df[[f.name for f in self.fields]].itertuples(index=False, name=None):
+                writer.writerow([self.copy_value(field, value) for field, value in zip(self.fields, row)])
+            row_count += len(covenants_df.index)
+            print(f'{row_count}/{len(parcel_ids)} covenanted parcels flattened...')
+        csv_file.flush()
+        return row_count
+
+    def swap_rows(self, csv_file, parcel_ids=None):
+        '''Load csv_file into a staging table, then replace the workflow's rows (or just the rows for parcel_ids) in one transaction. Returns number of rows inserted.'''
+        table = CovenantedParcel._meta.db_table
+        columns = ', '.join([f.column for f in self.fields])
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            # ON COMMIT DROP only fires at the outermost commit, so an earlier swap in the same transaction leaves this behind
+            cursor.execute('DROP TABLE IF EXISTS tmp_covenanted_parcels;')
+            cursor.execute(f'''
+                CREATE TEMP TABLE tmp_covenanted_parcels ON COMMIT DROP AS
+                SELECT {columns} FROM {table} WITH NO DATA;
+            ''')
+            csv_file.seek(0)
+            cursor.copy_expert(f"COPY tmp_covenanted_parcels ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true, NULL '{COPY_NULL}')", csv_file)
+
+            if parcel_ids is None:
+                cursor.execute(f'DELETE FROM {table} WHERE workflow_id = %s;', [self.workflow.pk])
+            else:
+                # Also clear rows left behind by deleted parcels
+                cursor.execute(f'''
+                    DELETE FROM {table}
+                    WHERE workflow_id = %s AND (parcel_id IS NULL OR parcel_id = ANY(%s));
+                ''', [self.workflow.pk, list(parcel_ids)])
+            print(f'{cursor.rowcount} old CovenantedParcel records deleted.')
+
+            cursor.execute(f'''
+                INSERT INTO {table} ({columns})
+                SELECT {columns} FROM tmp_covenanted_parcels;
+            ''')
+            return cursor.rowcount
+
+    def run(self, parcel_ids=None):
+        '''Refresh every covenanted parcel in the workflow, or just the parcel ids passed'''
+        run_start = time.perf_counter()
+
+        phase_start = time.perf_counter()
+        parcels = Parcel.objects.filter(workflow=self.workflow, bool_covenant=True)
+        if parcel_ids is not None:
+            parcels = parcels.filter(pk__in=list(parcel_ids))
+        covenanted_ids = list(parcels.order_by('pk').values_list('pk', flat=True))
+        self.log_phase(f'Gathering {len(covenanted_ids)} covenanted parcels', phase_start)
+
+        with tempfile.TemporaryFile('w+', newline='') as csv_file:
+            phase_start = time.perf_counter()
+            row_count = self.write_rows(covenanted_ids, csv_file)
+            self.log_phase('Flattening covenants', phase_start)
+
+            phase_start = time.perf_counter()
+            inserted = self.swap_rows(csv_file, parcel_ids)
+            self.log_phase(f'Swapping in {row_count} CovenantedParcel records', phase_start)
+
+        self.log_phase('Total', run_start)
+        return inserted
+
 
 def build_gdf(workflow):
     joined_covenants = CovenantedParcel.objects.filter(
@@ -0,0 +1,74 @@
+import os
+import glob
+import zlib
+import uuid
+import pickle
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.parcel.utils.parcel_utils import build_parcel_spatial_lookups
+
+
+def new_lookup_version():
+    '''A random version string rather than a counter, so a cached lookup can never be mistaken for a current one after a database restore or a rolled-back test transaction'''
+    return uuid.uuid4().hex
+
+
+def bump_parcel_lookup_version(workflow_id):
+    '''Call whenever ParcelJoinCandidate rows for a workflow change, so cached lookups for it are no longer used'''
+    from apps.zoon.models import ZooniverseWorkflow
+    if workflow_id is None:
+        return None
+    version = new_lookup_version()
+    ZooniverseWorkflow.objects.filter(pk=workflow_id).update(parcel_lookup_version=version)
+    return version
+
+
+def get_parcel_lookup_version(workflow):
+    from apps.zoon.models import ZooniverseWorkflow
+    return ZooniverseWorkflow.objects.filter(pk=workflow.pk).values_list('parcel_lookup_version', flat=True).first()
+
+
+def lookup_cache_path(workflow, version):
+    return os.path.join(settings.PARCEL_LOOKUP_CACHE_DIR, f'{workflow.slug}_{workflow.pk}_{version}.pickle.z')
+
+
+def write_disk_cache(workflow, version, blob):
+    '''Write atomically, then clear out older versions for this workflow'''
+    os.makedirs(settings.PARCEL_LOOKUP_CACHE_DIR, exist_ok=True)
+    out_path = lookup_cache_path(workflow, version)
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(blob)
+    os.replace(tmp_path, out_path)
+
+    for old_path in glob.glob(os.path.join(settings.PARCEL_LOOKUP_CACHE_DIR, f'{workflow.slug}_{workflow.pk}_*.pickle.z')):
+        if old_path != out_path:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+
+def get_cached_parcel_lookup(workflow):
+    '''Same result as build_parcel_spatial_lookups(workflow), but reused across calls and processes until this workflow's ParcelJoinCandidates change. Looks in the Django cache, then on local disk, and only then builds from the database. Stored as a zlib-compressed pickle, and each call gets its own copy, so callers are free to modify it.'''
+    if workflow is None:
+        return build_parcel_spatial_lookups(workflow)
+
+    version = get_parcel_lookup_version(workflow)
+    cache_key = f'parcel_lookup_{workflow.pk}_{version}'
+
+    blob = cache.get(cache_key)
+    if blob is None:
+        disk_path = lookup_cache_path(workflow, version)
+        try:
+            with open(disk_path, 'rb') as infile:
+                blob = infile.read()
+            print(f'Loaded parcel lookup from {disk_path}')
+        except FileNotFoundError:
+            blob = zlib.compress(pickle.dumps(build_parcel_spatial_lookups(workflow), protocol=pickle.HIGHEST_PROTOCOL))
+            write_disk_cache(workflow, version, blob)
+        cache.set(cache_key, blob, timeout=None)
+
+    return pickle.loads(zlib.decompress(blob))
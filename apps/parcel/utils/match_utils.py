@@ -0,0 +1,521 @@
+import json
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.parcel.models import Parcel, ParcelJoinCandidate, DirtyMatchKey, DIRTY_KEY_TYPES
+from apps.plat.models import Plat, PlatAlternateName, Subdivision, SubdivisionAlternateName
+from apps.zoon.models import ZooniverseSubject, ManualCovenant, ManualParcelPINLink, ManualCovenantParcelPINLink
+from apps.parcel.utils.parcel_utils import build_parcel_spatial_lookups, standardize_addition
+from apps.parcel.utils.lookup_cache import get_cached_parcel_lookup
+
+AW_EXCLUDED_ADDITIONS = ['', None, 'NONE', 'UNKNOWN']
+
+
+def chunk_list(input_list, chunk_size=10000):
+    input_list = list(input_list)
+    return [input_list[i:i + chunk_size] for i in range(0, len(input_list), chunk_size)]
+
+
+def cov_fk_name(model):
+    '''Name of the covenant-side column on a parcel_matches through table, e.g. zooniversesubject_id'''
+    return f'{model._meta.model_name}_id'
+
+
+def write_parcel_matches(model, pairs, batch_size=10000):
+    '''Insert (covenant_id, parcel_id) rows straight into the parcel_matches through table. Existing rows are left alone, same as parcel_matches.add()'''
+    through = model.parcel_matches.through
+    fk_name = cov_fk_name(model)
+    rows = [through(**{fk_name: cov_id, 'parcel_id': parcel_id}) for cov_id, parcel_id in set(pairs)]
+    through.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+    return len(rows)
+
+
+def clear_parcel_matches(model, cov_ids):
+    '''Set-based equivalent of parcel_matches.clear() for many covenants'''
+    through = model.parcel_matches.through
+    fk_name = cov_fk_name(model)
+    for chunk in chunk_list(cov_ids):
+        through.objects.filter(**{f'{fk_name}__in': chunk}).delete()
+
+
+def matched_parcel_ids(model, cov_ids):
+    '''Ids of parcels currently linked to any of these covenants'''
+    through = model.parcel_matches.through
+    fk_name = cov_fk_name(model)
+    parcel_ids = set()
+    for chunk in chunk_list(cov_ids):
+        parcel_ids.update(through.objects.filter(**{f'{fk_name}__in': chunk}).values_list('parcel_id', flat=True))
+    return parcel_ids
+
+
+def tag_covenanted_parcels(workflow, parcel_ids):
+    '''Same result as the bool_covenant tagging at the end of match_parcels, limited to a set of parcels'''
+    for chunk in chunk_list(parcel_ids):
+        parcels = Parcel.objects.filter(workflow=workflow, pk__in=chunk)
+        parcels.filter(bool_covenant=True).update(bool_covenant=False)
+        parcels.filter(zooniversesubject__isnull=False, zooniversesubject__bool_covenant_final=True).update(bool_covenant=True)
+        parcels.filter(manualcovenant__isnull=False, manualcovenant__bool_confirmed=True).update(bool_covenant=True)
+
+
+def group_dirty_keys(dirty_keys):
+    '''Split a DirtyMatchKey queryset into a dict of key_type -> set of keys. Covenant and parcel keys are returned as ints.'''
+    keys = {key_type: set() for key_type, label in DIRTY_KEY_TYPES}
+    for k in dirty_keys.values('key_type', 'key'):
+        if k['key_type'] == 'ad':
+            keys['ad'].add(k['key'])
+        else:
+            keys[k['key_type']].add(int(k['key']))
+    return keys
+
+
+def dirty_parcel_ids(workflow, dirty_keys):
+    '''Parcels whose bool_covenant value or CovenantedParcel rows may be out of date, given a DirtyMatchKey queryset'''
+    keys = group_dirty_keys(dirty_keys)
+    parcel_ids = set(keys['pa'])
+    parcel_ids.update(matched_parcel_ids(ZooniverseSubject, keys['zs']))
+    parcel_ids.update(matched_parcel_ids(ManualCovenant, keys['mc']))
+    for chunk in chunk_list(keys['ad']):
+        parcel_ids.update(Parcel.objects.filter(
+            workflow=workflow,
+            plat_standardized__in=chunk
+        ).values_list('pk', flat=True))
+    return parcel_ids
+
+
+def set_bool_parcel_match(model, cov_ids, value=True):
+    for chunk in chunk_list(cov_ids):
+        model.objects.filter(pk__in=chunk).update(bool_parcel_match=value)
+
+
+def set_geom_unions_bulk(subject_ids):
+    '''Same result as ZooniverseSubject.set_geom_union(), but computed for all subjects at once with one grouped ST_Union per chunk'''
+    subject_table = ZooniverseSubject._meta.db_table
+    through = ZooniverseSubject.parcel_matches.through
+    parcel_table = Parcel._meta.db_table
+
+    with connection.cursor() as cursor:
+        for chunk in chunk_list(subject_ids):
+            cursor.execute(f'''
+                UPDATE {subject_table} AS zs
+                SET geom_union_4326 = unions.geom
+                FROM (
+                    SELECT pm.zooniversesubject_id AS subject_id,
+                    ST_Multi(ST_CollectionExtract(ST_Union(p.geom_4326), 3)) AS geom
+                    FROM {through._meta.db_table} AS pm
+                    JOIN {parcel_table} AS p ON p.id = pm.parcel_id
+                    WHERE pm.zooniversesubject_id = ANY(%s)
+                    GROUP BY pm.zooniversesubject_id
+                ) AS unions
+                WHERE zs.id = unions.subject_id
+                AND zs.bool_parcel_match = TRUE;
+            ''', [chunk])
+
+            # Unmatched subjects, or matched subjects with no parcels, get an empty union
+            cursor.execute(f'''
+                UPDATE {subject_table} AS zs
+                SET geom_union_4326 = NULL
+                WHERE zs.id = ANY(%s)
+                AND (
+                    zs.bool_parcel_match = FALSE
+                    OR NOT EXISTS (
+                        SELECT 1 FROM {through._meta.db_table} AS pm
+                        WHERE pm.zooniversesubject_id = zs.id
+                    )
+                );
+            ''', [chunk])
+
+
+def set_addresses_bulk(model, cov_ids):
+    '''Same result as zooniverse_join.set_addresses() for many covenants, using one query per chunk to read parcel addresses and a bulk_update to write them.'''
+    through = model.parcel_matches.through
+    fk_name = cov_fk_name(model)
+    update_objs = []
+
+    for chunk in chunk_list(cov_ids):
+        covenants = {
+            c['pk']: c for c in model.objects.filter(
+                pk__in=chunk, bool_parcel_match=True
+            ).values('pk', 'parcel_city')
+        }
+
+        addresses = {pk: [] for pk in covenants.keys()}
+        for row in through.objects.filter(
+            **{f'{fk_name}__in': list(covenants.keys())}
+        ).order_by('id').values(
+            fk_name,
+            'parcel__street_address',
+            'parcel__city',
+            'parcel__state',
+            'parcel__zip_code'
+        ):
+            addresses[row[fk_name]].append({
+                'street_address': row['parcel__street_address'],
+                'city': row['parcel__city'],
+                'state': row['parcel__state'],
+                'zip_code': row['parcel__zip_code'],
+            })
+
+        for pk, address_list in addresses.items():
+            parcel_city = covenants[pk]['parcel_city']
+            if len(address_list) > 0:
+                parcel_city = address_list[0]['city']
+            update_objs.append(model(
+                pk=pk,
+                parcel_addresses=json.dumps(address_list),
+                parcel_city=parcel_city
+            ))
+
+    model.objects.bulk_update(
+        update_objs, ['parcel_addresses', 'parcel_city'], batch_size=1000)
+    return len(update_objs)
+
+
+def resolve_addition_wide_parcels(workflow, names):
+    '''Set-based version of addition_wide_parcel_match. Returns a dict of standardized addition name -> (bool_parcel_match, set of parcel ids). Plat and subdivision alternate names are only consulted when there is no direct plat or subdivision hit, same as the per-covenant version.'''
+    names = set(n for n in names if n is not None)
+    results = {n: [False, set()] for n in names}
+
+    def add_rows(rows, name_field, parcel_field):
+        found = set()
+        for row in rows:
+            name = row[name_field]
+            found.add(name)
+            results[name][0] = True
+            if row[parcel_field]:
+                results[name][1].add(row[parcel_field])
+        return found
+
+    # Lookup by addition name
+    add_rows(Parcel.objects.filter(
+        workflow=workflow,
+        plat_standardized__in=[n for n in names if n != '']
+    ).values('plat_standardized', 'pk'), 'plat_standardized', 'pk')
+
+    # Lookup by plat map obj, then by alternate name where there is no plat
+    plat_names = add_rows(Plat.objects.filter(
+        workflow=workflow,
+        plat_name_standardized__in=names
+    ).values('plat_name_standardized', 'parcel__pk'), 'plat_name_standardized', 'parcel__pk')
+
+    add_rows(PlatAlternateName.objects.filter(
+        workflow=workflow,
+        alternate_name_standardized__in=names - plat_names
+    ).values('alternate_name_standardized', 'plat__parcel__pk'), 'alternate_name_standardized', 'plat__parcel__pk')
+
+    # Lookup by subdivision, then by alternate name where there is no subdivision
+    subdivision_names = add_rows(Subdivision.objects.filter(
+        workflow=workflow,
+        name_standardized__in=names
+    ).values('name_standardized', 'parcel__pk'), 'name_standardized', 'parcel__pk')
+
+    add_rows(SubdivisionAlternateName.objects.filter(
+        workflow=workflow,
+        alternate_name_standardized__in=names - subdivision_names
+    ).values('alternate_name_standardized', 'subdivision__parcel__pk'), 'alternate_name_standardized', 'subdivision__parcel__pk')
+
+    return results
+
+
+class BulkParcelMatcher:
+    '''Set-based replacement for the covenant-by-covenant matching in the match_parcels management command. Join strings, addition-wide covenants and PIN links are each resolved in a single pass, M2M rows are written straight to the through tables, and bool_parcel_match, geometry unions and addresses are recomputed in bulk, without running ZooniverseSubject.save() or the ManualCovenant post_save signal for each covenant. The match_report rows are built in the same order and with the same fields as the per-covenant version so the resulting JoinReport is unchanged.'''
+
+    def __init__(self, workflow, parcel_lookup=None):
+        self.workflow = workflow
+        self.parcel_lookup = parcel_lookup
+        self.match_report = []
+        self.touched_ids = {ZooniverseSubject: set(), ManualCovenant: set()}
+        # Standardized addition of each addition-wide covenant, so cached unions can be reused
+        self.addition_wide_ids = {ZooniverseSubject: {}, ManualCovenant: {}}
+        # None means every covenant in the workflow
+        self.scope = {ZooniverseSubject: None, ManualCovenant: None}
+
+    def scoped(self, model, qs, field='pk'):
+        '''Limit a queryset to the covenants in scope, if this is a partial run'''
+        if self.scope[model] is None:
+            return qs
+        return qs.filter(**{f'{field}__in': list(self.scope[model])})
+
+    def match_join_candidates(self, model, covenants):
+        '''Resolve stored join_candidates against the parcel lookup. Returns set of matched covenant ids.'''
+        pairs = []
+        matched_ids = set()
+        for cov in covenants.values('pk', 'join_candidates').iterator(chunk_size=5000):
+            for c in cov['join_candidates'] or []:
+                lot_match = self.parcel_lookup.get(c['join_string'])
+                if lot_match:
+                    c['match'] = True
+                    c['parcel_metadata'] = dict(lot_match['parcel_metadata'], parcel_ids=lot_match['parcel_ids'])
+                    c['num_parcels'] = len(lot_match['parcel_ids'])
+
+                    for parcel_id in lot_match['parcel_ids']:
+                        pairs.append((cov['pk'], parcel_id))
+                    matched_ids.add(c['subject_id'])
+                else:
+                    c['match'] = False
+                    c['num_parcels'] = 0
+                self.match_report.append(c)
+
+        print(f'{len(matched_ids)} {model._meta.verbose_name_plural} matched, writing {len(set(pairs))} parcel links...')
+        write_parcel_matches(model, pairs)
+        set_bool_parcel_match(model, matched_ids, True)
+        self.touched_ids[model].update(matched_ids)
+        return matched_ids
+
+    def match_parcels_bulk_zoon(self):
+        print("Attempting to auto-join zooniverse covenants to parcels ...")
+        covenants = ZooniverseSubject.objects.filter(
+            workflow=self.workflow,
+            bool_covenant_final=True
+        ).exclude(
+            addition_final=''
+        ).exclude(
+            match_type_final='AW'  # Addition-wide covenants handled later
+        ).order_by('addition_final')
+        return self.match_join_candidates(ZooniverseSubject, self.scoped(ZooniverseSubject, covenants))
+
+    def match_parcels_bulk_manual(self):
+        print("Attempting to auto-join manual covenants to parcels ...")
+        covenants = ManualCovenant.objects.filter(
+            workflow=self.workflow,
+            bool_confirmed=True
+        ).exclude(
+            cov_type='PT'  # Addition-wide covenants handled later
+        ).order_by('addition')
+        return self.match_join_candidates(ManualCovenant, self.scoped(ManualCovenant, covenants))
+
+    def match_addition_wide(self, model, covenants, addition_field):
+        cov_additions = {c['pk']: standardize_addition(c[addition_field]) for c in covenants.values('pk', addition_field)}
+        if len(cov_additions) == 0:
+            return set()
+
+        from apps.parcel.utils.addition_cache import get_addition_wide_matches
+        entries = get_addition_wide_matches(self.workflow, cov_additions.values())
+
+        # Addition-wide matches replace whatever was there before
+        clear_parcel_matches(model, cov_additions.keys())
+
+        pairs = []
+        matched_ids = set()
+        for cov_id, addition in cov_additions.items():
+            entry = entries.get(addition)
+            bool_match, parcel_ids = (entry.bool_match, entry.parcel_ids) if entry is not None else (False, [])
+            if bool_match:
+                matched_ids.add(cov_id)
+            for parcel_id in parcel_ids:
+                pairs.append((cov_id, parcel_id))
+
+        print(f'{len(matched_ids)} of {len(cov_additions)} addition-wide {model._meta.verbose_name_plural} matched, writing {len(pairs)} parcel links...')
+        write_parcel_matches(model, pairs)
+        set_bool_parcel_match(model, set(cov_additions.keys()) - matched_ids, False)
+        set_bool_parcel_match(model, matched_ids, True)
+        self.touched_ids[model].update(cov_additions.keys())
+        self.addition_wide_ids[model].update(cov_additions)
+        return matched_ids
+
+    def match_addition_wide_covenants(self):
+        print("Attempting to auto-join previously confirmed addition-wide covenants to parcels ...")
+        zoon_covenants = ZooniverseSubject.objects.filter(
+            workflow=self.workflow,
+            bool_covenant_final=True,
+            match_type_final='AW',
+            bool_manual_correction=True
+        ).exclude(
+            addition_final__in=AW_EXCLUDED_ADDITIONS
+        )
+        zoon_covenants = self.scoped(ZooniverseSubject, zoon_covenants)
+        self.match_addition_wide(ZooniverseSubject, zoon_covenants, 'addition_final')
+
+        print("Auto-joining addition-wide manual covenants...")
+        manual_covenants = ManualCovenant.objects.filter(
+            workflow=self.workflow,
+            bool_confirmed=True,
+            cov_type='PT',
+        ).exclude(
+            addition__in=AW_EXCLUDED_ADDITIONS
+        )
+        manual_covenants = self.scoped(ManualCovenant, manual_covenants)
+        self.match_addition_wide(ManualCovenant, manual_covenants, 'addition')
+        # ManualCovenant.check_parcel_match blanks join candidates on plat covenants
+        manual_covenants.update(join_candidates='')
+
+    def match_parcel_pin_links(self, model, pin_links, cov_field, workflow_pins_lookup):
+        pairs = []
+        for link in pin_links.values(cov_field, 'parcel_pin'):
+            parcel_id = workflow_pins_lookup.get(link['parcel_pin'])
+            if parcel_id and link[cov_field]:
+                pairs.append((link[cov_field], parcel_id))
+
+        matched_ids = set(cov_id for cov_id, parcel_id in pairs)
+        print(f'{len(matched_ids)} {model._meta.verbose_name_plural} matched by PIN...')
+        write_parcel_matches(model, pairs)
+        set_bool_parcel_match(model, matched_ids, True)
+        self.touched_ids[model].update(matched_ids)
+        return matched_ids
+
+    def match_parcel_pins(self):
+        workflow_pins_lookup = {parcel['pin_primary']: parcel['pk'] for parcel in Parcel.objects.filter(workflow=self.workflow).values('pk', 'pin_primary')}
+
+        print("Attempting to join Parcel PIN matches on ZooniverseSubjects...")
+        self.match_parcel_pin_links(
+            ZooniverseSubject,
+            self.scoped(ZooniverseSubject, ManualParcelPINLink.objects.filter(workflow=self.workflow), 'zooniverse_subject_id'),
+            'zooniverse_subject_id',
+            workflow_pins_lookup
+        )
+
+        print("Attempting to join Parcel PIN matches on ManualCovenants...")
+        self.match_parcel_pin_links(
+            ManualCovenant,
+            self.scoped(ManualCovenant, ManualCovenantParcelPINLink.objects.filter(workflow=self.workflow), 'manual_covenant_id'),
+            'manual_covenant_id',
+            workflow_pins_lookup
+        )
+
+    def update_match_fields(self):
+        from apps.parcel.utils.addition_cache import apply_cached_geom_unions
+        subject_ids = list(self.touched_ids[ZooniverseSubject])
+        cached_ids = apply_cached_geom_unions(self.workflow, self.addition_wide_ids[ZooniverseSubject])
+        print(f'Updating geometry unions for {len(subject_ids)} ZooniverseSubjects ({len(cached_ids)} addition-wide from cache)...')
+        set_geom_unions_bulk([s for s in subject_ids if s not in cached_ids])
+
+        print(f'Updating parcel addresses for {len(subject_ids)} ZooniverseSubjects...')
+        set_addresses_bulk(ZooniverseSubject, subject_ids)
+
+        manual_ids = list(self.touched_ids[ManualCovenant])
+        print(f'Updating parcel addresses for {len(manual_ids)} ManualCovenants...')
+        set_addresses_bulk(ManualCovenant, manual_ids)
+
+    def run(self):
+        if self.parcel_lookup is None:
+            self.parcel_lookup = get_cached_parcel_lookup(self.workflow)
+
+        with transaction.atomic():
+            self.match_parcels_bulk_zoon()
+            self.match_parcels_bulk_manual()
+            self.match_addition_wide_covenants()
+            self.match_parcel_pins()
+            self.update_match_fields()
+
+        return self.match_report
+
+
+class IncrementalParcelMatcher(BulkParcelMatcher):
+    '''Re-match only the covenants affected by the DirtyMatchKey change log. Dirty covenants are re-matched directly. Dirty additions pull in every covenant in that addition or with a join string in it. Dirty parcels pull in the covenants currently linked to them, covenants sharing one of their join strings or PINs, and addition-wide covenants on their plat or subdivision. The affected covenants have their matches cleared and are run through the same steps as BulkParcelMatcher against a parcel lookup limited to their join strings.'''
+
+    def __init__(self, workflow, dirty_keys):
+        super().__init__(workflow)
+        self.dirty_key_pks = list(dirty_keys.values_list('pk', flat=True))
+        self.dirty_keys = group_dirty_keys(DirtyMatchKey.objects.filter(pk__in=self.dirty_key_pks))
+        self.affected_parcel_ids = set()
+
+    def gather_dirty_covenants(self):
+        additions = self.dirty_keys['ad']
+        parcel_ids = self.dirty_keys['pa']
+        scope = {
+            ZooniverseSubject: set(self.dirty_keys['zs']),
+            ManualCovenant: set(self.dirty_keys['mc']),
+        }
+
+        # Deleted parcels still need their bool_covenant and CovenantedParcel rows checked
+        self.affected_parcel_ids.update(parcel_ids)
+
+        dirty_parcels = Parcel.objects.filter(workflow=self.workflow, pk__in=list(parcel_ids))
+        dirty_join_strings = set(ParcelJoinCandidate.objects.filter(
+            parcel__in=dirty_parcels
+        ).values_list('join_string', flat=True))
+
+        # Names an addition-wide covenant could match a dirty parcel on
+        aw_names = set()
+        for p in dirty_parcels.values('plat_standardized', 'plat__plat_name_standardized', 'subdivision_spatial__name_standardized'):
+            aw_names.update(p.values())
+        aw_names.update(PlatAlternateName.objects.filter(
+            plat__parcel__in=dirty_parcels).values_list('alternate_name_standardized', flat=True))
+        aw_names.update(SubdivisionAlternateName.objects.filter(
+            subdivision__parcel__in=dirty_parcels).values_list('alternate_name_standardized', flat=True))
+        aw_names.difference_update(AW_EXCLUDED_ADDITIONS)
+
+        standardized = {}
+        for model, addition_field, type_field, aw_type in [
+            (ZooniverseSubject, 'addition_final', 'match_type_final', 'AW'),
+            (ManualCovenant, 'addition', 'cov_type', 'PT'),
+        ]:
+            for cov in model.objects.filter(
+                workflow=self.workflow
+            ).values('pk', addition_field, type_field, 'join_candidates').iterator(chunk_size=5000):
+                if cov[addition_field] not in standardized:
+                    standardized[cov[addition_field]] = standardize_addition(cov[addition_field])
+                addition = standardized[cov[addition_field]]
+
+                if addition in additions:
+                    scope[model].add(cov['pk'])
+                elif cov[type_field] == aw_type and addition in aw_names:
+                    scope[model].add(cov['pk'])
+                else:
+                    for c in cov['join_candidates'] or []:
+                        if c['join_string'] in dirty_join_strings or c['join_string'].rpartition(' block ')[0] in additions:
+                            scope[model].add(cov['pk'])
+                            break
+
+            # Covenants currently linked to a dirty parcel
+            through = model.parcel_matches.through
+            scope[model].update(through.objects.filter(
+                parcel_id__in=list(parcel_ids)
+            ).values_list(cov_fk_name(model), flat=True))
+
+        # Covenants linked by PIN to a dirty parcel or a parcel in a dirty addition
+        dirty_pins = Parcel.objects.filter(
+            Q(pk__in=list(parcel_ids)) | Q(plat_standardized__in=list(additions)),
+            workflow=self.workflow
+        ).values_list('pin_primary', flat=True)
+        scope[ZooniverseSubject].update(ManualParcelPINLink.objects.filter(
+            workflow=self.workflow, parcel_pin__in=dirty_pins
+        ).values_list('zooniverse_subject_id', flat=True))
+        scope[ManualCovenant].update(ManualCovenantParcelPINLink.objects.filter(
+            workflow=self.workflow, parcel_pin__in=dirty_pins
+        ).values_list('manual_covenant_id', flat=True))
+
+        for model, cov_ids in scope.items():
+            cov_ids.discard(None)
+            print(f'{len(cov_ids)} dirty {model._meta.verbose_name_plural} to re-match...')
+        self.scope = scope
+        return scope
+
+    def scope_join_strings(self):
+        join_strings = set()
+        for model, cov_ids in self.scope.items():
+            for chunk in chunk_list(cov_ids):
+                for join_candidates in model.objects.filter(pk__in=chunk).values_list('join_candidates', flat=True):
+                    join_strings.update(c['join_string'] for c in join_candidates or [])
+        return join_strings
+
+    def run(self):
+        self.gather_dirty_covenants()
+        self.parcel_lookup = build_parcel_spatial_lookups(self.workflow, join_strings=self.scope_join_strings())
+
+        with transaction.atomic():
+            # Start the affected covenants from scratch, same as their save routines would
+            for model, cov_ids in self.scope.items():
+                self.affected_parcel_ids.update(matched_parcel_ids(model, cov_ids))
+                clear_parcel_matches(model, cov_ids)
+                set_bool_parcel_match(model, cov_ids, False)
+                self.touched_ids[model].update(cov_ids)
+
+            self.match_parcels_bulk_zoon()
+            self.match_parcels_bulk_manual()
+            self.match_addition_wide_covenants()
+            self.match_parcel_pins()
+            self.update_match_fields()
+
+            for model, cov_ids in self.scope.items():
+                self.affected_parcel_ids.update(matched_parcel_ids(model, cov_ids))
+
+            print(f'Updating bool_covenant for {len(self.affected_parcel_ids)} affected Parcels...')
+            tag_covenanted_parcels(self.workflow, self.affected_parcel_ids)
+
+            # Matches are now current, but CovenantedParcel rows for these parcels still need a refresh
+            DirtyMatchKey.objects.mark(self.workflow, 'pa', self.affected_parcel_ids, bool_matched=True)
+            DirtyMatchKey.objects.filter(pk__in=self.dirty_key_pks).update(date_matched=timezone.now())
+
+        return self.match_report
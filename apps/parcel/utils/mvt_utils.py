@@ -0,0 +1,310 @@
+import io
+import math
+import struct
+
+# Pure-Python Mapbox Vector Tile (v2.1) encoding for polygon layers, used when tippecanoe isn't available
+# and to rebuild single tiles of an existing PMTiles archive
+
+EXTENT = 4096
+BUFFER = 64
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_CLOSE_PATH = 7
+GEOM_TYPE_POLYGON = 3
+
+MAX_LAT = 85.0511287798066
+
+
+def lonlat_to_world(lon, lat):
+    '''Web mercator position of a point as a fraction of the world, (0, 0) at the top left'''
+    lat = max(min(lat, MAX_LAT), -MAX_LAT)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def tile_range(bbox, z, buffer=BUFFER, extent=EXTENT):
+    '''Range of tile x and y at zoom z whose buffered area overlaps a (min_lon, min_lat, max_lon, max_lat) bbox'''
+    num_tiles = 1 << z
+    pad = buffer / extent
+    min_x, min_y = lonlat_to_world(bbox[0], bbox[3])
+    max_x, max_y = lonlat_to_world(bbox[2], bbox[1])
+    x0 = max(int(math.floor(min_x * num_tiles - pad)), 0)
+    x1 = min(int(math.floor(max_x * num_tiles + pad)), num_tiles - 1)
+    y0 = max(int(math.floor(min_y * num_tiles - pad)), 0)
+    y1 = min(int(math.floor(max_y * num_tiles + pad)), num_tiles - 1)
+    return x0, y0, x1, y1
+
+
+def iter_tiles_for_bbox(bbox, z, buffer=BUFFER, extent=EXTENT):
+    x0, y0, x1, y1 = tile_range(bbox, z, buffer, extent)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+def tile_bounds(z, x, y, buffer=BUFFER, extent=EXTENT):
+    '''(min_lon, min_lat, max_lon, max_lat) of a tile including its buffer'''
+    num_tiles = 1 << z
+    pad = buffer / extent
+
+    def lon(world_x):
+        return world_x / num_tiles * 360.0 - 180.0
+
+    def lat(world_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * world_y / num_tiles))))
+
+    return lon(x - pad), lat(y + 1 + pad), lon(x + 1 + pad), lat(y - pad)
+
+
+def project_polygons(geojson):
+    '''GeoJSON Polygon or MultiPolygon as a list of polygons, each a list of rings of world fraction points'''
+    if geojson['type'] == 'Polygon':
+        polygons = [geojson['coordinates']]
+    elif geojson['type'] == 'MultiPolygon':
+        polygons = geojson['coordinates']
+    else:
+        return []
+    return [[[lonlat_to_world(pt[0], pt[1]) for pt in ring] for ring in polygon] for polygon in polygons]
+
+
+def clip_ring(ring, low, high):
+    '''Sutherland-Hodgman clip of a ring to the square from low to high on both axes'''
+    for axis in (0, 1):
+        for bound, keep_below in ((low, False), (high, True)):
+            if len(ring) == 0:
+                return ring
+
+            def inside(pt):
+                return pt[axis] <= bound if keep_below else pt[axis] >= bound
+
+            clipped = []
+            prev = ring[-1]
+            prev_inside = inside(prev)
+            for pt in ring:
+                pt_inside = inside(pt)
+                if pt_inside != prev_inside:
+                    t = (bound - prev[axis]) / (pt[axis] - prev[axis])
+                    crossing = [prev[0] + t * (pt[0] - prev[0]), prev[1] + t * (pt[1] - prev[1])]
+                    crossing[axis] = bound
+                    clipped.append(tuple(crossing))
+                if pt_inside:
+                    clipped.append(pt)
+                prev, prev_inside = pt, pt_inside
+            ring = clipped
+    return ring
+
+
+def ring_area(ring):
+    '''Surveyor's formula in tile coordinates. Positive is clockwise on screen, which MVT requires for exterior rings.'''
+    area = 0
+    for i in range(len(ring)):
+        x1, y1 = ring[i - 1]
+        x2, y2 = ring[i]
+        area += x1 * y2 - x2 * y1
+    return area / 2
+
+
+def tile_rings(polygons, z, x, y, buffer=BUFFER, extent=EXTENT):
+    '''Rings of a projected feature clipped to one tile, in integer tile coordinates with exterior rings wound for MVT. Rings that collapse at this zoom are dropped, along with the holes of dropped exteriors.'''
+    scale = (1 << z) * extent
+    origin_x = x * extent
+    origin_y = y * extent
+    out_rings = []
+    for polygon in polygons:
+        for ring_num, ring in enumerate(polygon):
+            pts = [(px * scale - origin_x, py * scale - origin_y) for px, py in ring]
+            if len(pts) > 1 and pts[0] == pts[-1]:
+                pts = pts[:-1]
+            pts = clip_ring(pts, -buffer, extent + buffer)
+
+            int_pts = []
+            for px, py in pts:
+                pt = (int(round(px)), int(round(py)))
+                if len(int_pts) == 0 or pt != int_pts[-1]:
+                    int_pts.append(pt)
+            while len(int_pts) > 1 and int_pts[0] == int_pts[-1]:
+                int_pts.pop()
+
+            area = ring_area(int_pts) if len(int_pts) >= 3 else 0
+            if area == 0:
+                if ring_num == 0:
+                    break
+                continue
+            is_exterior = ring_num == 0
+            if (area > 0) != is_exterior:
+                int_pts.reverse()
+            out_rings.append(int_pts)
+    return out_rings
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_key(field_num, wire_type):
+    return encode_varint((field_num << 3) | wire_type)
+
+
+def encode_bytes_field(field_num, data):
+    return encode_key(field_num, 2) + encode_varint(len(data)) + data
+
+
+def encode_varint_field(field_num, value):
+    return encode_key(field_num, 0) + encode_varint(value)
+
+
+def encode_packed(field_num, values):
+    return encode_bytes_field(field_num, b''.join([encode_varint(v) for v in values]))
+
+
+def geometry_commands(rings):
+    commands = []
+    cursor_x = cursor_y = 0
+    for ring in rings:
+        commands.append((1 << 3) | CMD_MOVE_TO)
+        commands.extend([zigzag(ring[0][0] - cursor_x), zigzag(ring[0][1] - cursor_y)])
+        cursor_x, cursor_y = ring[0]
+        commands.append(((len(ring) - 1) << 3) | CMD_LINE_TO)
+        for px, py in ring[1:]:
+            commands.extend([zigzag(px - cursor_x), zigzag(py - cursor_y)])
+            cursor_x, cursor_y = px, py
+        commands.append((1 << 3) | CMD_CLOSE_PATH)
+    return commands
+
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return encode_varint_field(7, int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return encode_varint_field(5, value)
+        return encode_varint_field(6, zigzag(value))
+    if isinstance(value, float):
+        return encode_key(3, 1) + struct.pack('<d', value)
+    return encode_bytes_field(1, str(value).encode('utf-8'))
+
+
+class LayerBuilder:
+    '''Accumulates the features of one layer of one tile'''
+
+    def __init__(self, name, extent=EXTENT):
+        self.name = name
+        self.extent = extent
+        self.features = io.BytesIO()
+        self.keys = {}
+        self.values = {}
+        self.num_features = 0
+
+    def tag_index(self, table, item):
+        if item not in table:
+            table[item] = len(table)
+        return table[item]
+
+    def add_feature(self, feature_id, properties, rings):
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(self.tag_index(self.keys, key))
+            # Keep 1 and True apart, they're equal as dict keys
+            tags.append(self.tag_index(self.values, (type(value).__name__, value)))
+
+        feature = b''
+        if feature_id is not None:
+            feature += encode_varint_field(1, feature_id)
+        feature += encode_packed(2, tags)
+        feature += encode_varint_field(3, GEOM_TYPE_POLYGON)
+        feature += encode_packed(4, geometry_commands(rings))
+        self.features.write(encode_bytes_field(2, feature))
+        self.num_features += 1
+
+    def encode(self):
+        layer = encode_varint_field(15, 2)
+        layer += encode_bytes_field(1, self.name.encode('utf-8'))
+        layer += self.features.getvalue()
+        for key in self.keys:
+            layer += encode_bytes_field(3, key.encode('utf-8'))
+        for value_type, value in self.values:
+            layer += encode_bytes_field(4, encode_value(value))
+        layer += encode_varint_field(5, self.extent)
+        return encode_bytes_field(3, layer)
+
+
+def encode_tiles(features, layer_name, z, tile_filter=None, buffer=BUFFER, extent=EXTENT):
+    '''Encode every tile at zoom z that features fall in, or only the tiles in tile_filter (a set of (x, y)). features are (feature_id, properties, bbox, projected polygons) tuples. Returns {(x, y): tile bytes}, leaving out tiles where every feature collapsed.'''
+    layers = {}
+    for feature_id, properties, bbox, polygons in features:
+        for x, y in iter_tiles_for_bbox(bbox, z, buffer, extent):
+            if tile_filter is not None and (x, y) not in tile_filter:
+                continue
+            rings = tile_rings(polygons, z, x, y, buffer, extent)
+            if len(rings) == 0:
+                continue
+            if (x, y) not in layers:
+                layers[(x, y)] = LayerBuilder(layer_name, extent)
+            layers[(x, y)].add_feature(feature_id, properties, rings)
+    return {xy: layer.encode() for xy, layer in layers.items()}
+
+
+def decode_varint(data, pos):
+    shift = 0
+    result = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(data):
+    '''(field number, wire type, value) for each field of a protobuf message. Length-delimited values are bytes.'''
+    pos = 0
+    while pos < len(data):
+        key, pos = decode_varint(data, pos)
+        field_num, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = decode_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+        yield field_num, wire_type, value
+
+
+def decode_layer_summary(tile_data):
+    '''{layer name: [feature ids]} for a decoded (uncompressed) tile, for checking tiles without a full MVT library'''
+    summary = {}
+    for field_num, wire_type, layer in iter_fields(tile_data):
+        if field_num != 3:
+            continue
+        name = None
+        feature_ids = []
+        for layer_field, layer_wire_type, value in iter_fields(layer):
+            if layer_field == 1:
+                name = value.decode('utf-8')
+            elif layer_field == 2:
+                feature_ids.extend([v for f, w, v in iter_fields(value) if f == 1])
+        summary[name] = feature_ids
+    return summary
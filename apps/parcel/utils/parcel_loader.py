@@ -0,0 +1,181 @@
+import os
+import tempfile
+import multiprocessing
+
+import pandas as pd
+import pyogrio
+import shapely
+import geopandas as gpd
+
+from django.db import connection, connections
+
+from apps.parcel.models import Parcel, DirtyMatchKey, AdditionWideMatch
+from apps.parcel.utils.parcel_utils import standardize_many
+from apps.parcel.utils.export_utils import COPY_NULL
+from apps.parcel.utils.gis_utils import build_mapping
+
+# Shapefile parsing, reprojection and plat standardization run in worker processes, a chunk of features at a time. Each worker writes its chunk as a CSV that the main process COPYs into Parcel, so workers never touch the database.
+
+PARCEL_REQUIRED_ATTRS = [
+    "pin_primary", "pin_secondary", "street_address", "city",
+    "state", "zip_code", "county_name", "county_fips", "plat_name",
+    "block", "lot", "join_description", "phys_description",
+    "township", "range", "section"
+]
+PARCEL_INT_ATTRS = ['township', 'range', 'section']
+
+PARCEL_COPY_COLUMNS = PARCEL_REQUIRED_ATTRS + [
+    'workflow_id', 'feature_id', 'plat_standardized', 'plat_id',
+    'orig_data', 'orig_filename', 'geom_4326', 'bool_covenant'
+]
+
+# Set in each worker by init_chunk_worker, so the plat lookup is only sent to each process once
+_chunk_config = None
+
+
+def init_chunk_worker(config):
+    global _chunk_config
+    _chunk_config = config
+
+
+def parcel_chunk_ranges(shp_path, chunksize):
+    '''(start, stop) feature ranges covering the whole layer'''
+    num_features = pyogrio.read_info(shp_path)['features']
+    return [(start, min(start + chunksize, num_features)) for start in range(0, num_features, chunksize)]
+
+
+def multipolygons_4326(geoseries):
+    '''Polygon and MultiPolygon geometries with any Z values dropped, reprojected to 4326 and forced to multi, as a shapely array with SRID 4326 set. Layers with no CRS are assumed to already be 4326.'''
+    geoseries = geoseries.force_2d()
+    if geoseries.crs is not None:
+        geoseries = geoseries.to_crs(4326)
+    parts, part_index = shapely.get_parts(geoseries.values, return_index=True)
+    multipolygons = shapely.multipolygons(parts, indices=part_index)
+    return shapely.set_srid(multipolygons, 4326)
+
+
+def orig_data_json(attributes):
+    '''Every attribute of each feature as a JSON object, with dates as YYYY-MM-DD like gather_all_attributes'''
+    attributes = attributes.copy()
+    for column in attributes.columns:
+        if pd.api.types.is_datetime64_any_dtype(attributes[column]):
+            attributes[column] = attributes[column].dt.strftime('%Y-%m-%d')
+    return attributes.to_json(orient='records', lines=True, double_precision=15).splitlines()
+
+
+def string_values(column):
+    '''A column as strings, None where null. Integer fields with nulls are read as floats, so float columns of whole numbers are written without the ".0", as they would be with no nulls.'''
+    if pd.api.types.is_float_dtype(column) and (column.dropna() % 1 == 0).all():
+        column = column.astype('Int64')
+    return column.astype(str).where(column.notna(), None)
+
+
+def mapped_values(gdf, mapping):
+    '''Parcel fields from shapefile columns or static values, per the workflow's parcel_shps mapping'''
+    values = pd.DataFrame(index=gdf.index)
+    for attr in PARCEL_REQUIRED_ATTRS:
+        source = mapping.get(attr)
+        if source is None:
+            values[attr] = None
+        elif type(source) is tuple:
+            values[attr] = source[1]
+        elif attr in PARCEL_INT_ATTRS:
+            ints = pd.to_numeric(gdf[source], errors='coerce')
+            values[attr] = ints.where(ints % 1 == 0).astype('Int64')
+        else:
+            values[attr] = string_values(gdf[source])
+    return values
+
+
+def process_parcel_chunk(chunk_range):
+    '''Read, reproject and standardize one range of features, and write them to a CSV ready to COPY into Parcel. Returns the CSV path, number of parcels written and skipped, the standardized additions seen, and counts of parcels whose addition didn't match a plat.'''
+    config = _chunk_config
+    start, stop = chunk_range
+    gdf = gpd.read_file(config['shp_path'], engine='pyogrio', rows=slice(start, stop), fid_as_index=True)
+
+    # Same features save_multipoly_instances couldn't turn into a MultiPolygon
+    keep = gdf.geometry.notna() & ~gdf.geometry.is_empty & gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])
+    skipped = int((~keep).sum())
+    gdf = gdf[keep]
+
+    df = mapped_values(gdf, config['mapping'])
+    df['workflow_id'] = config['workflow_id']
+    df['feature_id'] = gdf.index.astype(int)
+    df['plat_standardized'] = standardize_many(df['plat_name'])
+    df['plat_id'] = df['plat_standardized'].map(config['plat_lookup']).astype('Int64')
+    df['orig_data'] = orig_data_json(gdf.drop(columns=gdf.geometry.name)) if len(gdf.index) > 0 else []
+    df['orig_filename'] = config['orig_filename']
+    df['geom_4326'] = shapely.to_wkb(multipolygons_4326(gdf.geometry), hex=True, include_srid=True) if len(gdf.index) > 0 else []
+    df['bool_covenant'] = False
+
+    unmatched = df.loc[df['plat_id'].isna(), 'plat_standardized'].value_counts()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', dir=config['tmp_dir'], delete=False) as csv_file:
+        df[PARCEL_COPY_COLUMNS].to_csv(csv_file, index=False, na_rep=COPY_NULL)
+
+    return (
+        csv_file.name,
+        len(df.index),
+        skipped,
+        set([a for a in df['plat_standardized'].unique() if a is not None]),
+        {a: int(n) for a, n in unmatched.items()},
+    )
+
+
+def copy_parcel_csv(csv_path):
+    with open(csv_path, 'r', newline='') as csv_file:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {Parcel._meta.db_table} ({', '.join(PARCEL_COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv, HEADER true, NULL '{COPY_NULL}')",
+                csv_file
+            )
+
+
+def load_parcel_shp_parallel(workflow, shp_path, shp_mapping, plat_lookup, chunksize=50000, workers=None):
+    '''Load a parcel shapefile into Parcel a chunk of features at a time, with parsing, reprojection, plat standardization and plat matching spread across worker processes and each chunk loaded with COPY. Replaces save_multipoly_instances followed by the per-row plat standardization and join. plat_lookup is {standardized plat or alternate name: Plat id}. Returns counts of parcels loaded and skipped, the standardized additions loaded, and unmatched additions with their parcel counts.'''
+    ranges = parcel_chunk_ranges(shp_path, chunksize)
+    workers = workers or os.cpu_count()
+    print(f'Loading {len(ranges)} chunks of up to {chunksize} features with {workers} workers...')
+
+    results = {'loaded': 0, 'skipped': 0, 'additions': set(), 'unmatched': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = {
+            'shp_path': shp_path,
+            'mapping': build_mapping(shp_mapping, PARCEL_REQUIRED_ATTRS),
+            'plat_lookup': plat_lookup,
+            'workflow_id': workflow.id,
+            'orig_filename': os.path.basename(shp_path),
+            'tmp_dir': tmp_dir,
+        }
+
+        if workers == 1:
+            init_chunk_worker(config)
+            chunk_results = map(process_parcel_chunk, ranges)
+            pool = None
+        else:
+            # Fork so workers inherit the configured Django app, but they mustn't share the parent's database connection
+            connections.close_all()
+            pool = multiprocessing.get_context('fork').Pool(processes=workers, initializer=init_chunk_worker, initargs=(config,))
+            chunk_results = pool.imap_unordered(process_parcel_chunk, ranges)
+
+        try:
+            for csv_path, loaded, skipped, additions, unmatched in chunk_results:
+                copy_parcel_csv(csv_path)
+                os.remove(csv_path)
+                results['loaded'] += loaded
+                results['skipped'] += skipped
+                results['additions'].update(additions)
+                for addition, num_parcels in unmatched.items():
+                    results['unmatched'][addition] = results['unmatched'].get(addition, 0) + num_parcels
+                print(f"Saved {results['loaded']} parcel records...")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    print(f"Saved {results['loaded']} parcel records, skipped {results['skipped']} features without polygon geometry.")
+
+    # Log reloaded additions for incremental re-matching. New parcels can also join plats and subdivisions under other names, so no cached addition-wide match is safe.
+    DirtyMatchKey.objects.mark(workflow, 'ad', results['additions'])
+    AdditionWideMatch.objects.invalidate(workflow)
+    return results
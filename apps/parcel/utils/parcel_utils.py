@@ -1,27 +1,49 @@
 import re
-import inflect
-
+import json
+from functools import lru_cache
 
-def check_repeated_text_num(input_str):
-    # Repeated text num, e.g. "six 6" or "6 six"
-    r_text_num_left = re.search(r'(\d+) ([a-z\-]+)', input_str)
-    if r_text_num_left:
-        p = inflect.engine()
-        test_left = p.number_to_words(r_text_num_left.group(1))
-        test_right = r_text_num_left.group(2)
-        if test_left and test_left == test_right:
-            return r_text_num_left.group(1)
-
-    # Same, but number on the right, parentheses optional
-    r_text_num_right = re.search(r'([a-z\-]+) (?:\()?(\d+)(?:\))?', input_str)
-    if r_text_num_right:
-        p = inflect.engine()
-        test_left = r_text_num_right.group(1)
-        test_right = p.number_to_words(r_text_num_right.group(2))
-        if test_right and test_left == test_right:
-            return r_text_num_right.group(2)
-
-    return None
+import inflect
+import pandas as pd
+
+ORDINAL_ABBREVIATIONS = {
+    'first': '1st',
+    'second': '2nd',
+    'third': '3rd',
+    'fourth': '4th',
+    'fifth': '5th',
+    'sixth': '6th',
+    'seventh': '7th',
+    'eighth': '8th',
+    'ninth': '9th',
+    'tenth': '10th',
+}
+
+# Substitutions applied in order by standardize_addition, after ordinal words
+ADDITION_SUBSTITUTIONS = [
+    # apostrophe with 's or 'n (ass'n)
+    (r'[\'`’]([sn])', r'\1'),
+    (r'([sn])[\'`’]', r'\1'),
+    # Variations of "addition"
+    (r'ADD(?:IT)?\.', 'ADDITION'),
+    (r' ADDN(\.)?', ' ADDITION'),
+    (r' ADD(\.)?$', ' ADDITION'),
+    # Sometimes it's misspelled
+    (r'SUBDIVSION', 'SUBDIVISION'),
+    (r'RE-SUB', 'RESUB'),
+    # SUBD abbreviation followed by space or end of string
+    (r'SUBD*\.*(?=\s|$)', 'SUBDIVISION'),
+    (r',(?: )?', ' '),
+    (r' & ', ' and '),
+    (r' no(\.)?\s*(?=\d+)', ' '),
+    (r'#\s*(?=\d+)', ''),
+    # Some weird cases (Crow Wing County) where it's not an addition to a city, so leave those alone (the (?<=.{4}) part)
+    (r'(?<=.{5}) (?:an )?addition to (?:the city of )?.+', ' '),
+    (r'\.\s*', ' '),
+    (r' addition', ' '),
+    (r' subdivision', ' '),
+]
+
+NUMBER_WORD_TABLE_SIZE = 1000
 
 
 def strip_leading_0s_str(input_str):
@@ -32,161 +54,235 @@ def strip_leading_0s_list(input_list):
     return [str(x).lstrip('0') for x in input_list]
 
 
-def get_blocks(input_str):
-    if input_str:
-        # First, strip "block" and make all lowercase
-        # input_str = input_str.lower().lstrip('block ')
-        input_str = re.sub(r'^bl(?:oc)?k ', '', input_str,
-                           flags=re.IGNORECASE).lower()
-
-        # Simple number
-        simple_num = re.match(r'^\d+$', input_str)
-        if simple_num:
-            return strip_leading_0s_str(input_str), 'simple_num'
+class ParcelNormalizer:
+    '''Addition, block and lot normalization used to build join strings on both the covenant and parcel side. Patterns are compiled once, number words for common numbers are looked up from a table rather than asking inflect each time, and results are kept in an LRU cache keyed on the raw value, since the same additions, blocks and lots come up over and over in a county. Output is identical to the original one-string-at-a-time functions, which now call a shared instance (see get_normalizer).'''
+
+    def __init__(self, cache_size=100000):
+        self.inflect_engine = inflect.engine()
+        self.number_words = {str(n): self.inflect_engine.number_to_words(str(n)) for n in range(NUMBER_WORD_TABLE_SIZE)}
+
+        self.re_text_num_left = re.compile(r'(\d+) ([a-z\-]+)')
+        self.re_text_num_right = re.compile(r'([a-z\-]+) (?:\()?(\d+)(?:\))?')
+
+        self.re_block_prefix = re.compile(r'^bl(?:oc)?k ', flags=re.IGNORECASE)
+        self.re_simple_num = re.compile(r'^\d+$')
+        self.re_letter = re.compile(r'[a-z]')
+
+        self.re_lot_none = re.compile(r'none', flags=re.IGNORECASE)
+        self.re_lot_partial = re.compile(r'partial', flags=re.IGNORECASE)
+        self.re_lot_full_plus_por = re.compile(r'^LOT (\d+[A-Z]?) POR \d+$', flags=re.IGNORECASE)
+        self.re_lot_prefix = re.compile('lot(?:s)? ', flags=re.IGNORECASE)
+        self.re_lot_simple_letter = re.compile(r'^[A-Za-z]{1}$')
+        self.re_lot_num_range = re.compile(r'^(\d+)(?:-| thru )(\d+)$')
+        self.re_lot_list_of_nums = re.compile(r'^[\d,]+$')
+
+        self.re_ordinals = [
+            (re.compile(f'{word}', flags=re.IGNORECASE), f'{abbr}') for word, abbr in ORDINAL_ABBREVIATIONS.items()
+        ]
+        self.re_addition_subs = [
+            (re.compile(pattern, flags=re.IGNORECASE), repl) for pattern, repl in ADDITION_SUBSTITUTIONS
+        ]
+        self.re_multi_space = re.compile(r'\s\s+')
+
+        # typed=True so that e.g. 1 and '1' don't share a cache entry
+        self.number_to_words_cached = lru_cache(maxsize=cache_size, typed=True)(self.inflect_engine.number_to_words)
+        self.standardize_addition = lru_cache(maxsize=cache_size, typed=True)(self._standardize_addition)
+        self.get_blocks = lru_cache(maxsize=cache_size, typed=True)(self._get_blocks)
+        self.get_lots_cached = lru_cache(maxsize=cache_size, typed=True)(self._get_lots)
+
+    def number_to_words(self, num_str):
+        try:
+            return self.number_words[num_str]
+        except KeyError:
+            return self.number_to_words_cached(num_str)
+
+    def check_repeated_text_num(self, input_str):
+        # Repeated text num, e.g. "six 6" or "6 six"
+        r_text_num_left = self.re_text_num_left.search(input_str)
+        if r_text_num_left:
+            test_left = self.number_to_words(r_text_num_left.group(1))
+            test_right = r_text_num_left.group(2)
+            if test_left and test_left == test_right:
+                return r_text_num_left.group(1)
+
+        # Same, but number on the right, parentheses optional
+        r_text_num_right = self.re_text_num_right.search(input_str)
+        if r_text_num_right:
+            test_left = r_text_num_right.group(1)
+            test_right = self.number_to_words(r_text_num_right.group(2))
+            if test_right and test_left == test_right:
+                return r_text_num_right.group(2)
+
+        return None
+
+    def _get_blocks(self, input_str):
+        if input_str:
+            # First, strip "block" and make all lowercase
+            input_str = self.re_block_prefix.sub('', input_str).lower()
+
+            # Simple number
+            simple_num = self.re_simple_num.match(input_str)
+            if simple_num:
+                return strip_leading_0s_str(input_str), 'simple_num'
+
+            # Simple letter
+            simple_letter = len(input_str) == 1 and self.re_letter.match(input_str)
+            if simple_letter:
+                return strip_leading_0s_str(input_str.upper()), 'simple_letter'
+
+            repeated_text_num = self.check_repeated_text_num(input_str)
+            if repeated_text_num:
+                return strip_leading_0s_str(repeated_text_num), 'repeated_text_num'
+
+            if str(input_str).lower() == 'none':
+                return 'none', 'no_block'
+
+            return input_str, None
+        return 'none', 'no_block'
+
+    def _get_lots(self, input_str):
+        '''Cached, so lot lists are returned as tuples'''
+        if input_str:
+            input_str = input_str.strip()
+
+            if self.re_lot_none.match(input_str):
+                return None, None
+
+            if self.re_lot_partial.search(input_str):
+                return None, 'partial_lot'
+
+            # Full lot followed by a partial lot
+            full_plus_por = self.re_lot_full_plus_por.search(input_str)
+            if full_plus_por:
+                return (full_plus_por.group(1),), 'full lot plus partial'
+
+            # First, strip "lot" and make all lowercase
+            input_str = self.re_lot_prefix.sub('', input_str).lower()
+
+            # Simple number
+            simple_num = self.re_simple_num.match(input_str)
+            if simple_num:
+                return tuple(strip_leading_0s_list([input_str])), 'simple_num'
+
+            # Simple letter
+            simple_num = self.re_lot_simple_letter.match(input_str)
+            if simple_num:
+                return (input_str,), 'simple_letter'
+
+            repeated_text_num = self.check_repeated_text_num(input_str)
+            if repeated_text_num:
+                return tuple(strip_leading_0s_list([repeated_text_num])), 'repeated_text_num'
+
+            num_range = self.re_lot_num_range.search(input_str)
+            if num_range:
+                start = int(num_range.group(1))
+                end = int(num_range.group(2))
+                return tuple(strip_leading_0s_list(list(range(start, end+1)))), 'num_range'
+
+            list_of_nums_preprocess = input_str.replace(', & ', ',').replace(' & ', ',').replace(', and', ',').replace(
+                ' and ', ',').replace(', ', ',')
+            list_of_nums = self.re_lot_list_of_nums.match(list_of_nums_preprocess)
+            if list_of_nums:
+                return tuple(strip_leading_0s_list(sorted(set(list_of_nums_preprocess.split(','))))), 'list_of_nums'
+
+        return None, None
+
+    def get_lots(self, input_str):
+        lots, lot_style = self.get_lots_cached(input_str)
+        if lots is not None:
+            lots = list(lots)
+        return lots, lot_style
+
+    def _standardize_addition(self, input_str):
+        if input_str:
+            # replace ordinal words with numerical abbreviations
+            for pattern, abbr in self.re_ordinals:
+                input_str = pattern.sub(abbr, input_str)
+
+            for pattern, repl in self.re_addition_subs:
+                input_str = pattern.sub(repl, input_str)
+
+            input_str = self.re_multi_space.sub(' ', input_str)
+            return input_str.lower().strip()
+        return ''
+
+    def write_join_strings(self, addition_raw, block_raw, lot_raw):
+        out_candidates = []
+        metadata = {}
+        addition = self.standardize_addition(addition_raw)
+        block, metadata['block'] = self.get_blocks(block_raw)
+        lots, metadata['lot'] = self.get_lots_cached(lot_raw)
+        if lots:  # Allow blank lot
+            for lot in lots:
+                out_candidates.append(
+                    {"join_string": f"{addition} block {block} lot {lot}", "metadata": metadata})
+            return out_candidates
+        return []
+
+    def none_for_na(self, series):
+        '''Missing values in a Series (NaN, NA, None) are all treated as None'''
+        return series.astype(object).where(series.notna(), None)
+
+    def standardize_many(self, additions):
+        '''standardize_addition for each value of a pandas Series. Each distinct value is only normalized once.'''
+        return self.none_for_na(additions).map(self.standardize_addition)
+
+    def write_join_strings_many(self, additions, blocks, lots):
+        '''write_join_strings for each row of three pandas Series of the same length and order. Returns a Series of candidate lists with the index of additions.'''
+        standardized = self.standardize_many(additions)
+        block_results = self.none_for_na(blocks).map(self.get_blocks)
+        lot_results = self.none_for_na(lots).map(self.get_lots_cached)
+
+        out = []
+        for addition, (block, block_style), (lot_list, lot_style) in zip(standardized, block_results, lot_results):
+            if lot_list:
+                metadata = {'block': block_style, 'lot': lot_style}
+                out.append([
+                    {"join_string": f"{addition} block {block} lot {lot}", "metadata": metadata} for lot in lot_list
+                ])
+            else:
+                out.append([])
+        return pd.Series(out, index=additions.index, dtype=object)
+
+
+_normalizer = None
+
+
+def get_normalizer():
+    '''Shared ParcelNormalizer, created on first use'''
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = ParcelNormalizer()
+    return _normalizer
 
-        # Simple letter
-        simple_letter = len(input_str) == 1 and re.match(r'[a-z]', input_str)
-        if simple_letter:
-            return strip_leading_0s_str(input_str.upper()), 'simple_letter'
 
-        repeated_text_num = check_repeated_text_num(input_str)
-        if repeated_text_num:
-            return strip_leading_0s_str(repeated_text_num), 'repeated_text_num'
+def check_repeated_text_num(input_str):
+    return get_normalizer().check_repeated_text_num(input_str)
 
-        if str(input_str).lower() == 'none':
-            return 'none', 'no_block'
 
-        return input_str, None
-    return 'none', 'no_block'
+def get_blocks(input_str):
+    return get_normalizer().get_blocks(input_str)
 
 
 def get_lots(input_str):
-    if input_str:
-        input_str = input_str.strip()
-
-        if re.match(r'none', input_str, flags=re.IGNORECASE):
-            return None, None
-
-        if re.search(r'partial', input_str, flags=re.IGNORECASE):
-            return None, 'partial_lot'
-        
-        # Full lot followed by a partial lot
-        full_plus_por = re.search(r'^LOT (\d+[A-Z]?) POR \d+$', input_str,
-                    flags=re.IGNORECASE)
-        if full_plus_por:
-            return [full_plus_por.group(1)], 'full lot plus partial'
-
-        # First, strip "lot" and make all lowercase
-        input_str = re.sub('lot(?:s)? ', '', input_str,
-                           flags=re.IGNORECASE).lower()
-
-        # Simple number
-        simple_num = re.match(r'^\d+$', input_str)
-        if simple_num:
-            return strip_leading_0s_list([input_str]), 'simple_num'
-        
-        # Simple letter
-        simple_num = re.match(r'^[A-Za-z]{1}$', input_str)
-        if simple_num:
-            return [input_str], 'simple_letter'
-
-        repeated_text_num = check_repeated_text_num(input_str)
-        if repeated_text_num:
-            return strip_leading_0s_list([repeated_text_num]), 'repeated_text_num'
-
-        num_range = re.search(r'^(\d+)(?:-| thru )(\d+)$', input_str)
-        if num_range:
-            start = int(num_range.group(1))
-            end = int(num_range.group(2))
-            return strip_leading_0s_list(list(range(start, end+1))), 'num_range'
-
-        # simple_multi_lot = [x.group() for x in re.finditer(r'(?:((?:(?<=^)|(?<=^LOTS )|(?<=& ))\d+(?= |$)))', re.sub(r' and ', ' & ', input_str))]
-        # if len(simple_multi_lot) > 0:
-        #     return strip_leading_0s_list(simple_multi_lot), 'simple_multi_lot'
-
-        list_of_nums_preprocess = input_str.replace(', & ', ',').replace(' & ', ',').replace(', and', ',').replace(
-            ' and ', ',').replace(', ', ',')
-        list_of_nums = re.match(r'^[\d,]+$', list_of_nums_preprocess)
-        if list_of_nums:
-            return strip_leading_0s_list(sorted(set(list_of_nums_preprocess.split(',')))), 'list_of_nums'
-
-    return None, None
+    return get_normalizer().get_lots(input_str)
 
 
 def standardize_addition(input_str):
-    if input_str:
-        # replace ordinal words with numerical abbreviations
-        for word, abbr in {
-            'first': '1st',
-            'second': '2nd',
-            'third': '3rd',
-            'fourth': '4th',
-            'fifth': '5th',
-            'sixth': '6th',
-            'seventh': '7th',
-            'eighth': '8th',
-            'ninth': '9th',
-            'tenth': '10th',
-        }.items():
-            input_str = re.sub(f'{word}', f'{abbr}',
-                           input_str, flags=re.IGNORECASE)
-
-        # apostrophe with 's or 'n (ass'n)
-        input_str = re.sub(r'[\'`’]([sn])', r'\1',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r'([sn])[\'`’]', r'\1',
-                           input_str, flags=re.IGNORECASE)
-        # Variations of "addition"
-        input_str = re.sub(r'ADD(?:IT)?\.', 'ADDITION',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r' ADDN(\.)?', ' ADDITION',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r' ADD(\.)?$', ' ADDITION',
-                           input_str, flags=re.IGNORECASE)
-        # Sometimes it's misspelled
-        input_str = re.sub(r'SUBDIVSION', 'SUBDIVISION',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r'RE-SUB', 'RESUB',
-                           input_str, flags=re.IGNORECASE)
-        # SUBD abbreviation followed by space or end of string
-        input_str = re.sub(r'SUBD*\.*(?=\s|$)', 'SUBDIVISION',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r',(?: )?', ' ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r' & ', ' and ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r' no(\.)?\s*(?=\d+)', ' ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r'#\s*(?=\d+)', '',
-                           input_str, flags=re.IGNORECASE)
-        # Some weird cases (Crow Wing County) where it's not an addition to a city, so leave those alone (the (?<=.{4}) part)
-        input_str = re.sub(r'(?<=.{5}) (?:an )?addition to (?:the city of )?.+', ' ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r'\.\s*', ' ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r' addition', ' ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r' subdivision', ' ',
-                           input_str, flags=re.IGNORECASE)
-        input_str = re.sub(r'\s\s+', ' ', input_str)
-        return input_str.lower().strip()
-    return ''
+    return get_normalizer().standardize_addition(input_str)
+
+
+def standardize_many(additions):
+    return get_normalizer().standardize_many(additions)
 
 
 def write_join_strings(addition_raw, block_raw, lot_raw):
     '''More low-level, to generate the actual string, using string values'''
-    out_candidates = []
-    metadata = {}
-    addition = standardize_addition(addition_raw)
-    block, metadata['block'] = get_blocks(block_raw)
-    lots, metadata['lot'] = get_lots(lot_raw)
-    if lots:  # Allow blank lot
-        for lot in lots:
-            out_candidates.append(
-                {"join_string": f"{addition} block {block} lot {lot}", "metadata": metadata})
-    # print(blocks, block_style)
-        return out_candidates
-    return []
+    return get_normalizer().write_join_strings(addition_raw, block_raw, lot_raw)
+
+
+def write_join_strings_many(additions, blocks, lots):
+    return get_normalizer().write_join_strings_many(additions, blocks, lots)
 
 
 def get_covenant_parcel_options(subject_obj):
@@ -217,10 +313,6 @@ def get_covenant_parcel_options(subject_obj):
 def get_all_parcel_options(parcel_obj):
     '''Get all possibilities for this Parcel that can be attempted to be mapped, and characterize the number of lots found and if they are the entire lot or a component'''
 
-    out_candidates = []
-    metadata = {'orig_filename': parcel_obj.orig_filename}
-    addition = parcel_obj.plat_standardized
-
     # Check for alternate addition spellings
     extra_additions = []
     if parcel_obj.plat:
@@ -232,31 +324,59 @@ def get_all_parcel_options(parcel_obj):
         extra_additions.append(parcel_obj.subdivision_spatial.name_standardized)
         for p in parcel_obj.subdivision_spatial.subdivisionalternatename_set.all():
             extra_additions.append(p.alternate_name_standardized)
-    
+
+    manual_candidates = [(mpc.addition, mpc.block, mpc.lot) for mpc in parcel_obj.manualparcelcandidate_set.all()]
+
+    return write_parcel_options(
+        parcel_obj.id,
+        parcel_obj.plat_standardized,
+        parcel_obj.block,
+        parcel_obj.lot,
+        extra_additions,
+        manual_candidates
+    )
+
+
+def write_parcel_options(parcel_id, addition, block, lot, extra_additions, manual_candidates):
+    '''Guts of get_all_parcel_options, using plain values rather than model instances so it can also run in a worker process. manual_candidates is a list of (addition, block, lot) tuples from ManualParcelCandidate objects.'''
     addition_list = list(set([addition] + extra_additions))
 
     join_strings = []
     for a in addition_list:
-        join_strings += write_join_strings(a, parcel_obj.block, parcel_obj.lot)
+        join_strings += write_join_strings(a, block, lot)
 
     # ManualParcelCandidates
-    for mpc in parcel_obj.manualparcelcandidate_set.all():
-        join_strings += write_join_strings(mpc.addition, mpc.block, mpc.lot)
+    for mpc_addition, mpc_block, mpc_lot in manual_candidates:
+        join_strings += write_join_strings(mpc_addition, mpc_block, mpc_lot)
 
     for candidate in join_strings:
-        candidate['parcel_id'] = parcel_obj.id
+        candidate['parcel_id'] = parcel_id
     return join_strings
 
 
-def build_parcel_spatial_lookups(workflow):
+def parcel_options_shard(shard):
+    '''Process pool worker for ParcelJoinCandidate rebuilds. Takes a list of (parcel_id, plat_standardized, block, lot, extra_additions, manual_candidates) tuples and returns (parcel_id, plat_standardized, join_string, metadata JSON) rows. Doesn't touch the database.'''
+    rows = []
+    for parcel_id, addition, block, lot, extra_additions, manual_candidates in shard:
+        for c in write_parcel_options(parcel_id, addition, block, lot, extra_additions, manual_candidates):
+            rows.append((parcel_id, addition, c['join_string'], json.dumps(c['metadata'])))
+    return rows
+
+
+def build_parcel_spatial_lookups(workflow, join_strings=None):
+    '''Optionally pass a list of join_strings to only build the part of the lookup that is needed, e.g. for incremental matching'''
     from apps.parcel.models import ParcelJoinCandidate
     print('Gathering all parcel records from this workflow...')
     parcel_spatial_lookup = {}
 
-    # Basic lots
-    for candidate in ParcelJoinCandidate.objects.filter(
+    candidates = ParcelJoinCandidate.objects.filter(
         workflow=workflow
-    ).exclude(join_string='').values('parcel__id', 'join_string', 'metadata'):
+    ).exclude(join_string='')
+    if join_strings is not None:
+        candidates = candidates.filter(join_string__in=list(join_strings))
+
+    # Basic lots
+    for candidate in candidates.values('parcel__id', 'join_string', 'metadata'):
         # Allow for multiple parcels with same lot combo, does happen with adjacent lots
         if candidate['join_string'] not in parcel_spatial_lookup:
             parcel_spatial_lookup[candidate['join_string']] = {
@@ -286,49 +406,17 @@ def gather_all_manual_covenant_candidates(manualcovenant_obj):
 
 
 def addition_wide_parcel_match(cov_obj):
-    '''Generally runs inside save routines of ZooniverseSubject and ManualCovenant'''
-    from apps.plat.models import Plat, PlatAlternateName, Subdivision, SubdivisionAlternateName
-    from apps.parcel.models import Parcel
+    '''Generally runs inside save routines of ZooniverseSubject and ManualCovenant. Every parcel with this addition name, or in a plat, subdivision or alternate name matching it, comes from the AdditionWideMatch cache, which is kept on cov_obj so the geometry union can be reused too.'''
+    from apps.parcel.utils.addition_cache import get_addition_wide_matches
 
     if hasattr(cov_obj, 'addition_final'):
         plat_name_standardized = standardize_addition(cov_obj.addition_final)
     else:
         plat_name_standardized = standardize_addition(cov_obj.addition)
 
-    # Lookup by addition name
-    if plat_name_standardized not in [None, '']:
-        matching_parcels = Parcel.objects.filter(workflow=cov_obj.workflow, plat_standardized=plat_name_standardized)
-        if matching_parcels.count() > 0:
-            cov_obj.bool_parcel_match = True
-            cov_obj.parcel_matches.add(*matching_parcels.all())
-
-    # Lookup by plat map obj
-    matching_plats = Plat.objects.filter(workflow=cov_obj.workflow, plat_name_standardized=plat_name_standardized)
-    matching_plat_alternates = PlatAlternateName.objects.filter(workflow=cov_obj.workflow, alternate_name_standardized=plat_name_standardized)
-
-    if matching_plats.count() > 0:
-        cov_obj.bool_parcel_match = True
-        for p in matching_plats:
-            cov_obj.parcel_matches.add(*p.parcel_set.all())
-
-    # Lookup by alternate name
-    elif matching_plat_alternates.count() > 0:
-        cov_obj.bool_parcel_match = True
-        for p in matching_plat_alternates:
-            cov_obj.parcel_matches.add(*p.plat.parcel_set.all())
-
-    # Lookup by subdivision
-    matching_subdivisions = Subdivision.objects.filter(workflow=cov_obj.workflow, name_standardized=plat_name_standardized)
-    matching_subdivision_alternates = SubdivisionAlternateName.objects.filter(workflow=cov_obj.workflow, alternate_name_standardized=plat_name_standardized)
-
-    if matching_subdivisions.count() > 0:
-        cov_obj.bool_parcel_match = True
-        for p in matching_subdivisions:
-            cov_obj.parcel_matches.add(*p.parcel_set.all())
-
-    # Lookup by alternate name
-    elif matching_subdivision_alternates.count() > 0:
+    entry = get_addition_wide_matches(cov_obj.workflow, [plat_name_standardized]).get(plat_name_standardized)
+    cov_obj.addition_wide_match = entry
+    if entry is not None and entry.bool_match:
         cov_obj.bool_parcel_match = True
-        for p in matching_subdivision_alternates:
-            cov_obj.parcel_matches.add(*p.subdivision.parcel_set.all())
+        cov_obj.parcel_matches.add(*entry.parcel_ids)
 
@@ -0,0 +1,215 @@
+import gzip
+import json
+import heapq
+
+from django.db import connection
+
+from apps.parcel.models import CovenantedParcel
+from apps.parcel.utils.match_utils import chunk_list
+from apps.parcel.utils.stream_export import COVENANT_EXPORT_SOURCES, covenant_export_queryset, covenant_export_row, json_value
+from apps.parcel.utils.export_utils import EXPORT_FIELDS_ORDERED
+from apps.parcel.utils.mvt_utils import project_polygons, encode_tiles, iter_tiles_for_bbox
+from apps.parcel.utils.pmtiles_utils import (
+    PMTilesReader, PMTilesWriter, COMPRESSION_GZIP, zxy_to_tileid, compress
+)
+
+# Zoom range for archives built by the Python tiler. Maplibre overzooms past the max zoom.
+PYTHON_TILER_MIN_ZOOM = 0
+PYTHON_TILER_MAX_ZOOM = 14
+
+# Incremental updates only rebuild tiles at this zoom and above. Below it a tile covers so much of the map that rebuilding it means re-encoding nearly every covenant, and tippecanoe's simplified low zoom tiles are better than anything the Python tiler would put in their place. Lower zoom tiles are copied from the base archive as they are until the next full export.
+INCREMENTAL_MIN_ZOOM = 10
+
+MANIFEST_VERSION = 1
+
+
+def covenant_manifest(workflow):
+    '''{CovenantedParcel id: [hash, min_lon, min_lat, max_lon, max_lat]} for every feature in the covenants export. The hash covers the geometry and every exported value, and is computed in the database so geometries never have to be fetched to find what changed.'''
+    db_fields = [COVENANT_EXPORT_SOURCES.get(f, f) for f in EXPORT_FIELDS_ORDERED]
+    columns = [CovenantedParcel._meta.get_field(f).column for f in db_fields if f is not None]
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            SELECT id,
+                md5(ST_AsBinary(geom_4326) || convert_to(json_build_array({', '.join(columns)})::text, 'UTF8')),
+                ST_XMin(geom_4326), ST_YMin(geom_4326), ST_XMax(geom_4326), ST_YMax(geom_4326)
+            FROM {CovenantedParcel._meta.db_table}
+            WHERE workflow_id = %s AND geom_4326 IS NOT NULL
+        ''', [workflow.pk])
+        return {str(row[0]): list(row[1:]) for row in cursor.fetchall()}
+
+
+def write_manifest(manifest, out_file, layer_name, min_zoom, max_zoom):
+    '''Save a manifest alongside the archive it describes, as gzipped JSON'''
+    out_file.write(gzip.compress(json.dumps({
+        'version': MANIFEST_VERSION,
+        'layer': layer_name,
+        'min_zoom': min_zoom,
+        'max_zoom': max_zoom,
+        'features': manifest,
+    }).encode('utf-8')))
+
+
+def read_manifest(in_file):
+    return json.loads(gzip.decompress(in_file.read()).decode('utf-8'))
+
+
+def manifest_bounds(manifest):
+    if len(manifest) == 0:
+        return (-180, -85, 180, 85)
+    entries = manifest.values()
+    return (
+        min([e[1] for e in entries]), min([e[2] for e in entries]),
+        max([e[3] for e in entries]), max([e[4] for e in entries]),
+    )
+
+
+def diff_manifests(old_manifest, new_manifest):
+    '''Ids of features that were added, changed or removed, and the bboxes they covered before and after'''
+    changed_ids = []
+    bboxes = []
+    for feature_id, entry in new_manifest.items():
+        old_entry = old_manifest.get(feature_id)
+        if old_entry is None or old_entry[0] != entry[0]:
+            changed_ids.append(feature_id)
+            bboxes.append(entry[1:])
+            if old_entry is not None:
+                bboxes.append(old_entry[1:])
+    for feature_id, old_entry in old_manifest.items():
+        if feature_id not in new_manifest:
+            changed_ids.append(feature_id)
+            bboxes.append(old_entry[1:])
+    return changed_ids, bboxes
+
+
+def affected_tiles(bboxes, min_zoom, max_zoom):
+    '''{zoom: set of (x, y)} for every tile, including its buffer, that any of the bboxes touch'''
+    tiles = {}
+    for z in range(min_zoom, max_zoom + 1):
+        tiles[z] = set()
+        for bbox in bboxes:
+            tiles[z].update(iter_tiles_for_bbox(bbox, z))
+    return tiles
+
+
+def features_for_tiles(manifest, tiles):
+    '''Ids of features in the manifest that fall in any of the tiles'''
+    feature_ids = []
+    for feature_id, entry in manifest.items():
+        for z, xys in tiles.items():
+            if len(xys) > 0 and any([xy in xys for xy in iter_tiles_for_bbox(entry[1:], z)]):
+                feature_ids.append(feature_id)
+                break
+    return feature_ids
+
+
+def tile_feature(row):
+    '''A covenants export row with a GeoJSON "geom" as a feature for encode_tiles'''
+    geom = json.loads(row['geom'])
+    polygons = [geom['coordinates']] if geom['type'] == 'Polygon' else geom['coordinates']
+    # Exterior rings are enough for the bbox
+    lons = [pt[0] for polygon in polygons for pt in polygon[0]]
+    lats = [pt[1] for polygon in polygons for pt in polygon[0]]
+    properties = {k: json_value(v) for k, v in covenant_export_row(row).items()}
+    return (row['id'], properties, (min(lons), min(lats), max(lons), max(lats)), project_polygons(geom))
+
+
+def load_tile_features(workflow, feature_ids=None, chunksize=5000):
+    '''Features for the Python tiler: every covenant in the export, or only feature_ids'''
+    qs = covenant_export_queryset(workflow, 'geojson')
+    if feature_ids is None:
+        return [tile_feature(row) for row in qs.iterator(chunk_size=chunksize)]
+
+    features = []
+    for id_chunk in chunk_list([int(i) for i in feature_ids], chunksize):
+        features.extend([tile_feature(row) for row in qs.filter(pk__in=id_chunk)])
+    return features
+
+
+def iter_python_tiles(features, layer_name, min_zoom, max_zoom, tiles=None, tile_compression=COMPRESSION_GZIP):
+    '''(tile_id, stored tile bytes) in tile_id order for every tile the features fall in, or only the tiles in a {zoom: set of (x, y)} dict'''
+    for z in range(min_zoom, max_zoom + 1):
+        tile_filter = tiles.get(z, set()) if tiles is not None else None
+        if tile_filter is not None and len(tile_filter) == 0:
+            continue
+        encoded = encode_tiles(features, layer_name, z, tile_filter)
+        for tile_id, data in sorted([(zxy_to_tileid(z, x, y), data) for (x, y), data in encoded.items()]):
+            yield tile_id, compress(data, tile_compression)
+        print(f'Zoom {z}: {len(encoded)} tiles encoded...')
+
+
+def tile_metadata(layer_name, min_zoom, max_zoom):
+    return {
+        'name': layer_name,
+        'format': 'pbf',
+        'generator': 'deed machine python tiler',
+        'vector_layers': [{
+            'id': layer_name,
+            'fields': {f: 'String' for f in EXPORT_FIELDS_ORDERED},
+            'minzoom': min_zoom,
+            'maxzoom': max_zoom,
+        }],
+    }
+
+
+def write_python_pmtiles(workflow, out_file, layer_name, manifest, min_zoom=PYTHON_TILER_MIN_ZOOM, max_zoom=PYTHON_TILER_MAX_ZOOM, chunksize=5000):
+    '''Build a whole PMTiles archive without tippecanoe. Returns number of tiles written.'''
+    features = load_tile_features(workflow, chunksize=chunksize)
+    writer = PMTilesWriter()
+    for tile_id, data in iter_python_tiles(features, layer_name, min_zoom, max_zoom):
+        writer.add_tile(tile_id, data)
+    return writer.finish(out_file, tile_metadata(layer_name, min_zoom, max_zoom), min_zoom, max_zoom, manifest_bounds(manifest))
+
+
+def archive_layer_name(reader, base_manifest):
+    '''Rebuilt tiles have to use the same layer name as the tiles kept from the base archive'''
+    vector_layers = reader.metadata.get('vector_layers', [])
+    if len(vector_layers) > 0:
+        return vector_layers[0]['id']
+    return base_manifest['layer']
+
+
+def update_pmtiles(workflow, base_file, base_manifest, manifest, out_file, chunksize=5000, min_rebuild_zoom=INCREMENTAL_MIN_ZOOM):
+    '''Write a copy of the base archive with only the tiles touched by covenants that changed since base_manifest re-encoded. Tiles from min_rebuild_zoom up to the base archive's max zoom are rebuilt with the Python tiler, and tiles left empty are dropped. Returns counts of changed features and rebuilt, removed and total tiles, plus the layer name, zoom range and first rebuilt zoom.'''
+    reader = PMTilesReader(base_file)
+    min_zoom = reader.header['min_zoom']
+    max_zoom = reader.header['max_zoom']
+    rebuild_min_zoom = min(max(min_zoom, min_rebuild_zoom), max_zoom)
+    layer_name = archive_layer_name(reader, base_manifest)
+
+    changed_ids, bboxes = diff_manifests(base_manifest['features'], manifest)
+    print(f'{len(changed_ids)} covenants added, changed or removed since the base export.')
+    tiles = affected_tiles(bboxes, rebuild_min_zoom, max_zoom)
+    affected_ids = set([zxy_to_tileid(z, x, y) for z, xys in tiles.items() for x, y in xys])
+
+    feature_ids = features_for_tiles(manifest, tiles)
+    print(f'Rebuilding {len(affected_ids)} tiles at zoom {rebuild_min_zoom}-{max_zoom} from {len(feature_ids)} covenants...')
+    features = load_tile_features(workflow, feature_ids, chunksize)
+    new_tiles = list(iter_python_tiles(
+        features, layer_name, rebuild_min_zoom, max_zoom, tiles, reader.header['tile_compression']
+    ))
+
+    replaced_ids = set()
+
+    def kept_tiles():
+        for tile_id, data in reader.iter_tiles():
+            if tile_id in affected_ids:
+                replaced_ids.add(tile_id)
+            else:
+                yield tile_id, data
+
+    writer = PMTilesWriter(tile_compression=reader.header['tile_compression'])
+    for tile_id, data in heapq.merge(kept_tiles(), new_tiles, key=lambda t: t[0]):
+        writer.add_tile(tile_id, data)
+    total_tiles = writer.finish(out_file, reader.metadata, min_zoom, max_zoom, manifest_bounds(manifest))
+
+    return {
+        'changed_features': len(changed_ids),
+        'rebuilt_tiles': len(new_tiles),
+        'removed_tiles': len(replaced_ids - set([t[0] for t in new_tiles])),
+        'total_tiles': total_tiles,
+        'layer': layer_name,
+        'min_zoom': min_zoom,
+        'max_zoom': max_zoom,
+        'rebuild_min_zoom': rebuild_min_zoom,
+    }
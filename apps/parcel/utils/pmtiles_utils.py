@@ -0,0 +1,289 @@
+import io
+import gzip
+import json
+import struct
+import hashlib
+import tempfile
+
+# Minimal PMTiles v3 reader and writer (https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md),
+# enough to read archives made by tippecanoe and write archives that tile servers and maplibre can read
+
+HEADER_SIZE = 127
+ROOT_DIR_MAX_SIZE = 16384 - HEADER_SIZE
+
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+TILE_TYPE_MVT = 1
+
+
+def rotate(n, x, y, rx, ry):
+    if ry == 0:
+        if rx != 0:
+            x = n - 1 - x
+            y = n - 1 - y
+        return y, x
+    return x, y
+
+
+def zxy_to_tileid(z, x, y):
+    '''Position of a tile on the Hilbert curve that orders tiles in a PMTiles archive'''
+    acc = ((1 << (z * 2)) - 1) // 3
+    a = z - 1
+    while a >= 0:
+        s = 1 << a
+        rx = 1 if s & x else 0
+        ry = 1 if s & y else 0
+        acc += ((3 * rx) ^ ry) << (a * 2)
+        x, y = rotate(s, x, y, rx, ry)
+        a -= 1
+    return acc
+
+
+def tileid_to_zxy(tile_id):
+    acc = 0
+    for z in range(32):
+        num_tiles = 1 << (z * 2)
+        if acc + num_tiles > tile_id:
+            pos = tile_id - acc
+            x = y = 0
+            s = 1
+            while s < (1 << z):
+                rx = 1 & (pos // 2)
+                ry = 1 & (pos ^ rx)
+                x, y = rotate(s, x, y, rx, ry)
+                x += s * rx
+                y += s * ry
+                pos //= 4
+                s *= 2
+            return z, x, y
+        acc += num_tiles
+    raise ValueError(f'Tile id {tile_id} out of range')
+
+
+def write_varint(buf, value):
+    while value >= 0x80:
+        buf.write(bytes([(value & 0x7f) | 0x80]))
+        value >>= 7
+    buf.write(bytes([value]))
+
+
+def read_varint(buf):
+    shift = 0
+    result = 0
+    while True:
+        byte = buf.read(1)[0]
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result
+        shift += 7
+
+
+def compress(data, compression):
+    if compression == COMPRESSION_GZIP:
+        return gzip.compress(data)
+    return data
+
+
+def decompress(data, compression):
+    if compression == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    return data
+
+
+def serialize_directory(entries, compression):
+    '''entries are (tile_id, offset, length, run_length) tuples sorted by tile_id'''
+    buf = io.BytesIO()
+    write_varint(buf, len(entries))
+    last_id = 0
+    for entry in entries:
+        write_varint(buf, entry[0] - last_id)
+        last_id = entry[0]
+    for entry in entries:
+        write_varint(buf, entry[3])
+    for entry in entries:
+        write_varint(buf, entry[2])
+    for i, entry in enumerate(entries):
+        if i > 0 and entry[1] == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(buf, 0)
+        else:
+            write_varint(buf, entry[1] + 1)
+    return compress(buf.getvalue(), compression)
+
+
+def deserialize_directory(data, compression):
+    buf = io.BytesIO(decompress(data, compression))
+    num_entries = read_varint(buf)
+    tile_ids = []
+    last_id = 0
+    for i in range(num_entries):
+        last_id += read_varint(buf)
+        tile_ids.append(last_id)
+    run_lengths = [read_varint(buf) for i in range(num_entries)]
+    lengths = [read_varint(buf) for i in range(num_entries)]
+    entries = []
+    for i in range(num_entries):
+        raw_offset = read_varint(buf)
+        if raw_offset == 0 and i > 0:
+            offset = entries[i - 1][1] + entries[i - 1][2]
+        else:
+            offset = raw_offset - 1
+        entries.append((tile_ids[i], offset, lengths[i], run_lengths[i]))
+    return entries
+
+
+HEADER_FORMAT = '<7sBQQQQQQQQQQQBBBBBBiiiiBii'
+
+
+def serialize_header(h):
+    return struct.pack(
+        HEADER_FORMAT, b'PMTiles', 3,
+        h['root_offset'], h['root_length'], h['metadata_offset'], h['metadata_length'],
+        h['leaf_offset'], h['leaf_length'], h['data_offset'], h['data_length'],
+        h['addressed_tiles'], h['tile_entries'], h['tile_contents'],
+        1, h['internal_compression'], h['tile_compression'], h['tile_type'],
+        h['min_zoom'], h['max_zoom'],
+        h['min_lon_e7'], h['min_lat_e7'], h['max_lon_e7'], h['max_lat_e7'],
+        h['center_zoom'], h['center_lon_e7'], h['center_lat_e7'],
+    )
+
+
+def deserialize_header(data):
+    values = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+    if values[0] != b'PMTiles' or values[1] != 3:
+        raise ValueError('Not a PMTiles v3 archive')
+    keys = [
+        'root_offset', 'root_length', 'metadata_offset', 'metadata_length',
+        'leaf_offset', 'leaf_length', 'data_offset', 'data_length',
+        'addressed_tiles', 'tile_entries', 'tile_contents',
+        'clustered', 'internal_compression', 'tile_compression', 'tile_type',
+        'min_zoom', 'max_zoom', 'min_lon_e7', 'min_lat_e7', 'max_lon_e7', 'max_lat_e7',
+        'center_zoom', 'center_lon_e7', 'center_lat_e7',
+    ]
+    return dict(zip(keys, values[2:]))
+
+
+class PMTilesReader:
+    '''Reads tiles from an open binary PMTiles file'''
+
+    def __init__(self, archive_file):
+        self.file = archive_file
+        self.header = deserialize_header(self.read_bytes(0, HEADER_SIZE))
+        self.metadata = json.loads(decompress(
+            self.read_bytes(self.header['metadata_offset'], self.header['metadata_length']),
+            self.header['internal_compression']
+        ) or b'{}')
+
+    def read_bytes(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def iter_entries(self, offset=None, length=None):
+        '''Every tile entry in tile_id order, following leaf directories'''
+        if offset is None:
+            offset, length = self.header['root_offset'], self.header['root_length']
+        for entry in deserialize_directory(self.read_bytes(offset, length), self.header['internal_compression']):
+            if entry[3] == 0:
+                yield from self.iter_entries(self.header['leaf_offset'] + entry[1], entry[2])
+            else:
+                yield entry
+
+    def iter_tiles(self):
+        '''(tile_id, tile bytes as stored) for every addressed tile, expanding runs'''
+        for tile_id, offset, length, run_length in self.iter_entries():
+            data = self.read_bytes(self.header['data_offset'] + offset, length)
+            for i in range(run_length):
+                yield tile_id + i, data
+
+
+class PMTilesWriter:
+    '''Writes a clustered PMTiles archive. Tiles must be added in tile_id order. Tile data is spooled to a temp file, and identical tiles are stored once.'''
+
+    def __init__(self, tile_compression=COMPRESSION_GZIP, internal_compression=COMPRESSION_GZIP):
+        self.tile_compression = tile_compression
+        self.internal_compression = internal_compression
+        self.data_file = tempfile.TemporaryFile()
+        self.entries = []
+        self.offsets_by_hash = {}
+        self.data_length = 0
+        self.addressed_tiles = 0
+        self.last_tile_id = -1
+
+    def add_tile(self, tile_id, data):
+        '''data is the tile as stored, already compressed with tile_compression'''
+        if tile_id <= self.last_tile_id:
+            raise ValueError('Tiles must be added in increasing tile_id order')
+        self.last_tile_id = tile_id
+        self.addressed_tiles += 1
+
+        tile_hash = hashlib.md5(data).digest()
+        if tile_hash in self.offsets_by_hash:
+            offset = self.offsets_by_hash[tile_hash]
+        else:
+            offset = self.data_length
+            self.offsets_by_hash[tile_hash] = offset
+            self.data_file.write(data)
+            self.data_length += len(data)
+
+        last = self.entries[-1] if self.entries else None
+        if last and last[0] + last[3] == tile_id and last[1] == offset:
+            self.entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+        else:
+            self.entries.append((tile_id, offset, len(data), 1))
+
+    def build_directories(self):
+        '''Root directory, and leaf directories if the root wouldn't fit in the first 16k'''
+        root = serialize_directory(self.entries, self.internal_compression)
+        if len(root) <= ROOT_DIR_MAX_SIZE:
+            return root, b''
+
+        leaf_size = 4096
+        while True:
+            leaves = io.BytesIO()
+            root_entries = []
+            for i in range(0, len(self.entries), leaf_size):
+                leaf = serialize_directory(self.entries[i:i + leaf_size], self.internal_compression)
+                root_entries.append((self.entries[i][0], leaves.tell(), len(leaf), 0))
+                leaves.write(leaf)
+            root = serialize_directory(root_entries, self.internal_compression)
+            if len(root) <= ROOT_DIR_MAX_SIZE:
+                return root, leaves.getvalue()
+            leaf_size *= 2
+
+    def finish(self, out_file, metadata, min_zoom, max_zoom, bounds):
+        '''Write the archive to an open binary file. bounds is (min_lon, min_lat, max_lon, max_lat).'''
+        root, leaves = self.build_directories()
+        metadata_bytes = compress(json.dumps(metadata).encode('utf-8'), self.internal_compression)
+
+        root_offset = HEADER_SIZE
+        metadata_offset = root_offset + len(root)
+        leaf_offset = metadata_offset + len(metadata_bytes)
+        data_offset = leaf_offset + len(leaves)
+
+        out_file.write(serialize_header({
+            'root_offset': root_offset, 'root_length': len(root),
+            'metadata_offset': metadata_offset, 'metadata_length': len(metadata_bytes),
+            'leaf_offset': leaf_offset, 'leaf_length': len(leaves),
+            'data_offset': data_offset, 'data_length': self.data_length,
+            'addressed_tiles': self.addressed_tiles, 'tile_entries': len(self.entries),
+            'tile_contents': len(self.offsets_by_hash),
+            'internal_compression': self.internal_compression,
+            'tile_compression': self.tile_compression, 'tile_type': TILE_TYPE_MVT,
+            'min_zoom': min_zoom, 'max_zoom': max_zoom,
+            'min_lon_e7': int(bounds[0] * 1e7), 'min_lat_e7': int(bounds[1] * 1e7),
+            'max_lon_e7': int(bounds[2] * 1e7), 'max_lat_e7': int(bounds[3] * 1e7),
+            'center_zoom': min_zoom,
+            'center_lon_e7': int((bounds[0] + bounds[2]) / 2 * 1e7),
+            'center_lat_e7': int((bounds[1] + bounds[3]) / 2 * 1e7),
+        }))
+        out_file.write(root)
+        out_file.write(metadata_bytes)
+        out_file.write(leaves)
+
+        self.data_file.seek(0)
+        while True:
+            block = self.data_file.read(1024 * 1024)
+            if not block:
+                break
+            out_file.write(block)
+        self.data_file.close()
+        return self.addressed_tiles
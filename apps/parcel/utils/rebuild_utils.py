@@ -0,0 +1,160 @@
+import os
+import csv
+import time
+import tempfile
+from collections import defaultdict
+from multiprocessing import Pool
+
+from django.db import transaction
+
+from apps.parcel.models import Parcel, ParcelJoinCandidate, ManualParcelCandidate
+from apps.plat.models import Plat, PlatAlternateName, Subdivision, SubdivisionAlternateName
+from apps.parcel.utils.parcel_utils import parcel_options_shard
+from apps.parcel.utils.lookup_cache import bump_parcel_lookup_version
+
+COPY_NULL = '\\N'
+PJC_CSV_HEADERS = ['workflow_id', 'parcel_id', 'plat_name_standardized', 'join_string', 'metadata']
+
+
+class ParcelJoinCandidateRebuilder:
+    '''Rebuild ParcelJoinCandidate rows for a workflow, or for a subset of its parcels. Produces the same rows as calling get_all_parcel_options on each Parcel, but plat and subdivision names, their alternate names and ManualParcelCandidates are each read once into dicts rather than queried per parcel. Candidate generation is sharded across a process pool, and the rows are streamed to a temporary CSV and loaded with COPY.'''
+
+    def __init__(self, workflow, workers=None, shard_size=20000):
+        self.workflow = workflow
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.timings = {}
+
+    def log_phase(self, phase, start):
+        self.timings[phase] = time.perf_counter() - start
+        print(f'{phase} took {self.timings[phase]:.1f}s')
+
+    def gather_parcels(self, parcels=None):
+        '''With no parcels passed, this is every parcel in the workflow with a lot value, same as rebuild_parcel_spatial_lookups has always used'''
+        qs = Parcel.objects.filter(workflow=self.workflow)
+        if parcels is None:
+            qs = qs.exclude(lot__isnull=True)
+        else:
+            qs = qs.filter(pk__in=parcels)
+        return list(qs.values_list('pk', 'plat_standardized', 'block', 'lot', 'plat_id', 'subdivision_spatial_id'))
+
+    def prefetch(self, parcel_rows):
+        '''Extra addition names for each plat and subdivision, and ManualParcelCandidates for each parcel'''
+        plat_ids = set(p[4] for p in parcel_rows if p[4])
+        subdivision_ids = set(p[5] for p in parcel_rows if p[5])
+
+        plat_additions = defaultdict(list)
+        for plat_id, name in Plat.objects.filter(pk__in=plat_ids).values_list('pk', 'plat_name_standardized'):
+            plat_additions[plat_id].append(name)
+        for plat_id, name in PlatAlternateName.objects.filter(plat_id__in=plat_ids).order_by('pk').values_list('plat_id', 'alternate_name_standardized'):
+            plat_additions[plat_id].append(name)
+
+        subdivision_additions = defaultdict(list)
+        for subdivision_id, name in Subdivision.objects.filter(pk__in=subdivision_ids).values_list('pk', 'name_standardized'):
+            subdivision_additions[subdivision_id].append(name)
+        for subdivision_id, name in SubdivisionAlternateName.objects.filter(subdivision_id__in=subdivision_ids).order_by('pk').values_list('subdivision_id', 'alternate_name_standardized'):
+            subdivision_additions[subdivision_id].append(name)
+
+        manual_candidates = defaultdict(list)
+        for parcel_id, addition, block, lot in ManualParcelCandidate.objects.filter(
+            parcel__workflow=self.workflow
+        ).order_by('pk').values_list('parcel_id', 'addition', 'block', 'lot'):
+            manual_candidates[parcel_id].append((addition, block, lot))
+
+        return plat_additions, subdivision_additions, manual_candidates
+
+    def build_shards(self, parcel_rows):
+        plat_additions, subdivision_additions, manual_candidates = self.prefetch(parcel_rows)
+
+        work = []
+        for parcel_id, plat_standardized, block, lot, plat_id, subdivision_id in parcel_rows:
+            extra_additions = plat_additions.get(plat_id, []) + subdivision_additions.get(subdivision_id, [])
+            work.append((parcel_id, plat_standardized, block, lot, extra_additions, manual_candidates.get(parcel_id, [])))
+
+        return [work[i:i + self.shard_size] for i in range(0, len(work), self.shard_size)]
+
+    def write_candidates(self, shards, csv_file):
+        '''Generate candidates for each shard and write them to csv_file as they come back. Returns number of rows written.'''
+        writer = csv.writer(csv_file)
+        writer.writerow(PJC_CSV_HEADERS)
+
+        total_parcels = sum(len(shard) for shard in shards)
+        done_parcels = 0
+        row_count = 0
+
+        def write_results(results):
+            nonlocal done_parcels, row_count
+            for shard_size, rows in results:
+                for parcel_id, plat_standardized, join_string, metadata in rows:
+                    writer.writerow([
+                        COPY_NULL if self.workflow is None else self.workflow.id,
+                        parcel_id,
+                        COPY_NULL if plat_standardized is None else plat_standardized,
+                        join_string,
+                        metadata
+                    ])
+                done_parcels += shard_size
+                row_count += len(rows)
+                print(f'{done_parcels}/{total_parcels} parcels processed, {row_count} candidates...')
+
+        if self.workers > 1 and len(shards) > 1:
+            with Pool(processes=min(self.workers, len(shards))) as pool:
+                write_results(zip(
+                    [len(shard) for shard in shards],
+                    pool.imap(parcel_options_shard, shards)
+                ))
+        else:
+            write_results((len(shard), parcel_options_shard(shard)) for shard in shards)
+
+        return row_count
+
+    def copy_candidates(self, csv_path):
+        return ParcelJoinCandidate.objects.from_csv(
+            csv_path,
+            mapping={
+                'workflow': 'workflow_id',
+                'parcel': 'parcel_id',
+                'plat_name_standardized': 'plat_name_standardized',
+                'join_string': 'join_string',
+                'metadata': 'metadata',
+            },
+            null=COPY_NULL,
+            # Same table holds every workflow, so leave indexes and constraints alone
+            drop_constraints=False,
+            drop_indexes=False
+        )
+
+    def run(self, parcels=None):
+        '''Rebuild candidates for every parcel in the workflow, or just the parcels passed (queryset or list of ids). Old candidates for those parcels are replaced in the same transaction.'''
+        run_start = time.perf_counter()
+
+        phase_start = time.perf_counter()
+        parcel_rows = self.gather_parcels(parcels)
+        shards = self.build_shards(parcel_rows)
+        print(f'{len(parcel_rows)} parcels in {len(shards)} shards, using {self.workers} workers...')
+        self.log_phase('Gathering parcels', phase_start)
+
+        with tempfile.NamedTemporaryFile('w+', suffix='.csv', newline='') as csv_file:
+            phase_start = time.perf_counter()
+            row_count = self.write_candidates(shards, csv_file)
+            csv_file.flush()
+            self.log_phase('Generating candidates', phase_start)
+
+            with transaction.atomic():
+                phase_start = time.perf_counter()
+                print("Clearing old ParcelJoinCandidate objects...")
+                old_candidates = ParcelJoinCandidate.objects.filter(workflow=self.workflow)
+                if parcels is not None:
+                    old_candidates = ParcelJoinCandidate.objects.filter(parcel_id__in=[p[0] for p in parcel_rows])
+                old_candidates.delete()
+                self.log_phase('Clearing old candidates', phase_start)
+
+                phase_start = time.perf_counter()
+                print(f'Copying {row_count} candidates to DB...')
+                inserted = self.copy_candidates(csv_file.name) if row_count > 0 else 0
+                if self.workflow is not None:
+                    bump_parcel_lookup_version(self.workflow.pk)
+                self.log_phase('Copying candidates', phase_start)
+
+        self.log_phase('Total', run_start)
+        return inserted
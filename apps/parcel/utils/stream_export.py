@@ -0,0 +1,277 @@
+import csv
+import json
+import itertools
+
+import pandas as pd
+import geopandas as gpd
+
+from django.contrib.gis.db.models.functions import AsGeoJSON, AsWKB
+
+from apps.parcel.models import CovenantedParcel
+from apps.parcel.utils.export_utils import EXPORT_FIELDS_ORDERED, deduped_str_list
+from apps.zoon.models import ZooniverseSubject, ManualCovenant
+from apps.zoon.utils.zooniverse_load import get_image_url_prefix, get_full_url
+
+# Export columns that aren't CovenantedParcel fields, and what they come from
+COVENANT_EXPORT_SOURCES = {
+    'db_id': 'id',
+    'workflow': 'workflow_id',
+    'geocd_addr': None,
+    'geocd_dist': None,
+}
+
+UNMAPPED_ATTRS = [
+    'id', 'workflow', 'doc_num', 'deed_date_final', 'seller_final', 'buyer_final', 'cov_type', 'cov_text',
+    'zn_subj_id', 'zn_dt_ret', 'image_ids', 'med_score', 'manual_cx', 'match_type', 'join_candidates',
+    'add_cov', 'block_cov', 'lot_cov', 'map_book_final', 'map_book_page_final', 'city_cov', 'dt_updated',
+]
+UNMAPPED_RENAME = {
+    'deed_date_final': 'deed_date',
+    'seller_final': 'seller',
+    'buyer_final': 'buyer',
+    'map_book_final': 'map_book',
+    'map_book_page_final': 'map_page',
+}
+UNMAPPED_FIELDS = [UNMAPPED_RENAME.get(f, f) for f in UNMAPPED_ATTRS] + ['cnty_name', 'cnty_fips']
+
+VALIDATION_ATTRS = [
+    'id', 'workflow', 'doc_num', 'deed_date_final', 'cov_type', 'cov_text', 'zn_subj_id', 'zn_dt_ret',
+    'resp_count', 'med_score', 'cov_score', 'hand_score', 'mtype_score', 'text_score', 'add_score',
+    'lot_score', 'block_score', 'city_score', 'sell_score', 'buy_score', 'manual_cx', 'match_type',
+    'join_candidates', 'add_cov', 'block_cov', 'lot_cov', 'map_book', 'map_page', 'city_cov', 'dt_updated',
+]
+
+ALL_DOCS_ATTRIBUTES = [
+    'workflow', 'cov_type', 'db_id', 'doc_num', 'deed_year', 'deed_date', 'cov_text', 'seller', 'buyer',
+    'add_cov', 'block_cov', 'lot_cov', 'map_book', 'map_page', 'is_mapped', 'addresses', 'cities', 'state',
+    'cnty_pins', 'join_strgs', 'match_type', 'manual_cx', 'dt_updated', 'zn_subj_id', 'zn_dt_ret',
+    'main_image', 'web_image', 'highlight_image', 'image_ids', 'med_score',
+]
+ALL_DOCS_PARCEL_FIELDS = ['mapped_address', 'mapped_city', 'mapped_state', 'mapped_parcel_pin']
+
+# GeoJSON header written by GDAL for EPSG:4326 layers, so streamed files look like the old gpd.to_file output
+GEOJSON_CRS = {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}}
+
+
+def iter_chunks(queryset, chunksize=5000):
+    '''Rows of a values() queryset in lists of chunksize, read through a server-side cursor so the whole result is never in memory'''
+    chunk = []
+    for row in queryset.iterator(chunk_size=chunksize):
+        chunk.append(row)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def csv_value(value):
+    '''Same text pandas to_csv would write for a single value'''
+    if value is None:
+        return ''
+    return str(value)
+
+
+def json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def covenant_export_row(row):
+    out_row = {}
+    for field in EXPORT_FIELDS_ORDERED:
+        source = COVENANT_EXPORT_SOURCES.get(field, field)
+        # Currently blank fields in existing workflows
+        out_row[field] = row[source] if source else ''
+    return out_row
+
+
+def covenant_export_queryset(workflow, geom_output=None):
+    '''CovenantedParcel values for the main covenants export. geom_output adds a "geom" column: "geojson" for ST_AsGeoJSON text, "wkb" for WKB bytes.'''
+    qs = CovenantedParcel.objects.filter(workflow=workflow).order_by('pk')
+    if geom_output == 'geojson':
+        qs = qs.annotate(geom=AsGeoJSON('geom_4326'))
+    elif geom_output == 'wkb':
+        qs = qs.annotate(geom=AsWKB('geom_4326'))
+
+    db_fields = [COVENANT_EXPORT_SOURCES.get(f, f) for f in EXPORT_FIELDS_ORDERED]
+    db_fields = [f for f in db_fields if f is not None]
+    if geom_output:
+        db_fields.append('geom')
+    return qs.values(*db_fields)
+
+
+def iter_covenant_rows(workflow, geom_output=None, chunksize=5000):
+    '''Chunks of covenants export rows, with EXPORT_FIELDS_ORDERED keys (plus "geom" if geom_output is set)'''
+    for chunk in iter_chunks(covenant_export_queryset(workflow, geom_output), chunksize):
+        rows = []
+        for row in chunk:
+            out_row = covenant_export_row(row)
+            if geom_output:
+                out_row['geom'] = row['geom']
+            rows.append(out_row)
+        yield rows
+
+
+def write_csv_rows(chunks, fields, out_file):
+    '''Write chunks of row dicts to an open text file as CSV. Returns number of rows written.'''
+    writer = csv.writer(out_file)
+    writer.writerow(fields)
+    row_count = 0
+    for chunk in chunks:
+        writer.writerows([[csv_value(row[f]) for f in fields] for row in chunk])
+        row_count += len(chunk)
+        print(f'{row_count} rows written...')
+    out_file.flush()
+    return row_count
+
+
+def write_covenants_csv(workflow, out_file, chunksize=5000):
+    return write_csv_rows(iter_covenant_rows(workflow, None, chunksize), EXPORT_FIELDS_ORDERED, out_file)
+
+
+def write_covenants_geojson(workflow, out_file, layer_name, chunksize=5000):
+    '''Write the covenants export as a GeoJSON FeatureCollection, one feature at a time. Geometries are written exactly as PostGIS encoded them, without being parsed. Returns number of features written.'''
+    out_file.write('{\n"type": "FeatureCollection",\n')
+    out_file.write(f'"name": {json.dumps(layer_name)},\n')
+    out_file.write(f'"crs": {json.dumps(GEOJSON_CRS)},\n')
+    out_file.write('"features": [\n')
+
+    feature_count = 0
+    for chunk in iter_covenant_rows(workflow, 'geojson', chunksize):
+        for row in chunk:
+            geom = row.pop('geom')
+            properties = json.dumps({k: json_value(v) for k, v in row.items()})
+            if feature_count > 0:
+                out_file.write(',\n')
+            out_file.write(f'{{ "type": "Feature", "properties": {properties}, "geometry": {geom} }}')
+            feature_count += 1
+        print(f'{feature_count} features written...')
+
+    out_file.write('\n]\n}\n')
+    out_file.flush()
+    return feature_count
+
+
+def covenant_chunk_gdf(chunk):
+    '''GeoDataFrame for one chunk of covenants export rows, with the same dtypes in every chunk so they can be appended to one file'''
+    df = pd.DataFrame(chunk, columns=EXPORT_FIELDS_ORDERED + ['geom'])
+    df['deed_date'] = pd.to_datetime(df['deed_date'], errors='coerce', format='%Y-%m-%d')
+    for int_field in ['db_id', 'workflow', 'deed_year', 'zn_subj_id', 'plat_dbid', 'subd_dbid']:
+        df[int_field] = df[int_field].astype('Int64')
+    df['med_score'] = df['med_score'].astype('float64')
+    df['manual_cx'] = df['manual_cx'].astype('boolean')
+
+    geometry = gpd.GeoSeries.from_wkb(df.pop('geom').apply(bytes), crs='EPSG:4326')
+    return gpd.GeoDataFrame(df, geometry=geometry)
+
+
+def write_covenants_shapefile(workflow, shp_path, chunksize=5000):
+    '''Write the covenants export to a shapefile a chunk at a time, appending to the same layer. Returns number of features written.'''
+    feature_count = 0
+    for chunk in iter_covenant_rows(workflow, 'wkb', chunksize):
+        covenant_chunk_gdf(chunk).to_file(
+            shp_path,
+            index=False,
+            driver='ESRI Shapefile',
+            mode='w' if feature_count == 0 else 'a'
+        )
+        feature_count += len(chunk)
+        print(f'{feature_count} features written...')
+    return feature_count
+
+
+def iter_unmapped_rows(workflow, cnty_name=None, cnty_fips=None, chunksize=5000):
+    queryset = ZooniverseSubject.unmapped_objects.filter(workflow=workflow).order_by('pk').values(*UNMAPPED_ATTRS)
+    for chunk in iter_chunks(queryset, chunksize):
+        rows = []
+        for row in chunk:
+            out_row = {UNMAPPED_RENAME.get(k, k): v for k, v in row.items()}
+            out_row['cnty_name'] = cnty_name
+            out_row['cnty_fips'] = cnty_fips
+            rows.append(out_row)
+        yield rows
+
+
+def write_unmapped_csv(workflow, out_file, cnty_name=None, cnty_fips=None, chunksize=5000):
+    return write_csv_rows(iter_unmapped_rows(workflow, cnty_name, cnty_fips, chunksize), UNMAPPED_FIELDS, out_file)
+
+
+def write_validation_csv(workflow, out_file, chunksize=5000):
+    queryset = ZooniverseSubject.validation_objects.filter(workflow=workflow).order_by('pk').values(*VALIDATION_ATTRS)
+    return write_csv_rows(iter_chunks(queryset, chunksize), VALIDATION_ATTRS, out_file)
+
+
+def all_docs_zooniverse_queryset(workflow):
+    return ZooniverseSubject.all_covenanted_docs_objects.filter(workflow=workflow).order_by('pk').values(
+        'db_id', 'workflow', 'is_mapped', 'deed_date_final', 'cov_text', 'image_ids', 'zn_subj_id', 'zn_dt_ret',
+        'main_image', 'web_image', 'highlight_image', 'med_score', 'manual_cx', 'add_cov', 'block_cov', 'lot_cov',
+        'map_book_final', 'map_book_page_final', 'join_strgs', 'seller_final', 'buyer_final', 'dt_updated',
+        'doc_num', 'cov_type', 'match_type_final', *ALL_DOCS_PARCEL_FIELDS
+    )
+
+
+def all_docs_manual_queryset(workflow):
+    return ManualCovenant.all_covenanted_docs_objects.filter(workflow=workflow).order_by('pk').values(
+        'db_id', 'workflow', 'is_mapped', 'deed_date', 'cov_text', 'zn_subj_id', 'zn_dt_ret', 'med_score',
+        'manual_cx', 'add_cov', 'block_cov', 'lot_cov', 'map_book', 'map_book_page', 'join_strgs', 'seller',
+        'buyer', 'dt_updated', 'doc_num', 'cov_type', *ALL_DOCS_PARCEL_FIELDS
+    )
+
+
+def zoon_doc_row(row):
+    return {
+        **row,
+        'deed_date': row['deed_date_final'],
+        'map_book': row['map_book_final'],
+        'map_page': row['map_book_page_final'],
+        'seller': row['seller_final'],
+        'buyer': row['buyer_final'],
+        'match_type': row['match_type_final'],
+    }
+
+
+def manual_doc_row(row):
+    return {
+        **row,
+        'match_type': row['cov_type'],
+        'map_page': row['map_book_page'],
+        'image_ids': '',
+        'main_image': '',
+        'web_image': '',
+        'highlight_image': '',
+        'cov_type': 'manual',
+    }
+
+
+def iter_all_docs_rows(workflow, chunksize=5000):
+    '''Same rows as build_all_covenanted_docs_df. Each covenant's queryset rows (one per matched parcel) arrive together because they're ordered by pk, so its parcel addresses can be rolled up without holding more than one document at a time.'''
+    zoon_rows = (zoon_doc_row(row) for row in all_docs_zooniverse_queryset(workflow).iterator(chunk_size=chunksize))
+    manual_rows = (manual_doc_row(row) for row in all_docs_manual_queryset(workflow).iterator(chunk_size=chunksize))
+
+    url_prefix = None
+    chunk = []
+    for (cov_type, db_id), doc_rows in itertools.groupby(itertools.chain(zoon_rows, manual_rows), key=lambda r: (r['cov_type'], r['db_id'])):
+        doc_rows = list(doc_rows)
+        doc = doc_rows[0]
+        if url_prefix is None:
+            url_prefix = get_image_url_prefix(doc['web_image'])
+        doc['addresses'] = deduped_str_list([r['mapped_address'] for r in doc_rows])
+        doc['cities'] = deduped_str_list([r['mapped_city'] for r in doc_rows])
+        doc['state'] = deduped_str_list([r['mapped_state'] for r in doc_rows])
+        doc['cnty_pins'] = deduped_str_list([r['mapped_parcel_pin'] for r in doc_rows])
+        doc['web_image'] = get_full_url(url_prefix, doc['web_image'])
+        doc['highlight_image'] = get_full_url(url_prefix, doc['highlight_image'])
+        doc['deed_year'] = doc['deed_date'].year if doc['deed_date'] else None
+
+        chunk.append(doc)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def write_all_covenanted_docs_csv(workflow, out_file, chunksize=5000):
+    return write_csv_rows(iter_all_docs_rows(workflow, chunksize), ALL_DOCS_ATTRIBUTES, out_file)
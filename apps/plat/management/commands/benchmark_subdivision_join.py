@@ -0,0 +1,89 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from apps.parcel.models import Parcel
+from apps.plat.models import Subdivision
+from apps.plat.utils.plat_utils import assign_parcel_subdivisions, generate_subdivisions_sql
+from apps.zoon.models import ZooniverseWorkflow
+
+
+class Command(BaseCommand):
+    '''Time subdivision generation and the parcel to subdivision spatial join on a synthetic grid of square parcels, comparing the set-based join against the old query-then-bulk_update join. Everything runs in a transaction that is rolled back, so nothing is left behind.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('-g', '--grid', type=int, default=200,
+                            help='Parcels per side of the grid. Default = 200 (40,000 parcels)')
+        parser.add_argument('-b', '--block', type=int, default=10,
+                            help='Parcels per side of each synthetic plat. Default = 10')
+        parser.add_argument('-c', '--concave-hull', type=float, default=0.5,
+                            help='Target percent for the concave hull run. Default = 0.5')
+
+    def timed(self, label, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        print(f'{label}: {time.perf_counter() - start:.2f}s')
+        return result
+
+    def create_grid(self, workflow, grid, block, size=0.0005, origin=(-93.3, 44.9)):
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO {Parcel._meta.db_table} (workflow_id, feature_id, plat_name, bool_covenant, geom_4326)
+                SELECT %s, x * %s + y, 'BENCHMARK ADDN ' || (x / %s) || '-' || (y / %s), false,
+                    ST_Multi(ST_MakeEnvelope(
+                        %s + x * %s, %s + y * %s, %s + (x + 1) * %s, %s + (y + 1) * %s, 4326
+                    ))
+                FROM generate_series(0, %s - 1) AS x, generate_series(0, %s - 1) AS y
+            ''', [
+                workflow.id, grid, block, block,
+                origin[0], size, origin[1], size, origin[0], size, origin[1], size,
+                grid, grid
+            ])
+            created = cursor.rowcount
+            cursor.execute(f'ANALYZE {Parcel._meta.db_table}')
+        return created
+
+    def row_join(self, workflow):
+        '''The previous join: fetch every parcel with its subdivision, then bulk_update them back'''
+        parcels_with_subs = list(Parcel.objects.raw(f'''SELECT
+              parcels.id AS id,
+              subdivisions.id AS subdivision_spatial_id
+            FROM {Parcel._meta.db_table} AS parcels
+            JOIN {Subdivision._meta.db_table} AS subdivisions
+            ON ST_Contains(subdivisions.geom_4326, ST_Centroid(parcels.geom_4326))
+            AND subdivisions.workflow_id = parcels.workflow_id
+            WHERE parcels.workflow_id = %s;''', [workflow.id]))
+        Parcel.objects.bulk_update(parcels_with_subs, ['subdivision_spatial_id'], batch_size=5000)
+        return len(parcels_with_subs)
+
+    def assignments(self, workflow):
+        return dict(Parcel.objects.filter(workflow=workflow).values_list('id', 'subdivision_spatial_id'))
+
+    def handle(self, *args, **kwargs):
+        grid = kwargs['grid']
+        block = kwargs['block']
+        print(f'Benchmarking on a {grid} x {grid} grid of parcels in {block} x {block} plats...')
+
+        with transaction.atomic():
+            workflow = ZooniverseWorkflow.objects.create(workflow_name='Subdivision join benchmark')
+
+            self.timed('Create grid', self.create_grid, workflow, grid, block)
+
+            self.timed('Generate subdivisions (concave hull)', generate_subdivisions_sql, workflow, kwargs['concave_hull'])
+            Subdivision.objects.filter(workflow=workflow).delete()
+            self.timed('Generate subdivisions (union)', generate_subdivisions_sql, workflow)
+
+            self.timed('Row join + bulk_update', self.row_join, workflow)
+            row_assignments = self.assignments(workflow)
+            Parcel.objects.filter(workflow=workflow).update(subdivision_spatial=None)
+
+            self.timed('Set-based spatial join', assign_parcel_subdivisions, workflow)
+            set_assignments = self.assignments(workflow)
+
+            diffs = [k for k, v in row_assignments.items() if set_assignments.get(k) != v]
+            transaction.set_rollback(True)
+
+        if len(diffs) > 0:
+            raise CommandError(f'{len(diffs)} parcels assigned differently. First 20: {diffs[:20]}')
+        print(f'Both joins assigned the same subdivisions to all {len(row_assignments)} parcels.')
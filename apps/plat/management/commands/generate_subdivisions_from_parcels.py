@@ -1,63 +1,22 @@
-import pandas as pd
-import geopandas as gpd
-
-# from shapely.geometry.polygon import Polygon
-# from shapely.geometry.multipolygon import MultiPolygon
-from django.contrib.gis.geos import MultiPolygon, GEOSGeometry
-# from django.contrib.gis.gdal import OGRGeometry, OGRGeomType
-
 from django.core.management.base import BaseCommand
 from django.core import management
 from django.conf import settings
-from django.contrib.gis.db.models.aggregates import Union
-from django.contrib.gis.db.models.functions import AsWKT, MakeValid
 
-from apps.plat.models import Subdivision
-from apps.parcel.models import Parcel
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
-from apps.plat.utils.plat_utils import standardize_subdivisions
-
-from django.db import connection
+from apps.plat.utils.plat_utils import standardize_subdivisions, generate_subdivisions_sql
 
 
 class Command(BaseCommand):
-    '''Download and load a county parcel shapefile'''
+    '''Generate Subdivision objects from the parcels sharing each plat_name, for workflows without a subdivision GIS layer'''
     batch_config = None  # Set in handle
     shp_dir = None
 
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
-        
-    # def get_groups_sql(self, workflow):
-    #     '''Fair to say this did not work performantly, though this DB is not well tuned'''
-    #     with connection.cursor() as cursor:
-    #         cursor.execute("""
-    #             SELECT plat_name,
-    #             ST_ConcaveHull(
-    #                 ST_MakeValid(
-    #                     ST_Union(
-    #                         geom_4326
-    #                     )
-    #                 ), 0.5
-    #             ) AS hull_geom_4326
-    #             FROM parcel_parcel
-    #             WHERE workflow_id = %s
-    #             AND plat_name IS NOT NULL
-    #             GROUP BY plat_name
-    #         """, [workflow.id])
-    #         rows = cursor.fetchall()
-
-    #         return rows
-    #     return False
 
-    def ensure_multi(self, input_geom):
-        # print(input_geom)
-        # print(type(input_geom))
-        try:
-            return MultiPolygon(GEOSGeometry(input_geom))
-        except TypeError:
-            return input_geom        
+        parser.add_argument('-c', '--concave-hull', type=float, default=None,
+                            help='Use a concave hull of each plat\'s parcels with this target percent (0-1) instead of their union')
 
     def handle(self, *args, **kwargs):
         workflow_name = kwargs['workflow']
@@ -68,55 +27,7 @@ class Command(BaseCommand):
             self.batch_config = settings.ZOONIVERSE_QUESTION_LOOKUP[workflow_name]
             workflow = get_workflow_obj(workflow_name)
 
-            grouped_parcels = Parcel.objects.filter(
-                workflow=workflow,
-                plat_name__isnull=False
-            ).values(
-                'plat_name'
-            ).annotate(
-                # geom_4326=AsWKT(MakeValid(Union('geom_4326')))
-                geom_4326=MakeValid(Union('geom_4326'))
-            ).order_by(
-                'plat_name'
-            )
-
-            print(grouped_parcels.count())
-
-            # grouped_df = pd.DataFrame(grouped_parcels)
-            # gs = gpd.GeoSeries.from_wkt(grouped_df['geom_4326'])
-            # grouped_gdf = gpd.GeoDataFrame(grouped_df.drop(columns=['geom_4326']), geometry=gs, crs="EPSG:4326")
-            # grouped_gdf['concave_hull'] = grouped_gdf['geometry'].concave_hull()
-            # grouped_gdf.set_geometry('concave_hull', drop=True)
-
-            # grouped_gdf["concave_hull"] = [MultiPolygon([feature]) if isinstance(feature, Polygon) else feature for feature in grouped_gdf["concave_hull"]]
-
-            # print(grouped_gdf)
-
-            objs = []
-            obj_count = 0
-
-            for row in grouped_parcels:
-
-                geom_multi = self.ensure_multi(row['geom_4326'])
-
-                subdivision = Subdivision(
-                    workflow=workflow,
-                    name=row['plat_name'],
-                    orig_filename="Generated from parcels",
-                    geom_4326=geom_multi
-                )
-                print(subdivision)
-
-                objs.append(subdivision)
-                obj_count += 1
-
-                if obj_count % 10000 == 0:
-                    Subdivision.objects.bulk_create(objs)
-                    print(f'Saved {obj_count} Subdivision records...')
-                    objs = []
-
-            Subdivision.objects.bulk_create(objs)
-            print(f'Saved {obj_count} Subdivision records.')
+            generate_subdivisions_sql(workflow, kwargs['concave_hull'])
 
             standardize_subdivisions(workflow)
             management.call_command(
@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from apps.parcel.models import Parcel
+from apps.plat.utils.plat_utils import assign_parcel_subdivisions
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 class Command(BaseCommand):
@@ -23,21 +23,4 @@ class Command(BaseCommand):
             workflow = get_workflow_obj(workflow_name)
 
             print('Finding matching subdivisions by spatial join...')
-
-            parcels_with_subs = Parcel.objects.raw('''SELECT
-              parcels.id AS id,
-              parcels.join_description AS join_description,
-              subdivisions.name AS subdivision_name,
-              subdivisions.id AS subdivision_spatial_id
-            FROM parcel_parcel AS parcels
-            JOIN plat_subdivision AS subdivisions
-            ON ST_Contains(subdivisions.geom_4326, ST_Centroid(parcels.geom_4326))
-            WHERE parcels.workflow_id = %s;''', [workflow.id])
-
-            parcels_with_subs_list = list(parcels_with_subs)
-            # for p in parcels_with_subs[:10]:
-            #     print(p.id, p.join_description, p.subdivision_name, p.subdivision_id)
-
-            print(f'Updating {len(parcels_with_subs_list)} parcels ...')
-            Parcel.objects.bulk_update(
-                parcels_with_subs_list, ['subdivision_spatial_id'], batch_size=5000)
+            assign_parcel_subdivisions(workflow)
@@ -6,7 +6,7 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from apps.plat.models import Plat, PlatMapPage
-from apps.parcel.utils.parcel_utils import standardize_addition
+from apps.parcel.utils.parcel_utils import standardize_many
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 
 
@@ -64,8 +64,7 @@ class Command(BaseCommand):
         plats_to_upload = plats_to_upload.drop(
             columns=['local_path', 'remote_link', 'web_or_raw']).drop_duplicates()
 
-        plats_to_upload['plat_name_standardized'] = plats_to_upload['plat_name'].apply(
-            lambda x: standardize_addition(x))
+        plats_to_upload['plat_name_standardized'] = standardize_many(plats_to_upload['plat_name'])
 
         upload_objs = []
         for p in plats_to_upload.to_dict('records'):
@@ -4,7 +4,8 @@ from django.utils.text import slugify
 from django.utils.html import mark_safe
 from django.db.models import F
 
-from apps.parcel.utils.parcel_utils import standardize_addition, get_all_parcel_options, build_parcel_spatial_lookups
+from apps.parcel.utils.parcel_utils import standardize_addition
+from apps.parcel.utils.lookup_cache import get_cached_parcel_lookup
 from racial_covenants_processor.storage_backends import PrivateMediaStorage
 
 from postgres_copy import CopyManager
@@ -69,7 +70,8 @@ class PlatAlternateName(models.Model):
     objects = CopyManager()
 
     def save(self, *args, **kwargs):
-        from apps.parcel.models import Parcel, ParcelJoinCandidate
+        from apps.parcel.models import Parcel, DirtyMatchKey
+        from apps.parcel.utils.rebuild_utils import ParcelJoinCandidateRebuilder
         from apps.zoon.models import ZooniverseSubject, ManualCovenant
         self.plat_name = self.plat.plat_name
         self.zoon_workflow_id = self.plat.workflow.zoon_id
@@ -77,6 +79,7 @@ class PlatAlternateName(models.Model):
             self.alternate_name)
 
         super(PlatAlternateName, self).save(*args, **kwargs)
+        DirtyMatchKey.objects.mark(self.plat.workflow, 'ad', [self.alternate_name_standardized, self.plat.plat_name_standardized])
 
         parcel_matches = Parcel.objects.filter(
             workflow=self.workflow,
@@ -89,28 +92,11 @@ class PlatAlternateName(models.Model):
             plat=self.plat
         )
 
-        # avoid duplication
-        ParcelJoinCandidate.objects.filter(
-            parcel__pk__in=plat_parcels.values_list('pk', flat=True)
-        ).delete()
-
         # update parcel candidates for all parcels in this plat
-        join_cands = []
-        for parcel in plat_parcels:
-            candidates = get_all_parcel_options(parcel)
-            for c in candidates:
-                # parcel_spatial_lookup[c['join_string']] = c
-                join_cands.append(ParcelJoinCandidate(
-                    workflow=self.workflow,
-                    parcel=parcel,
-                    plat_name_standardized=parcel.plat_standardized,
-                    join_string=c['join_string'],
-                    metadata=c['metadata']
-                ))
-        ParcelJoinCandidate.objects.bulk_create(join_cands, batch_size=5000)
+        ParcelJoinCandidateRebuilder(self.workflow, workers=1).run(parcels=plat_parcels)
 
         print(self.alternate_name)
-        parcel_lookup = build_parcel_spatial_lookups(self.workflow)
+        parcel_lookup = get_cached_parcel_lookup(self.workflow)
         for z in ZooniverseSubject.objects.filter(workflow=self.workflow, addition_final__iexact=self.alternate_name):
             z.save(parcel_lookup=parcel_lookup)
 
@@ -163,7 +149,8 @@ class SubdivisionAlternateName(models.Model):
     objects = CopyManager()
 
     def save(self, *args, **kwargs):
-        from apps.parcel.models import Parcel, ParcelJoinCandidate
+        from apps.parcel.models import Parcel, DirtyMatchKey
+        from apps.parcel.utils.rebuild_utils import ParcelJoinCandidateRebuilder
         from apps.zoon.models import ZooniverseSubject, ManualCovenant
         self.subdivision_name = self.subdivision.name
         self.zoon_workflow_id = self.subdivision.workflow.zoon_id
@@ -171,6 +158,7 @@ class SubdivisionAlternateName(models.Model):
             self.alternate_name)
 
         super(SubdivisionAlternateName, self).save(*args, **kwargs)
+        DirtyMatchKey.objects.mark(self.subdivision.workflow, 'ad', [self.alternate_name_standardized, self.subdivision.name_standardized])
 
         parcel_matches = Parcel.objects.filter(
             workflow=self.workflow,
@@ -184,29 +172,12 @@ class SubdivisionAlternateName(models.Model):
             subdivision_spatial=self.subdivision
         )
 
-        # avoid duplication
-        ParcelJoinCandidate.objects.filter(
-            parcel__pk__in=subdivision_parcels.values_list('pk', flat=True)
-        ).delete()
-
-        # update parcel candidates for all parcels in this plat
-        join_cands = []
-        for parcel in subdivision_parcels:
-            candidates = get_all_parcel_options(parcel)
-            for c in candidates:
-                # parcel_spatial_lookup[c['join_string']] = c
-                join_cands.append(ParcelJoinCandidate(
-                    workflow=self.workflow,
-                    parcel=parcel,
-                    plat_name_standardized=parcel.plat_standardized,
-                    join_string=c['join_string'],
-                    metadata=c['metadata']
-                ))
-        ParcelJoinCandidate.objects.bulk_create(join_cands, batch_size=5000)
+        # update parcel candidates for all parcels in this subdivision
+        ParcelJoinCandidateRebuilder(self.workflow, workers=1).run(parcels=subdivision_parcels)
 
         # Re-save all zooniverse subjects with this alternate name
         print(self.alternate_name)
-        parcel_lookup = build_parcel_spatial_lookups(self.workflow)
+        parcel_lookup = get_cached_parcel_lookup(self.workflow)
         for z in ZooniverseSubject.objects.filter(workflow=self.workflow, addition_final__iexact=self.alternate_name):
             z.save(parcel_lookup=parcel_lookup)
 
@@ -1,4 +1,5 @@
 from django.test import TestCase
+from django.contrib.gis.geos import GEOSGeometry
 from django.core.management import call_command
 
 from .models import Plat, Subdivision, SubdivisionAlternateName
@@ -65,6 +66,30 @@ class PlatTests(TestCase):
 
         self.assertEqual(parcels_count, 0)
 
+    def test_addition_wide_match_cache(self):
+        """Is an addition-wide match cached with its parcels, and dropped when the addition's plats change"""
+        from apps.parcel.models import AdditionWideMatch
+        from apps.parcel.utils.addition_cache import get_addition_wide_matches
+
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        call_command("rebuild_parcel_spatial_lookups", workflow='MN Test County')
+
+        addition = standardize_addition('Lyndale Beach 2nd Addition')
+        entry = get_addition_wide_matches(workflow, [addition])[addition]
+        self.assertTrue(entry.bool_match)
+        self.assertEqual(
+            set(entry.parcel_ids),
+            set(Parcel.objects.filter(workflow=workflow, plat_name='LYNDALE BEACH 2ND ADDN').values_list('pk', flat=True))
+        )
+        self.assertIsNotNone(entry.geom_union_4326)
+        self.assertEqual(AdditionWideMatch.objects.filter(workflow=workflow, addition_standardized=addition).count(), 1)
+
+        # Reused while nothing changes
+        self.assertEqual(get_addition_wide_matches(workflow, [addition])[addition].pk, entry.pk)
+
+        Plat.objects.filter(workflow=workflow).first().save()
+        self.assertEqual(AdditionWideMatch.objects.filter(workflow=workflow).count(), 0)
+
     def test_subdivision_alternate_parcel_match(self):
         """Does an addition-wide covenant match all parcels in a subdivision with alternate name"""
 
@@ -94,6 +119,22 @@ class PlatTests(TestCase):
 
         self.assertEqual(parcels_count, 0)
 
+    def test_alternate_name_without_workflow(self):
+        '''Can an alternate name whose workflow has been deleted still be saved, without touching the workflow's parcel lookup?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        version = workflow.parcel_lookup_version
+
+        san = SubdivisionAlternateName(
+            workflow=None,
+            subdivision_id=1,
+            subdivision_name='LYNDALE BEACH 2ND ADDN',
+            alternate_name='Orphaned Alternate Name'
+        )
+        san.save()
+
+        self.assertIsNotNone(san.pk)
+        self.assertEqual(ZooniverseWorkflow.objects.get(pk=1).parcel_lookup_version, version)
+
     def test_standardize_subdivisions(self):
         workflow = ZooniverseWorkflow.objects.get(pk=1)
         sub_name = 'LYNDALE BEACH 2ND ADDN'
@@ -120,3 +161,36 @@ class PlatTests(TestCase):
 
         with self.settings(ZOONIVERSE_QUESTION_LOOKUP=TEST_ZOON_SETTINGS):
             call_command("generate_subdivisions_from_parcels", workflow='MN Test County')
+
+    def test_join_subdivisions_to_parcels(self):
+        """Does the spatial join assign parcels inside a subdivision to it, and leave a parcel outside every subdivision unassigned?"""
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        Parcel.objects.filter(workflow=workflow).update(subdivision_spatial=None)
+        # Move one parcel a few miles east of the fixture subdivision
+        Parcel.objects.filter(pk=11).update(geom_4326=GEOSGeometry(
+            'MULTIPOLYGON (((-93.113996 44.968512,-93.112839 44.969831,-93.111711 44.969427,-93.113996 44.968512)))', srid=4326))
+
+        TEST_ZOON_SETTINGS = {
+            workflow.workflow_name: {
+                'zoon_workflow_id': workflow.zoon_id,
+                'zoon_workflow_version': workflow.version,
+            }
+        }
+        with self.settings(ZOONIVERSE_QUESTION_LOOKUP=TEST_ZOON_SETTINGS):
+            call_command("join_subdivisions_to_parcels", workflow='MN Test County')
+
+        subdivision = Subdivision.objects.get(name='LYNDALE BEACH 2ND ADDN')
+        for pk in [1, 3, 8, 10]:
+            self.assertEqual(Parcel.objects.get(pk=pk).subdivision_spatial_id, subdivision.pk)
+        self.assertIsNone(Parcel.objects.get(pk=11).subdivision_spatial_id)
+
+    def test_benchmark_subdivision_join(self):
+        """Does the subdivision join benchmark run on a small grid and leave nothing behind?"""
+        parcel_count = Parcel.objects.count()
+        subdivision_count = Subdivision.objects.count()
+
+        call_command("benchmark_subdivision_join", grid=6, block=3)
+
+        self.assertEqual(Parcel.objects.count(), parcel_count)
+        self.assertEqual(Subdivision.objects.count(), subdivision_count)
+        self.assertFalse(ZooniverseWorkflow.objects.filter(workflow_name='Subdivision join benchmark').exists())
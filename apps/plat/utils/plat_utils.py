@@ -1,4 +1,9 @@
+import time
+
+from django.db import connection
+
 from apps.plat.models import Subdivision
+from apps.parcel.models import Parcel, AdditionWideMatch
 
 from apps.parcel.utils.parcel_utils import standardize_addition
 
@@ -16,4 +21,64 @@ def standardize_subdivisions(workflow):
 
     print(f'Updating {len(subs_to_update)} subdivisions ...')
     Subdivision.objects.bulk_update(
-        subs_to_update, ['name_standardized'])
\ No newline at end of file
+        subs_to_update, ['name_standardized'])
+
+
+def assign_parcel_subdivisions(workflow):
+    '''Set Parcel.subdivision_spatial for every parcel in the workflow whose point on surface falls inside one of the workflow's Subdivisions, in a single UPDATE. Each parcel probes the Subdivision GiST index once, and only rows whose subdivision actually changes are written. Where subdivisions overlap, the lowest id wins. Returns number of parcels updated.'''
+    start = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            UPDATE {Parcel._meta.db_table} AS parcels
+            SET subdivision_spatial_id = matches.subdivision_id
+            FROM (
+                SELECT p.id AS parcel_id, sub.id AS subdivision_id
+                FROM {Parcel._meta.db_table} AS p
+                CROSS JOIN LATERAL (
+                    SELECT s.id
+                    FROM {Subdivision._meta.db_table} AS s
+                    WHERE s.workflow_id = p.workflow_id
+                    AND ST_Contains(s.geom_4326, ST_PointOnSurface(p.geom_4326))
+                    ORDER BY s.id
+                    LIMIT 1
+                ) AS sub
+                WHERE p.workflow_id = %s
+            ) AS matches
+            WHERE parcels.id = matches.parcel_id
+            AND parcels.subdivision_spatial_id IS DISTINCT FROM matches.subdivision_id
+        ''', [workflow.id])
+        updated = cursor.rowcount
+    if updated > 0:
+        AdditionWideMatch.objects.invalidate(workflow)
+    print(f'Spatial join updated {updated} parcels in {time.perf_counter() - start:.1f}s')
+    return updated
+
+
+def generate_subdivisions_sql(workflow, concave_hull=None):
+    '''Create one Subdivision per parcel plat_name in the workflow, grouped and built in a single INSERT ... SELECT. By default each subdivision is the union of its parcels. With concave_hull (a target percent between 0 and 1, as in ST_ConcaveHull) it is the concave hull of the parcels instead, which skips the union entirely. Returns number of subdivisions created.'''
+    start = time.perf_counter()
+    if concave_hull is None:
+        hull_sql = 'ST_MakeValid(ST_Union(geom_4326))'
+        params = [workflow.id, workflow.id]
+    else:
+        hull_sql = 'ST_MakeValid(ST_ConcaveHull(ST_Collect(geom_4326), %s))'
+        params = [workflow.id, concave_hull, workflow.id]
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            INSERT INTO {Subdivision._meta.db_table} (workflow_id, name, orig_filename, geom_4326)
+            SELECT workflow_id, name, 'Generated from parcels', geom_4326
+            FROM (
+                SELECT %s AS workflow_id, plat_name AS name,
+                    ST_Multi(ST_CollectionExtract({hull_sql}, 3)) AS geom_4326
+                FROM {Parcel._meta.db_table}
+                WHERE workflow_id = %s AND plat_name IS NOT NULL
+                GROUP BY plat_name
+            ) AS hulls
+            WHERE NOT ST_IsEmpty(geom_4326)
+            ORDER BY name
+        ''', params)
+        created = cursor.rowcount
+    AdditionWideMatch.objects.invalidate(workflow)
+    print(f'Generated {created} subdivisions in {time.perf_counter() - start:.1f}s')
+    return created
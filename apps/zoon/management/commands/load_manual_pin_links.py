@@ -1,7 +1,8 @@
 from django.core import management
 from django.core.management.base import BaseCommand
+from django.db.models import Max
 
-from apps.zoon.models import ManualParcelPINLink
+from apps.zoon.models import ManualParcelPINLink, RecomputeRequest
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 from apps.zoon.utils.django_export import check_workflow_match
 
@@ -46,9 +47,21 @@ class Command(BaseCommand):
                 'comments': 'comments',
             }
 
+            # COPY doesn't return the new rows, but their ids are all above the current max
+            last_pk = ManualParcelPINLink.objects.aggregate(Max('pk'))['pk__max'] or 0
+
             insert_count = ManualParcelPINLink.objects.from_csv(
                 infile, mapping=mapping)
             print("{} records inserted".format(insert_count))
 
             management.call_command(
                 'connect_manual_pin_links', workflow=workflow_name)
+
+            # One recompute per subject in this file, however many rows it has
+            subject_ids = ManualParcelPINLink.objects.filter(
+                pk__gt=last_pk,
+                workflow=workflow,
+                zooniverse_subject__isnull=False
+            ).values_list('zooniverse_subject_id', flat=True).distinct()
+            queued = RecomputeRequest.objects.enqueue(workflow, 'zs', subject_ids)
+            print(f'Queued {queued} subjects for recompute. Run process_recompute_queue to apply.')
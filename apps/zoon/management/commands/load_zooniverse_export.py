@@ -3,10 +3,9 @@ import re
 import csv
 import json
 import datetime
+import tempfile
 import numpy as np
 import pandas as pd
-from itertools import chain
-from sqlalchemy import create_engine
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
@@ -18,7 +17,8 @@ from apps.zoon.models import ZooniverseResponseRaw, ZooniverseResponseProcessed,
 # from apps.zoon.utils.zooniverse_config import get_workflow_version
 from apps.zoon.utils.zooniverse_config import get_workflow_obj
 # from apps.zoon.utils.zooniverse_load import bulk_delete_models
-from apps.parcel.utils.parcel_utils import write_join_strings
+from apps.zoon.utils.zooniverse_consolidate import reduced_answers_df, parse_deed_dates, copy_dataframe, upsert_subjects, filter_new_classifications, write_individual_responses
+from apps.parcel.utils.parcel_utils import write_join_strings_many
 
 
 class Command(BaseCommand):
@@ -32,6 +32,9 @@ class Command(BaseCommand):
         parser.add_argument('-s', '--slow', action='store_true',
                             help="Don't use bulk copy to avoid I/O limitations")
 
+        parser.add_argument('-i', '--incremental', action='store_true',
+                            help="Only load classifications that aren't in the database yet, and update the subjects they touch in place instead of clearing the workflow")
+
     def load_csv_bulk(self, infile: str, workflow: object):
         '''
         Implements a django-postgres-copy loader to bulk load raw Zooniverse responses into the ZooniverseResponseRaw model.
@@ -92,19 +95,25 @@ class Command(BaseCommand):
         msg = ZooniverseResponseRaw.objects.bulk_create(objs, 10000)
         return msg
 
-    def flatten_subject_data(self, workflow):
+    def flatten_subject_data(self, workflow, subject_ids=None):
         '''
-        The raw "subject_data" coming back from Zooniverse is a JSON object with the key of the "subject_id". The data being stored behind this key cannot easily be queried by Django, but if we flatten it, we can. This creates a flattened copy of the subject_data field to make querying easier, and updates the raw responses in bulk.
+        The raw "subject_data" coming back from Zooniverse is a JSON object with the key of the "subject_id". The data being stored behind this key cannot easily be queried by Django, but if we flatten it, we can. This creates a flattened copy of the subject_data field to make querying easier, and updates the raw responses in bulk. With subject_ids, only responses on those subjects are flattened, all of them from the subject_data of the subject's newest classification.
         '''
         print("Creating flattened version of subject_data...")
         responses = ZooniverseResponseRaw.objects.filter(
             workflow_name=workflow.workflow_name,
             # workflow_version=workflow.version
         ).only('subject_data')
+        latest_subject_data = None
+        if subject_ids is not None:
+            responses = list(responses.filter(subject_ids__in=subject_ids).only('subject_ids', 'classification_id', 'subject_data'))
+            # Responses loaded from an older export still have the subject's retirement as it was then
+            latest_subject_data = {r.subject_ids: r.subject_data for r in sorted(responses, key=lambda r: r.classification_id)}
 
         for response in responses:
-            first_key = next(iter(response.subject_data))
-            response.subject_data_flat = response.subject_data[first_key]
+            subject_data = latest_subject_data[response.subject_ids] if latest_subject_data is not None else response.subject_data
+            first_key = next(iter(subject_data))
+            response.subject_data_flat = subject_data[first_key]
 
             # In some workflows the key for the match number is just a number, which will throw off querying of it later, so fix that
             response.subject_data_flat = {re.sub(
@@ -187,47 +196,41 @@ class Command(BaseCommand):
 
         return True
 
-    def sql_df_writer(self, conn, var_name, question_lookup, workflow):
-        '''Help pandas return a sensible response for each question that can be joined back to a unique subject id. Scores are put into percentages to handle possible changes to what's required to retire.'''
-        if var_name in question_lookup:
-            return pd.read_sql(f"SELECT zoon_subject_id, best_answer AS {var_name}, cast(best_answer_score as float)/cast(total_votes as float) AS {var_name}_score FROM zoon_reducedresponse_question WHERE zoon_workflow_id = '{workflow.zoon_id}' AND task_id = '{question_lookup[var_name]}'",
-                           conn)
-        # If empty, return empty dataframe that won't break join
-        return pd.DataFrame({
-            'zoon_subject_id': pd.Series(dtype='int'),
-            f'{var_name}': pd.Series(dtype='str'),
-            f'{var_name}_score': pd.Series(dtype='float'),
-        })
-
-    def sql_df_writer_text(self, conn, var_name, question_lookup, workflow):
-        '''Help pandas return a sensible response for each question that can be joined back to a unique subject id. Scores are put into percentages to handle possible changes to what's required to retire.'''
-        if var_name in question_lookup:
-            return pd.read_sql(f"SELECT zoon_subject_id, consensus_text AS {var_name}, cast(consensus_score as float)/cast(total_votes as float) AS {var_name}_score FROM zoon_reducedresponse_text WHERE zoon_workflow_id = '{workflow.zoon_id}' AND task_id = '{question_lookup[var_name]}'",
-                           conn)
-        # If empty, return empty dataframe that won't break join
-        return pd.DataFrame({
-            'zoon_subject_id': pd.Series(dtype='int'),
-            f'{var_name}': pd.Series(dtype='str'),
-            f'{var_name}_score': pd.Series(dtype='float'),
-        })
-
-    def parse_deed_date(self, row, month_lookup):
-        try:
-            month = month_lookup[row['month']]
-            return datetime.datetime(int(row['year']), month, int(row['day'])).date()
-        except:
-            return None
-
-    def consolidate_responses(self, workflow, question_lookup: dict):
+    def load_new_classifications(self, infile: str, workflow: object, bool_use_slow: bool):
+        '''
+        Load only the rows of a classifications export whose classification_id isn't already in ZooniverseResponseRaw for this workflow. Returns the set of Zooniverse subject ids the new classifications touch.
+        '''
+        existing_ids = set(ZooniverseResponseRaw.objects.filter(
+            workflow_name=workflow.workflow_name
+        ).values_list('classification_id', flat=True))
+        print(f'{len(existing_ids)} classifications already loaded, looking for new ones...')
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='') as new_csv:
+            new_count, subject_ids = filter_new_classifications(infile, new_csv, existing_ids)
+            print(f'{new_count} new classifications on {len(subject_ids)} subjects.')
+            if new_count > 0:
+                if bool_use_slow:
+                    self.load_csv_by_record(new_csv.name, workflow)
+                else:
+                    self.load_csv_bulk(new_csv.name, workflow)
+
+        return subject_ids
+
+    def consolidate_responses(self, workflow, question_lookup: dict, subject_ids=None):
+        '''Build ZooniverseSubject records from reduced answers. With subject_ids, only those subjects are rebuilt, and existing records are updated in place rather than added.'''
         print('Bring together reducer answers to a final results for this subject...')
 
         # Only get retired subjects
-        subject_df = pd.DataFrame(ZooniverseResponseRaw.objects.filter(
+        raw_responses = ZooniverseResponseRaw.objects.filter(
             workflow_name=workflow.workflow_name,
             # workflow_version=workflow.version
         ).exclude(
             subject_data_flat__retired=None  # Only loading retired subjects for now
-        ).values(
+        )
+        if subject_ids is not None:
+            raw_responses = raw_responses.filter(subject_ids__in=subject_ids)
+
+        subject_df = pd.DataFrame(raw_responses.values(
             'subject_ids',
             'subject_data_flat__pk',
             'subject_data_flat__doc_num',
@@ -240,6 +243,10 @@ class Command(BaseCommand):
             'subject_data_flat__image_4',
         ).distinct())
 
+        if len(subject_df.index) == 0:
+            print('No retired subjects to consolidate.')
+            return
+
         print(subject_df)
 
         # Make a list of image ids associated with this subject
@@ -271,75 +278,11 @@ class Command(BaseCommand):
         }, inplace=True)
         print(subject_df)
 
-        sa_engine = create_engine(settings.SQL_ALCHEMY_DB_CONNECTION_URL)
-
         question_lookup = {k:v for k, v in question_lookup.items() if v}
 
-        # Make a DF for each question, then left join to subject IDs to create subject records
-        bool_covenant_df = self.sql_df_writer(
-            sa_engine, 'bool_covenant', question_lookup, workflow=workflow)
-        bool_handwritten_df = self.sql_df_writer(
-            sa_engine, 'bool_handwritten', question_lookup, workflow=workflow)
-        match_type_df = self.sql_df_writer(
-            sa_engine, 'match_type', question_lookup, workflow=workflow)
-        covenant_text_df = self.sql_df_writer_text(
-            sa_engine, 'covenant_text', question_lookup, workflow=workflow)
-        addition_df = self.sql_df_writer_text(
-            sa_engine, 'addition', question_lookup, workflow=workflow)
-        lot_df = self.sql_df_writer_text(
-            sa_engine, 'lot', question_lookup, workflow=workflow)
-        block_df = self.sql_df_writer_text(
-            sa_engine, 'block', question_lookup, workflow=workflow)
-        map_book_df = self.sql_df_writer_text(
-            sa_engine, 'map_book', question_lookup, workflow=workflow)
-        map_book_page_df = self.sql_df_writer_text(
-            sa_engine, 'map_book_page', question_lookup, workflow=workflow)
-        city_df = self.sql_df_writer_text(
-            sa_engine, 'city', question_lookup, workflow=workflow)
-        seller_df = self.sql_df_writer_text(
-            sa_engine, 'seller', question_lookup, workflow=workflow)
-        buyer_df = self.sql_df_writer_text(sa_engine, 'buyer', question_lookup, workflow=workflow)
-
-        # deed_date
-        deed_date_year_df = self.sql_df_writer(
-            sa_engine, 'year', question_lookup['deed_date'], workflow=workflow)
-        deed_date_month_df = self.sql_df_writer(
-            sa_engine, 'month', question_lookup['deed_date'], workflow=workflow)
-        deed_date_day_df = self.sql_df_writer(
-            sa_engine, 'day', question_lookup['deed_date'], workflow=workflow)
-
-        # Join back to subject ids/retired dates
-        final_df = subject_df.merge(
-            bool_covenant_df, how="left", on="zoon_subject_id"
-        ).merge(
-            bool_handwritten_df, how="left", on="zoon_subject_id"
-        ).merge(
-            match_type_df, how="left", on="zoon_subject_id"
-        ).merge(
-            covenant_text_df, how="left", on="zoon_subject_id"
-        ).merge(
-            addition_df, how="left", on="zoon_subject_id"
-        ).merge(
-            lot_df, how="left", on="zoon_subject_id"
-        ).merge(
-            block_df, how="left", on="zoon_subject_id"
-        ).merge(
-            map_book_df, how="left", on="zoon_subject_id"
-        ).merge(
-            map_book_page_df, how="left", on="zoon_subject_id"
-        ).merge(
-            city_df, how="left", on="zoon_subject_id"
-        ).merge(
-            seller_df, how="left", on="zoon_subject_id"
-        ).merge(
-            buyer_df, how="left", on="zoon_subject_id"
-        ).merge(
-            deed_date_year_df, how="left", on="zoon_subject_id"
-        ).merge(
-            deed_date_month_df, how="left", on="zoon_subject_id"
-        ).merge(
-            deed_date_day_df, how="left", on="zoon_subject_id"
-        )
+        # Every reduced answer for every subject in one pivoted query, then left join to subject IDs to create subject records
+        answers_df = reduced_answers_df(workflow, question_lookup, subject_ids)
+        final_df = subject_df.merge(answers_df, how="left", on="zoon_subject_id")
 
         # Make overall and individual scores for deed date components
         final_df['deed_date_overall_score'] = final_df[[
@@ -372,8 +315,8 @@ class Command(BaseCommand):
 
         # Parse final deed_date
         month_lookup = question_lookup['month_lookup']
-        final_df['deed_date'] = final_df.apply(
-            lambda row: self.parse_deed_date(row, month_lookup), axis=1)
+        final_df['deed_date'] = parse_deed_dates(
+            final_df['year'], final_df['month'], final_df['day'], month_lookup)
         
         print(final_df['bool_covenant'].value_counts(dropna=False))
 
@@ -440,8 +383,8 @@ class Command(BaseCommand):
         final_df['workflow_id'] = workflow.id
 
         # Set beginning join_strings
-        final_df['join_candidates'] = final_df.apply(
-            self.get_join_candidates, axis=1)
+        final_df['join_candidates'] = write_join_strings_many(
+            final_df['addition'], final_df['block'], final_df['lot']).apply(json.dumps)
 
         # Set initial bool_parcel_match to False
         final_df['bool_parcel_match'] = False
@@ -456,109 +399,20 @@ class Command(BaseCommand):
 
         print('Sending consolidated subject results to Django ...')
 
-        final_df.to_sql('zoon_zooniversesubject',
-                        if_exists='append', index=False, con=sa_engine)
+        for field in ['zoon_subject_id', 'deedpage_pk', 'workflow_id']:
+            final_df[field] = final_df[field].astype('Int64')
+        if subject_ids is not None:
+            upsert_subjects(final_df, workflow)
+            return
+        insert_count = copy_dataframe(final_df, ZooniverseSubject._meta.db_table)
+        print(f'{insert_count} subjects loaded.')
 
-    def get_join_candidates(self, row):
-        return json.dumps(write_join_strings(row['addition'], row['block'], row['lot']))
-
-    def anno_accessor(self, input_obj, q_id):
-        try:
-            return [a['value'] for a in input_obj if a['task'] == q_id][0]
-        except:
-            # Search for nested: Find a value that is a list
-            nested_lists = [a['value']
-                            for a in input_obj if type(a['value']) is list]
-            combined_list = list(chain(*nested_lists))
-            try:
-                # Pulldown (select) version
-                return [a['value'][0]['label']
-                        for a in combined_list if a['task'] == q_id][0]
-            except:
-                try:
-                    # Nested text entry
-                    return [a['value']
-                            for a in combined_list if a['task'] == q_id][0]
-                except:
-                    return ''
-        return ''
-
-    def extract_individual_responses(self, workflow, question_lookup: dict):
+    def extract_individual_responses(self, workflow, question_lookup: dict, new_only=False, subject_ids=None):
         print(
             'Pulling individual responses out of annotations object for easier display...')
 
-        subject_ids = pd.DataFrame(ZooniverseSubject.objects.filter(
-            workflow=workflow
-        ).values('id', 'zoon_subject_id')).rename(columns={'id': 'subject_id'})
-
-        df = pd.DataFrame(ZooniverseResponseRaw.objects.filter(
-            workflow_name=workflow.workflow_name
-        ).exclude(
-            subject_data_flat__retired=None  # Only loading retired subjects for now
-        ).values(
-            'id',
-            'classification_id',
-            'user_name',
-            'user_id',
-            'subject_ids',
-            'created_at',
-            'annotations'
-        ))
-
-        df = df.merge(
-            subject_ids,
-            how="left",
-            left_on="subject_ids",
-            right_on="zoon_subject_id"
-        )
-
-        df['workflow_id'] = workflow.id
-        df = df.rename(columns={
-            'id': 'response_raw_id'
-        })
-
-        for attr in [
-            'bool_covenant',
-            'bool_handwritten',
-            'covenant_text',
-            'addition',
-            'block',
-            'city',
-            'lot',
-            'map_book',
-            'map_book_page',
-            'seller',
-            'buyer',
-            'match_type'
-        ]:
-            if attr in question_lookup:
-                df[attr] = df['annotations'].apply(
-                    lambda x: self.anno_accessor(x, question_lookup[attr]))
-
-        df['deed_date_year'] = df['annotations'].apply(
-            lambda x: self.anno_accessor(x, question_lookup['deed_date']['year']))
-
-        df['deed_date_month'] = df['annotations'].apply(
-            lambda x: self.anno_accessor(x, question_lookup['deed_date']['month']))
-
-        df['deed_date_day'] = df['annotations'].apply(
-            lambda x: self.anno_accessor(x, question_lookup['deed_date']['day']))
-    
-        # Clear invalid values in date fields caused by weird input
-        df.loc[df['deed_date_year'].apply(lambda x: type(x)) == dict, 'deed_date_year'] = 'Bad value'
-        df.loc[df['deed_date_month'].apply(lambda x: type(x)) == dict, 'deed_date_month'] = 'Bad value'
-        df.loc[df['deed_date_day'].apply(lambda x: type(x)) == dict, 'deed_date_day'] = 'Bad value'
-
-        df.loc[df['deed_date_year'].apply(lambda x: type(x)) == list, 'deed_date_year'] = 'Bad value'
-        df.loc[df['deed_date_month'].apply(lambda x: type(x)) == list, 'deed_date_month'] = 'Bad value'
-        df.loc[df['deed_date_day'].apply(lambda x: type(x)) == list, 'deed_date_day'] = 'Bad value'
-
-        df = df.drop(columns=['annotations', 'subject_ids', 'zoon_subject_id'])
-
-        print('Sending processed individual responses to Django ...')
-        sa_engine = create_engine(settings.SQL_ALCHEMY_DB_CONNECTION_URL)
-        df.to_sql('zoon_zooniverseresponseprocessed',
-                  if_exists='append', index=False, con=sa_engine)
+        insert_count = write_individual_responses(workflow, question_lookup, new_only=new_only, subject_ids=subject_ids)
+        print(f'{insert_count} processed individual responses loaded.')
 
     def handle(self, *args, **kwargs):
         workflow_name = kwargs['workflow']
@@ -580,6 +434,10 @@ class Command(BaseCommand):
             # raw_classifications_csv = os.path.join(
             #     self.batch_dir, f"{workflow.slug}-denested.csv")
 
+            if kwargs['incremental']:
+                self.handle_incremental(workflow, raw_classifications_csv, bool_use_slow)
+                return
+
             bool_cleared = self.clear_all_tables(workflow_name)
             if not bool_cleared:
                 return False
@@ -600,3 +458,25 @@ class Command(BaseCommand):
 
             self.extract_individual_responses(
                 workflow, self.batch_config['zooniverse_config'])
+
+    def handle_incremental(self, workflow, raw_classifications_csv, bool_use_slow):
+        '''Load a newer export of the same workflow on top of what's already loaded. Only new classifications are loaded, and only the subjects they touch are re-reduced and re-consolidated. Existing ZooniverseSubjects keep their ids, so ManualCorrections and other records joined to them stay attached.'''
+        subject_ids = self.load_new_classifications(raw_classifications_csv, workflow, bool_use_slow)
+        if len(subject_ids) == 0:
+            print('Nothing new to load.')
+            return
+
+        # Earlier responses on these subjects may only now be retired, so re-flatten them all
+        self.flatten_subject_data(workflow, subject_ids=sorted(subject_ids))
+
+        management.call_command(
+            'load_zooniverse_reductions', workflow=workflow.workflow_name, subjects=sorted(subject_ids))
+
+        self.consolidate_responses(
+            workflow, self.batch_config['zooniverse_config'], subject_ids=sorted(subject_ids))
+
+        # Including earlier responses on these subjects that were skipped before they retired
+        self.extract_individual_responses(
+            workflow, self.batch_config['zooniverse_config'], new_only=True, subject_ids=sorted(subject_ids))
+
+        print(f'Done. Run process_recompute_queue --workflow "{workflow.workflow_name}" to refresh final values and parcel matches for updated subjects, and connect_manual_corrections for new ones.')
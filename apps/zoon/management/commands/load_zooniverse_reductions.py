@@ -7,6 +7,7 @@ from sqlalchemy import create_engine
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from apps.zoon.models import ZooniverseWorkflow, ReducedResponse_Question, ReducedResponse_Text
 from apps.zoon.utils.zooniverse_config import parse_config_yaml
 
 
@@ -14,11 +15,15 @@ class Command(BaseCommand):
     '''This script loads the output of the Zooniverse reducer commands/functions into Django models for each reduced answer, and gets for each question a best or consensus answer, the number of people who agreed with that answer, and any additional metadata Zooniverse provides about the reducer output'''
 
     batch_config = None  # Set in handle
+    subject_ids = None  # Set in handle, None means every subject in the reducer output
 
     def add_arguments(self, parser):
         parser.add_argument('-w', '--workflow', type=str,
                             help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
 
+        parser.add_argument('--subjects', type=int, nargs='+',
+                            help='Only (re)load reduced answers for these Zooniverse subject ids, e.g. after an incremental export load')
+
     def find_best_answer(self, column_name, answer_lookup):
         '''Find out which answer for this particular task has the most votes'''
         return answer_lookup[column_name]
@@ -46,6 +51,23 @@ class Command(BaseCommand):
 
         return sorted(joined, key=lambda i: i['votes'], reverse=True)
 
+    def read_reducer_csv(self, batch_dir: str, reducer_csv: str):
+        '''Reducer output for this batch, limited to self.subject_ids if set'''
+        df = pd.read_csv(os.path.join(batch_dir, reducer_csv))
+        if self.subject_ids is not None:
+            df = df[df['subject_id'].isin(self.subject_ids)]
+        return df
+
+    def clear_subject_reductions(self, workflow_name: str):
+        '''Delete reduced answers already loaded for self.subject_ids so they can be replaced'''
+        workflow = ZooniverseWorkflow.objects.get(workflow_name=workflow_name)
+        ReducedResponse_Question.objects.filter(
+            zoon_workflow_id=workflow.zoon_id, zoon_subject_id__in=self.subject_ids
+        ).delete()
+        ReducedResponse_Text.objects.filter(
+            zoon_workflow_id=workflow.zoon_id, zoon_subject_id__in=self.subject_ids
+        ).delete()
+
     def load_questions_reduced(self, batch_dir: str, workflow_slug: str, master_config: dict):
         '''Process reduced responses from the question reducer
         Arguments:
@@ -54,8 +76,7 @@ class Command(BaseCommand):
             master_config: Question text and label lookup object
         '''
 
-        df = pd.read_csv(os.path.join(
-            batch_dir, f'question_reducer_{workflow_slug}.csv'))
+        df = self.read_reducer_csv(batch_dir, f'question_reducer_{workflow_slug}.csv')
         config_df = pd.DataFrame(master_config)
         print(config_df)
 
@@ -151,8 +172,7 @@ class Command(BaseCommand):
             master_config: Question text and label lookup object
         '''
 
-        df = pd.read_csv(os.path.join(
-            batch_dir, f'dropdown_reducer_{workflow_slug}.csv'))
+        df = self.read_reducer_csv(batch_dir, f'dropdown_reducer_{workflow_slug}.csv')
         config_df = pd.DataFrame(master_config)
 
         # Join responses to config so we know the possible answers to each question
@@ -210,8 +230,7 @@ class Command(BaseCommand):
             master_config: Question text and label lookup object
         '''
 
-        df = pd.read_csv(os.path.join(
-            batch_dir, f'text_reducer_{workflow_slug}.csv'))
+        df = self.read_reducer_csv(batch_dir, f'text_reducer_{workflow_slug}.csv')
         config_df = pd.DataFrame(master_config)
 
         # We're not really doing anything with the config data for text-type questions, but just to maintain parallel structure...
@@ -279,6 +298,11 @@ class Command(BaseCommand):
 
             workflow_slug = workflow_name.lower().replace(" ", "-")
 
+            self.subject_ids = kwargs['subjects']
+            if self.subject_ids is not None:
+                print(f'Replacing reduced answers for {len(self.subject_ids)} subjects...')
+                self.clear_subject_reductions(workflow_name)
+
             self.load_questions_reduced(
                 self.batch_dir, workflow_slug, master_config)
             self.load_dropdowns_reduced(
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from apps.zoon.utils.zooniverse_config import get_workflow_obj
+from apps.zoon.utils.recompute_queue import RecomputeQueueWorker
+
+
+class Command(BaseCommand):
+    '''Re-save every ZooniverseSubject and ManualCovenant queued by deferred recompute (e.g. after load_manual_corrections or load_extra_parcels), once per subject. Use --loop to keep running as a local worker.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workflow', type=str,
+                            help='Name of Zooniverse workflow to process, e.g. "Ramsey County"')
+
+        parser.add_argument('-b', '--batch-size', type=int, default=500,
+                            help='Number of queued records to recompute per batch')
+
+        parser.add_argument('-l', '--loop', action='store_true',
+                            help='Keep polling for new requests instead of exiting when the queue is empty')
+
+        parser.add_argument('-s', '--sleep', type=int, default=5,
+                            help='Seconds to wait between polls when using --loop')
+
+    def handle(self, *args, **kwargs):
+        workflow_name = kwargs['workflow']
+        if not workflow_name:
+            print('Missing workflow name. Please specify with --workflow.')
+        else:
+            workflow = get_workflow_obj(workflow_name)
+
+            worker = RecomputeQueueWorker(workflow, batch_size=kwargs['batch_size'])
+            worker.run(loop=kwargs['loop'], sleep=kwargs['sleep'])
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import apps.parcel.utils.lookup_cache
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zoon', '0061_alter_manualcovenant_doc_num_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='zooniverseworkflow',
+            name='parcel_lookup_version',
+            field=models.CharField(default=apps.parcel.utils.lookup_cache.new_lookup_version, editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zoon', '0062_zooniverseworkflow_parcel_lookup_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecomputeRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject_type', models.CharField(choices=[('zs', 'ZooniverseSubject'), ('mc', 'ManualCovenant')], max_length=2)),
+                ('subject_id', models.IntegerField()),
+                ('date_requested', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zoon.zooniverseworkflow')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('subject_type', 'subject_id'), name='unique_recompute_request')],
+            },
+        ),
+    ]
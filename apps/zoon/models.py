@@ -6,15 +6,18 @@ from django.db.models import F, Value, Count, OuterRef, Case, When, Exists, Subq
 
 # from django.db.models import OuterRef, Subquery, F, Case, Value, When, Exists, BooleanField, DateField, CharField, IntegerField, JSONField, FloatField
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.text import slugify
 
 from postgres_copy import CopyManager
 
 from racial_covenants_processor.storage_backends import PublicMediaStorage
 from apps.plat.models import Plat, PlatAlternateName, Subdivision, SubdivisionAlternateName
-from apps.parcel.models import Parcel
-from apps.parcel.utils.parcel_utils import build_parcel_spatial_lookups, gather_all_covenant_candidates, gather_all_manual_covenant_candidates, standardize_addition, addition_wide_parcel_match
+from apps.parcel.models import Parcel, DirtyMatchKey
+from apps.parcel.utils.parcel_utils import gather_all_covenant_candidates, gather_all_manual_covenant_candidates, standardize_addition, addition_wide_parcel_match
+from apps.parcel.utils.lookup_cache import new_lookup_version, get_cached_parcel_lookup
 from apps.zoon.utils.zooniverse_join import set_addresses
+from apps.zoon.utils.recompute_queue import recompute_deferred
 
 
 class ZooniverseWorkflow(models.Model):
@@ -24,6 +27,8 @@ class ZooniverseWorkflow(models.Model):
     # version = models.FloatField(null=True, blank=True)
     version = models.CharField(max_length=20, null=True, blank=True)
     slug = models.CharField(max_length=100, db_index=True, blank=True)
+    parcel_lookup_version = models.CharField(max_length=32, default=new_lookup_version, editable=False)
+    """Changed every time ParcelJoinCandidate rows for this workflow change, so cached parcel lookups know when they are stale. See apps/parcel/utils/lookup_cache.py"""
 
     def __str__(self):
         return self.workflow_name
@@ -366,7 +371,9 @@ class ZooniverseSubject(models.Model):
 
     def set_geom_union(self):
         if self.bool_parcel_match:
-            self.geom_union_4326 = self.get_geom_union()
+            from apps.parcel.utils.addition_cache import cached_geom_union
+            cached_union = cached_geom_union(self)
+            self.geom_union_4326 = cached_union if cached_union is not None else self.get_geom_union()
         else:
             self.geom_union_4326 = None
 
@@ -436,6 +443,7 @@ class ZooniverseSubject(models.Model):
         # Clear existing parcel matches
         self.parcel_matches.clear()
         self.bool_parcel_match = False
+        self.addition_wide_match = None
 
         join_strings = []
         # Main parcel
@@ -445,7 +453,7 @@ class ZooniverseSubject(models.Model):
                 addition_wide_parcel_match(self)
             elif self.addition_final != '' and self.lot_final != '':
                 if not parcel_lookup:
-                    parcel_lookup = build_parcel_spatial_lookups(self.workflow)
+                    parcel_lookup = get_cached_parcel_lookup(self.workflow)
                 self.join_candidates = gather_all_covenant_candidates(self)
                 # print(self.join_candidates)
 
@@ -599,6 +607,56 @@ class ReducedResponse_Text(models.Model):
     # TODO: Need to get individual "something is wrong" responses direct from classifier, since reduce won't handle these well. Or use a different reducer that doesn't, um, reduce
 
 
+RECOMPUTE_SUBJECT_TYPES = (
+    ('zs', 'ZooniverseSubject'),
+    ('mc', 'ManualCovenant'),
+)
+
+
+class RecomputeRequestManager(models.Manager):
+
+    def enqueue(self, workflow, subject_type, subject_ids):
+        '''Queue a recompute for each subject. Requests for a subject that is already queued are merged into the existing row, only moving its date_requested forward.'''
+        if workflow is None:
+            return 0
+        subject_ids = set([s for s in subject_ids if s is not None])
+        now = timezone.now()
+        self.bulk_create([
+            self.model(workflow=workflow, subject_type=subject_type, subject_id=s, date_requested=now) for s in subject_ids
+        ], batch_size=5000, update_conflicts=True, unique_fields=['subject_type', 'subject_id'], update_fields=['date_requested'])
+        return len(subject_ids)
+
+
+class RecomputeRequest(models.Model):
+    """A pending re-save of a ZooniverseSubject or ManualCovenant, queued when one of its ManualCorrections, ExtraParcelCandidates or PIN links changes while recompute is deferred (see apps/zoon/utils/recompute_queue.py). There is at most one row per subject, however many child records changed. Processed by the process_recompute_queue management command."""
+    workflow = models.ForeignKey(
+        ZooniverseWorkflow, on_delete=models.CASCADE)
+    subject_type = models.CharField(max_length=2, choices=RECOMPUTE_SUBJECT_TYPES)
+    subject_id = models.IntegerField()
+    """Database id of the ZooniverseSubject or ManualCovenant"""
+    date_requested = models.DateTimeField(default=timezone.now, db_index=True)
+    """Time of the most recent request for this subject"""
+
+    objects = RecomputeRequestManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['subject_type', 'subject_id'], name='unique_recompute_request'),
+        ]
+
+    def __str__(self):
+        return f"{self.workflow} {self.get_subject_type_display()} {self.subject_id}"
+
+
+def request_recompute(subject):
+    '''Re-save a ZooniverseSubject or ManualCovenant after one of its child records changes, or queue it if recompute is currently deferred'''
+    if recompute_deferred():
+        subject_type = 'mc' if isinstance(subject, ManualCovenant) else 'zs'
+        RecomputeRequest.objects.enqueue(subject.workflow, subject_type, [subject.pk])
+    else:
+        subject.save()
+
+
 class ManualCorrection(models.Model):
     '''This is set up as a separate model to preserve any manual work that is done in the event a re-import of zooniverse data is needed'''
     workflow = models.ForeignKey(
@@ -639,9 +697,10 @@ class ManualCorrection(models.Model):
         self.zoon_workflow_id = self.zooniverse_subject.workflow.zoon_id
         self.zoon_subject_id = self.zooniverse_subject.zoon_subject_id
         super(ManualCorrection, self).save(*args, **kwargs)
+        DirtyMatchKey.objects.mark(self.workflow, 'zs', [self.zooniverse_subject.pk])
 
         # self.zooniverse_subject.get_final_values()
-        self.zooniverse_subject.save()
+        request_recompute(self.zooniverse_subject)
 
 
 EPC_TYPE_CHOICES = (
@@ -680,7 +739,8 @@ class ExtraParcelCandidate(models.Model):
         self.zoon_workflow_id = self.zooniverse_subject.workflow.zoon_id
         self.zoon_subject_id = self.zooniverse_subject.zoon_subject_id
         super(ExtraParcelCandidate, self).save(*args, **kwargs)
-        self.zooniverse_subject.save()  # Does this really need to trigger every time? Seems so, but causes problems on large numbers of EPCs
+        DirtyMatchKey.objects.mark(self.workflow, 'zs', [self.zooniverse_subject.pk])
+        request_recompute(self.zooniverse_subject)
 
 
 class ManualParcelPINLink(models.Model):
@@ -709,14 +769,15 @@ class ManualParcelPINLink(models.Model):
         self.zoon_workflow_id = self.zooniverse_subject.workflow.zoon_id
         self.zoon_subject_id = self.zooniverse_subject.zoon_subject_id
         super(ManualParcelPINLink, self).save(*args, **kwargs)
-        self.zooniverse_subject.save()  # Does this really need to trigger every time? Seems so.
+        DirtyMatchKey.objects.mark(self.workflow, 'zs', [self.zooniverse_subject.pk])
+        request_recompute(self.zooniverse_subject)
 
 
 @receiver(models.signals.post_delete, sender=ManualCorrection)
 def model_delete(sender, instance, **kwargs):
     try:
-        instance.zooniverse_subject.get_final_values()
-        instance.zooniverse_subject.save()
+        DirtyMatchKey.objects.mark(instance.workflow, 'zs', [instance.zooniverse_subject.pk])
+        request_recompute(instance.zooniverse_subject)
     except AttributeError:
         pass
 
@@ -724,8 +785,8 @@ def model_delete(sender, instance, **kwargs):
 @receiver(models.signals.post_delete, sender=ExtraParcelCandidate)
 def model_delete(sender, instance, **kwargs):
     try:
-        instance.zooniverse_subject.get_final_values()
-        instance.zooniverse_subject.save()
+        DirtyMatchKey.objects.mark(instance.workflow, 'zs', [instance.zooniverse_subject.pk])
+        request_recompute(instance.zooniverse_subject)
     except AttributeError:
         pass
 
@@ -733,8 +794,8 @@ def model_delete(sender, instance, **kwargs):
 @receiver(models.signals.post_delete, sender=ManualParcelPINLink)
 def model_delete(sender, instance, **kwargs):
     try:
-        instance.zooniverse_subject.get_final_values()
-        instance.zooniverse_subject.save()
+        DirtyMatchKey.objects.mark(instance.workflow, 'zs', [instance.zooniverse_subject.pk])
+        request_recompute(instance.zooniverse_subject)
     except AttributeError:
         pass
 
@@ -855,7 +916,7 @@ class ManualCovenant(models.Model):
             # Method for one-off covenants that is more similar to previous joinstring setup
             elif self.lot != '':
                 if not parcel_lookup:
-                    parcel_lookup = build_parcel_spatial_lookups(self.workflow)
+                    parcel_lookup = get_cached_parcel_lookup(self.workflow)
                 self.join_candidates = gather_all_manual_covenant_candidates(self)
                 print(self.join_candidates)
 
@@ -904,6 +965,7 @@ class ManualCovenant(models.Model):
 
         if len(parcel_match_pks) > 0:
             print('found some matches to clear')
+            DirtyMatchKey.objects.mark(self.workflow, 'pa', parcel_match_pks)
             from apps.parcel.utils.export_utils import save_flat_covenanted_parcels, delete_flat_covenanted_parcels
             parcels_to_clear = Parcel.objects.filter(pk__in=parcel_match_pks).only('id')
             delete_flat_covenanted_parcels(parcels_to_clear)
@@ -918,6 +980,8 @@ def manual_cov_post_save(sender, instance=None, created=False, **kwargs):
 
     if hasattr(instance, '_dirty'):
         return
+
+    DirtyMatchKey.objects.mark(instance.workflow, 'mc', [instance.pk])
     
     # # Can pass parcel lookup for bulk matches
     # instance.check_parcel_match(kwargs.get('parcel_lookup', None))
@@ -981,14 +1045,13 @@ class ManualCovenantParcelPINLink(models.Model):
         # self.zoon_workflow_id = self.zooniverse_subject.workflow.zoon_id
         # self.zoon_subject_id = self.zooniverse_subject.zoon_subject_id
         super(ManualCovenantParcelPINLink, self).save(*args, **kwargs)
-        self.manual_covenant.save()  # Does this really need to trigger every time? Seems so.
+        request_recompute(self.manual_covenant)
 
 
 @receiver(models.signals.post_delete, sender=ManualCovenantParcelPINLink)
 def model_delete(sender, instance, **kwargs):
     try:
-        # instance.zooniverse_subject.get_final_values()
-        instance.manual_covenant.save()
+        request_recompute(instance.manual_covenant)
     except AttributeError:
         pass
 
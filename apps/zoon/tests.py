@@ -1,10 +1,18 @@
+import io
+import os
+import datetime
+import tempfile
+import pandas as pd
+
 from django.test import TestCase, override_settings
 from django.core import management
 
-from apps.zoon.models import ZooniverseWorkflow, ZooniverseSubject, ManualCovenant, ManualParcelPINLink, ManualCovenantParcelPINLink
+from apps.zoon.models import ZooniverseWorkflow, ZooniverseSubject, ManualCovenant, ManualCorrection, ManualParcelPINLink, ManualCovenantParcelPINLink, RecomputeRequest, ZooniverseResponseRaw, ZooniverseResponseProcessed
 from apps.parcel.models import Parcel
 from apps.deed.utils.deed_pagination import tag_prev_next_image_sql
 from apps.zoon.utils.zooniverse_load import build_zooniverse_manifest
+from apps.zoon.utils.recompute_queue import defer_recompute, RecomputeQueueWorker
+from apps.zoon.utils.zooniverse_consolidate import parse_deed_dates, AnnotationExtractor, filter_new_classifications, upsert_subjects, write_individual_responses
 # from apps.zoon.management.commands import load_zooniverse_export
 from apps.zoon.management.commands.load_zooniverse_export import Command as LoadZooniverseExportTest
 
@@ -221,6 +229,106 @@ class ZooniverseUploadTests(TestCase):
         self.assertIn('web/fake/30000102/02720303_NOTINDEX_0002.jpg', test_image_row['#image2'].iloc[0])
         self.assertIn('web/fake/30000102/02720303_NOTINDEX_0003.jpg', test_image_row['#image3'].iloc[0])
 
+    def test_parse_deed_dates(self):
+        '''Does the vectorized deed date parser only return real calendar dates?'''
+        month_lookup = {'January': 1, 'February': 2}
+        dates = parse_deed_dates(
+            pd.Series(['1945', ' 1920 ', '1900', 'abc', None, '1950.0']),
+            pd.Series(['January', 'February', 'February', 'January', 'January', 'January']),
+            pd.Series(['12', '29', '29', '1', '1', '1']),
+            month_lookup
+        )
+        self.assertEqual(dates.tolist(), [
+            datetime.date(1945, 1, 12), datetime.date(1920, 2, 29), None, None, None, None
+        ])
+
+    def test_annotation_extractor(self):
+        '''Are top-level, nested text and nested pulldown answers all found in one pass over the annotations?'''
+        extractor = AnnotationExtractor({
+            'bool_covenant': 'T0',
+            'addition': 'T2',
+            'lot': 'T3',
+            'deed_date': {'year': 'T4', 'month': 'T5', 'day': 'T6'},
+        })
+        answers = extractor.extract([
+            {'task': 'T0', 'value': 'Yes'},
+            {'task': 'T7', 'value': [
+                {'task': 'T2', 'value': 'Covenant Addition'},
+                {'task': 'T4', 'value': '1945'},
+                {'task': 'T5', 'value': [{'label': 'March', 'value': 'a1b2'}]},
+                {'task': 'T6', 'value': {'bad': 'value'}},
+            ]},
+        ])
+        self.assertEqual(answers, {
+            'bool_covenant': 'Yes',
+            'addition': 'Covenant Addition',
+            'lot': '',
+            'deed_date_year': '1945',
+            'deed_date_month': 'March',
+            'deed_date_day': 'Bad value',
+        })
+
+    def test_filter_new_classifications(self):
+        '''Are only classifications that aren't loaded yet copied from the export, with the subjects they touch?'''
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as export_csv:
+            export_csv.write('classification_id,annotations,subject_ids\n')
+            export_csv.write('101,"[{""task"": ""T0"", ""value"": ""Yes""}]",5001\n')
+            export_csv.write('102,"[{""task"": ""T0"", ""value"": ""No""}]",5001\n')
+            export_csv.write('103,"[]",5002\n')
+        self.addCleanup(os.remove, export_csv.name)
+
+        out_file = io.StringIO()
+        new_count, subject_ids = filter_new_classifications(export_csv.name, out_file, set([101, 103]))
+
+        self.assertEqual(new_count, 1)
+        self.assertEqual(subject_ids, set([5001]))
+        self.assertEqual(out_file.getvalue().splitlines(), [
+            'classification_id,annotations,subject_ids',
+            '102,"[{""task"": ""T0"", ""value"": ""No""}]",5001',
+        ])
+
+    def test_upsert_subjects_keeps_ids(self):
+        '''Does an incremental load update an existing subject in place and queue it for a recompute?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        zs = ZooniverseSubject.objects.filter(workflow=workflow, bool_manual_correction=False).first()
+
+        counts = upsert_subjects(pd.DataFrame([{
+            'zoon_subject_id': zs.zoon_subject_id,
+            'workflow_id': workflow.pk,
+            'addition': 'Incremental Addition',
+            'addition_final': 'Incremental Addition',
+        }]), workflow)
+
+        self.assertEqual(counts, {'updated': 1, 'inserted': 0})
+        updated = ZooniverseSubject.objects.get(pk=zs.pk)
+        self.assertEqual(updated.addition, 'Incremental Addition')
+        self.assertEqual(updated.addition_final, 'Incremental Addition')
+        self.assertEqual(RecomputeRequest.objects.filter(subject_type='zs', subject_id=zs.pk).count(), 1)
+
+    def test_incremental_reflattens_earlier_responses(self):
+        '''When a new classification retires a subject, are the subject's earlier responses re-flattened as retired, and extracted along with the new one?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        for classification_id, retired in [(201, None), (202, {'retired_at': '2024-07-18T00:00:00Z'})]:
+            ZooniverseResponseRaw.objects.create(
+                classification_id=classification_id,
+                workflow_name=workflow.workflow_name,
+                workflow_version=4.1,
+                created_at=datetime.datetime(2024, 7, 18, tzinfo=datetime.timezone.utc),
+                metadata={},
+                annotations=[{'task': 'T0', 'value': 'Yes'}],
+                subject_data={'7001': {'retired': retired}},
+                subject_ids=7001,
+            )
+        # The earlier response was flattened when it was loaded, before the subject retired
+        LoadZooniverseExportTest().flatten_subject_data(workflow, subject_ids=[7001])
+        for response in ZooniverseResponseRaw.objects.filter(subject_ids=7001):
+            self.assertEqual(response.subject_data_flat['retired'], {'retired_at': '2024-07-18T00:00:00Z'})
+
+        question_lookup = {'bool_covenant': 'T0', 'deed_date': {'year': 'T4', 'month': 'T5', 'day': 'T6'}}
+        self.assertEqual(write_individual_responses(workflow, question_lookup, new_only=True, subject_ids=[7001]), 2)
+        self.assertEqual(sorted(ZooniverseResponseProcessed.objects.filter(
+            response_raw__subject_ids=7001).values_list('classification_id', flat=True)), [201, 202])
+
     # Run this one last in this class
     def test_clear_all_tables(self):
 
@@ -349,4 +457,68 @@ class ParcelMatchTests(TestCase):
         
         self.assertEqual(man_cov_4.bool_parcel_match, True)
         self.assertIn(parcel_lot_11, man_cov_4.parcel_matches.all())
-        self.assertEqual(parcel_lot_11.bool_covenant, True)
\ No newline at end of file
+        self.assertEqual(parcel_lot_11.bool_covenant, True)
+
+
+class RecomputeQueueTests(TestCase):
+    fixtures = ['parcel', 'zoon', 'plat']
+
+    @classmethod
+    def setUpTestData(cls):
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        management.call_command('rebuild_parcel_spatial_lookups', workflow=workflow.workflow_name)
+
+    def test_deferred_pin_links_coalesce(self):
+        '''Do several PIN links saved while recompute is deferred queue a single request for their subject, which the worker then applies?'''
+        with defer_recompute():
+            for pin in ['mppl-test-pin-1', 'mppl-test-pin-1', 'not-a-real-pin']:
+                ManualParcelPINLink(
+                    zooniverse_subject_id=6,
+                    parcel_pin=pin,
+                    comments="Deferred link"
+                ).save()
+
+        self.assertEqual(RecomputeRequest.objects.filter(subject_type='zs', subject_id=6).count(), 1)
+        parcel_lot_10 = Parcel.objects.get(workflow_id=1, pin_primary='mppl-test-pin-1')
+        self.assertNotIn(parcel_lot_10, ZooniverseSubject.objects.get(pk=6).parcel_matches.all())
+
+        processed = RecomputeQueueWorker(ZooniverseWorkflow.objects.get(pk=1)).run()
+
+        self.assertEqual(processed, 1)
+        self.assertEqual(RecomputeRequest.objects.count(), 0)
+        self.assertIn(parcel_lot_10, ZooniverseSubject.objects.get(pk=6).parcel_matches.all())
+
+    def test_incremental_load_keeps_manual_correction(self):
+        '''Does a ManualCorrection's final value survive an incremental load that updates the subject's Zooniverse answers?'''
+        workflow = ZooniverseWorkflow.objects.get(pk=1)
+        zs = ZooniverseSubject.objects.get(pk=5)
+        ManualCorrection(zooniverse_subject=zs, addition='Corrected Addition').save()
+        self.assertEqual(ZooniverseSubject.objects.get(pk=5).addition_final, 'Corrected Addition')
+
+        upsert_subjects(pd.DataFrame([{
+            'zoon_subject_id': zs.zoon_subject_id,
+            'workflow_id': workflow.pk,
+            'addition': 'Incremental Addition',
+            'addition_final': 'Incremental Addition',
+        }]), workflow)
+
+        updated = ZooniverseSubject.objects.get(pk=5)
+        self.assertEqual(updated.addition, 'Incremental Addition')
+        self.assertEqual(updated.addition_final, 'Corrected Addition')
+
+        RecomputeQueueWorker(workflow).run()
+        self.assertEqual(ZooniverseSubject.objects.get(pk=5).addition_final, 'Corrected Addition')
+
+    def test_load_pin_links_queues_file_subjects(self):
+        '''Does loading a file of PIN links queue only the subjects in that file, not every subject that already had a link?'''
+        RecomputeRequest.objects.all().delete()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as infile:
+            infile.write('workflow_name,zoon_subject_id,zoon_workflow_id,parcel_pin,date_added,date_updated,comments\n')
+            infile.write('MN Test County,4,13143,mppl-test-pin-1,2024-07-18 00:00:00+00:00,2024-07-18 00:00:00+00:00,Loaded link\n')
+
+        management.call_command('load_manual_pin_links', workflow='MN Test County', infile=infile.name)
+        os.remove(infile.name)
+
+        self.assertEqual(RecomputeRequest.objects.filter(subject_type='zs', subject_id=5).count(), 1)
+        # Subject 6 already had a link in the fixture, but it isn't in this file
+        self.assertEqual(RecomputeRequest.objects.filter(subject_type='zs', subject_id=6).count(), 0)
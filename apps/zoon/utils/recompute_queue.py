@@ -0,0 +1,86 @@
+import time
+import threading
+from functools import reduce
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Q
+
+from apps.parcel.utils.lookup_cache import get_cached_parcel_lookup
+
+_local = threading.local()
+
+
+@contextmanager
+def defer_recompute():
+    '''Inside this block, saving or deleting child records (ManualCorrection, ExtraParcelCandidate, PIN links) only queues a recompute of the parent ZooniverseSubject or ManualCovenant instead of re-saving it each time'''
+    depth = getattr(_local, 'defer_depth', 0)
+    _local.defer_depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.defer_depth = depth
+
+
+def recompute_deferred():
+    return getattr(_local, 'defer_depth', 0) > 0 or getattr(settings, 'DEFER_SUBJECT_RECOMPUTE', False)
+
+
+class RecomputeQueueWorker:
+    '''Drains RecomputeRequest rows, re-saving each queued ZooniverseSubject or ManualCovenant once no matter how many child records asked for it. A request that is re-queued while its subject is being processed keeps its row (its date_requested has moved on), so it will be picked up again on the next batch.'''
+
+    def __init__(self, workflow=None, batch_size=500):
+        self.workflow = workflow
+        self.batch_size = batch_size
+        self.parcel_lookups = {}
+
+    def claim_batch(self):
+        from apps.zoon.models import RecomputeRequest
+        requests = RecomputeRequest.objects.all()
+        if self.workflow:
+            requests = requests.filter(workflow=self.workflow)
+        return list(requests.order_by('date_requested').values(
+            'pk', 'workflow_id', 'subject_type', 'subject_id', 'date_requested'
+        )[:self.batch_size])
+
+    def get_parcel_lookup(self, workflow):
+        if workflow.pk not in self.parcel_lookups:
+            self.parcel_lookups[workflow.pk] = get_cached_parcel_lookup(workflow)
+        return self.parcel_lookups[workflow.pk]
+
+    def recompute(self, batch):
+        from apps.zoon.models import ZooniverseSubject, ManualCovenant
+        subject_ids = [r['subject_id'] for r in batch if r['subject_type'] == 'zs']
+        covenant_ids = [r['subject_id'] for r in batch if r['subject_type'] == 'mc']
+
+        for subject in ZooniverseSubject.objects.filter(pk__in=subject_ids).select_related('workflow'):
+            subject.save(parcel_lookup=self.get_parcel_lookup(subject.workflow))
+
+        for covenant in ManualCovenant.objects.filter(pk__in=covenant_ids):
+            covenant.save()
+
+    def finish_batch(self, batch):
+        from apps.zoon.models import RecomputeRequest
+        done = reduce(lambda a, b: a | b, [Q(pk=r['pk'], date_requested=r['date_requested']) for r in batch])
+        RecomputeRequest.objects.filter(done).delete()
+
+    def run(self, loop=False, sleep=5):
+        '''Process the queue until it is empty. With loop=True, keep polling for new requests every `sleep` seconds.'''
+        processed = 0
+        while True:
+            batch = self.claim_batch()
+            if len(batch) == 0:
+                if not loop:
+                    break
+                # Lookups may have changed while we were idle
+                self.parcel_lookups = {}
+                time.sleep(sleep)
+                continue
+
+            print(f'Recomputing {len(batch)} queued records...')
+            self.recompute(batch)
+            self.finish_batch(batch)
+            processed += len(batch)
+
+        print(f'{processed} queued records recomputed.')
+        return processed
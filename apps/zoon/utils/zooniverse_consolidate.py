@@ -0,0 +1,304 @@
+import sys
+import csv
+import json
+import calendar
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+
+from django.db import connection, transaction
+
+from apps.zoon.models import ReducedResponse_Question, ReducedResponse_Text, ZooniverseResponseRaw, ZooniverseResponseProcessed, ZooniverseSubject, RecomputeRequest
+from apps.parcel.utils.export_utils import COPY_NULL
+
+# Reduced answers consolidated into each ZooniverseSubject, by the reducer table they come from
+REDUCED_QUESTION_FIELDS = ['bool_covenant', 'bool_handwritten', 'match_type']
+REDUCED_TEXT_FIELDS = ['covenant_text', 'addition', 'lot', 'block', 'map_book', 'map_book_page', 'city', 'seller', 'buyer']
+# Parts of the deed_date question, each its own reduced question
+DEED_DATE_FIELDS = ['year', 'month', 'day']
+
+INT_PATTERN = r'[+-]?\d+'
+
+# Individual answers copied into ZooniverseResponseProcessed, when the workflow asks the question
+RESPONSE_FIELDS = ['bool_covenant', 'bool_handwritten', 'covenant_text', 'addition', 'block', 'city', 'lot', 'map_book', 'map_book_page', 'seller', 'buyer', 'match_type']
+RESPONSE_DATE_FIELDS = ['deed_date_year', 'deed_date_month', 'deed_date_day']
+
+
+def reduced_tasks(question_lookup):
+    '''(column name, reducer table, task id) for every reduced question this workflow's config maps'''
+    tasks = [(f, 'question', question_lookup[f]) for f in REDUCED_QUESTION_FIELDS if question_lookup.get(f)]
+    tasks += [(f, 'text', question_lookup[f]) for f in REDUCED_TEXT_FIELDS if question_lookup.get(f)]
+    deed_date_lookup = question_lookup.get('deed_date') or {}
+    tasks += [(f, 'question', deed_date_lookup[f]) for f in DEED_DATE_FIELDS if deed_date_lookup.get(f)]
+    return tasks
+
+
+def reduced_answers_df(workflow, question_lookup, subject_ids=None):
+    '''One row per subject with the consensus answer to every question and its score (share of total votes), pivoted from both reducer tables in a single query. Questions the workflow doesn't ask come back as empty columns, so the result always has the same shape. subject_ids limits the result to those Zooniverse subject ids.'''
+    tasks = reduced_tasks(question_lookup)
+    columns = ['zoon_subject_id']
+    for field in REDUCED_QUESTION_FIELDS + REDUCED_TEXT_FIELDS + DEED_DATE_FIELDS:
+        columns += [field, f'{field}_score']
+
+    answers_df = pd.DataFrame({'zoon_subject_id': []})
+    if len(tasks) > 0:
+        answers_df = query_reduced_answers(workflow, tasks, subject_ids)
+
+    # Answers stay object columns, since they get replaced with booleans and codes during consolidation
+    answers_df['zoon_subject_id'] = answers_df['zoon_subject_id'].astype('int')
+    for column in columns[1:]:
+        if column not in answers_df.columns:
+            answers_df[column] = None
+        answers_df[column] = answers_df[column].astype('float' if column.endswith('_score') else 'object')
+    return answers_df[columns]
+
+
+def query_reduced_answers(workflow, tasks, subject_ids=None):
+    '''Pivot answers for the (column, table, task id) tasks in one GROUP BY. If a subject somehow has more than one reduction for a task, the greatest answer wins.'''
+    select_cols = []
+    params = []
+    for field, table, task_id in tasks:
+        select_cols.append(f'MAX(answer) FILTER (WHERE src = %s AND task_id = %s) AS {field}')
+        select_cols.append(f'MAX(score) FILTER (WHERE src = %s AND task_id = %s) AS {field}_score')
+        params += [table, task_id, table, task_id]
+
+    task_ids = list(set([t[2] for t in tasks]))
+    subject_filter = ''
+    filter_params = [workflow.zoon_id, task_ids]
+    if subject_ids is not None:
+        subject_filter = 'AND zoon_subject_id = ANY(%s)'
+        filter_params.append(list(subject_ids))
+    params += filter_params + filter_params
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            SELECT zoon_subject_id, {', '.join(select_cols)}
+            FROM (
+                SELECT zoon_subject_id, 'question' AS src, task_id, best_answer AS answer,
+                    cast(best_answer_score as float) / NULLIF(cast(total_votes as float), 0) AS score
+                FROM {ReducedResponse_Question._meta.db_table}
+                WHERE zoon_workflow_id = %s AND task_id = ANY(%s) {subject_filter}
+                UNION ALL
+                SELECT zoon_subject_id, 'text' AS src, task_id, consensus_text AS answer,
+                    cast(consensus_score as float) / NULLIF(cast(total_votes as float), 0) AS score
+                FROM {ReducedResponse_Text._meta.db_table}
+                WHERE zoon_workflow_id = %s AND task_id = ANY(%s) {subject_filter}
+            ) AS reduced
+            GROUP BY zoon_subject_id
+        ''', params)
+        return pd.DataFrame(cursor.fetchall(), columns=[c.name for c in cursor.description])
+
+
+def int_parts(values):
+    '''Whole numbers written as text (or numbers) as floats, NaN for anything int() wouldn't accept'''
+    text = values.astype('string').str.strip()
+    valid = text.str.fullmatch(INT_PATTERN).fillna(False).astype(bool)
+    return pd.to_numeric(text.where(valid), errors='coerce')
+
+
+def parse_deed_dates(years, months, days, month_lookup):
+    '''Vectorized version of parsing one deed date from its reduced parts: a date where the year, month name and day make a real calendar date, otherwise None'''
+    year = int_parts(years)
+    month = pd.to_numeric(months.map(month_lookup), errors='coerce')
+    day = int_parts(days)
+
+    valid = year.between(datetime.MINYEAR, datetime.MAXYEAR) & month.between(1, 12) & day.notna()
+    leap = valid & year.fillna(1).astype(int).map(calendar.isleap)
+    month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    max_day = pd.Series(month_days[month.fillna(1).astype(int).clip(1, 12) - 1], index=month.index)
+    max_day = max_day + (leap & (month == 2)).astype(int)
+    valid = valid & day.between(1, max_day)
+
+    dates = pd.Series([None] * len(year.index), index=year.index, dtype='object')
+    if valid.any():
+        dates[valid] = [
+            datetime.date(y, m, d) for y, m, d in zip(
+                year[valid].astype(int), month[valid].astype(int), day[valid].astype(int)
+            )
+        ]
+    return dates
+
+
+def copy_dataframe(df, table):
+    '''Append a DataFrame whose columns are all columns of table, like DataFrame.to_sql(if_exists='append'), but with one COPY instead of batched INSERTs. Returns number of rows copied.'''
+    with tempfile.TemporaryFile('w+', newline='') as csv_file:
+        df.to_csv(csv_file, index=False, na_rep=COPY_NULL)
+        csv_file.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv, HEADER true, NULL '{COPY_NULL}')",
+                csv_file
+            )
+    return len(df.index)
+
+
+def upsert_subjects(df, workflow):
+    '''Update ZooniverseSubjects already loaded for these Zooniverse subject ids in place, so their database ids (and the ManualCorrections, DeedPages and parcel matches that point at them) stay the same, and insert the rest. "Final" values of subjects with manual corrections are left alone. Updated subjects are queued for a recompute so their final values and parcel matches catch up with the new answers. Returns counts of updated and inserted subjects.'''
+    table = ZooniverseSubject._meta.db_table
+    df = df.drop_duplicates('zoon_subject_id', keep='last')
+    columns = list(df.columns)
+    update_cols = []
+    for c in columns:
+        if c in ['workflow_id', 'zoon_subject_id']:
+            continue
+        if c.endswith('_final'):
+            update_cols.append(f'{c} = CASE WHEN zs.bool_manual_correction THEN zs.{c} ELSE tmp.{c} END')
+        else:
+            update_cols.append(f'{c} = tmp.{c}')
+
+    counts = {}
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # ON COMMIT DROP only fires at the outermost commit, so an earlier upsert in the same transaction leaves this behind
+            cursor.execute('DROP TABLE IF EXISTS tmp_zooniverse_subjects;')
+            cursor.execute(f'''
+                CREATE TEMP TABLE tmp_zooniverse_subjects ON COMMIT DROP AS
+                SELECT {', '.join(columns)} FROM {table} WITH NO DATA;
+            ''')
+        copy_dataframe(df, 'tmp_zooniverse_subjects')
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE {table} AS zs SET {', '.join(update_cols)}
+                FROM tmp_zooniverse_subjects AS tmp
+                WHERE zs.workflow_id = %s AND zs.zoon_subject_id = tmp.zoon_subject_id
+                RETURNING zs.id;
+            ''', [workflow.pk])
+            updated_ids = [row[0] for row in cursor.fetchall()]
+            counts['updated'] = len(updated_ids)
+
+            cursor.execute(f'''
+                INSERT INTO {table} ({', '.join(columns)})
+                SELECT {', '.join([f'tmp.{c}' for c in columns])} FROM tmp_zooniverse_subjects AS tmp
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {table} AS zs
+                    WHERE zs.workflow_id = %s AND zs.zoon_subject_id = tmp.zoon_subject_id
+                );
+            ''', [workflow.pk])
+            counts['inserted'] = cursor.rowcount
+
+        RecomputeRequest.objects.enqueue(workflow, 'zs', updated_ids)
+
+    print(f"{counts['updated']} subjects updated in place, {counts['inserted']} new subjects inserted.")
+    return counts
+
+
+def filter_new_classifications(infile, out_file, existing_ids):
+    '''Copy rows of a Zooniverse classifications export whose classification_id isn't in existing_ids to an open text file, unchanged. Returns the number of rows copied and the set of subject ids they classify.'''
+    csv.field_size_limit(sys.maxsize)
+    new_count = 0
+    subject_ids = set()
+    with open(infile, 'r', newline='') as in_file:
+        reader = csv.reader(in_file)
+        writer = csv.writer(out_file)
+        header = next(reader)
+        writer.writerow(header)
+        id_col = header.index('classification_id')
+        subject_col = header.index('subject_ids')
+        for row in reader:
+            if int(row[id_col]) in existing_ids:
+                continue
+            writer.writerow(row)
+            new_count += 1
+            subject_ids.add(int(row[subject_col]))
+    out_file.flush()
+    return new_count, subject_ids
+
+
+class AnnotationExtractor:
+    '''Pulls every question's answer out of one classification's annotations list in a single walk. Answers are looked up by task id, first among top-level annotations, then among annotations nested in a list-valued annotation (combo tasks), where a pulldown answer is the label of its first selected option.'''
+
+    def __init__(self, question_lookup):
+        self.columns = [f for f in RESPONSE_FIELDS if f in question_lookup] + RESPONSE_DATE_FIELDS
+        tasks = {f: question_lookup[f] for f in RESPONSE_FIELDS if f in question_lookup}
+        for f in DEED_DATE_FIELDS:
+            tasks[f'deed_date_{f}'] = question_lookup['deed_date'][f]
+
+        self.task_columns = {}
+        for column, task_id in tasks.items():
+            self.task_columns.setdefault(task_id, []).append(column)
+
+    def nested_value(self, value):
+        try:
+            return value[0]['label']
+        except Exception:
+            return value
+
+    def extract(self, annotations):
+        '''{column: answer}, '' for questions not answered. Date parts that aren't plain values become "Bad value".'''
+        top_level = {}
+        nested = {}
+        for annotation in annotations or []:
+            task = annotation.get('task')
+            if task in self.task_columns and task not in top_level:
+                top_level[task] = annotation.get('value')
+            if isinstance(annotation.get('value'), list):
+                for nested_annotation in annotation['value']:
+                    nested_task = nested_annotation.get('task') if isinstance(nested_annotation, dict) else None
+                    if nested_task in self.task_columns and nested_task not in nested:
+                        nested[nested_task] = self.nested_value(nested_annotation.get('value'))
+
+        answers = {}
+        for task, columns in self.task_columns.items():
+            if task in top_level:
+                value = top_level[task]
+            else:
+                value = nested.get(task, '')
+            for column in columns:
+                answers[column] = value
+        for column in RESPONSE_DATE_FIELDS:
+            if isinstance(answers[column], (dict, list)):
+                answers[column] = 'Bad value'
+        return answers
+
+
+def response_copy_value(value):
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def write_individual_responses(workflow, question_lookup, chunksize=5000, new_only=False, subject_ids=None):
+    '''Extract the individual answers from every retired classification in the workflow into ZooniverseResponseProcessed, or with new_only, just the ones that haven't been processed yet. subject_ids limits this to classifications of those Zooniverse subjects. Raw responses are read through a server-side cursor a chunk at a time, spooled to disk as CSV and loaded with one COPY. Returns number of responses loaded.'''
+    extractor = AnnotationExtractor(question_lookup)
+    subject_pks = dict(ZooniverseSubject.objects.filter(
+        workflow=workflow
+    ).values_list('zoon_subject_id', 'id'))
+
+    raw_responses = ZooniverseResponseRaw.objects.filter(
+        workflow_name=workflow.workflow_name
+    ).exclude(
+        subject_data_flat__retired=None  # Only loading retired subjects for now
+    )
+    if new_only:
+        raw_responses = raw_responses.filter(zooniverseresponseprocessed__isnull=True)
+    if subject_ids is not None:
+        raw_responses = raw_responses.filter(subject_ids__in=subject_ids)
+    raw_responses = raw_responses.values_list(
+        'id', 'classification_id', 'user_name', 'user_id', 'subject_ids', 'created_at', 'annotations'
+    )
+
+    columns = ['response_raw_id', 'classification_id', 'user_name', 'user_id', 'created_at', 'subject_id', 'workflow_id'] + extractor.columns
+    row_count = 0
+    with tempfile.TemporaryFile('w+', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(columns)
+        for raw_id, classification_id, user_name, user_id, subject_ids, created_at, annotations in raw_responses.iterator(chunk_size=chunksize):
+            answers = extractor.extract(annotations)
+            writer.writerow([response_copy_value(v) for v in [
+                raw_id, classification_id, user_name, user_id, created_at.isoformat(), subject_pks.get(subject_ids), workflow.id
+            ]] + [response_copy_value(answers[c]) for c in extractor.columns])
+            row_count += 1
+            if row_count % chunksize == 0:
+                print(f'{row_count} responses extracted...')
+
+        csv_file.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {ZooniverseResponseProcessed._meta.db_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true, NULL '{COPY_NULL}')",
+                csv_file
+            )
+    return row_count
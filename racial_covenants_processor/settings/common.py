@@ -257,6 +257,17 @@ CACHES = {
     }
 }
 
+# Local disk copies of cached parcel join-string lookups, see apps/parcel/utils/lookup_cache.py
+PARCEL_LOOKUP_CACHE_DIR = os.path.join(BASE_DIR, "data", "parcel_lookups")
+
+# When True, saving or deleting a ManualCorrection, ExtraParcelCandidate or PIN link only queues a
+# recompute of its ZooniverseSubject/ManualCovenant, to be run by the process_recompute_queue command
+DEFER_SUBJECT_RECOMPUTE = False
+
+# Search terms for the local fuzzy term search engine (apps/deed/utils/term_search.py), used when a workflow
+# has no 'term_search_terms' of its own. Strings, or dicts like {'term': 'jew', 'max_edits': 0}
+TERM_SEARCH_TERMS = []
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework.authentication.BasicAuthentication",